@@ -10,8 +10,19 @@ from quart import Quart, render_template, request, redirect, url_for, jsonify, j
 from werkzeug.datastructures import FileStorage
 
 import asobann
-from asobann.store import tables, components, kits
-from . import debug_tools
+from asobann import metrics, tracing
+from asobann.store import tables, components, kits, oplog, templates
+from asobann.store.backends.memory import MemoryBackend
+from asobann.store.backends.mongo import MongoBackend
+from asobann.store.backends.sqlite import SqliteBackend
+from . import access_token, debug_tools
+from .broadcasting import MouseMovementBatcher, ComponentUpdateBatcher
+from .event_recorder import EventRecorder
+from .load_table_cache import LoadTableCache
+from .loop_monitor import LoopMonitor
+from .outbound import OutboundLimitingServer
+from .room_routing import RoomAffineRedisManager
+from .wire import MsgPackNegotiatingServer
 
 # prevent 'Too many packets in payload' error
 # see https://github.com/miguelgrinberg/python-engineio/issues/142
@@ -38,6 +49,11 @@ dictConfig({
             'handlers': ['wsgi'],
             'propagate': False,
         },
+        'asobann.store': {
+            'level': 'INFO',
+            'handlers': ['wsgi'],
+            'propagate': False,
+        },
         'socketio': {
             'level': 'WARNING',
             'handlers': ['wsgi'],
@@ -159,6 +175,49 @@ def redact_credentials(uri: str) -> str:
     return f'{parts.scheme}://{host}{parts.path}'
 
 
+async def shutdown(app):
+    """create_app() で作ったものを畳む。プロセスを終える前に呼ぶ。
+
+    store層のキャッシュに溜まった書き込みはDB接続が生きているうちに書き出す必要が
+    あるので、接続を閉じるのは最後。
+    """
+    for batcher in (app.mouse_movement_batcher, app.component_update_batcher):
+        if batcher:
+            await batcher.close()
+    if app.loop_monitor:
+        await app.loop_monitor.close()
+    if app.sio.event_recorder:
+        await app.sio.event_recorder.close()
+    await tables.close()
+    await app.storage.close()
+    await debug_tools.close()
+    # AsyncMongoClientはトポロジ監視のバックグラウンドタスクを持つ。閉じずに
+    # 落とすと、SIGTERM後もそれが残ったままプロセスが終わる。
+    if app.mongo_client:
+        await app.mongo_client.aclose()
+
+
+async def connect_mongo(app, tracing_sample_rate):
+    """app.mongo_client / app.mongo_db を用意する。つながらなければ起動させない。"""
+    try:
+        app.logger.info("connecting mongo")
+        app.logger.info(redact_credentials(app.config["MONGO_URI"]))
+        if tracing_sample_rate > 0:
+            # Mongoのコマンドも、それを呼んだハンドラのトレースのスパンにする
+            app.mongo_client = AsyncMongoClient(
+                app.config["MONGO_URI"], event_listeners=[tracing.MongoCommandListener()])
+        else:
+            app.mongo_client = AsyncMongoClient(app.config["MONGO_URI"])
+        app.mongo_db = app.mongo_client.get_default_database()
+        # make sure mongodb is available and fail fast if not
+        await app.mongo_db.list_collection_names()
+        app.logger.info("connected to mongo")
+    except Exception as e:
+        app.logger.error('failed to connect to mongo')
+        app.logger.error(f'connection string: {redact_credentials(app.config["MONGO_URI"])}')
+        raise
+
+
 async def create_app(testing=False):
     app = Quart(__name__)
     configure_app(app, testing=testing)
@@ -173,18 +232,36 @@ async def create_app(testing=False):
         sio_kwargs['engineio_logger'] = app.logger
         app.logger.setLevel('DEBUG')
 
-    try:
-        app.logger.info("connecting mongo")
-        app.logger.info(redact_credentials(app.config["MONGO_URI"]))
-        app.mongo_client = AsyncMongoClient(app.config["MONGO_URI"])
-        app.mongo_db = app.mongo_client.get_default_database()
-        # make sure mongodb is available and fail fast if not
-        await app.mongo_db.list_collection_names()
-        app.logger.info("connected to mongo")
-    except Exception as e:
-        app.logger.error('failed to connect to mongo')
-        app.logger.error(f'connection string: {redact_credentials(app.config["MONGO_URI"])}')
-        raise
+    # サーバ側のトレースを取る割合。PERFORMANCE_RECORDING のときは指定が無ければすべて
+    tracing_sample_rate = app.config.get('TRACE_SAMPLE_RATE', 0)
+    if app.config.get('DEBUG_PERFORMANCE_RECORDING', False) and tracing_sample_rate <= 0:
+        tracing_sample_rate = 1.0
+
+    storage = app.config.get('STORAGE', 'mongo')
+    if storage == 'memory':
+        # Mongoに一切つながない。卓もキットもプロセスの中だけに置き、終われば消える
+        app.logger.warning('store tables, kits and components in memory only')
+        app.mongo_client = None
+        app.mongo_db = None
+        app.storage = MemoryBackend()
+        if tracing_sample_rate > 0:
+            app.logger.warning('traces are written to mongo; tracing is off with in-memory storage')
+            tracing_sample_rate = 0
+    elif storage == 'sqlite':
+        # Mongoに一切つながない。1つのファイルに置く1インスタンス構成
+        app.logger.info(f'store tables, kits and components in {app.config["SQLITE_PATH"]}')
+        app.mongo_client = None
+        app.mongo_db = None
+        app.storage = SqliteBackend(app.config['SQLITE_PATH'],
+                                    commit_interval=app.config.get('SQLITE_COMMIT_INTERVAL', 0.05))
+        if tracing_sample_rate > 0:
+            app.logger.warning('traces are written to mongo; tracing is off with sqlite storage')
+            tracing_sample_rate = 0
+    elif storage != 'mongo':
+        raise ValueError(f'config STORAGE "{storage}" is invalid')
+    else:
+        await connect_mongo(app, tracing_sample_rate)
+        app.storage = MongoBackend(app.mongo_db)
 
     if app.config['REDIS_URI']:
         uri = app.config["REDIS_URI"]
@@ -192,7 +269,11 @@ async def create_app(testing=False):
         if uri.startswith('redis+srv://'):
             uri = resolve_redis_srv(uri)
             app.logger.info(f'actual uri {uri}')
-        sio_kwargs['client_manager'] = socketio.AsyncRedisManager(uri)
+        if app.config.get('REDIS_ROOM_SHARDS', 0) > 0:
+            app.logger.info(f'route rooms through {app.config["REDIS_ROOM_SHARDS"]} redis channels')
+            sio_kwargs['client_manager'] = RoomAffineRedisManager(uri, shards=app.config['REDIS_ROOM_SHARDS'])
+        else:
+            sio_kwargs['client_manager'] = socketio.AsyncRedisManager(uri)
     else:
         app.logger.info('use no message queue')
 
@@ -219,17 +300,88 @@ async def create_app(testing=False):
         sio_kwargs['cors_allowed_origins'] = os.environ.get(
             'CORS_ALLOWED_ORIGINS_OVERRIDE', app.config['BASE_URL'])
 
-    sio = socketio.AsyncServer(**sio_kwargs)
+    if app.config.get('OUTBOUND_HIGH_WATER', 0) > 0:
+        app.logger.info(f'shed volatile events above {app.config["OUTBOUND_HIGH_WATER"]} queued packets')
+        sio_kwargs['outbound_high_water'] = app.config['OUTBOUND_HIGH_WATER']
+    if app.config.get('RECORD_EVENTS'):
+        sio_kwargs['event_recorder'] = EventRecorder(app.config['RECORD_EVENTS'])
+        app.logger.warning(f'recording inbound events to {sio_kwargs["event_recorder"].path}')
+    if app.config.get('WIRE_MSGPACK'):
+        app.logger.info('use msgpack for clients asking for it')
+        sio = MsgPackNegotiatingServer(**sio_kwargs)
+    else:
+        sio = OutboundLimitingServer(**sio_kwargs)
     app.sio = sio
+    metrics.REGISTRY.set_collector('socketio', sio.collect_room_metrics)
+    if app.config.get('MOUSE_MOVEMENT_TICK', 0) > 0:
+        app.logger.info(f'broadcast mouse movements every {app.config["MOUSE_MOVEMENT_TICK"]}s')
+        app.mouse_movement_batcher = MouseMovementBatcher(sio, tick=app.config['MOUSE_MOVEMENT_TICK'])
+    else:
+        app.mouse_movement_batcher = None
+    if app.config.get('COMPONENT_UPDATE_TICK', 0) > 0:
+        app.logger.info(f'broadcast component updates every {app.config["COMPONENT_UPDATE_TICK"]}s')
+        app.component_update_batcher = ComponentUpdateBatcher(sio, tick=app.config['COMPONENT_UPDATE_TICK'])
+    else:
+        app.component_update_batcher = None
+    if app.config.get('LOOP_LAG_THRESHOLD', 0) > 0:
+        app.logger.info(f'log stacks when the event loop lags over {app.config["LOOP_LAG_THRESHOLD"]}s')
+        app.loop_monitor = LoopMonitor(threshold=app.config['LOOP_LAG_THRESHOLD'])
+        app.loop_monitor.start()
+    else:
+        app.loop_monitor = None
 
-    tables.connect(app.mongo_db)
-    components.connect(app.mongo_db)
-    kits.connect(app.mongo_db)
+    tables.connect(app.storage)
+    components.connect(app.storage)
+    kits.connect(app.storage)
+    templates.connect(app.storage)
     await tables.ensure_indexes()
+    oplog.connect(app.storage)
+    if storage != 'mongo' and not await kits.get_all():
+        # 別プロセスの deploy では入れられないので、初期のキットとコンポーネントをここで入れる
+        from asobann import deploy
+        await deploy.load_default()
+    if app.config.get('OPLOG_LENGTH', 0) > 0:
+        app.logger.info(f'keep last {app.config["OPLOG_LENGTH"]} operations per table for rejoin')
+        await oplog.ensure_indexes()
+        oplog.enable(app.config['OPLOG_LENGTH'])
+    else:
+        oplog.disable()
+    if app.config.get('TABLE_CACHE', False):
+        if app.config['REDIS_URI']:
+            # 他のインスタンスが同じ卓に書くと、キャッシュはそれを知らずに古い状態を返す。
+            app.logger.warning('table cache assumes a single instance but REDIS_URI is set')
+        app.logger.info(f'use table cache (flush every {app.config["TABLE_CACHE_FLUSH_INTERVAL"]}s)')
+        tables.enable_cache(flush_interval=app.config['TABLE_CACHE_FLUSH_INTERVAL'])
+    if app.config.get('LOAD_TABLE_CACHE', False):
+        if app.config['REDIS_URI']:
+            # 他のインスタンスの変更では store.tables.version() が変わらず、古い卓を送ってしまう。
+            app.logger.warning('load table cache assumes a single instance but REDIS_URI is set')
+        app.logger.info('reuse encoded load table payloads while tables are unchanged')
+        app.load_table_cache = LoadTableCache(
+            encode=lambda table: sio.encode_event('load table', table),
+            max_tables=app.config.get('LOAD_TABLE_CACHE_TABLES', 256))
+        # テンプレートを受け取れるクライアント向け。参照の形の卓と、それが使うテンプレートを覚える
+        app.referenced_load_table_cache = LoadTableCache(
+            encode=lambda referenced: (sio.encode_event('load table', referenced[0]), referenced[1]),
+            max_tables=app.config.get('LOAD_TABLE_CACHE_TABLES', 256))
+    else:
+        app.load_table_cache = None
+        app.referenced_load_table_cache = None
+    if app.config.get('WRITE_COALESCING_WINDOW', 0) > 0:
+        app.logger.info(f'coalesce component writes within {app.config["WRITE_COALESCING_WINDOW"]}s')
+        tables.enable_write_coalescing(window=app.config['WRITE_COALESCING_WINDOW'])
     debug_tools.configure(
         app.mongo_db,
-        performance_recording=app.config.get('DEBUG_PERFORMANCE_RECORDING', False),
+        tracing_sample_rate=tracing_sample_rate,
+        flush_interval=app.config.get('TRACE_FLUSH_INTERVAL', 1.0),
+        buffer_size=app.config.get('TRACE_BUFFER_SIZE', 10000),
+        follow_client_traces=app.config.get('DEBUG_PERFORMANCE_RECORDING', False),
     )
+    if tracing_sample_rate > 0:
+        app.logger.info(f'trace {tracing_sample_rate:.0%} of socket.io handler calls')
+        await debug_tools.ensure_indexes(app.mongo_db, retention=app.config.get('TRACE_RETENTION', 86400))
+        # storeのコルーチンはすべてスパンにする（トレースの外で呼ばれたときはそのまま呼ぶだけ）
+        tracing.instrument_package(asobann.store)
 
     from asobann.app.blueprints import table, kit, component
     table.register_handlers(sio, app)
@@ -239,6 +391,13 @@ async def create_app(testing=False):
     if app.config['ENV'] == 'development' or app.config['ENV'] == 'test':
         from asobann.app.blueprints import debug
         app.register_blueprint(debug.blueprint)
+    if app.config.get('PROFILER', False):
+        if app.config.get('PROFILER_TOKEN'):
+            from asobann.app.blueprints import debug
+            app.logger.warning('sampling profiler is available at /debug/profile')
+            app.register_blueprint(debug.profiler_blueprint)
+        else:
+            app.logger.error('ASOBANN_PROFILER needs ASOBANN_PROFILER_TOKEN; /debug/profile is off')
 
     @app.route('/')
     async def index():
@@ -250,7 +409,7 @@ async def create_app(testing=False):
     async def export_table():
         tablename = request.args.get("tablename")
         app.logger.info(f"exporting table <{tablename}>")
-        table = await tables.get(tablename)
+        table = await tables.get(tablename, read_only=True)
         return jsonify(table)
 
     @app.route('/import', methods=["POST"])
@@ -286,6 +445,15 @@ async def create_app(testing=False):
         image_base_path = Path('/tmp/asobann/images')
         return await send_file(image_base_path / file_name)
 
+    # 本番では ASOBANN_METRICS_TOKEN を設定したときだけ開き、そのトークンを求める
+    metrics_token = app.config.get('METRICS_TOKEN')
+    if metrics_token or app.config['ENV'] in ('development', 'test'):
+        @app.route('/metrics', methods=['GET'])
+        async def get_metrics():
+            if metrics_token and not access_token.authorized(metrics_token):
+                return access_token.unauthorized()
+            return metrics.REGISTRY.exposition(), 200, {'Content-Type': metrics.CONTENT_TYPE}
+
     @app.route('/config', methods=['GET'])
     async def get_config():
         client_config = {}
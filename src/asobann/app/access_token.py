@@ -0,0 +1,16 @@
+import hmac
+
+from quart import request
+
+# 運用向けのエンドポイント（/metrics、/debug/profile）を、設定したトークンを知っている人にだけ開く。
+# リクエストは Authorization: Bearer <トークン> を付ける。
+
+
+def authorized(token):
+    """このリクエストが Authorization: Bearer <token> を付けているか。"""
+    scheme, _, given = request.headers.get('Authorization', '').partition(' ')
+    return scheme.lower() == 'bearer' and hmac.compare_digest(given.strip().encode(), token.encode())
+
+
+def unauthorized():
+    return 'unauthorized', 401, {'WWW-Authenticate': 'Bearer'}
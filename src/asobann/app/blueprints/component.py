@@ -1,5 +1,5 @@
 from quart import Blueprint, request, abort, jsonify
-from asobann.store import components
+from asobann.store import components, templates
 
 blueprint = Blueprint('components', __name__, url_prefix='/components')
 
@@ -10,3 +10,20 @@ async def get_components_for_kit():
     if not kit_name:
         return abort(500)
     return jsonify(await components.get_for_kit(kit_name))
+
+
+@blueprint.route('/templates')
+async def get_component_templates():
+    # サーバが展開したキット（add kit の expansion）を、クライアントが同じように展開するときに使う。
+    # 同じIDの中身は変わらないので、いくらでもキャッシュしてよい。ただし無いIDがあるときは
+    # キャッシュさせない（後から置かれることがある）
+    template_ids = [template_id for template_id in request.args.get("ids", "").split(",") if template_id]
+    if not template_ids:
+        return abort(400)
+    found = await templates.get_many(template_ids)
+    response = jsonify(found)
+    if found.keys() >= set(template_ids):
+        response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    else:
+        response.headers['Cache-Control'] = 'no-store'
+    return response
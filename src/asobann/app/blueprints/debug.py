@@ -1,9 +1,42 @@
-import time
-from quart import Blueprint, request, current_app, render_template, make_response, jsonify, json
+import asyncio
+import math
+import threading
 
-from .. import debug_tools
+from quart import Blueprint, request, current_app, render_template, make_response, jsonify, json, abort
+
+from .. import access_token, debug_tools, profiler, trace_analysis
 
 blueprint = Blueprint('debug', __name__, url_prefix='/debug')
+# ASOBANN_PROFILER のときだけ、環境によらず登録する（ステージングで使うため）
+profiler_blueprint = Blueprint('debug_profiler', __name__, url_prefix='/debug')
+
+_MAX_PROFILE_SECONDS = 120
+
+
+def _traces():
+    """トレースを残す traces コレクション。Mongoを使わない構成（ASOBANN_STORAGE=memory|sqlite）なら 404。"""
+    if current_app.mongo_db is None:
+        abort(404, 'traces are kept only with ASOBANN_STORAGE=mongo')
+    return current_app.mongo_db.traces
+
+
+def _number_arg(name, default):
+    """クエリの数。数でない、有限でないなら 400。"""
+    try:
+        value = float(request.args.get(name, default))
+    except ValueError:
+        abort(400, f'{name} must be a number')
+    if not math.isfinite(value):
+        abort(400, f'{name} must be a finite number')
+    return value
+
+
+def _positive_number_arg(name, default):
+    """クエリの正の数。数でない、0以下、有限でないなら 400。"""
+    value = _number_arg(name, default)
+    if value <= 0:
+        abort(400, f'{name} must be a positive number')
+    return value
 
 
 @blueprint.route('setting')
@@ -19,7 +52,7 @@ async def add_traces():
     data = json.loads(await request.get_data())
     s = str(data)
     current_app.logger.debug(f"add trace: {s[:30]}...")
-    await current_app.mongo_db.traces.insert_one({'traces': data, 'created_at': time.time() * 1000})
+    debug_tools.record_traces(data)
     return await make_response()
 
 
@@ -30,14 +63,14 @@ async def view_traces():
 
 @blueprint.route('delete_traces')
 async def delete_traces():
-    await current_app.mongo_db.traces.delete_many({})
+    await _traces().delete_many({})
     return "{}"
 
 
 @blueprint.route('get_traces', methods=['GET'])
 async def get_traces():
-    since = request.args.get('since')
-    traces = current_app.mongo_db.traces.find({'created_at': {'$gt': float(since)}})
+    since = _number_arg('since', 0)
+    traces = _traces().find({'created_at': {'$gt': since}})
     return jsonify({
         'data': [{'traces': t['traces'],
                   'created_at': t['created_at']
@@ -45,6 +78,55 @@ async def get_traces():
     })
 
 
+@blueprint.route('trace_latencies', methods=['GET'])
+async def get_trace_latencies():
+    """トレースポイントの間の所要時間の分布（→ trace_analysis.latency_distribution）。
+
+    since/until は記録時刻（ミリ秒）、bucket は分布を分ける幅（秒、既定60）。
+    label を2つ以上並べると（?label=emitted&label=handle update many components&...）、
+    その順の組だけを数える。無ければ隣り合うトレースポイントの組すべて。
+    """
+    created_at = {'$gt': _number_arg('since', 0)}
+    if 'until' in request.args:
+        created_at['$lte'] = _number_arg('until', None)
+    bucket_seconds = _positive_number_arg('bucket', 60)
+    path = request.args.getlist('label')
+    documents = _traces().find(
+        {'created_at': created_at}, {'_id': 0, 'traces.traces.traceId': 1, 'traces.traces.points': 1})
+    latencies = trace_analysis.latency_distribution(
+        [document async for document in documents],
+        bucket_ms=bucket_seconds * 1000,
+        path=path if len(path) >= 2 else None)
+    return jsonify({'bucketSeconds': bucket_seconds, 'pairs': latencies})
+
+
+@blueprint.route('loop')
+async def get_loop_status():
+    """イベントループの遅れ（→ loop_monitor.LoopMonitor.snapshot）。ASOBANN_LOOP_LAG_THRESHOLD が 0 なら測っていない。"""
+    if not current_app.loop_monitor:
+        return jsonify({'enabled': False})
+    return jsonify(dict(enabled=True, **current_app.loop_monitor.snapshot()))
+
+
 @blueprint.route('delete_all_traces')
 async def delete_all_traces():
-    await current_app.mongo_db.traces.delete_many({})
+    await _traces().delete_many({})
+
+
+@profiler_blueprint.route('profile')
+async def get_profile():
+    """seconds 秒（既定10）の間スタックを読み、collapsed 形式で返す（→ profiler）。
+
+    ASOBANN_PROFILER_TOKEN を Authorization: Bearer で求める。
+    """
+    if not access_token.authorized(current_app.config['PROFILER_TOKEN']):
+        return access_token.unauthorized()
+    seconds = min(_positive_number_arg('seconds', 10), _MAX_PROFILE_SECONDS)
+    interval = max(_positive_number_arg('interval', 0.01), 0.001)
+    current_app.logger.info(f'profiling for {seconds}s')
+    try:
+        counts = await asyncio.to_thread(
+            profiler.profile, asyncio.get_running_loop(), threading.get_ident(), seconds, interval)
+    except profiler.AlreadyRunning:
+        return 'another profile is running', 409
+    return profiler.collapsed(counts), 200, {'Content-Type': 'text/plain; charset=utf-8'}
@@ -1,7 +1,8 @@
+import contextlib
+
 from quart import Blueprint, render_template, request, redirect, url_for, make_response
 
-from asobann.store import tables, components, kits
-from asobann.app import debug_tools
+from asobann.store import tables, components, kits, oplog, templates, kit_expansion
 
 blueprint = Blueprint('tables', __name__, url_prefix='/tables')
 
@@ -14,6 +15,14 @@ async def play_table(tablename):
 def register_handlers(sio, app):
     logger = app.logger
 
+    async def sequence(tablename, event, data):
+        """操作ログが有効なら、配信する data を残して seq を付ける。
+
+        卓への書き込みと一緒に oplog.recording() の中で、書き込んだ（まとめ書きなら窓に入れた）後に呼ぶ。
+        """
+        if oplog.enabled():
+            data['seq'] = await oplog.append(tablename, event, data)
+
     @sio.on('come by table')
     async def handle_come_by_table(sid, json):
         if 'DEBUG_HANDLER_WAIT' in app.config:
@@ -21,77 +30,168 @@ def register_handlers(sio, app):
             await asyncio.sleep(float(app.config['DEBUG_HANDLER_WAIT']))
         logger.info(f'come by table')
         logger.debug(f'come by table: {json}')
-        table = await tables.get(json["tablename"])
-        if not table:
-            table = await tables.create(json["tablename"], None)
+        # 卓や操作ログを読む前に room へ入る。読んだ後に振られた seq の操作は配信で届く。
         await sio.enter_room(sid, json["tablename"])
-        await sio.emit("load table", table, to=sid)
+        if oplog.enabled() and 'lastSeq' in json:
+            operations = await oplog.since(json["tablename"], json['lastSeq'])
+            if operations is not None:
+                logger.info(f'catch up table: {len(operations)} operations')
+                await sio.emit("catch up table", {"tablename": json["tablename"], "operations": operations},
+                               to=sid)
+                return
+        # 卓より先に読む。この seq 以下の操作は、次に読む卓に必ず入っている。
+        seq = await oplog.current(json["tablename"]) if oplog.enabled() else None
+        if 'knownTemplates' in json:
+            # コンポーネントを定義（テンプレート）への参照の形で受け取れるクライアント。
+            # 持っていないテンプレートだけを load table の前に送る（src/js/component_templates.js）
+            await load_referenced_table(sid, json["tablename"], seq, set(json['knownTemplates']))
+            return
+        if app.load_table_cache:
+            encoded = await app.load_table_cache.get(
+                json["tablename"], lambda: tables.get_or_create(json["tablename"], read_only=True))
+        else:
+            table = await tables.get_or_create(json["tablename"])
+        if seq is not None:
+            await sio.emit("table sequence", {"tablename": json["tablename"], "seq": seq}, to=sid)
+        if app.load_table_cache:
+            await sio.emit_encoded("load table", encoded, to=sid)
+        else:
+            await sio.emit("load table", table, to=sid)
+
+    async def load_referenced_table(sid, tablename, seq, known_templates):
+        async def load():
+            return await templates.referenced_table(await tables.get_or_create(tablename, read_only=True))
+
+        if app.referenced_load_table_cache:
+            encoded, used = await app.referenced_load_table_cache.get(tablename, load)
+        else:
+            table, used = await templates.referenced_table(await tables.get_or_create(tablename))
+        if seq is not None:
+            await sio.emit("table sequence", {"tablename": tablename, "seq": seq}, to=sid)
+        missing = {template_id: template for template_id, template in used.items()
+                   if template_id not in known_templates}
+        if missing:
+            await sio.emit("component templates", {"templates": missing}, to=sid)
+        if app.referenced_load_table_cache:
+            await sio.emit_encoded("load table", encoded, to=sid)
+        else:
+            await sio.emit("load table", table, to=sid)
 
     @sio.on('set player name')
     async def handle_set_player(sid, json):
         logger.info(f'set player')
         logger.debug(f'set player: {json}')
-        table = await tables.get(json["tablename"])
-        if not table:
-            logger.error(f"table {json['tablename']} on set player")
-            raise RuntimeError('table does not exist')
         player_name = json['player']['name']
-        table["players"][player_name] = {
-            "name": player_name,
-            "isHost": json['player']['isHost'],
-        }
-        await tables.store(json["tablename"], table)
+        # コンポーネントには触らないので seq は振らない。他の書き込みとは順に行う
+        async with oplog.recording(json["tablename"]):
+            try:
+                await tables.set_player(json["tablename"], {
+                    "name": player_name,
+                    "isHost": json['player']['isHost'],
+                })
+            except tables.TableNotFound:
+                logger.error(f"table {json['tablename']} on set player")
+                raise RuntimeError('table does not exist')
         await sio.emit("confirmed player name", {"player": {"name": player_name}}, to=sid)
 
     @sio.on('update many components')
     async def handle_update_many_components(sid, json):
-        trace = debug_tools.resume_trace(json)
-        trace.trace_point('handle update many components')
         logger.debug(f'update many component: {json}')
         logger.info(f'update many component')
-        trace.trace_point('before update_table')
-        if json['diffs']:
-            await tables.update_components(json['tablename'], json['diffs'], json.get('volatileKeys'))
-        if json['componentIdsToRemove']:
-            await tables.remove_components(json['tablename'], json['componentIdsToRemove'])
-        trace.trace_point('after update_table')
-        await sio.emit("update many components", json, room=json["tablename"])
-        await trace.end()
+        # volatileだけの更新（ドラッグ中の中間座標など）は保存されないので、ログにも残さない。
+        persisted = json['componentIdsToRemove'] or tables.collect_update_candidates(
+            json['diffs'], json.get('volatileKeys') or {})
+        # まとめ書き（store.write_coalescer）のときは、窓に入れた時点で書く順が決まる。採番まではロックの中で、
+        # 書き終わるのは外で待つ。ロックの中で待つと、窓ごとに1件しか入らずまとまらない
+        written = []
+        try:
+            async with oplog.recording(json['tablename']) if persisted else contextlib.nullcontext():
+                if json['diffs']:
+                    written.append(await tables.update_components(
+                        json['tablename'], json['diffs'], json.get('volatileKeys'), wait=False))
+                if json['componentIdsToRemove']:
+                    written.append(await tables.remove_components(
+                        json['tablename'], json['componentIdsToRemove'], wait=False))
+                if persisted:
+                    await sequence(json['tablename'], "update many components", json)
+        finally:
+            for write in written:
+                if write is not None:
+                    await write
+        if app.component_update_batcher:
+            app.component_update_batcher.add(json["tablename"], json)
+        else:
+            await sio.emit("update many components", json, room=json["tablename"])
 
     @sio.on('add component')
     async def handle_add_component(sid, json):
         logger.info(f'add component: {json["component"]["componentId"]} {json["component"]["name"]}')
         logger.debug(f'add component: {json}')
-        await tables.add_component(json["tablename"], json["component"])
-        await sio.emit("add component", {"tablename": json["tablename"], "component": json["component"]},
-                        room=json["tablename"])
+        data = {"tablename": json["tablename"], "component": json["component"]}
+        async with oplog.recording(json["tablename"]):
+            await tables.add_component(json["tablename"], json["component"])
+            await sequence(json["tablename"], "add component", data)
+        await sio.emit("add component", data, room=json["tablename"])
         logger.info(f'add component end')
 
     @sio.on('add kit')
     async def handle_add_kit(sid, json):
         logger.info(f'add kit')
         logger.debug(f'add kit: {json}')
-        await tables.add_new_kit_and_components(
-            tablename=json['tablename'],
-            kitData=json['kitData']['kit'],
-            components=json['newComponents'])
-        await sio.emit('add kit',
-                        {"tablename": json["tablename"],
-                         "kit": json["kitData"]["kit"],
-                         "newComponents": json["newComponents"]},
-                        room=json["tablename"])
+        if 'newComponents' not in json:
+            await add_expanded_kit(sid, json)
+            return
+        data = {"tablename": json["tablename"],
+                "kit": json["kitData"]["kit"],
+                "newComponents": json["newComponents"]}
+        async with oplog.recording(json["tablename"]):
+            await tables.add_new_kit_and_components(
+                tablename=json['tablename'],
+                kitData=json['kitData']['kit'],
+                components=json['newComponents'])
+            await sequence(json["tablename"], "add kit", data)
+        await sio.emit('add kit', data, room=json["tablename"])
         logger.info(f'add kit end')
 
+    async def add_expanded_kit(sid, json):
+        # placement だけが来たときは、ここで展開して保存し、展開のしかただけを配る（store/kit_expansion.py）
+        kit = json['kitData']['kit']
+        try:
+            expansion, new_components = await kit_expansion.prepare(kit['name'], kit['kitId'], json.get('placement'))
+        except kit_expansion.KitExpansionError as e:
+            # 送ってきたクライアントに返す。クライアントは自分で展開して newComponents で送り直す
+            logger.warning(f'add kit rejected: {e}')
+            await sio.emit('add kit rejected', {"tablename": json["tablename"], "kit": kit, "reason": str(e)}, to=sid)
+            return
+        data = {"tablename": json["tablename"],
+                "kit": kit,
+                "expansion": expansion}
+        async with oplog.recording(json["tablename"]):
+            await tables.add_new_kit_and_components(
+                tablename=json['tablename'],
+                kitData=kit,
+                components=new_components)
+            await sequence(json["tablename"], "add kit", data)
+        await sio.emit('add kit', data, room=json["tablename"])
+        logger.info(f'add kit end: {len(new_components)} components')
+
     @sio.on("sync with me")
     async def handle_sync_with_me(sid, json):
         logger.info(f'sync with me')
         logger.debug(f'sync with me: {json}')
-        await tables.store(json['tablename'], json['tableData'])
-        table = await tables.get(json["tablename"])
-        await sio.emit("refresh table", {"tablename": json["tablename"], "table": table}, room=json["tablename"])
+        async with oplog.recording(json["tablename"]):
+            await tables.store(json['tablename'], json['tableData'])
+            table = await tables.get(json["tablename"])
+            data = {"tablename": json["tablename"], "table": table}
+            if oplog.enabled():
+                data['seq'] = await oplog.append_barrier(json["tablename"], "refresh table")
+        await sio.emit("refresh table", data, room=json["tablename"])
 
     @sio.on("mouse movement")
     async def handle_mouse_movement(sid, json):
+        if app.mouse_movement_batcher:
+            app.mouse_movement_batcher.add(json["tablename"], json)
+            return
         await sio.emit("mouse movement", json, room=json["tablename"])
 
 
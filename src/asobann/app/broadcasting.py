@@ -0,0 +1,154 @@
+import abc
+import asyncio
+import logging
+
+from asobann import metrics
+
+logger = logging.getLogger(__name__)
+
+# 受け取った数と送ったフレームの数。差が「まとめたことで減った配信」。
+_batched = metrics.Counter(
+    'asobann_broadcast_batched', 'Items added to a room batcher', ['event'])
+_frames = metrics.Counter(
+    'asobann_broadcast_frames', 'Frames a room batcher sent', ['event'])
+
+
+class RoomBatcher(abc.ABC):
+    """room ごとに、tick 秒の間に届いたものを溜めて1回の配信にまとめる。
+
+    最初の add() で窓が開き、tick 秒後にそれまでの分を frame() にして room へ送る。
+    何も届いていない room には何もしない。溜め方（new_pending / merge）と
+    送る形（event / frame）はサブクラスが決める。
+
+    配信だけを遅らせるもので、保存はしない（保存は呼び出し側が済ませておく）。
+    終了時に溜まっている分は送らずに捨てる。送り先のクライアントはどのみち切断され、
+    再接続で卓を読み直す。
+    """
+
+    event = None
+
+    def __init__(self, sio, tick):
+        self.sio = sio
+        self.tick = tick
+        self._pending = {}
+        self._tasks = set()
+        self._batched = _batched.labels(event=self.event)
+        self._frames = _frames.labels(event=self.event)
+
+    @abc.abstractmethod
+    def new_pending(self):
+        """room の溜め先を1つ作る。"""
+
+    @abc.abstractmethod
+    def merge(self, pending, item):
+        """届いた item を pending に溜める。"""
+
+    @abc.abstractmethod
+    def frame(self, room, pending):
+        """溜めた pending から、room へ送るペイロードを作る。"""
+
+    def add(self, room, item):
+        pending = self._pending.get(room)
+        if pending is None:
+            pending = self._pending[room] = self.new_pending()
+            task = asyncio.get_running_loop().create_task(self._flush_later(room))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        self.merge(pending, item)
+        self._batched.inc()
+
+    async def close(self):
+        for task in list(self._tasks):
+            task.cancel()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._pending.clear()
+
+    async def _flush_later(self, room):
+        await asyncio.sleep(self.tick)
+        # 以降の add() は新しい窓に入る。emit は await を挟むので、先に外す。
+        pending = self._pending.pop(room)
+        self._frames.inc()
+        try:
+            await self.sio.emit(self.event, self.frame(room, pending), room=room)
+        except Exception:
+            logger.exception(f'failed to broadcast {self.event} to {room}')
+
+
+class MouseMovementBatcher(RoomBatcher):
+    """mouse movement を room ごとにまとめる。プレイヤーごとに最新の位置だけを残す。
+
+    カーソルは途中の位置を見せる意味が無いので、古い位置は溜めずに上書きする。
+    1人のカーソルを受け取るたびに room 全員へ送ると、配信は人数の2乗で増える。
+    まとめれば tick ごとに room の人数分のフレームで済む。
+    """
+
+    event = 'mouse movements'
+
+    def new_pending(self):
+        return {}
+
+    def merge(self, pending, item):
+        pending[item['playerName']] = item['mouseMovement']
+
+    def frame(self, room, pending):
+        return {
+            'tablename': room,
+            'movements': [{'playerName': player_name, 'mouseMovement': mouse_movement}
+                          for player_name, mouse_movement in pending.items()],
+        }
+
+
+class ComponentUpdateBatcher(RoomBatcher):
+    """update many components を room ごとにまとめる。
+
+    送り手ごとの区別は残す。フレームは {tablename, updates: [...]} で、updates の各要素が
+    1人の送り手の {originator, diffs, componentIdsToRemove, seqs, volatileKeys}。クライアントは
+    自分の originator の要素を読み飛ばす。
+
+    同じ送り手から続けて届いた分だけを1つの要素にまとめる（同じキーは後勝ち）。
+    間に別の送り手を挟んだものまでまとめると、同じキーへの更新の順序が入れ替わり、
+    DBに残った値（後に届いた方）とクライアントの表示が食い違う。
+    seqs はまとめた元のメッセージの seq（操作ログが有効なときだけ）。volatileKeys は
+    まとめた後の値がvolatileな書き込みのものであるキー（app.outbound が間引きの判断に使う）。
+    """
+
+    event = 'update many components'
+
+    def new_pending(self):
+        return []
+
+    def merge(self, pending, item):
+        originator = item.get('originator')
+        if pending and pending[-1]['originator'] == originator:
+            update = pending[-1]
+        else:
+            update = {'originator': originator, 'diffs': {}, 'componentIdsToRemove': [], 'seqs': [],
+                      'volatileKeys': {}}
+            pending.append(update)
+        volatile_keys = item.get('volatileKeys') or {}
+        for diff in item['diffs']:
+            for component_id, value in diff.items():
+                update['diffs'].setdefault(component_id, {}).update(value)
+                volatile = update['volatileKeys'].setdefault(component_id, set())
+                for key in value:
+                    if key in volatile_keys.get(component_id, ()):
+                        volatile.add(key)
+                    else:
+                        volatile.discard(key)
+        update['componentIdsToRemove'].extend(item['componentIdsToRemove'])
+        if 'seq' in item:
+            update['seqs'].append(item['seq'])
+
+    def frame(self, room, pending):
+        return {
+            'tablename': room,
+            'updates': [{
+                'originator': update['originator'],
+                'diffs': [{component_id: diff} for component_id, diff in update['diffs'].items()],
+                'componentIdsToRemove': update['componentIdsToRemove'],
+                'seqs': update['seqs'],
+                'volatileKeys': {component_id: sorted(keys)
+                                 for component_id, keys in update['volatileKeys'].items() if keys},
+            } for update in pending],
+        }
@@ -1,62 +1,133 @@
+import asyncio
+import collections
+import datetime
+import logging
 import time
-from typing import List
+
+from pymongo.errors import OperationFailure
+
+from asobann import metrics, tracing
+
+logger = logging.getLogger(__name__)
 
 # socketioイベントハンドラはQuartのリクエスト/アプリコンテキスト外で実行されるため、
 # current_appではなくcreate_app()から明示的に渡された状態を保持する。
 _state = {
-    'trace_db': None,
-    'performance_recording': False,
+    'sink': None,
 }
 
+_traces_dropped = metrics.Counter(
+    'asobann_traces_dropped', 'Traces dropped because the trace buffer was full')
 
-def configure(mongo_db, performance_recording):
-    _state['trace_db'] = mongo_db.traces
-    _state['performance_recording'] = performance_recording
-
-
-def timestamp():
-    return int(time.time() * 1000)
-
+# 同名の索引が違う定義で既にあるときのエラーコード（IndexOptionsConflict）
+_INDEX_OPTIONS_CONFLICT = 85
 
-class NoOpPerformanceRecordingTrace:
-    def trace_point(self, label):
-        pass
 
-    async def end(self):
-        pass
+def configure(mongo_db, tracing_sample_rate=0.0, flush_interval=1.0, buffer_size=10000, follow_client_traces=False):
+    """トレースの書き出し先を用意する。tracing_sample_rate > 0 ならサーバのトレースも取る。
 
+    follow_client_traces は tracing.enable() に渡す。
 
-class PerformanceRecordingTrace:
-    def __init__(self, trace_id):
-        self.trace_id = trace_id
-        self.locus = 'server'
-        self.points: List = []
+    mongo_db が None（ASOBANN_STORAGE=memory）ならトレースは残さない。
+    """
+    if mongo_db is None:
+        _state['sink'] = None
+        tracing.disable()
+        return
+    _state['sink'] = TraceSink(mongo_db.traces, flush_interval=flush_interval, capacity=buffer_size)
+    if tracing_sample_rate > 0:
+        # ハンドラ・store・Mongoのコマンドのスパンを、終わったトレースごとにtracesへ書く
+        tracing.enable(export_trace, sample_rate=tracing_sample_rate, follow_client_traces=follow_client_traces)
+    else:
+        tracing.disable()
 
-    def trace_point(self, label):
-        point = {
-            'label': label,
-            'timestamp': timestamp()
-        }
-        self.points.append(point)
 
-    async def end(self):
-        data = {
-            'traces': [{
-                'traceId': self.trace_id,
-                'name': None,
-                'points': self.points
-            }],
-            'originator': self.locus,
-        }
-        await _state['trace_db'].insert_one({'traces': data, 'created_at': timestamp()})
+async def close():
+    """溜まっているトレースを書き出す。DB接続を閉じる前に呼ぶ。"""
+    if _state['sink']:
+        await _state['sink'].close()
 
 
-def resume_trace(envelope):
-    if not _state['performance_recording']:
-        return NoOpPerformanceRecordingTrace()
+def timestamp():
+    return int(time.time() * 1000)
 
-    if 'inspectionTraceId' in envelope:
-        trace_id = envelope['inspectionTraceId']
-        return PerformanceRecordingTrace(trace_id)
 
-    return NoOpPerformanceRecordingTrace()
+def record_traces(data):
+    """/debug/traces の形のトレース（{'traces': [断片...], 'originator': ...}）を書き出し待ちにする。"""
+    if _state['sink'] is None:
+        return
+    _state['sink'].add({
+        'traces': data,
+        'created_at': timestamp(),
+        # TTL索引（ensure_indexes）で古いものを消すための時刻
+        'recorded_at': datetime.datetime.now(datetime.timezone.utc),
+    })
+
+
+def export_trace(fragment):
+    """asobann.tracing のトレース1つを、/debug/traces で見られるように書き出し待ちにする。"""
+    record_traces({
+        'traces': [fragment],
+        'originator': 'server',
+    })
+
+
+async def ensure_indexes(mongo_db, retention):
+    """traces を retention 秒で消える（TTL）コレクションにする。
+
+    保持期間を変えて起動し直したときは、既存の索引の expireAfterSeconds を書き換える。
+    """
+    try:
+        await mongo_db.traces.create_index('recorded_at', expireAfterSeconds=retention)
+    except OperationFailure as e:
+        if e.code != _INDEX_OPTIONS_CONFLICT:
+            raise
+        await mongo_db.command('collMod', 'traces', index={
+            'keyPattern': {'recorded_at': 1},
+            'expireAfterSeconds': retention,
+        })
+
+
+class TraceSink:
+    """トレースをメモリに溜めて、flush_interval 秒ごとに insert_many でまとめて書く。
+
+    計測しているハンドラやリクエストの中でDBに書くと、その書き込みが計測値に入ってしまう。
+    溜められるのは capacity 件までで、書き出しが追いつかないときは古いものから捨てる
+    （リングバッファ）。捨てた数は asobann_traces_dropped に数える。
+    """
+
+    def __init__(self, collection, flush_interval, capacity):
+        self.collection = collection
+        self.flush_interval = flush_interval
+        self._buffer = collections.deque(maxlen=capacity)
+        self._task = None
+
+    def add(self, document):
+        if len(self._buffer) == self._buffer.maxlen:
+            _traces_dropped.inc()
+        self._buffer.append(document)
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def flush(self):
+        if not self._buffer:
+            return
+        documents = list(self._buffer)
+        self._buffer.clear()
+        try:
+            await self.collection.insert_many(documents, ordered=False)
+        except Exception as e:
+            # トレースは失っても困らない。書けなかった分は捨てる
+            logger.warning(f'failed to write {len(documents)} traces: {e!r}')
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
@@ -0,0 +1,74 @@
+import asyncio
+import gzip
+import json
+import logging
+import os
+import time
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+# クライアントから届いたイベントを、届いた順に gzip した NDJSON に書き出す（ASOBANN_RECORD_EVENTS）。
+#
+# 1行が1イベントで {'t': 受け取った時刻(ms), 'sid', 'table', 'event', 'data'}。
+# connect / disconnect も data なしで書く（リプレイで接続の始まりと終わりにする）。
+# tests/performance/replay.py がこれを読んで、ローカルのサーバに同じ順・同じ間隔で送り直す。
+#
+# 書き出しは flush_interval 秒ごとにスレッドでまとめて行う。1回ごとに gzip のメンバを
+# 追記するので、プロセスが途中で落ちても書けたところまでは読める。
+
+
+class EventRecorder:
+    def __init__(self, directory, flush_interval=1.0):
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        # 複数のプロセス・インスタンスが同じディレクトリに書いても混ざらない名前
+        self.path = directory / f'events-{time.strftime("%Y%m%d-%H%M%S")}-{os.getpid()}.ndjson.gz'
+        self.flush_interval = flush_interval
+        self._lines = []
+        self._task = None
+        self.recorded = 0
+
+    def record(self, event, sid, data=None):
+        table = data.get('tablename') if isinstance(data, dict) else None
+        try:
+            line = json.dumps({
+                't': int(time.time() * 1000),
+                'sid': sid,
+                'table': table,
+                'event': event,
+                'data': data,
+            }, separators=(',', ':'))
+        except (TypeError, ValueError) as e:
+            logger.warning(f'cannot record {event}: {e!r}')
+            return
+        self._lines.append(line + '\n')
+        self.recorded += 1
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def flush(self):
+        if not self._lines:
+            return
+        lines, self._lines = self._lines, []
+        try:
+            await asyncio.to_thread(self._write, lines)
+        except OSError as e:
+            logger.warning(f'failed to write {len(lines)} events to {self.path}: {e!r}')
+
+    def _write(self, lines):
+        with gzip.open(self.path, 'at', encoding='utf-8') as f:
+            f.writelines(lines)
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
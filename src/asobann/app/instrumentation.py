@@ -0,0 +1,117 @@
+import time
+
+import socketio
+from engineio import packet as eio_packet
+from socketio import packet
+
+from asobann import metrics, tracing
+
+_handler_seconds = metrics.Histogram(
+    'asobann_socket_handler_seconds', 'Latency of socket.io event handlers', ['event'])
+_emits = metrics.Counter(
+    'asobann_socket_emits', 'Events emitted by this instance', ['event'])
+# emits との比が1回の emit あたりの配信先の数（このインスタンスに接続しているものだけ）
+_emit_recipients = metrics.Counter(
+    'asobann_socket_emit_recipients', 'Local recipients of events emitted by this instance', ['event'])
+_packets_sent = metrics.Counter(
+    'asobann_socket_packets_sent', 'Event packets handed to engine.io, including those relayed from other instances')
+
+_ROOM_SIZE_BUCKETS = (1, 2, 3, 4, 5, 6, 8, 10, 15, 20, 30, 50, 100)
+
+
+def _inspection_trace_id(args):
+    """クライアントが開発者ツールで付けたトレースID（あれば、そのトレースの続きにする）。"""
+    for arg in args:
+        if isinstance(arg, dict) and 'inspectionTraceId' in arg:
+            return arg['inspectionTraceId']
+    return None
+
+
+class InstrumentedServer(socketio.AsyncServer):
+    """イベントハンドラの所要時間と emit の配信先の数を asobann.metrics に残す AsyncServer。
+
+    ハンドラは登録されているイベントだけを数える（クライアントが送ってきた任意の
+    イベント名でラベルが増えないように）。
+
+    asobann.tracing が有効なら、ハンドラ1回をトレース1つ（ルートスパン「handle <event>」）にし、
+    emit もその中のスパンにする。
+
+    event_recorder（app.event_recorder.EventRecorder）があれば、届いたイベントをそこに書く。
+    """
+
+    def __init__(self, event_recorder=None, **kwargs):
+        super().__init__(**kwargs)
+        self.event_recorder = event_recorder
+
+    async def _trigger_event(self, event, namespace, *args):
+        if self.event_recorder and args:
+            self._record(event, namespace, args)
+        if event not in self.handlers.get(namespace or '/', {}):
+            return await super()._trigger_event(event, namespace, *args)
+        started = time.perf_counter()
+        try:
+            with tracing.trace(f'handle {event}', trace_id=_inspection_trace_id(args)):
+                return await super()._trigger_event(event, namespace, *args)
+        finally:
+            _handler_seconds.labels(event=event).observe(time.perf_counter() - started)
+
+    def _record(self, event, namespace, args):
+        sid = args[0]
+        if event in ('connect', 'disconnect'):
+            # connect の environ や auth は書かない（JSONにならず、認証情報を含みうる）
+            self.event_recorder.record(event, sid)
+        elif event in self.handlers.get(namespace or '/', {}):
+            self.event_recorder.record(event, sid, args[1] if len(args) > 1 else None)
+
+    async def emit(self, event, data=None, to=None, room=None, skip_sid=None, namespace=None, **kwargs):
+        _emits.labels(event=event).inc()
+        _emit_recipients.labels(event=event).inc(self._count_local_recipients(namespace or '/', to or room))
+        with tracing.span(f'emit {event}'):
+            return await super().emit(event, data, to=to, room=room, skip_sid=skip_sid, namespace=namespace, **kwargs)
+
+    def encode_event(self, event, data, namespace=None):
+        """emit(event, data) で送るのと同じパケットを、エンコードした形で返す（→ emit_encoded()）。"""
+        return self.packet_class(packet.EVENT, namespace=namespace or '/', data=[event, data]).encode()
+
+    async def emit_encoded(self, event, encoded, to, namespace=None):
+        """encode_event() の結果を、このインスタンスにつながっている sid（to）へ送る。
+
+        同じものを何度も送るときに、エンコードを1回で済ませる。client manager（Redis）は通さない。
+        """
+        namespace = namespace or '/'
+        eio_sid = self.manager.eio_sid_from_sid(to, namespace)
+        if eio_sid is None:
+            return
+        _emits.labels(event=event).inc()
+        _emit_recipients.labels(event=event).inc()
+        with tracing.span(f'emit {event}'):
+            await self._send_eio_packet(eio_sid, eio_packet.Packet(eio_packet.MESSAGE, encoded))
+
+    def _count_local_recipients(self, namespace, room):
+        rooms = self.manager.rooms.get(namespace, {})
+        if isinstance(room, list):
+            return sum(len(rooms.get(r, ())) for r in room)
+        return len(rooms.get(room, ()))
+
+    async def _send_eio_packet(self, eio_sid, eio_pkt):
+        _packets_sent.inc()
+        await super()._send_eio_packet(eio_sid, eio_pkt)
+
+    def collect_room_metrics(self):
+        """このインスタンスの接続と room（卓）の状態。metrics.Registry.set_collector に渡す。"""
+        rooms = self.manager.rooms.get('/', {})
+        connected = rooms.get(None, {})
+        table_sizes = [len(members) for room, members in rooms.items()
+                       if room is not None and room not in connected]
+        connected_sids = metrics.Gauge(
+            'asobann_socket_connected_sids', 'Clients connected to this instance', registry=False)
+        connected_sids.set(len(connected))
+        room_count = metrics.Gauge(
+            'asobann_socket_rooms', 'Tables with clients on this instance', registry=False)
+        room_count.set(len(table_sizes))
+        room_size = metrics.Histogram(
+            'asobann_socket_room_size', 'Clients per table on this instance',
+            buckets=_ROOM_SIZE_BUCKETS, registry=False)
+        for size in table_sizes:
+            room_size.observe(size)
+        return [connected_sids, room_count, room_size]
@@ -0,0 +1,58 @@
+import collections
+
+from asobann import metrics
+from asobann.store import tables
+from asobann.store.single_flight import SingleFlight
+
+_lookups = metrics.Counter(
+    'asobann_load_table_cache_lookups', 'Lookups of encoded load table payloads', ['result'])
+
+
+class LoadTableCache:
+    """卓ごとに、エンコード済みの load table を store.tables.version() と一緒に持つ。
+
+    come by table のたびに卓を読んで（Mongoなら BSON から dict にして）、それを socket.io が
+    JSONにし直していた。同じ卓に何十人も入ってくると、同じ卓を人数分読み、人数分エンコードする。
+    版が変わっていなければ、前にエンコードしたものをそのまま送る。
+
+    版を先に読んでから卓を読むので、覚えたものはその版の時点より古くない（→ store.tables.version）。
+    版が変わった後に同時に来た呼び出しは、1回の読み込みとエンコードを共有する。
+
+    版はこのプロセスからの変更しか知らないので、1インスタンス構成専用（卓キャッシュと同じ）。
+    """
+
+    def __init__(self, encode, max_tables=256):
+        self._encode = encode
+        self.max_tables = max_tables
+        # tablename -> (版, エンコード済みの load table)。古く使われたものから捨てる
+        self._entries = collections.OrderedDict()
+        self._fills = SingleFlight()
+
+    async def get(self, tablename, load):
+        """卓 tablename の load table をエンコードした形で返す。無ければ load() で卓を得てエンコードする。
+
+        load() の結果は受け取ってすぐ（await を挟まずに）エンコードするので、
+        tables.get(read_only=True) の戻り値を渡してよい。
+        """
+        version = tables.version(tablename)
+        entry = self._entries.get(tablename)
+        if entry is not None and entry[0] == version:
+            self._entries.move_to_end(tablename)
+            _lookups.labels(result='hit').inc()
+            return entry[1]
+        _lookups.labels(result='miss').inc()
+        return await self._fills.run((tablename, version), lambda: self._fill(tablename, version, load))
+
+    async def _fill(self, tablename, version, load):
+        encoded = self._encode(await load())
+        entry = self._entries.get(tablename)
+        # 待っている間に、もっと新しい版で埋まっていることがある
+        if entry is None or entry[0] < version:
+            self._entries[tablename] = (version, encoded)
+            self._entries.move_to_end(tablename)
+            while len(self._entries) > self.max_tables:
+                self._entries.popitem(last=False)
+        return encoded
+
+    def clear(self):
+        self._entries.clear()
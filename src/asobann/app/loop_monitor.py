@@ -0,0 +1,112 @@
+import asyncio
+import heapq
+import logging
+import sys
+import threading
+import time
+import traceback
+
+from asobann import metrics
+
+logger = logging.getLogger(__name__)
+
+_lag_seconds = metrics.Histogram(
+    'asobann_event_loop_lag_seconds', 'How late the event loop woke up a sleeping task',
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0))
+_tasks = metrics.Gauge('asobann_event_loop_tasks', 'Tasks not yet done on the event loop')
+_stalls = metrics.Counter('asobann_event_loop_stalls', 'Times the event loop lag passed the threshold')
+
+# 遅かったものをいくつ残すか
+_SLOWEST = 10
+# ログに出すスタックの深さ（内側から）
+_STACK_LIMIT = 30
+
+
+class LoopMonitor:
+    """イベントループの遅れ（スケジューリングの遅延）と、動いているタスクの数を測る。
+
+    ループ上のタスクが interval 秒ごとに眠り、予定より何秒遅れて起きたかを記録する。
+    別スレッドの見張りは、そのタスクが threshold 秒を超えて起きてこないとき、ループの
+    スレッドで今動いているコードのスタックを取ってログに出す。JSONの処理でCPUを
+    使っているのか、emitの配信か、といったことはこのスタックで分かる（Mongoを待っている
+    だけならループは止まらないので、遅れではなくタスクの数に出る）。
+
+    値は asobann.metrics と snapshot()（/debug/loop）で読む。
+    """
+
+    def __init__(self, threshold, interval=0.1):
+        self.threshold = threshold
+        self.interval = interval
+        self.max_lag = 0.0
+        # (遅れ, 時刻, スタック) の遅かった順の上位
+        self._slowest = []
+        self._task = None
+        self._thread = None
+        self._stopped = threading.Event()
+        self._heartbeat = time.monotonic()
+        self._loop_thread_id = None
+        # 見張りが取った、今止まっているループのスタック（起きたタスクが受け取る）
+        self._stalled_stack = None
+
+    def start(self):
+        self._loop_thread_id = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+        self._thread = threading.Thread(target=self._watch, name='asobann-loop-monitor', daemon=True)
+        self._thread.start()
+
+    async def close(self):
+        self._stopped.set()
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def snapshot(self):
+        return {
+            'threshold': self.threshold,
+            'interval': self.interval,
+            'maxLag': self.max_lag,
+            'tasks': len(asyncio.all_tasks()),
+            'slowest': [{'lag': lag, 'at': at, 'stack': stack}
+                        for lag, at, stack in sorted(self._slowest, reverse=True)],
+        }
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - expected)
+            self._heartbeat = time.monotonic()
+            stack, self._stalled_stack = self._stalled_stack, None
+            self._record(lag, stack)
+            _tasks.set(len(asyncio.all_tasks(loop)))
+
+    def _record(self, lag, stack):
+        _lag_seconds.observe(lag)
+        self.max_lag = max(self.max_lag, lag)
+        if lag < self.threshold:
+            return
+        _stalls.inc()
+        entry = (lag, time.time() * 1000, stack)
+        if len(self._slowest) < _SLOWEST:
+            heapq.heappush(self._slowest, entry)
+        else:
+            heapq.heappushpop(self._slowest, entry)
+
+    def _watch(self):
+        sampled = None
+        while not self._stopped.wait(self.interval):
+            heartbeat = self._heartbeat
+            stalled = time.monotonic() - heartbeat - self.interval
+            # 1回の停止につき1回だけ取る
+            if stalled < self.threshold or heartbeat == sampled:
+                continue
+            sampled = heartbeat
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is None:
+                continue
+            stack = ''.join(traceback.format_stack(frame, limit=_STACK_LIMIT))
+            self._stalled_stack = stack
+            logger.warning(f'event loop has been blocked for {stalled:.3f}s, running:\n{stack}')
@@ -0,0 +1,174 @@
+import asyncio
+
+from engineio import packet as eio_packet
+from socketio import packet
+
+from asobann import metrics
+from asobann.store import tables
+from .instrumentation import InstrumentedServer
+
+# 間引いたイベント（持った数）と、それをまとめて送ったフレームの数。
+# 持ったまま接続が切れて送らずに捨てた分も数える。
+_shed = metrics.Counter(
+    'asobann_outbound_shed_events', 'Volatile events held back from a client with a full outbound queue')
+_collapsed_frames = metrics.Counter(
+    'asobann_outbound_collapsed_frames', 'Frames sent in place of held volatile events')
+_dropped_on_disconnect = metrics.Counter(
+    'asobann_outbound_dropped_on_disconnect', 'Clients that disconnected while volatile events were held')
+
+
+def _volatile_update(update):
+    """保存されない（ドラッグ中の中間座標など、volatileKeys だけの）コンポーネント更新か。"""
+    if update.get('componentIdsToRemove') or 'seq' in update or update.get('seqs'):
+        return False
+    return not tables.collect_update_candidates(update['diffs'], update.get('volatileKeys') or {})
+
+
+class _Held:
+    """1つの接続に送らずに持っている volatile なイベント。
+
+    後から来たもので上書きして、room ごとに最新の値だけを持つ。送るときは
+    mouse movements / update many components（まとめ配信の形）にして送る。
+    """
+
+    def __init__(self):
+        # (namespace, tablename) -> {playerName: mouseMovement}
+        self.movements = {}
+        # (namespace, tablename) -> {originator: {componentId: diff}}
+        self.updates = {}
+
+    def __bool__(self):
+        return bool(self.movements or self.updates)
+
+    def hold(self, namespace, event, data):
+        """持てれば True。保存されるもの・知らないイベントは持たない（必ず送る）。"""
+        if event == 'mouse movement':
+            movements = self.movements.setdefault((namespace, data['tablename']), {})
+            movements[data['playerName']] = data['mouseMovement']
+            return True
+        if event == 'mouse movements':
+            movements = self.movements.setdefault((namespace, data['tablename']), {})
+            for movement in data['movements']:
+                movements[movement['playerName']] = movement['mouseMovement']
+            return True
+        if event == 'update many components':
+            updates = data['updates'] if 'updates' in data else [data]
+            if not all(_volatile_update(update) for update in updates):
+                return False
+            held = self.updates.setdefault((namespace, data['tablename']), {})
+            for update in updates:
+                diffs = held.setdefault(update.get('originator'), {})
+                for diff in update['diffs']:
+                    for component_id, value in diff.items():
+                        diffs.setdefault(component_id, {}).update(value)
+            return True
+        return False
+
+    def take(self):
+        """持っていたものを (namespace, event, data) のリストにして空にする。"""
+        taken = []
+        for (namespace, tablename), movements in self.movements.items():
+            taken.append((namespace, 'mouse movements', {
+                'tablename': tablename,
+                'movements': [{'playerName': player_name, 'mouseMovement': mouse_movement}
+                              for player_name, mouse_movement in movements.items()],
+            }))
+        for (namespace, tablename), updates in self.updates.items():
+            taken.append((namespace, 'update many components', {
+                'tablename': tablename,
+                'updates': [{
+                    'originator': originator,
+                    'diffs': [{component_id: diff} for component_id, diff in diffs.items()],
+                    'componentIdsToRemove': [],
+                    'seqs': [],
+                    'volatileKeys': {component_id: list(diff) for component_id, diff in diffs.items()},
+                } for originator, diffs in updates.items()],
+            }))
+        self.movements = {}
+        self.updates = {}
+        return taken
+
+
+class OutboundLimitingServer(InstrumentedServer):
+    """接続ごとの送信待ちが outbound_high_water 個を超えたら、volatile なイベントを間引く AsyncServer。
+
+    engine.io は接続ごとの送信キューに上限を持たないので、回線の遅いクライアント
+    （電波の悪いスマートフォン、バックグラウンドで絞られたタブ）には mouse movement や
+    update many components がいくらでも溜まる。
+
+    キューが high water を超えている接続には、カーソル位置と保存されないコンポーネント更新
+    （volatileKeys だけのもの）を送らずに持ち、新しいもので上書きする。キューが空いたら、
+    持っていた最新の値だけをまとめて送る。保存されるイベントは必ず送り、その前に持っていた
+    ものを先に送って順序を保つ。
+
+    outbound_high_water が 0 なら何もしない。
+    """
+
+    def __init__(self, outbound_high_water=0, drain_interval=0.05, **kwargs):
+        super().__init__(**kwargs)
+        self.outbound_high_water = outbound_high_water
+        self.drain_interval = drain_interval
+        self._held = {}
+        self._draining = {}
+
+    def _outbound_queue_size(self, eio_sid):
+        try:
+            return self.eio._get_socket(eio_sid).queue.qsize()
+        except KeyError:
+            return None
+
+    async def _send_eio_packet(self, eio_sid, eio_pkt):
+        if self.outbound_high_water <= 0:
+            await super()._send_eio_packet(eio_sid, eio_pkt)
+            return
+        size = self._outbound_queue_size(eio_sid)
+        if size is not None and size >= self.outbound_high_water and self._hold(eio_sid, eio_pkt):
+            _shed.inc()
+            if eio_sid not in self._draining:
+                self._draining[eio_sid] = asyncio.get_running_loop().create_task(self._drain_later(eio_sid))
+            return
+        # 保存されるイベントや、キューが空いた後のイベントより前に、持っていたものを送る
+        await self._release(eio_sid)
+        await super()._send_eio_packet(eio_sid, eio_pkt)
+
+    def _hold(self, eio_sid, eio_pkt):
+        if eio_pkt.packet_type != eio_packet.MESSAGE:
+            return False
+        try:
+            pkt = self.packet_class(encoded_packet=eio_pkt.data)
+        except Exception:
+            return False
+        if pkt.packet_type != packet.EVENT or not isinstance(pkt.data, list) or len(pkt.data) != 2:
+            return False
+        event, data = pkt.data
+        if not isinstance(data, dict):
+            return False
+        held = self._held.get(eio_sid)
+        if held is None:
+            held = self._held[eio_sid] = _Held()
+        try:
+            return held.hold(pkt.namespace or '/', event, data)
+        except (KeyError, TypeError, ValueError, tables.InvalidComponentId):
+            return False
+
+    async def _release(self, eio_sid):
+        held = self._held.pop(eio_sid, None)
+        if not held:
+            return
+        for namespace, event, data in held.take():
+            _collapsed_frames.inc()
+            await self._send_packet(eio_sid, self.packet_class(packet.EVENT, namespace=namespace, data=[event, data]))
+
+    async def _drain_later(self, eio_sid):
+        try:
+            while eio_sid in self._held:
+                await asyncio.sleep(self.drain_interval)
+                size = self._outbound_queue_size(eio_sid)
+                if size is None:
+                    self._held.pop(eio_sid, None)
+                    _dropped_on_disconnect.inc()
+                    return
+                if size < self.outbound_high_water:
+                    await self._release(eio_sid)
+        finally:
+            self._draining.pop(eio_sid, None)
@@ -0,0 +1,135 @@
+import asyncio
+import collections
+import concurrent.futures
+import os
+import sys
+import threading
+import time
+
+# その場で動かすサンプリングプロファイラ（/debug/profile）。
+#
+# 別スレッドから一定間隔で、イベントループのスレッドと asyncio.to_thread のワーカーの
+# スタックを読み、Brendan Gregg の collapsed 形式（「フレーム;フレーム;... 回数」）で返す。
+# flamegraph.pl や speedscope にそのまま渡せる。
+#
+# コルーチンは待っている間スレッドのスタックに載らないので、それとは別に、ループ上の
+# 止まっているタスクをたどって「どのハンドラが何を待っているか」も数える。タスクはループの
+# スレッドでしか触れないので、call_soon_threadsafe でループに読ませる（ループが詰まって
+# いる間は読めず、その分は数えない）。
+#
+# - loop;...: ループのスレッドで動いていたもの（CPUを使っていた）
+# - await;...: 止まっていたタスク。コルーチンの呼び出し順に、最後は待っているもの
+# - thread <名前>;...: to_thread のワーカー
+#
+# 呼ばれている間だけスレッドを1つ動かす。呼ばれなければ何もしない。
+
+# asyncio の既定の executor のスレッド名（asyncio.to_thread もこれを使う）
+_WORKER_THREAD_PREFIX = 'asyncio_'
+
+_running = threading.Lock()
+
+
+class AlreadyRunning(Exception):
+    pass
+
+
+def _frame_label(frame):
+    code = frame.f_code
+    label = f'{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})'
+    return label.replace(';', ':')
+
+
+def _thread_stack(frame):
+    labels = []
+    while frame is not None:
+        labels.append(_frame_label(frame))
+        frame = frame.f_back
+    labels.reverse()
+    return labels
+
+
+def _awaiting_stack(coro):
+    """止まっているコルーチンを cr_await でたどり、外側から順のラベルにする。動いていれば None。"""
+    if getattr(coro, 'cr_running', False) or getattr(coro, 'gi_running', False):
+        return None
+    labels = []
+    awaited = coro
+    while awaited is not None:
+        frame = getattr(awaited, 'cr_frame', None) or getattr(awaited, 'gi_frame', None)
+        if frame is None:
+            # コルーチンではないもの（Future など）を待っている。Future の await は FutureIter に見える
+            name = type(awaited).__name__
+            labels.append('[Future]' if name == 'FutureIter' else f'[{name}]')
+            break
+        labels.append(_frame_label(frame))
+        awaited = getattr(awaited, 'cr_await', None) or getattr(awaited, 'gi_yieldfrom', None)
+    return labels
+
+
+def _sample_threads(counts, loop_thread_id, worker_names):
+    own = threading.get_ident()
+    for thread_id, frame in sys._current_frames().items():
+        if thread_id == own:
+            continue
+        if thread_id == loop_thread_id:
+            counts[';'.join(['loop'] + _thread_stack(frame))] += 1
+        elif thread_id in worker_names:
+            counts[';'.join([f'thread {worker_names[thread_id]}'] + _thread_stack(frame))] += 1
+
+
+def _awaiting_stacks(loop):
+    """止まっているタスクの collapsed stack のリスト。ループのスレッドで呼ぶ。"""
+    stacks = []
+    for task in asyncio.all_tasks(loop):
+        if task.done():
+            continue
+        labels = _awaiting_stack(task.get_coro())
+        if labels:
+            stacks.append(';'.join(['await'] + labels))
+    return stacks
+
+
+def _request_awaiting_stacks(loop):
+    """ループに _awaiting_stacks() を頼み、結果の入る concurrent.futures.Future を返す。"""
+    future = concurrent.futures.Future()
+
+    def snapshot():
+        try:
+            future.set_result(_awaiting_stacks(loop))
+        except Exception as e:
+            future.set_exception(e)
+
+    loop.call_soon_threadsafe(snapshot)
+    return future
+
+
+def profile(loop, loop_thread_id, seconds, interval=0.01):
+    """seconds 秒の間 interval 秒ごとにスタックを読み、{collapsed stack: 回数} を返す。
+
+    ループのスレッド以外から呼ぶ（asyncio.to_thread など）。同時に1つしか動かさない。
+    """
+    if not _running.acquire(blocking=False):
+        raise AlreadyRunning()
+    try:
+        counts = collections.Counter()
+        # 頼んだタスクの読み取り。終わるまでは次を頼まない（ループが詰まっても溜まらない）
+        snapshot = None
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            worker_names = {thread.ident: thread.name for thread in threading.enumerate()
+                            if thread.name.startswith(_WORKER_THREAD_PREFIX)}
+            _sample_threads(counts, loop_thread_id, worker_names)
+            if snapshot is not None and snapshot.done():
+                counts.update(snapshot.result())
+                snapshot = None
+            if snapshot is None:
+                snapshot = _request_awaiting_stacks(loop)
+            time.sleep(interval)
+        return counts
+    finally:
+        _running.release()
+
+
+def collapsed(counts):
+    """collapsed 形式のテキスト。多いものから。"""
+    return ''.join(f'{stack} {count}\n' for stack, count in counts.most_common())
@@ -0,0 +1,193 @@
+import asyncio
+import time
+import zlib
+
+import socketio
+
+
+class RoomAffineRedisManager(socketio.AsyncRedisManager):
+    """room 宛ての emit を、その room の参加者がいるインスタンスにだけ届ける client manager。
+
+    AsyncRedisManager はすべての emit を1つのチャネルに流すので、どのインスタンスも
+    全 room の配信を受け取ってデコードする。インスタンスを増やしても、1台あたりの
+    pub/sub の仕事は減らない。
+
+    ここでは room を名前のハッシュで shards 個のチャネル（shard）に振り分ける。
+    インスタンスは自分の接続がいる room の shard だけを購読し、誰もいなくなったら
+    購読をやめる。room 宛ての emit はその room の shard にだけ publish する。
+
+    - 自分の接続の sid 宛ての emit はこのインスタンスの中で配るだけで、Redis へは送らない。
+      別インスタンスの sid 宛ての emit は届かない（このアプリは自分の接続にしか to=sid で送らない）
+    - room を指定しない emit、切断、コールバックなどは従来どおり共通のチャネルで全員に送る
+    - publish の結果、shard の購読者が自分だけだった（room の参加者が全員このインスタンスに
+      いる）ときは、しばらくその shard へは publish しない。shard の購読を始めたインスタンスは
+      watch チャネルで知らせ、他のインスタンスはそれを受けて止めるのをやめる。知らせが届く前の
+      一瞬に送った分は相手に届かないことがあるので、念のため alone_ttl 秒で必ず publish をやり直す。
+      自分の購読を数に入れるのは、自分の知らせが戻ってきて購読が済んだと分かってから
+
+    全インスタンスで shards を揃えること。
+    """
+
+    name = 'asobann-room-affine-redis'
+
+    def __init__(self, url='redis://localhost:6379/0', channel='socketio', shards=64, alone_ttl=1.0, **kwargs):
+        super().__init__(url=url, channel=channel, **kwargs)
+        self.shards = shards
+        self.alone_ttl = alone_ttl
+        self.watch_channel = f'{channel}#watch'
+        # shard -> そのshardに入る、このインスタンスに参加者のいる (namespace, room)
+        self._local_rooms = {}
+        self._subscribed = set()
+        self._subscribing = {}
+        # 自分の watch の知らせが戻ってきた（Redis 側で購読が済んでいる）shard
+        self._confirmed = set()
+        # shard -> 購読者が自分だけだと分かった時刻
+        self._alone_since = {}
+        self._listening_pubsub = None
+        # publish した数と、参加者が全員ここにいたので publish しなかった数
+        self.published = 0
+        self.kept_local = 0
+
+    def shard_of(self, room):
+        return zlib.crc32(str(room).encode('utf-8')) % self.shards
+
+    def shard_channel(self, shard):
+        return f'{self.channel}#room{shard}'
+
+    def basic_enter_room(self, sid, namespace, room, eio_sid=None):
+        super().basic_enter_room(sid, namespace, room, eio_sid=eio_sid)
+        if room is None or room == sid:
+            return
+        shard = self.shard_of(room)
+        self._local_rooms.setdefault(shard, set()).add((namespace, room))
+        if shard not in self._subscribed and shard not in self._subscribing:
+            task = asyncio.get_running_loop().create_task(self._subscribe_shard(shard))
+            self._subscribing[shard] = task
+
+    def basic_leave_room(self, sid, namespace, room):
+        super().basic_leave_room(sid, namespace, room)
+        if room is None or room in self.rooms.get(namespace, {}):
+            return
+        shard = self.shard_of(room)
+        rooms = self._local_rooms.get(shard)
+        if rooms is None:
+            return
+        rooms.discard((namespace, room))
+        if not rooms:
+            del self._local_rooms[shard]
+            asyncio.get_running_loop().create_task(self._unsubscribe_shard(shard))
+
+    async def enter_room(self, sid, namespace, room, eio_sid=None):
+        await super().enter_room(sid, namespace, room, eio_sid=eio_sid)
+        # 戻った時点で、この room への他のインスタンスからの emit が届くようにしておく
+        subscribing = self._subscribing.get(self.shard_of(room))
+        if subscribing is not None:
+            await asyncio.shield(subscribing)
+
+    async def _subscribe_shard(self, shard):
+        try:
+            self._subscribed.add(shard)
+            if self._listening_pubsub is not None:
+                await self._listening_pubsub.subscribe(self.shard_channel(shard))
+            await self._announce(shard)
+        except Exception as exc:
+            # 購読は listen の再接続時にやり直される
+            self._get_logger().error(f'cannot subscribe to room shard {shard}',
+                                     extra={'redis_exception': str(exc)})
+        finally:
+            self._subscribing.pop(shard, None)
+
+    async def _unsubscribe_shard(self, shard):
+        if shard in self._local_rooms or shard not in self._subscribed:
+            return
+        self._subscribed.discard(shard)
+        self._confirmed.discard(shard)
+        if self._listening_pubsub is not None:
+            try:
+                await self._listening_pubsub.unsubscribe(self.shard_channel(shard))
+            except Exception as exc:
+                self._get_logger().error(f'cannot unsubscribe from room shard {shard}',
+                                         extra={'redis_exception': str(exc)})
+
+    async def _publish(self, data):
+        room = data.get('room')
+        if data.get('method') != 'emit' or room is None or isinstance(room, list):
+            await self._publish_to(self.channel, self.json.dumps(data))
+            return
+        if self.is_sid_room(data.get('namespace'), room):
+            return
+        shard = self.shard_of(room)
+        alone_since = self._alone_since.get(shard)
+        if alone_since is not None and time.monotonic() - alone_since < self.alone_ttl:
+            self.kept_local += 1
+            return
+        receivers = await self._publish_to(self.shard_channel(shard), self.json.dumps(data))
+        self.published += 1
+        if receivers is not None and receivers <= (1 if shard in self._confirmed else 0):
+            self._alone_since[shard] = time.monotonic()
+        else:
+            self._alone_since.pop(shard, None)
+
+    async def _announce(self, shard):
+        await self._publish_to(self.watch_channel, f'{self.host_id} {shard}')
+
+    def _handle_watch(self, message):
+        host_id, shard = message.decode('utf-8').split(' ')
+        shard = int(shard)
+        if host_id != self.host_id:
+            self._alone_since.pop(shard, None)
+        elif shard in self._subscribed:
+            self._confirmed.add(shard)
+
+    async def _publish_to(self, channel, message):
+        for retries_left in range(1, -1, -1):  # 2 attempts
+            try:
+                if not self.connected:
+                    self._redis_connect()
+                return await self.redis.publish(channel, message)
+            except Exception as exc:
+                if retries_left > 0:
+                    self._get_logger().error('Cannot publish to redis... retrying',
+                                             extra={'redis_exception': str(exc)})
+                    self.connected = False
+                else:
+                    self._get_logger().error('Cannot publish to redis... giving up',
+                                             extra={'redis_exception': str(exc)})
+
+    async def _redis_listen_with_retries(self):
+        retry_sleep = 1
+        while True:
+            try:
+                self._redis_connect()
+                pubsub = self.pubsub
+                # 購読し直すまでの間に他のインスタンスが来ているかもしれない
+                self._alone_since.clear()
+                self._confirmed.clear()
+                # これ以降に増えた shard は _subscribe_shard が直接購読する
+                self._listening_pubsub = pubsub
+                shards = list(self._subscribed)
+                await pubsub.subscribe(self.channel, self.watch_channel,
+                                       *[self.shard_channel(shard) for shard in shards])
+                for shard in shards:
+                    await self._announce(shard)
+                retry_sleep = 1
+                async for message in pubsub.listen():
+                    yield message
+            except Exception as exc:
+                self._listening_pubsub = None
+                self._get_logger().error(f'Cannot receive from redis... retrying in {retry_sleep} secs',
+                                         extra={'redis_exception': str(exc)})
+                await asyncio.sleep(retry_sleep)
+                retry_sleep = min(retry_sleep * 2, 60)
+
+    async def _listen(self):
+        prefix = f'{self.channel}#room'.encode('utf-8')
+        channel = self.channel.encode('utf-8')
+        watch_channel = self.watch_channel.encode('utf-8')
+        async for message in self._redis_listen_with_retries():
+            if message['type'] != 'message' or 'data' not in message:
+                continue
+            if message['channel'] == watch_channel:
+                self._handle_watch(message['data'])
+            elif message['channel'] == channel or message['channel'].startswith(prefix):
+                yield message['data']
@@ -0,0 +1,86 @@
+import math
+
+# /debug/traces のトレースを集計して、トレースポイントの間の所要時間の分布にする。
+#
+# トレースは traceId ごとに、クライアント・サーバのどこで記録されたものも合わせて1つにする
+# （クライアントのトレースポイント、/debug/add_traces で届いたもの、asobann.tracing の
+# スパンの開始と終わり）。ラベルの組 (from, to) ごとに、時間の区切り（バケット）ごとの
+# p50/p95/p99/max を返す。生のトレースをブラウザに送らずに済む。
+
+PERCENTILES = (50, 95, 99)
+
+
+def collect_points(documents):
+    """traces の文書を traceId -> [(timestamp, label)]（時刻順）にする。"""
+    points = {}
+    for document in documents:
+        for fragment in document['traces'].get('traces', []):
+            trace_points = points.setdefault(fragment.get('traceId'), [])
+            for point in fragment.get('points') or []:
+                trace_points.append((point['timestamp'], point['label']))
+    for trace_points in points.values():
+        trace_points.sort(key=lambda p: p[0])
+    return points
+
+
+def pair_latencies(trace_points, path=None):
+    """1つのトレースから ((from, to), 開始時刻, ミリ秒) を作る。
+
+    path が無ければ、時刻順に隣り合うトレースポイントの組すべて。path（ラベルのリスト）が
+    あれば、隣り合うラベルの組ごとに、from が最初に現れてから、その後に to が現れるまで。
+    to が何度も現れる（受け取ったクライアントごとのトレースポイントなど）ときは、
+    それぞれを1つとして数える。
+    """
+    if not trace_points:
+        return
+    if path is None:
+        for (start, label_from), (end, label_to) in zip(trace_points, trace_points[1:]):
+            yield (label_from, label_to), start, end - start
+        return
+    for label_from, label_to in zip(path, path[1:]):
+        start = next((ts for ts, label in trace_points if label == label_from), None)
+        if start is None:
+            continue
+        for ts, label in trace_points:
+            if label == label_to and ts >= start:
+                yield (label_from, label_to), start, ts - start
+
+
+def percentile(sorted_values, p):
+    """最近順位法（nearest-rank）のパーセンタイル。"""
+    rank = max(1, math.ceil(p / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def summarize(values):
+    values = sorted(values)
+    summary = {'count': len(values)}
+    for p in PERCENTILES:
+        summary[f'p{p}'] = percentile(values, p)
+    summary['max'] = values[-1]
+    return summary
+
+
+def latency_distribution(documents, bucket_ms, path=None):
+    """traces の文書から、ラベルの組ごと・バケットごとの所要時間の分布を作る。
+
+    バケットはトレースの組の開始時刻（from の時刻）で分ける。戻り値は
+    [{'from', 'to', 'buckets': [{'start', 'count', 'p50', 'p95', 'p99', 'max'}]}]。
+    path があればその順、無ければ数の多い組から並べる。
+    """
+    samples = {}
+    for trace_points in collect_points(documents).values():
+        for pair, start, latency in pair_latencies(trace_points, path):
+            bucket = int(start // bucket_ms * bucket_ms)
+            samples.setdefault(pair, {}).setdefault(bucket, []).append(latency)
+
+    if path is not None:
+        pairs = [pair for pair in zip(path, path[1:]) if pair in samples]
+    else:
+        pairs = sorted(samples, key=lambda pair: -sum(len(v) for v in samples[pair].values()))
+    return [{
+        'from': label_from,
+        'to': label_to,
+        'buckets': [dict(start=bucket, **summarize(latencies))
+                    for bucket, latencies in sorted(samples[(label_from, label_to)].items())],
+    } for label_from, label_to in pairs]
@@ -0,0 +1,95 @@
+from urllib.parse import parse_qs
+
+import msgpack
+from engineio import packet as eio_packet
+from socketio import packet
+
+from .outbound import OutboundLimitingServer
+
+
+class _EncodedPacket(str):
+    """JSONでエンコードしたパケット。msgpackで送る相手のために元のパケットを持つ。"""
+
+    def __new__(cls, encoded, source):
+        self = super().__new__(cls, encoded)
+        self.source = source
+        return self
+
+
+class DualPacket(packet.Packet):
+    """JSON（文字列）とmsgpack（バイト列）のどちらでも読み書きできるsocket.ioパケット。
+
+    受け取ったものは型で見分ける。クライアントは接続の最初のパケット（CONNECT）を
+    必ずJSONで送ってくるので、相手がどちらを話すかはその前に決まっている必要が無い。
+
+    送るときは従来どおりJSONにする（encode()）。manager は room 全員に同じエンコード
+    結果を配るので、その中に元のパケットを持たせておき、msgpackの相手に送る直前で
+    encode_msgpack() に差し替える（→ MsgPackNegotiatingServer）。どちらの形式も
+    パケットごとに高々1回しかエンコードしない。
+
+    msgpackの形式は socket.io-msgpack-parser と同じで、パケット1つが
+    {type, data, nsp, id} のmap1つ。
+    """
+
+    _msgpack = None
+
+    def encode(self):
+        encoded = super().encode()
+        if isinstance(encoded, str):
+            return _EncodedPacket(encoded, self)
+        # バイナリを含むイベントは添付つきのリストになる。このアプリでは送らない。
+        return encoded
+
+    def encode_msgpack(self):
+        if self._msgpack is None:
+            encoded = self._to_dict()
+            # JSONでは '/' を省略するが（namespace が None）、msgpackでは nsp を必ず書く
+            encoded['nsp'] = encoded['nsp'] or '/'
+            self._msgpack = msgpack.dumps(encoded)
+        return self._msgpack
+
+    def decode(self, encoded_packet):
+        if not isinstance(encoded_packet, bytes):
+            return super().decode(encoded_packet)
+        decoded = msgpack.loads(encoded_packet)
+        self.packet_type = decoded['type']
+        self.data = decoded.get('data')
+        self.id = decoded.get('id')
+        self.namespace = decoded.get('nsp')
+        return 0
+
+
+class MsgPackNegotiatingServer(OutboundLimitingServer):
+    """接続ごとに、クライアントが望めばmsgpackで送るサーバ。
+
+    接続URLのクエリに serializer=msgpack があるクライアント（sync_table.js の
+    msgpack_parser.js）にはmsgpackで、それ以外（古いクライアント、テスト用の
+    socketio.AsyncClient など）にはJSONで送る。
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(serializer=DualPacket, **kwargs)
+        self._msgpack_eio_sids = set()
+
+    async def _handle_eio_connect(self, eio_sid, environ):
+        query = parse_qs(environ.get('QUERY_STRING', ''))
+        if query.get('serializer') == ['msgpack']:
+            self._msgpack_eio_sids.add(eio_sid)
+        return await super()._handle_eio_connect(eio_sid, environ)
+
+    async def _handle_eio_disconnect(self, eio_sid, reason):
+        try:
+            return await super()._handle_eio_disconnect(eio_sid, reason)
+        finally:
+            self._msgpack_eio_sids.discard(eio_sid)
+
+    async def _send_packet(self, eio_sid, pkt):
+        if eio_sid in self._msgpack_eio_sids:
+            await self.eio.send(eio_sid, pkt.encode_msgpack())
+            return
+        await super()._send_packet(eio_sid, pkt)
+
+    async def _send_eio_packet(self, eio_sid, eio_pkt):
+        if eio_sid in self._msgpack_eio_sids and isinstance(eio_pkt.data, _EncodedPacket):
+            eio_pkt = eio_packet.Packet(eio_packet.MESSAGE, eio_pkt.data.source.encode_msgpack())
+        await super()._send_eio_packet(eio_sid, eio_pkt)
@@ -23,10 +23,10 @@ async def _serve():
     try:
         await server.serve()
     finally:
-        # AsyncMongoClientはトポロジ監視のバックグラウンドタスクを持つ。閉じずに
-        # 落とすと、SIGTERM後もそれが残ったままプロセスが終わる。Fargateのタスク
-        # 停止時に無意味なログが出る程度だが、graceful shutdownとしては宙ぶらりん。
-        await quart_app.mongo_client.aclose()
+        # 卓キャッシュの書き残しをフラッシュしてからMongoを閉じる。SIGTERMで
+        # uvicornが止まった後もここは通るので、Fargateのタスク停止でも書き込みを
+        # 取りこぼさない。
+        await asobann.app.shutdown(quart_app)
 
 
 if __name__ == '__main__':
@@ -30,3 +30,77 @@ else:
 
 AWS_COGNITO_USER_POOL_ID = from_env('AWS_COGNITO_USER_POOL_ID', default=None)
 AWS_COGNITO_CLIENT_ID = from_env('AWS_COGNITO_CLIENT_ID', default=None)
+
+# 卓の状態をプロセス内に持ち、変更をまとめて書く（store.tables.enable_cache）。
+# このプロセスが卓の唯一の書き手であること（1インスタンス構成）が前提。
+TABLE_CACHE = 'ASOBANN_TABLE_CACHE' in os.environ
+TABLE_CACHE_FLUSH_INTERVAL = float(from_env('ASOBANN_TABLE_CACHE_FLUSH_INTERVAL', default='1.0'))
+
+# come by table に返す load table を、卓が変わるまでエンコード済みのまま使い回す（app.load_table_cache）。
+# 持つのは最近使われた LOAD_TABLE_CACHE_TABLES 卓分。卓キャッシュと同じく1インスタンス構成が前提。
+LOAD_TABLE_CACHE = 'ASOBANN_LOAD_TABLE_CACHE' in os.environ
+LOAD_TABLE_CACHE_TABLES = int(from_env('ASOBANN_LOAD_TABLE_CACHE_TABLES', default='256'))
+
+# 卓ごとにこの秒数の間に届いた部分更新を1回のupdateにまとめる（store.tables.enable_write_coalescing）。
+# 0 ならまとめない。
+WRITE_COALESCING_WINDOW = float(from_env('ASOBANN_WRITE_COALESCING_WINDOW', default='0'))
+
+# 卓ごとに直近この件数の操作に seq を振って残し、再接続時に差分だけを送る（store.oplog）。
+# 0 なら残さず、再接続のたびに卓全体を送る。
+OPLOG_LENGTH = int(from_env('ASOBANN_OPLOG_LENGTH', default='0'))
+
+# mouse movement をこの秒数ごとに room 単位でまとめて配信する（app.broadcasting.MouseMovementBatcher）。
+# プレイヤーごとに最新の位置だけを送る。0 なら受け取るたびにそのまま配信する。
+MOUSE_MOVEMENT_TICK = float(from_env('ASOBANN_MOUSE_MOVEMENT_TICK', default='0'))
+
+# update many components をこの秒数ごとに room 単位でまとめて配信する（app.broadcasting.ComponentUpdateBatcher）。
+# 保存は従来どおり受け取るたびに行う。0 なら受け取るたびにそのまま配信する。
+COMPONENT_UPDATE_TICK = float(from_env('ASOBANN_COMPONENT_UPDATE_TICK', default='0'))
+
+# クライアントが望めば socket.io のパケットを MessagePack で送受信する（app.wire）。
+# 望まないクライアントとは従来どおりJSONで話す。
+WIRE_MSGPACK = 'ASOBANN_WIRE_MSGPACK' in os.environ
+
+# REDIS_URI を使うとき、room をこの数の shard チャネルに分けて、参加者のいるインスタンスだけが
+# 購読する（app.room_routing）。全インスタンスで揃えること。0 なら全員が1つのチャネルを購読する。
+REDIS_ROOM_SHARDS = int(from_env('ASOBANN_REDIS_ROOM_SHARDS', default='0'))
+
+# 接続ごとの送信待ちがこの数を超えたら、カーソル位置や保存されないコンポーネント更新を間引いて
+# 最新の値だけを送る（app.outbound）。保存されるイベントは必ず送る。0 なら間引かない。
+OUTBOUND_HIGH_WATER = int(from_env('ASOBANN_OUTBOUND_HIGH_WATER', default='0'))
+
+# サーバのハンドラ・store・Mongoのコマンドのスパントレースを、この割合のハンドラ呼び出しで取る
+# （asobann.tracing）。ASOBANN_DEBUG_OPTS の PERFORMANCE_RECORDING のときは 0 でもすべて取る。
+TRACE_SAMPLE_RATE = float(from_env('ASOBANN_TRACE_SAMPLE_RATE', default='0'))
+# トレースはメモリに溜めて、この秒数ごとにまとめて traces へ書く。溜めるのは TRACE_BUFFER_SIZE 件まで
+# （超えたら古いものから捨てる）。
+TRACE_FLUSH_INTERVAL = float(from_env('ASOBANN_TRACE_FLUSH_INTERVAL', default='1.0'))
+TRACE_BUFFER_SIZE = int(from_env('ASOBANN_TRACE_BUFFER_SIZE', default='10000'))
+# traces に書いたトレースをこの秒数で消す（TTL索引）。
+TRACE_RETENTION = int(from_env('ASOBANN_TRACE_RETENTION', default='86400'))
+
+# イベントループがこの秒数より遅れたら、そのとき動いていたコードのスタックをログに出す
+# （app.loop_monitor）。遅れとタスクの数は /metrics に出る。0 なら測らない。
+LOOP_LAG_THRESHOLD = float(from_env('ASOBANN_LOOP_LAG_THRESHOLD', default='0'))
+
+# /metrics に Authorization: Bearer <このトークン> を求める。本番では設定したときだけ /metrics を開く。
+METRICS_TOKEN = from_env('ASOBANN_METRICS_TOKEN', default=None)
+
+# /debug/profile（app.profiler のサンプリングプロファイラ）を環境によらず使えるようにする。
+# 呼ばれている間だけ動く。Authorization: Bearer <PROFILER_TOKEN> を求め、トークンが無ければ開かない。
+PROFILER = 'ASOBANN_PROFILER' in os.environ
+PROFILER_TOKEN = from_env('ASOBANN_PROFILER_TOKEN', default=None)
+
+# クライアントから届いたイベントを、このディレクトリに gzip した NDJSON で書き出す（app.event_recorder）。
+# tests/performance/replay.py でローカルのサーバに送り直して、ベンチマークに使う。未設定なら書かない。
+RECORD_EVENTS = from_env('ASOBANN_RECORD_EVENTS', default=None)
+
+# 卓・キット・コンポーネントの置き場所（store.backends）。mongo（MONGO_URI）か memory か sqlite。
+# memory はプロセスの中だけに置き、終われば消える。sqlite は SQLITE_PATH のファイルに置く。
+# どちらも1インスタンス専用で、トレースは残さない。
+STORAGE = from_env('ASOBANN_STORAGE', default='mongo')
+
+# STORAGE=sqlite のときのファイルと、まとめてコミットする間隔（秒）。
+# 落ちると最大でこの間隔の分の書き込みを失う。0 なら書くたびにコミットする。
+SQLITE_PATH = from_env('ASOBANN_SQLITE_PATH', default='asobann.sqlite3')
+SQLITE_COMMIT_INTERVAL = float(from_env('ASOBANN_SQLITE_COMMIT_INTERVAL', default='0.05'))
@@ -28,6 +28,30 @@ AWS_S3_IMAGE_BUCKET_NAME = common.AWS_S3_IMAGE_BUCKET_NAME
 AWS_COGNITO_USER_POOL_ID = common.AWS_COGNITO_USER_POOL_ID
 AWS_COGNITO_CLIENT_ID = common.AWS_COGNITO_CLIENT_ID
 
+TABLE_CACHE = common.TABLE_CACHE
+TABLE_CACHE_FLUSH_INTERVAL = common.TABLE_CACHE_FLUSH_INTERVAL
+LOAD_TABLE_CACHE = common.LOAD_TABLE_CACHE
+LOAD_TABLE_CACHE_TABLES = common.LOAD_TABLE_CACHE_TABLES
+WRITE_COALESCING_WINDOW = common.WRITE_COALESCING_WINDOW
+OPLOG_LENGTH = common.OPLOG_LENGTH
+MOUSE_MOVEMENT_TICK = common.MOUSE_MOVEMENT_TICK
+COMPONENT_UPDATE_TICK = common.COMPONENT_UPDATE_TICK
+WIRE_MSGPACK = common.WIRE_MSGPACK
+REDIS_ROOM_SHARDS = common.REDIS_ROOM_SHARDS
+OUTBOUND_HIGH_WATER = common.OUTBOUND_HIGH_WATER
+TRACE_SAMPLE_RATE = common.TRACE_SAMPLE_RATE
+TRACE_FLUSH_INTERVAL = common.TRACE_FLUSH_INTERVAL
+TRACE_BUFFER_SIZE = common.TRACE_BUFFER_SIZE
+TRACE_RETENTION = common.TRACE_RETENTION
+LOOP_LAG_THRESHOLD = common.LOOP_LAG_THRESHOLD
+METRICS_TOKEN = common.METRICS_TOKEN
+PROFILER = common.PROFILER
+PROFILER_TOKEN = common.PROFILER_TOKEN
+RECORD_EVENTS = common.RECORD_EVENTS
+STORAGE = common.STORAGE
+SQLITE_PATH = common.SQLITE_PATH
+SQLITE_COMMIT_INTERVAL = common.SQLITE_COMMIT_INTERVAL
+
 if 'ASOBANN_DEBUG_OPTS' in os.environ:
     opts = os.environ['ASOBANN_DEBUG_OPTS'].split(',')
     DEBUG_PERFORMANCE_RECORDING = 'PERFORMANCE_RECORDING' in opts
@@ -8,11 +8,14 @@ import asobann.app
 import asobann.store
 import asobann.store.components
 import asobann.store.kits
+import asobann.store.oplog
 import asobann.store.tables
+import asobann.store.templates
 
 
 async def purge_all():
-    for d in [asobann.store.tables, asobann.store.components, asobann.store.kits]:
+    for d in [asobann.store.tables, asobann.store.oplog, asobann.store.components, asobann.store.kits,
+              asobann.store.templates]:
         await d.purge_all()
 
 
@@ -40,15 +43,19 @@ async def run(cmd):
         elif cmd == 'purge_kits_and_components':
             print("purge kits and components ...")
             await purge_kits_and_components()
+        elif cmd == 'migrate_tables':
+            print("migrate tables ...")
+            print(f"{await asobann.store.tables.split_embedded_components()} tables migrated")
+            print(f"{await asobann.store.tables.compact_stored_components()} components compacted")
         else:
-            print("python deploy.py (load_default | purge_kits_and_components)")
+            print("python deploy.py (load_default | purge_kits_and_components | migrate_tables)")
             exit(1)
     finally:
         # 閉じないと、asyncio.run()が戻るときにクライアントのバックグラウンド
         # タスクが未完了のままループが閉じ、"Task was destroyed but it is pending"
         # が出る。Dockerfile.aws の CMD はこの直後にサーバを起動するので、
         # コンテナ起動ログの先頭が毎回それで汚れる。
-        await app.mongo_client.aclose()
+        await asobann.app.shutdown(app)
 
 
 def main():
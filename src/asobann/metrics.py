@@ -0,0 +1,228 @@
+import abc
+import bisect
+import functools
+import math
+import time
+
+# プロセス内のメトリクス（Prometheus のテキスト形式で /metrics から読む）。
+#
+# 常に有効なので、記録はメモリ上の数を増やすだけにしてある。使い方は prometheus_client に
+# 合わせてあり（Counter / Gauge / Histogram、labels()、inc() / set() / observe()）、
+# 必要になったら置き換えられる。
+#
+# 値はプロセスごと。複数インスタンスのときは、それぞれを scrape して集計する。
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels) + '}'
+
+
+class _Metric(abc.ABC):
+    type = None
+    # Counter は名前に _total を付けて出す
+    suffix = ''
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        if not self.labelnames:
+            self._children[()] = self._new_child()
+        if registry is None:
+            registry = REGISTRY
+        if registry is not False:
+            registry.register(self)
+
+    @abc.abstractmethod
+    def _new_child(self):
+        """ラベルの値の組1つ分の値を持つものを返す。"""
+
+    def labels(self, *values, **labels):
+        if labels:
+            values = tuple(labels[name] for name in self.labelnames)
+        values = tuple(str(value) for value in values)
+        if len(values) != len(self.labelnames):
+            raise ValueError(f'{self.name} takes labels {self.labelnames}')
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = self._new_child()
+        return child
+
+    def _unlabeled(self):
+        if self.labelnames:
+            raise ValueError(f'{self.name} needs labels {self.labelnames}')
+        return self._children[()]
+
+    def samples(self):
+        """(サフィックス, [(ラベル名, 値)], 値) を返す。"""
+        for values, child in sorted(self._children.items()):
+            yield from child.samples(list(zip(self.labelnames, values)))
+
+    def exposition(self):
+        name = self.name + self.suffix
+        lines = [f'# HELP {name} {self.documentation}', f'# TYPE {name} {self.type}']
+        for suffix, labels, value in self.samples():
+            lines.append(f'{name}{suffix}{_format_labels(labels)} {_format_value(value)}')
+        return '\n'.join(lines)
+
+
+class _CounterChild:
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self, labels):
+        yield '', labels, self.value
+
+
+class Counter(_Metric):
+    type = 'counter'
+    suffix = '_total'
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self._unlabeled().inc(amount)
+
+
+class _GaugeChild:
+    def __init__(self):
+        self.value = 0
+        self.function = None
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set_function(self, function):
+        """scrape のたびに function() の値を読む。"""
+        self.function = function
+
+    def samples(self, labels):
+        yield '', labels, self.function() if self.function else self.value
+
+
+class Gauge(_Metric):
+    type = 'gauge'
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def set(self, value):
+        self._unlabeled().set(value)
+
+    def inc(self, amount=1):
+        self._unlabeled().inc(amount)
+
+    def dec(self, amount=1):
+        self._unlabeled().dec(amount)
+
+    def set_function(self, function):
+        self._unlabeled().set_function(function)
+
+
+class _HistogramChild:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def samples(self, labels):
+        cumulative = 0
+        for bound, count in zip(self.buckets + (math.inf,), self.counts):
+            cumulative += count
+            yield '_bucket', labels + [('le', _format_value(bound))], cumulative
+        yield '_sum', labels, self.sum
+        yield '_count', labels, cumulative
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, registry=None):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, registry)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self._unlabeled().observe(value)
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._collectors = {}
+
+    def register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f'metric {metric.name} is already registered')
+        self._metrics[metric.name] = metric
+
+    def set_collector(self, name, collect):
+        """scrape のたびに collect() が返すメトリクスも出す。同じ name で呼び直すと置き換える。
+
+        サーバの状態（room の数など）のように、記録するより読んだ方が安いもの用。
+        collect() が返すメトリクスは registry=False で作る。
+        """
+        self._collectors[name] = collect
+
+    def exposition(self):
+        metrics = list(self._metrics.values())
+        for collect in self._collectors.values():
+            metrics.extend(collect())
+        return '\n'.join(metric.exposition() for metric in metrics) + '\n'
+
+
+REGISTRY = Registry()
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def timed(histogram, labelname):
+    """async 関数の所要時間を histogram に記録するデコレータを作る。ラベル labelname は関数名。"""
+
+    def decorator(func):
+        child = histogram.labels(**{labelname: func.__name__})
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                child.observe(time.perf_counter() - started)
+
+        return wrapper
+
+    return decorator
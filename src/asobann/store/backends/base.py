@@ -0,0 +1,196 @@
+import abc
+
+# store の永続化先（バックエンド）が満たす約束。
+#
+# store.tables / components / kits / templates / oplog は、キャッシュやまとめ書き、検査、採番の規則を
+# 受け持ち、読み書きそのものは connect() で渡されたバックエンドに任せる。バックエンドは
+# 5つの部分（tables / components / kits / templates / oplog）を属性に持つ。
+#
+# 卓は store.tables.get() が返すのと同じ {"tablename", "table": {..., "components": {...}}} の形で
+# やりとりする。部分更新は PendingModification（`table.<キー>` / `table.components.<id>...` の
+# ドット記法のパス）で渡す。componentId の検査は store.tables が済ませてから渡す。
+#
+# 5つの部分は abc.ABC で、足りないメソッドのあるものは作る時点で TypeError になる。
+
+class Backend:
+    """tables / components / kits / templates / oplog の5つをまとめたもの。"""
+
+    tables = None
+    components = None
+    kits = None
+    templates = None
+    oplog = None
+
+    async def close(self):
+        pass
+
+
+class TableBackend(abc.ABC):
+    @abc.abstractmethod
+    async def load(self, tablename):
+        """卓を {"tablename", "table"} の形で返す。無ければ None。戻り値は呼び出し側が書き換えてよい。"""
+
+    @abc.abstractmethod
+    async def create(self, tablename, table):
+        """卓を新しく作る。作った時刻を残す。同じ名前の卓があれば TableAlreadyExists。"""
+
+    @abc.abstractmethod
+    async def replace(self, tablename, table, upsert):
+        """卓を丸ごと置き換える。無い卓は upsert なら作り、そうでなければ何もしない。"""
+
+    @abc.abstractmethod
+    async def touch(self, tablename):
+        """卓を更新した時刻を残す。"""
+
+    @abc.abstractmethod
+    async def apply(self, tablename, pending):
+        """PendingModification を書く。無い卓なら TableNotFound。
+
+        `table.components.<id>.<キー>` は、そのコンポーネントが無ければ捨てる
+        （消されたコンポーネントの一部のキーだけを復活させない）。
+        """
+
+    @abc.abstractmethod
+    async def add_kit(self, tablename, kit_data, components):
+        """卓の kits に kit_data を足し、components（id -> コンポーネント）を置く。無い卓なら TableNotFound。"""
+
+    @abc.abstractmethod
+    async def add_component(self, tablename, component_id, component):
+        """コンポーネントを1つ置く（同じ id があれば置き換える）。無い卓なら TableNotFound。"""
+
+    async def split_embedded_components(self):
+        """古い形式で残っている卓を今の形式へ移し、移した数を返す。形式の移行が無いバックエンドは 0。"""
+        return 0
+
+    @abc.abstractmethod
+    async def rewrite_components(self, rewrite):
+        """すべての卓のコンポーネントを rewrite(保存されているコンポーネント) に置き換え、置き換えた数を返す。
+
+        rewrite が None を返したものはそのまま。読んでから書くまでの間に書き換わったコンポーネントは
+        上書きしない（プレイ中の更新を古い値に戻さない）。
+        """
+
+    @abc.abstractmethod
+    async def purge_all(self):
+        ...
+
+    async def ensure_indexes(self):
+        pass
+
+
+class ComponentBackend(abc.ABC):
+    """キットに属するコンポーネント定義。1件は {"component": {"name", ...}}。"""
+
+    @abc.abstractmethod
+    async def get(self, name):
+        ...
+
+    @abc.abstractmethod
+    async def find_by_names(self, names):
+        """component.name が names のどれかであるものを [{"component"}] で返す。"""
+
+    @abc.abstractmethod
+    async def get_all(self):
+        ...
+
+    @abc.abstractmethod
+    async def exists(self, name):
+        ...
+
+    @abc.abstractmethod
+    async def create(self, data):
+        ...
+
+    @abc.abstractmethod
+    async def update(self, data):
+        ...
+
+    @abc.abstractmethod
+    async def store_default(self, data):
+        """component.name が同じものは data の中身で上書きし、無ければ足す。"""
+
+    @abc.abstractmethod
+    async def purge_all(self):
+        ...
+
+
+class KitBackend(abc.ABC):
+    """キット。1件は {"kit": {"name", ...}, "version"}。"""
+
+    @abc.abstractmethod
+    async def get(self, name):
+        """{"kit", "version"} を返す。無ければ None。"""
+
+    @abc.abstractmethod
+    async def get_all(self):
+        """[{"kit"}] を返す。"""
+
+    @abc.abstractmethod
+    async def exists(self, name):
+        ...
+
+    @abc.abstractmethod
+    async def create(self, kit_data):
+        """version 1 で作る。"""
+
+    @abc.abstractmethod
+    async def update(self, kit_data):
+        """置き換えて version を1つ上げる。"""
+
+    @abc.abstractmethod
+    async def store_default(self, data):
+        """kit.name が同じものは data の中身で上書きし、無ければ足す。"""
+
+    @abc.abstractmethod
+    async def purge_all(self):
+        ...
+
+
+class TemplateBackend(abc.ABC):
+    """卓のコンポーネントが参照するテンプレート（→ store.templates）。中身から決まるIDで引く。
+
+    同じIDの中身は変わらないので、置いたものを書き換えることはない。
+    """
+
+    @abc.abstractmethod
+    async def get_many(self, template_ids):
+        """{テンプレートID: コンポーネント} を返す。無いIDは入れない。"""
+
+    @abc.abstractmethod
+    async def put_many(self, templates):
+        """{テンプレートID: コンポーネント} を置く。既にあるIDはそのまま。"""
+
+    @abc.abstractmethod
+    async def purge_all(self):
+        ...
+
+
+class OplogBackend(abc.ABC):
+    """卓ごとの操作ログ（→ store.oplog）。"""
+
+    @abc.abstractmethod
+    async def next_seq(self, tablename):
+        """卓の seq を1つ進めて返す。同時に呼ばれても同じ番号を2度返さない。"""
+
+    @abc.abstractmethod
+    async def insert(self, tablename, seq, operation):
+        """操作（{"event", "data"} か {"event", "barrier"}）を seq で残す。"""
+
+    @abc.abstractmethod
+    async def counter(self, tablename):
+        """(最後に振った seq, floor) を返す。まだ無ければ (0, 0)。"""
+
+    @abc.abstractmethod
+    async def compact(self, tablename, floor):
+        """floor を上げてから、seq が floor 以下の操作を消す。"""
+
+    @abc.abstractmethod
+    async def operations(self, tablename, after, upto):
+        """after < seq <= upto の操作を seq 順に返す。各操作は {"seq", "event", "data" or "barrier"}。"""
+
+    @abc.abstractmethod
+    async def purge_all(self):
+        ...
+
+    async def ensure_indexes(self):
+        pass
@@ -0,0 +1,219 @@
+import copy
+import datetime
+
+from asobann.store.modification import assign_path, remove_path
+from asobann.store.tables import TableAlreadyExists, TableNotFound
+from .base import Backend, TableBackend, ComponentBackend, KitBackend, TemplateBackend, OplogBackend
+
+# プロセスのメモリにだけ置くバックエンド（ASOBANN_STORAGE=memory）。
+#
+# プロセスが終われば消える。ハンドラと配信の速さをMongo抜きで測るときや、
+# 1プロセスで済む小さな自前の環境のためのもの。複数インスタンスでは使えない
+# （インスタンスごとに別の卓になる）。
+#
+# 受け取ったもの・返すものはコピーする。呼び出し側は戻り値を書き換えてから
+# store() することがあり（set player name）、共有するとDBを通らずに変わってしまう。
+# Mongoのバックエンドが読むたびに新しい dict を返すのと同じにする。
+
+
+class MemoryBackend(Backend):
+    def __init__(self):
+        self.tables = MemoryTables()
+        self.components = MemoryComponents()
+        self.kits = MemoryKits()
+        self.templates = MemoryTemplates()
+        self.oplog = MemoryOplog()
+
+
+_COMPONENTS_PATH = 'table.components.'
+
+
+class MemoryTables(TableBackend):
+    def __init__(self):
+        # tablename -> {"tablename", "table": {..., "components": {...}}}
+        self.documents = {}
+        # tablename -> {"created_at", "updated_at"}
+        self.metas = {}
+
+    async def load(self, tablename):
+        document = self.documents.get(tablename)
+        return copy.deepcopy(document) if document is not None else None
+
+    async def create(self, tablename, table):
+        if tablename in self.documents:
+            raise TableAlreadyExists(tablename)
+        self.documents[tablename] = {"tablename": tablename, "table": copy.deepcopy(table)}
+        self.metas[tablename] = {"created_at": datetime.datetime.now()}
+
+    async def replace(self, tablename, table, upsert):
+        if tablename not in self.documents and not upsert:
+            return
+        table = copy.deepcopy(table)
+        table.setdefault("components", {})
+        self.documents[tablename] = {"tablename": tablename, "table": table}
+
+    async def touch(self, tablename):
+        if tablename in self.metas:
+            self.metas[tablename]["updated_at"] = datetime.datetime.now()
+
+    def _document(self, tablename):
+        document = self.documents.get(tablename)
+        if document is None:
+            raise TableNotFound(tablename)
+        return document
+
+    async def apply(self, tablename, pending):
+        document = self._document(tablename)
+        components = document["table"].setdefault("components", {})
+        for path in pending.unset_fields:
+            remove_path(document, path)
+        for path, value in pending.set_fields.items():
+            if path.startswith(_COMPONENTS_PATH):
+                component_id, _, key = path[len(_COMPONENTS_PATH):].partition('.')
+                if key and component_id not in components:
+                    continue
+            assign_path(document, path, copy.deepcopy(value))
+
+    async def add_kit(self, tablename, kit_data, components):
+        table = self._document(tablename)["table"]
+        table.setdefault("kits", []).append(copy.deepcopy(kit_data))
+        table.setdefault("components", {}).update(copy.deepcopy(components))
+
+    async def add_component(self, tablename, component_id, component):
+        table = self._document(tablename)["table"]
+        table.setdefault("components", {})[component_id] = copy.deepcopy(component)
+
+    async def rewrite_components(self, rewrite):
+        count = 0
+        for document in self.documents.values():
+            components = document["table"].get("components", {})
+            for component_id, component in components.items():
+                rewritten = rewrite(component)
+                if rewritten is not None:
+                    components[component_id] = copy.deepcopy(rewritten)
+                    count += 1
+        return count
+
+    async def purge_all(self):
+        self.documents.clear()
+        self.metas.clear()
+
+
+class MemoryComponents(ComponentBackend):
+    def __init__(self):
+        # component.name -> {"component": {...}}
+        self.components = {}
+
+    async def get(self, name):
+        # Mongoの {"name": name} で引くのと同じく、今の形（{"component"}）の文書には当たらない
+        return None
+
+    async def find_by_names(self, names):
+        return [{"component": copy.deepcopy(self.components[name]["component"])}
+                for name in names if name in self.components]
+
+    async def get_all(self):
+        return [{"component": copy.deepcopy(data["component"])} for data in self.components.values()]
+
+    async def exists(self, name):
+        return name in self.components
+
+    async def create(self, data):
+        self.components[data["component"]["name"]] = copy.deepcopy(data)
+
+    async def update(self, data):
+        if data["component"]["name"] in self.components:
+            self.components[data["component"]["name"]] = copy.deepcopy(data)
+
+    async def store_default(self, data):
+        for c in data:
+            self.components.setdefault(c["component"]["name"], {}).update(copy.deepcopy(c))
+
+    async def purge_all(self):
+        self.components.clear()
+
+
+class MemoryKits(KitBackend):
+    def __init__(self):
+        # kit.name -> {"kit": {...}, "version"}
+        self.kits = {}
+
+    async def get(self, name):
+        data = self.kits.get(name)
+        return copy.deepcopy(data) if data is not None else None
+
+    async def get_all(self):
+        return [{"kit": copy.deepcopy(data["kit"])} for data in self.kits.values()]
+
+    async def exists(self, name):
+        return name in self.kits
+
+    async def create(self, kit_data):
+        self.kits[kit_data["kit"]["name"]] = {"kit": copy.deepcopy(kit_data["kit"]), "version": 1}
+
+    async def update(self, kit_data):
+        current = self.kits[kit_data["kit"]["name"]]
+        self.kits[kit_data["kit"]["name"]] = {"kit": copy.deepcopy(kit_data["kit"]),
+                                              "version": current["version"] + 1}
+
+    async def store_default(self, data):
+        for c in data:
+            self.kits.setdefault(c["kit"]["name"], {}).update(copy.deepcopy(c))
+
+    async def purge_all(self):
+        self.kits.clear()
+
+
+class MemoryTemplates(TemplateBackend):
+    def __init__(self):
+        # テンプレートID -> コンポーネント
+        self.templates = {}
+
+    async def get_many(self, template_ids):
+        return {template_id: copy.deepcopy(self.templates[template_id])
+                for template_id in template_ids if template_id in self.templates}
+
+    async def put_many(self, templates):
+        for template_id, component in templates.items():
+            self.templates.setdefault(template_id, copy.deepcopy(component))
+
+    async def purge_all(self):
+        self.templates.clear()
+
+
+class MemoryOplog(OplogBackend):
+    def __init__(self):
+        # tablename -> {"seq", "floor"}
+        self.counters = {}
+        # tablename -> {seq: 操作}
+        self.ops = {}
+
+    async def next_seq(self, tablename):
+        # await を挟まないので、同時に呼ばれても番号は重ならない
+        counter = self.counters.setdefault(tablename, {"seq": 0, "floor": 0})
+        counter["seq"] += 1
+        return counter["seq"]
+
+    async def insert(self, tablename, seq, operation):
+        self.ops.setdefault(tablename, {})[seq] = copy.deepcopy(operation)
+
+    async def counter(self, tablename):
+        counter = self.counters.get(tablename)
+        if not counter:
+            return 0, 0
+        return counter["seq"], counter["floor"]
+
+    async def compact(self, tablename, floor):
+        counter = self.counters.setdefault(tablename, {"seq": 0, "floor": 0})
+        counter["floor"] = max(counter["floor"], floor)
+        ops = self.ops.get(tablename, {})
+        for seq in [seq for seq in ops if seq <= floor]:
+            del ops[seq]
+
+    async def operations(self, tablename, after, upto):
+        ops = self.ops.get(tablename, {})
+        return [dict(copy.deepcopy(ops[seq]), seq=seq) for seq in sorted(ops) if after < seq <= upto]
+
+    async def purge_all(self):
+        self.counters.clear()
+        self.ops.clear()
@@ -0,0 +1,387 @@
+import datetime
+
+from pymongo import DeleteOne, ReplaceOne, ReturnDocument, UpdateOne, operations
+from pymongo.errors import DuplicateKeyError
+
+from asobann.store.tables import TableAlreadyExists, TableNotFound
+from .base import Backend, TableBackend, ComponentBackend, KitBackend, TemplateBackend, OplogBackend
+
+
+class MongoBackend(Backend):
+    """MongoDB に置く。既定のバックエンド。"""
+
+    def __init__(self, mongo_db):
+        self.tables = MongoTables(mongo_db)
+        self.components = MongoComponents(mongo_db)
+        self.kits = MongoKits(mongo_db)
+        self.templates = MongoTemplates(mongo_db)
+        self.oplog = MongoOplog(mongo_db)
+
+
+# 読むときは使うフィールドだけを返させる。返ってきたものは全部 dict に decode されるので、
+# コンポーネント数百個の卓だと、使わない _id（ObjectId）や tablename の分だけでも数百個ずつ作って捨てることになる。
+_COMPONENT_FIELDS = {"_id": False, "componentId": True, "component": True}
+
+
+def _component_documents(tablename, components):
+    return [{"tablename": tablename, "componentId": component_id, "component": component}
+            for component_id, component in components.items()]
+
+
+def _header_of(table):
+    return {key: value for key, value in table.items() if key != "components"}
+
+
+def _ensure_matched(result, tablename):
+    """卓が見つからなかった書き込みを、黙って捨てずに落とす。
+
+    卓全体を読んでから書き戻していた頃は、読んだ時点で存在しない卓が None として
+    返り、その後のアクセスで必ず落ちていた。部分更新はフィルタが一致しなくても
+    update_one が成功扱いで返るので、放っておくと「クライアントには配信されたのに
+    DBには入っていない」状態を無言で作る（リロードで消える）。
+    """
+    if result.matched_count == 0:
+        raise TableNotFound(tablename)
+
+
+_COMPONENTS_PATH = 'table.components.'
+
+
+def _plan_pending(tablename, pending):
+    """`table.components.<id>...` のパスをコンポーネント文書ごとの操作に、残りをヘッダへの update に分ける。
+
+    PendingModification のパス同士は親子関係に無いので、1つのコンポーネントに
+    丸ごとの置き換え（削除）と中のキーの書き換えが同時に来ることは無い。
+    戻り値は (ヘッダへの update, コンポーネント文書への操作のリスト, upsert を含むか)。
+    """
+    header = {}
+    replaced = {}
+    removed = []
+    updates = {}
+    for operator, fields in (('$set', pending.set_fields), ('$unset', pending.unset_fields)):
+        for path, value in fields.items():
+            if not path.startswith(_COMPONENTS_PATH):
+                header.setdefault(operator, {})[path] = value
+                continue
+            component_id, _, key = path[len(_COMPONENTS_PATH):].partition('.')
+            if key:
+                updates.setdefault(component_id, {}).setdefault(operator, {})[f'component.{key}'] = value
+            elif operator == '$set':
+                replaced[component_id] = value
+            else:
+                removed.append(component_id)
+
+    operations = [ReplaceOne({"tablename": tablename, "componentId": d["componentId"]}, d, upsert=True)
+                  for d in _component_documents(tablename, replaced)]
+    # 置き換え以外は upsert しない。削除済みのコンポーネントの一部のキーだけを復活させない。
+    operations += [UpdateOne({"tablename": tablename, "componentId": component_id}, update)
+                   for component_id, update in updates.items()]
+    operations += [DeleteOne({"tablename": tablename, "componentId": component_id})
+                   for component_id in removed]
+    return header, operations, bool(replaced)
+
+
+class MongoTables(TableBackend):
+    """卓は3つのコレクションに置く。
+
+    - tables: {tablename, table} — コンポーネント以外（kits / players など）のヘッダ
+    - table_components: {tablename, componentId, component} — コンポーネントは1つずつ別文書
+    - table_metas: {tablename, created_at, updated_at}
+    """
+
+    def __init__(self, mongo_db):
+        self.tables = mongo_db.tables
+        self.table_metas = mongo_db.table_metas
+        self.table_components = mongo_db.table_components
+
+    async def load(self, tablename):
+        """ヘッダとコンポーネント文書を読み、分割前と同じ {"tablename", "table": {...}} の形に組み立てる。"""
+        document = await self.tables.find_one({"tablename": tablename}, projection={"_id": False})
+        if document is None:
+            return None
+        table = document["table"]
+        if "components" in table:
+            # 分割前の形式で残っている卓。ここで移してから、移した先を読む。
+            await self._split_embedded_components(tablename, table.pop("components"))
+        table["components"] = {
+            c["componentId"]: c["component"]
+            async for c in self.table_components.find({"tablename": tablename}, projection=_COMPONENT_FIELDS)}
+        return document
+
+    async def _split_embedded_components(self, tablename, components):
+        """分割前の卓（table.components に全コンポーネントを埋め込んだ文書）を今の形式へ移す。
+
+        コンポーネント文書は $setOnInsert で作る。同じ卓の移行が並行して走ったり、
+        途中で落ちてやり直したりしても、既に移っていて更新されたかもしれない
+        コンポーネントを古い値で上書きしない。ヘッダから components を外すのは最後。
+        """
+        if components:
+            await self.table_components.bulk_write([
+                UpdateOne({"tablename": tablename, "componentId": component_id},
+                          {"$setOnInsert": {"component": component}},
+                          upsert=True)
+                for component_id, component in components.items()], ordered=False)
+        await self.tables.update_one({"tablename": tablename, "table.components": {"$exists": True}},
+                                     {"$unset": {"table.components": ""}})
+
+    async def split_embedded_components(self):
+        """分割前の形式で残っている卓をすべて移す。移した卓の数を返す。"""
+        count = 0
+        async for document in self.tables.find({"table.components": {"$exists": True}},
+                                               projection={"tablename": True, "table.components": True}):
+            await self._split_embedded_components(document["tablename"], document["table"]["components"])
+            count += 1
+        return count
+
+    async def _ensure_table_exists(self, tablename):
+        document = await self.tables.find_one({"tablename": tablename}, projection={"_id": True})
+        if document is None:
+            raise TableNotFound(tablename)
+
+    async def create(self, tablename, table):
+        try:
+            await self.tables.insert_one({"tablename": tablename, "table": _header_of(table)})
+        except DuplicateKeyError:
+            # tablename の unique 索引（ensure_indexes）で弾かれた。別のインスタンスが先に作った
+            raise TableAlreadyExists(tablename)
+        documents = _component_documents(tablename, table["components"])
+        if documents:
+            await self.table_components.insert_many(documents)
+        await self.table_metas.insert_one({"tablename": tablename, "created_at": datetime.datetime.now()})
+
+    async def replace(self, tablename, table, upsert):
+        """コンポーネントは消してから入れ直すのではなく、1つずつ置き換えてから残りを消す。
+        入れ直しの間に読んだ人へ空の卓が見えないように。
+        """
+        result = await self.tables.update_one(
+            {"tablename": tablename},
+            {"$set": {"table": _header_of(table)}},
+            upsert=upsert)
+        if result.matched_count == 0 and result.upserted_id is None:
+            # 無い卓の update_table()。ヘッダが無いところへコンポーネントだけ作らない。
+            return
+        components = table.get("components", {})
+        operations = [ReplaceOne({"tablename": tablename, "componentId": d["componentId"]}, d, upsert=True)
+                      for d in _component_documents(tablename, components)]
+        if operations:
+            await self.table_components.bulk_write(operations, ordered=False)
+        await self.table_components.delete_many({"tablename": tablename, "componentId": {"$nin": list(components)}})
+
+    async def touch(self, tablename):
+        await self.table_metas.update_one(
+            {"tablename": tablename},
+            {"$set": {"updated_at": datetime.datetime.now()}})
+
+    async def apply(self, tablename, pending):
+        header, operations, upserts = _plan_pending(tablename, pending)
+        if header:
+            result = await self.tables.update_one({"tablename": tablename}, header)
+            _ensure_matched(result, tablename)
+        elif upserts:
+            # 置き換えは無い卓にもコンポーネント文書を作ってしまうので、書く前に確かめる。
+            await self._ensure_table_exists(tablename)
+        if not operations:
+            return
+        result = await self.table_components.bulk_write(operations, ordered=False)
+        if header or upserts or result.matched_count + result.deleted_count > 0:
+            return
+        # どのコンポーネントにも当たらなかった。卓が無いのか、まだ分割前の形式なのか、
+        # 消されたコンポーネントへの更新なだけなのかを、ここで初めて読んで見分ける。
+        document = await self.tables.find_one({"tablename": tablename}, projection={"table.components": True})
+        if document is None:
+            raise TableNotFound(tablename)
+        if "components" in document.get("table", {}):
+            await self._split_embedded_components(tablename, document["table"]["components"])
+            await self.table_components.bulk_write(operations, ordered=False)
+
+    async def add_kit(self, tablename, kit_data, components):
+        result = await self.tables.update_one({"tablename": tablename}, {"$push": {"table.kits": kit_data}})
+        _ensure_matched(result, tablename)
+        if not components:
+            return
+        await self.table_components.bulk_write(
+            [ReplaceOne({"tablename": tablename, "componentId": d["componentId"]}, d, upsert=True)
+             for d in _component_documents(tablename, components)], ordered=False)
+
+    async def add_component(self, tablename, component_id, component):
+        # 無い卓にコンポーネント文書だけができないよう、書く前に確かめる。
+        await self._ensure_table_exists(tablename)
+        await self.table_components.replace_one(
+            {"tablename": tablename, "componentId": component_id},
+            {"tablename": tablename, "componentId": component_id, "component": component},
+            upsert=True)
+
+    async def rewrite_components(self, rewrite, batch_size=1000):
+        count = 0
+        operations = []
+        async for document in self.table_components.find({}, projection={"component": True}):
+            rewritten = rewrite(document["component"])
+            if rewritten is None:
+                continue
+            # 読んだときと同じ中身のときだけ置き換える。間に部分更新が入っていたら当たらない
+            operations.append(UpdateOne({"_id": document["_id"], "component": document["component"]},
+                                        {"$set": {"component": rewritten}}))
+            if len(operations) >= batch_size:
+                count += (await self.table_components.bulk_write(operations, ordered=False)).modified_count
+                operations = []
+        if operations:
+            count += (await self.table_components.bulk_write(operations, ordered=False)).modified_count
+        return count
+
+    async def purge_all(self):
+        # table_metas も一緒に消す。tables だけ消していたころは、同じ卓名で create() する
+        # たびに table_metas 側へ insert_one が積み上がり、tablename が重複していった。
+        await self.tables.delete_many({})
+        await self.table_components.delete_many({})
+        await self.table_metas.delete_many({})
+
+    async def ensure_indexes(self):
+        """tablenameで引くための索引を用意する。
+
+        この2コレクションへのアクセスはすべて {"tablename": ...} で、_id 以外の索引が
+        無いとコレクションスキャンになる。update_components() だけでもプレイ中に
+        1クライアントあたり約13回/秒（読み1回+書き1回）走るため、卓が増えるほど効く。
+
+        tablenameは実質的な主キーなのでuniqueにする。create_index は同じ定義に対しては
+        冪等だが、**同名で定義が違う索引（uniqueの有無など）が既にあると
+        IndexKeySpecsConflict で失敗する**。起動時に呼んでいるので、その場合タスクが
+        上がらない。索引の定義を変えるときは、先に既存の索引を落とす手順が要る。
+        """
+        await self.tables.create_index('tablename', unique=True)
+        await self.table_metas.create_index('tablename', unique=True)
+        # 卓1つ分の読み込み（tablename だけで引く）にも、この索引の先頭が効く。
+        await self.table_components.create_index([('tablename', 1), ('componentId', 1)], unique=True)
+
+
+class MongoComponents(ComponentBackend):
+    def __init__(self, mongo_db):
+        self.components = mongo_db.components
+
+    async def get(self, name):
+        data = await self.components.find_one({"name": name})
+        if not data:
+            return None
+        return data["table"]
+
+    async def find_by_names(self, names):
+        data = self.components.find({"component.name": {"$in": names}}, projection={"_id": False, "component": True})
+        return [{"component": d["component"]} async for d in data]
+
+    async def get_all(self):
+        data = self.components.find(projection={"_id": False, "component": True})
+        return [{"component": d["component"]} async for d in data]
+
+    async def exists(self, name):
+        return await self.components.count_documents({"component.name": name}) > 0
+
+    async def create(self, data):
+        await self.components.insert_one(data)
+
+    async def update(self, data):
+        await self.components.find_one_and_replace({'component.name': data['component']['name']}, data)
+
+    async def store_default(self, data):
+        await self.components.bulk_write(
+            [operations.UpdateOne({"component.name": c["component"]["name"]}, {"$set": c}, upsert=True)
+             for c in data])
+
+    async def purge_all(self):
+        await self.components.delete_many({})
+
+
+class MongoKits(KitBackend):
+    def __init__(self, mongo_db):
+        self.kits = mongo_db.kits
+
+    async def get(self, name):
+        return await self.kits.find_one({"kit.name": name}, projection={"_id": False})
+
+    async def get_all(self):
+        data = self.kits.find(projection={"_id": False, "kit": True})
+        return [{"kit": d["kit"]} async for d in data]
+
+    async def exists(self, name):
+        return await self.kits.count_documents({"kit.name": name}) > 0
+
+    async def create(self, kit_data):
+        await self.kits.insert_one({'kit': kit_data["kit"], 'version': 1})
+
+    async def update(self, kit_data):
+        current = await self.kits.find_one({'kit.name': kit_data['kit']['name']}, projection={'version': True})
+        current_version = current['version']
+        await self.kits.find_one_and_replace({'kit.name': kit_data['kit']['name']},
+                                             {'kit': kit_data["kit"], 'version': current_version + 1})
+
+    async def store_default(self, data):
+        await self.kits.bulk_write(
+            [operations.UpdateOne({"kit.name": c["kit"]["name"]}, {"$set": c}, upsert=True) for c in data])
+
+    async def purge_all(self):
+        await self.kits.delete_many({})
+
+
+class MongoTemplates(TemplateBackend):
+    """component_templates に {_id: テンプレートID, component} で置く。"""
+
+    def __init__(self, mongo_db):
+        self.templates = mongo_db.component_templates
+
+    async def get_many(self, template_ids):
+        return {d["_id"]: d["component"]
+                async for d in self.templates.find({"_id": {"$in": list(template_ids)}})}
+
+    async def put_many(self, templates):
+        if not templates:
+            return
+        # 中身はIDで決まるので、他のインスタンスが先に置いていても同じもの
+        await self.templates.bulk_write(
+            [UpdateOne({"_id": template_id}, {"$setOnInsert": {"component": component}}, upsert=True)
+             for template_id, component in templates.items()], ordered=False)
+
+    async def purge_all(self):
+        await self.templates.delete_many({})
+
+
+class MongoOplog(OplogBackend):
+    """table_ops: {tablename, seq, event, data}、table_op_counters: {tablename, seq, floor}。"""
+
+    def __init__(self, mongo_db):
+        self.ops = mongo_db.table_ops
+        self.counters = mongo_db.table_op_counters
+
+    async def ensure_indexes(self):
+        await self.ops.create_index([('tablename', 1), ('seq', 1)], unique=True)
+        await self.counters.create_index('tablename', unique=True)
+
+    async def next_seq(self, tablename):
+        counter = await self.counters.find_one_and_update(
+            {"tablename": tablename},
+            {"$inc": {"seq": 1}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER)
+        return counter["seq"]
+
+    async def insert(self, tablename, seq, operation):
+        await self.ops.insert_one(
+            {"tablename": tablename, "seq": seq, "created_at": datetime.datetime.now(), **operation})
+
+    async def counter(self, tablename):
+        counter = await self.counters.find_one({"tablename": tablename}, projection={"_id": False, "seq": True, "floor": True})
+        if not counter:
+            return 0, 0
+        return counter["seq"], counter.get("floor", 0)
+
+    async def compact(self, tablename, floor):
+        # 先に floor を上げる。消してから上げると、その間に since() した人が
+        # 歯抜けのログを「全部そろっている」と思って受け取ってしまう。
+        await self.counters.update_one({"tablename": tablename}, {"$max": {"floor": floor}})
+        await self.ops.delete_many({"tablename": tablename, "seq": {"$lte": floor}})
+
+    async def operations(self, tablename, after, upto):
+        return [op async for op in self.ops.find(
+            {"tablename": tablename, "seq": {"$gt": after, "$lte": upto}},
+            projection={"_id": False, "tablename": False, "created_at": False}).sort("seq", 1)]
+
+    async def purge_all(self):
+        await self.ops.delete_many({})
+        await self.counters.delete_many({})
@@ -0,0 +1,608 @@
+import asyncio
+import concurrent.futures
+import datetime
+import json
+import logging
+import sqlite3
+import threading
+import weakref
+
+from asobann.store.modification import assign_path, remove_path
+from asobann.store.tables import TableAlreadyExists, TableNotFound
+from .base import Backend, TableBackend, ComponentBackend, KitBackend, TemplateBackend, OplogBackend
+
+logger = logging.getLogger(__name__)
+
+# 1つのファイルに置くバックエンド（ASOBANN_STORAGE=sqlite）。1インスタンス構成用。
+#
+# Mongoへのネットワークの往復が無く、別にDBのコンテナを動かす必要も無い。
+# コンポーネントは卓ごと・componentIdごとに1行（table_components）に置き、部分更新は
+# その行だけを読み書きする（Mongoのバックエンドがコンポーネント文書ごとに update するのと同じ）。
+#
+# sqlite3 の呼び出しはブロックするので、専用のスレッド1本で順に実行する。接続もそのスレッドの
+# ものだけを使うので、書いた直後に読めば（コミット前でも）書いたものが見える。
+# WALモード・synchronous=NORMAL で、コミットは commit_interval 秒ごとにまとめて行う。
+# 呼び出し側はコミットを待たないので、プロセスが落ちると最大 commit_interval 秒分の
+# 書き込みを失う（store.tables の卓キャッシュと同じ種類の割り切り）。0 なら書くたびにコミットする。
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS tables (
+    tablename TEXT PRIMARY KEY,
+    header TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS table_components (
+    tablename TEXT NOT NULL,
+    component_id TEXT NOT NULL,
+    component TEXT NOT NULL,
+    PRIMARY KEY (tablename, component_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS table_metas (
+    tablename TEXT PRIMARY KEY,
+    created_at TEXT,
+    updated_at TEXT
+);
+CREATE TABLE IF NOT EXISTS components (
+    name TEXT PRIMARY KEY,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS kits (
+    name TEXT PRIMARY KEY,
+    kit TEXT NOT NULL,
+    version INTEGER
+);
+CREATE TABLE IF NOT EXISTS component_templates (
+    template_id TEXT PRIMARY KEY,
+    component TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS table_ops (
+    tablename TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    operation TEXT NOT NULL,
+    created_at TEXT,
+    PRIMARY KEY (tablename, seq)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS table_op_counters (
+    tablename TEXT PRIMARY KEY,
+    seq INTEGER NOT NULL,
+    floor INTEGER NOT NULL
+);
+'''
+
+_COMPONENTS_PATH = 'table.components.'
+_TABLE_PATH = 'table.'
+
+
+def _dumps(value):
+    return json.dumps(value, separators=(',', ':'), ensure_ascii=False)
+
+
+def _now():
+    return datetime.datetime.now().isoformat()
+
+
+def _commit_from_timer(executor, commit_ref):
+    # タイマーのスレッドから呼ばれる。コミットそのものは接続のスレッドで行う
+    commit = commit_ref()
+    if commit is None:
+        return
+    try:
+        executor.submit(commit)
+    except RuntimeError:
+        # close() で止めた後。そちらがコミットしている
+        pass
+
+
+def _finish(path, connection):
+    """書きかけのトランザクションをコミットして閉じる。
+
+    close() から呼ぶほか、close() されずに捨てられたとき（shutdown() せずにイベントループが
+    止まったなど）とプロセスの終了時にも weakref.finalize から呼ばれる。コミットしないまま
+    残すと書き込みのロックを持ち続け、同じファイルを開いた他の接続が書けなくなる。
+    """
+    try:
+        if connection.in_transaction:
+            connection.execute('COMMIT')
+    except sqlite3.Error as e:
+        logger.error(f'failed to commit to {path}: {e!r}')
+    connection.close()
+
+
+class _Database:
+    """sqlite3 の接続と、それを使う専用のスレッド。
+
+    トランザクションは書き込みのときにだけ始め、commit_interval 秒後にコミットする。その間だけ
+    書き込みのロックを持つ。コミットのタイマーはイベントループではなくスレッドのものなので、
+    書いたループが止まってもコミットされる。
+    """
+
+    def __init__(self, path, commit_interval):
+        self.path = path
+        self.commit_interval = commit_interval
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='asobann-sqlite')
+        self._connection = None
+        self._finalizer = None
+        # 以下は接続のスレッドからだけ触る
+        self._commit_timer = None
+        self.commits = 0
+
+    def _open(self):
+        # 自分で BEGIN / COMMIT する（isolation_level=None）。このスレッドからしか使わない
+        connection = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        connection.executescript(_SCHEMA)
+        return connection
+
+    async def run(self, func, *args):
+        """func(接続, *args) を専用のスレッドで実行する（読み込み）。"""
+        return await asyncio.get_running_loop().run_in_executor(self._executor, self._call, func, *args)
+
+    def _call(self, func, *args):
+        # 接続は最初に使うときに開く。開くのも専用のスレッドなので、同時に呼ばれても1本しか開かない
+        if self._connection is None:
+            self._connection = self._open()
+            self._finalizer = weakref.finalize(self, _finish, self.path, self._connection)
+        return func(self._connection, *args)
+
+    async def write(self, func, *args):
+        """func(接続, *args) を実行し、コミットを予約する。
+
+        func が例外で終わったら、その func の書いたものだけを取り消す（同じトランザクションに
+        入っている他の書き込みは残す）。
+        """
+        return await self.run(self._write, func, *args)
+
+    def _write(self, connection, func, *args):
+        if not connection.in_transaction:
+            # 始めに書き込みのロックを取る。読んでから書くときに、他の接続のコミットで失敗しないように
+            connection.execute('BEGIN IMMEDIATE')
+        try:
+            return self._in_savepoint(connection, func, *args)
+        finally:
+            self._schedule_commit()
+
+    @staticmethod
+    def _in_savepoint(connection, func, *args):
+        connection.execute('SAVEPOINT write')
+        try:
+            result = func(connection, *args)
+        except BaseException:
+            connection.execute('ROLLBACK TO write')
+            connection.execute('RELEASE write')
+            raise
+        connection.execute('RELEASE write')
+        return result
+
+    def _schedule_commit(self):
+        if self.commit_interval <= 0:
+            self._commit()
+        elif self._commit_timer is None:
+            self._commit_timer = threading.Timer(
+                self.commit_interval, _commit_from_timer, (self._executor, weakref.WeakMethod(self._commit)))
+            self._commit_timer.daemon = True
+            self._commit_timer.start()
+
+    def _commit(self):
+        if self._commit_timer is not None:
+            self._commit_timer.cancel()
+            self._commit_timer = None
+        if self._connection is None or not self._connection.in_transaction:
+            return
+        try:
+            self._connection.execute('COMMIT')
+            self.commits += 1
+        except sqlite3.Error as e:
+            logger.error(f'failed to commit to {self.path}: {e!r}')
+            self._connection.execute('ROLLBACK')
+
+    async def close(self):
+        await asyncio.get_running_loop().run_in_executor(self._executor, self._close)
+        self._executor.shutdown(wait=True)
+
+    def _close(self):
+        self._commit()
+        if self._finalizer is not None:
+            self._connection = None
+            self._finalizer()
+
+
+class SqliteBackend(Backend):
+    def __init__(self, path, commit_interval=0.05):
+        self.database = _Database(path, commit_interval)
+        self.tables = SqliteTables(self.database)
+        self.components = SqliteComponents(self.database)
+        self.kits = SqliteKits(self.database)
+        self.templates = SqliteTemplates(self.database)
+        self.oplog = SqliteOplog(self.database)
+
+    async def close(self):
+        await self.database.close()
+
+
+def _header_of(table):
+    return {key: value for key, value in table.items() if key != "components"}
+
+
+def _exists(connection, tablename):
+    row = connection.execute('SELECT 1 FROM tables WHERE tablename = ?', (tablename,)).fetchone()
+    return row is not None
+
+
+def _ensure_exists(connection, tablename):
+    if not _exists(connection, tablename):
+        raise TableNotFound(tablename)
+
+
+def _encode_components(components):
+    """JSONにするのはイベントループのスレッドで行う。渡された dict を、呼び出し側がこの後に
+    書き換えることがある（卓キャッシュ）ので、別スレッドから読まない。"""
+    return [(component_id, _dumps(component)) for component_id, component in components.items()]
+
+
+def _put_components(connection, tablename, encoded_components):
+    connection.executemany(
+        'INSERT OR REPLACE INTO table_components (tablename, component_id, component) VALUES (?, ?, ?)',
+        [(tablename, component_id, component) for component_id, component in encoded_components])
+
+
+class SqliteTables(TableBackend):
+    def __init__(self, database):
+        self.database = database
+
+    async def load(self, tablename):
+        return await self.database.run(self._load, tablename)
+
+    @staticmethod
+    def _load(connection, tablename):
+        row = connection.execute('SELECT header FROM tables WHERE tablename = ?', (tablename,)).fetchone()
+        if row is None:
+            return None
+        table = json.loads(row[0])
+        table["components"] = {
+            component_id: json.loads(component)
+            for component_id, component in connection.execute(
+                'SELECT component_id, component FROM table_components WHERE tablename = ?', (tablename,))}
+        return {"tablename": tablename, "table": table}
+
+    async def create(self, tablename, table):
+        await self.database.write(self._create, tablename, _dumps(_header_of(table)),
+                                  _encode_components(table["components"]))
+
+    @staticmethod
+    def _create(connection, tablename, header, components):
+        if _exists(connection, tablename):
+            raise TableAlreadyExists(tablename)
+        connection.execute('INSERT INTO tables (tablename, header) VALUES (?, ?)', (tablename, header))
+        _put_components(connection, tablename, components)
+        connection.execute('INSERT OR REPLACE INTO table_metas (tablename, created_at) VALUES (?, ?)',
+                           (tablename, _now()))
+
+    async def replace(self, tablename, table, upsert):
+        await self.database.write(self._replace, tablename, _dumps(_header_of(table)),
+                                  _encode_components(table.get("components", {})), upsert)
+
+    @staticmethod
+    def _replace(connection, tablename, header, components, upsert):
+        # 1つのトランザクションの中なので、消してから入れ直しても途中の空の卓は誰にも見えない
+        if not _exists(connection, tablename):
+            if not upsert:
+                return
+            connection.execute('INSERT INTO tables (tablename, header) VALUES (?, ?)', (tablename, header))
+        else:
+            connection.execute('UPDATE tables SET header = ? WHERE tablename = ?', (header, tablename))
+        connection.execute('DELETE FROM table_components WHERE tablename = ?', (tablename,))
+        _put_components(connection, tablename, components)
+
+    async def touch(self, tablename):
+        await self.database.write(self._touch, tablename)
+
+    @staticmethod
+    def _touch(connection, tablename):
+        connection.execute('UPDATE table_metas SET updated_at = ? WHERE tablename = ?', (_now(), tablename))
+
+    async def apply(self, tablename, pending):
+        await self.database.write(self._apply, tablename, _dumps(pending.set_fields), list(pending.unset_fields))
+
+    @staticmethod
+    def _apply(connection, tablename, set_fields, unset_fields):
+        """パスをヘッダとコンポーネント（行）ごとに分け、触る行だけを読んで書き戻す。"""
+        set_fields = json.loads(set_fields)
+        unset_fields = dict.fromkeys(unset_fields, '')
+        header_row = connection.execute('SELECT header FROM tables WHERE tablename = ?', (tablename,)).fetchone()
+        if header_row is None:
+            raise TableNotFound(tablename)
+        header = None
+        # componentId -> [(set か unset, 行の中のパス or '', 値)]
+        changes = {}
+        for operator, fields in (('unset', unset_fields), ('set', set_fields)):
+            for path, value in fields.items():
+                if path.startswith(_COMPONENTS_PATH):
+                    component_id, _, key = path[len(_COMPONENTS_PATH):].partition('.')
+                    changes.setdefault(component_id, []).append((operator, key, value))
+                    continue
+                if header is None:
+                    header = json.loads(header_row[0])
+                subpath = path[len(_TABLE_PATH):]
+                if operator == 'set':
+                    assign_path(header, subpath, value)
+                else:
+                    remove_path(header, subpath)
+        if header is not None:
+            connection.execute('UPDATE tables SET header = ? WHERE tablename = ?', (_dumps(header), tablename))
+
+        for component_id, component_changes in changes.items():
+            row = connection.execute(
+                'SELECT component FROM table_components WHERE tablename = ? AND component_id = ?',
+                (tablename, component_id)).fetchone()
+            component = json.loads(row[0]) if row else None
+            for operator, key, value in component_changes:
+                if not key:
+                    component = value if operator == 'set' else None
+                elif component is None:
+                    # 消されたコンポーネントの一部のキーだけを復活させない
+                    continue
+                elif operator == 'set':
+                    assign_path(component, key, value)
+                else:
+                    remove_path(component, key)
+            if component is None:
+                connection.execute('DELETE FROM table_components WHERE tablename = ? AND component_id = ?',
+                                   (tablename, component_id))
+            else:
+                connection.execute(
+                    'INSERT OR REPLACE INTO table_components (tablename, component_id, component) VALUES (?, ?, ?)',
+                    (tablename, component_id, _dumps(component)))
+
+    async def add_kit(self, tablename, kit_data, components):
+        await self.database.write(self._add_kit, tablename, _dumps(kit_data), _encode_components(components))
+
+    @staticmethod
+    def _add_kit(connection, tablename, kit_data, components):
+        row = connection.execute('SELECT header FROM tables WHERE tablename = ?', (tablename,)).fetchone()
+        if row is None:
+            raise TableNotFound(tablename)
+        header = json.loads(row[0])
+        header.setdefault("kits", []).append(json.loads(kit_data))
+        connection.execute('UPDATE tables SET header = ? WHERE tablename = ?', (_dumps(header), tablename))
+        _put_components(connection, tablename, components)
+
+    async def add_component(self, tablename, component_id, component):
+        await self.database.write(self._add_component, tablename, _encode_components({component_id: component}))
+
+    @staticmethod
+    def _add_component(connection, tablename, components):
+        _ensure_exists(connection, tablename)
+        _put_components(connection, tablename, components)
+
+    async def rewrite_components(self, rewrite):
+        rows = await self.database.run(self._all_components)
+        rewrites = []
+        for tablename, component_id, stored in rows:
+            rewritten = rewrite(json.loads(stored))
+            if rewritten is not None:
+                rewrites.append((_dumps(rewritten), tablename, component_id, stored))
+        if not rewrites:
+            return 0
+        return await self.database.write(self._rewrite_components, rewrites)
+
+    @staticmethod
+    def _all_components(connection):
+        return connection.execute('SELECT tablename, component_id, component FROM table_components').fetchall()
+
+    @staticmethod
+    def _rewrite_components(connection, rewrites):
+        # 読んだときと同じ中身のときだけ置き換える。間に書き換わっていたら当たらない
+        count = 0
+        for rewrite in rewrites:
+            count += connection.execute(
+                'UPDATE table_components SET component = ? WHERE tablename = ? AND component_id = ? AND component = ?',
+                rewrite).rowcount
+        return count
+
+    async def purge_all(self):
+        await self.database.write(self._purge_all)
+
+    @staticmethod
+    def _purge_all(connection):
+        for name in ('tables', 'table_components', 'table_metas'):
+            connection.execute(f'DELETE FROM {name}')
+
+
+class SqliteComponents(ComponentBackend):
+    def __init__(self, database):
+        self.database = database
+
+    async def get(self, name):
+        # Mongoの {"name": name} で引くのと同じく、今の形（{"component"}）の文書には当たらない
+        return None
+
+    async def find_by_names(self, names):
+        return await self.database.run(self._find_by_names, list(names))
+
+    @staticmethod
+    def _find_by_names(connection, names):
+        if not names:
+            return []
+        placeholders = ','.join('?' * len(names))
+        return [{"component": json.loads(data)["component"]} for (data,) in connection.execute(
+            f'SELECT data FROM components WHERE name IN ({placeholders})', names)]
+
+    async def get_all(self):
+        return await self.database.run(self._get_all)
+
+    @staticmethod
+    def _get_all(connection):
+        return [{"component": json.loads(data)["component"]}
+                for (data,) in connection.execute('SELECT data FROM components')]
+
+    async def exists(self, name):
+        return await self.database.run(self._exists, name)
+
+    @staticmethod
+    def _exists(connection, name):
+        return connection.execute('SELECT 1 FROM components WHERE name = ?', (name,)).fetchone() is not None
+
+    async def create(self, data):
+        await self.database.write(self._put, data["component"]["name"], _dumps(data))
+
+    async def update(self, data):
+        await self.database.write(self._put, data["component"]["name"], _dumps(data))
+
+    @staticmethod
+    def _put(connection, name, data):
+        connection.execute('INSERT OR REPLACE INTO components (name, data) VALUES (?, ?)', (name, data))
+
+    async def store_default(self, data):
+        await self.database.write(self._store_default, _dumps(data))
+
+    @staticmethod
+    def _store_default(connection, data):
+        for c in json.loads(data):
+            name = c["component"]["name"]
+            row = connection.execute('SELECT data FROM components WHERE name = ?', (name,)).fetchone()
+            stored = json.loads(row[0]) if row else {}
+            stored.update(c)
+            SqliteComponents._put(connection, name, _dumps(stored))
+
+    async def purge_all(self):
+        await self.database.write(lambda connection: connection.execute('DELETE FROM components'))
+
+
+class SqliteKits(KitBackend):
+    def __init__(self, database):
+        self.database = database
+
+    async def get(self, name):
+        return await self.database.run(self._get, name)
+
+    @staticmethod
+    def _get(connection, name):
+        row = connection.execute('SELECT kit, version FROM kits WHERE name = ?', (name,)).fetchone()
+        if row is None:
+            return None
+        data = {"kit": json.loads(row[0])}
+        if row[1] is not None:
+            data["version"] = row[1]
+        return data
+
+    async def get_all(self):
+        return await self.database.run(
+            lambda connection: [{"kit": json.loads(kit)} for (kit,) in connection.execute('SELECT kit FROM kits')])
+
+    async def exists(self, name):
+        return await self.database.run(
+            lambda connection: connection.execute('SELECT 1 FROM kits WHERE name = ?', (name,)).fetchone() is not None)
+
+    async def create(self, kit_data):
+        await self.database.write(self._put, kit_data["kit"]["name"], _dumps(kit_data["kit"]), 1)
+
+    async def update(self, kit_data):
+        await self.database.write(self._update, kit_data["kit"]["name"], _dumps(kit_data["kit"]))
+
+    @staticmethod
+    def _update(connection, name, kit):
+        row = connection.execute('SELECT version FROM kits WHERE name = ?', (name,)).fetchone()
+        SqliteKits._put(connection, name, kit, (row[0] or 0) + 1)
+
+    @staticmethod
+    def _put(connection, name, kit, version):
+        connection.execute('INSERT OR REPLACE INTO kits (name, kit, version) VALUES (?, ?, ?)', (name, kit, version))
+
+    async def store_default(self, data):
+        await self.database.write(self._store_default, _dumps(data))
+
+    @staticmethod
+    def _store_default(connection, data):
+        for c in json.loads(data):
+            name = c["kit"]["name"]
+            row = connection.execute('SELECT version FROM kits WHERE name = ?', (name,)).fetchone()
+            SqliteKits._put(connection, name, _dumps(c["kit"]), c.get("version", row[0] if row else None))
+
+    async def purge_all(self):
+        await self.database.write(lambda connection: connection.execute('DELETE FROM kits'))
+
+
+class SqliteTemplates(TemplateBackend):
+    def __init__(self, database):
+        self.database = database
+
+    async def get_many(self, template_ids):
+        return await self.database.run(self._get_many, list(template_ids))
+
+    @staticmethod
+    def _get_many(connection, template_ids):
+        if not template_ids:
+            return {}
+        placeholders = ','.join('?' * len(template_ids))
+        return {template_id: json.loads(component) for template_id, component in connection.execute(
+            f'SELECT template_id, component FROM component_templates WHERE template_id IN ({placeholders})',
+            template_ids)}
+
+    async def put_many(self, templates):
+        if not templates:
+            return
+        await self.database.write(self._put_many, [(template_id, _dumps(component))
+                                                   for template_id, component in templates.items()])
+
+    @staticmethod
+    def _put_many(connection, templates):
+        connection.executemany(
+            'INSERT OR IGNORE INTO component_templates (template_id, component) VALUES (?, ?)', templates)
+
+    async def purge_all(self):
+        await self.database.write(self._purge_all)
+
+    @staticmethod
+    def _purge_all(connection):
+        connection.execute('DELETE FROM component_templates')
+
+
+class SqliteOplog(OplogBackend):
+    def __init__(self, database):
+        self.database = database
+
+    async def next_seq(self, tablename):
+        return await self.database.write(self._next_seq, tablename)
+
+    @staticmethod
+    def _next_seq(connection, tablename):
+        connection.execute('INSERT OR IGNORE INTO table_op_counters (tablename, seq, floor) VALUES (?, 0, 0)',
+                           (tablename,))
+        connection.execute('UPDATE table_op_counters SET seq = seq + 1 WHERE tablename = ?', (tablename,))
+        return connection.execute('SELECT seq FROM table_op_counters WHERE tablename = ?', (tablename,)).fetchone()[0]
+
+    async def insert(self, tablename, seq, operation):
+        operation = _dumps(operation)
+        await self.database.write(
+            lambda connection: connection.execute(
+                'INSERT INTO table_ops (tablename, seq, operation, created_at) VALUES (?, ?, ?, ?)',
+                (tablename, seq, operation, _now())))
+
+    async def counter(self, tablename):
+        row = await self.database.run(
+            lambda connection: connection.execute(
+                'SELECT seq, floor FROM table_op_counters WHERE tablename = ?', (tablename,)).fetchone())
+        return tuple(row) if row else (0, 0)
+
+    async def compact(self, tablename, floor):
+        await self.database.write(self._compact, tablename, floor)
+
+    @staticmethod
+    def _compact(connection, tablename, floor):
+        connection.execute('UPDATE table_op_counters SET floor = MAX(floor, ?) WHERE tablename = ?', (floor, tablename))
+        connection.execute('DELETE FROM table_ops WHERE tablename = ? AND seq <= ?', (tablename, floor))
+
+    async def operations(self, tablename, after, upto):
+        rows = await self.database.run(
+            lambda connection: connection.execute(
+                'SELECT seq, operation FROM table_ops WHERE tablename = ? AND seq > ? AND seq <= ? ORDER BY seq',
+                (tablename, after, upto)).fetchall())
+        return [dict(json.loads(operation), seq=seq) for seq, operation in rows]
+
+    async def purge_all(self):
+        await self.database.write(self._purge_all)
+
+    @staticmethod
+    def _purge_all(connection):
+        connection.execute('DELETE FROM table_ops')
+        connection.execute('DELETE FROM table_op_counters')
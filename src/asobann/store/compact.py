@@ -0,0 +1,171 @@
+import re
+
+from .modification import PendingModification
+
+# コンポーネントを保存するときの詰めた形（compact schema）。
+#
+# 卓のコンポーネントは、どのカードも "faceupImage" / "facedownImage" / "top": "100px" ... と
+# 同じ長いキーと文字列を繰り返している。保存するときだけ次のように詰め、読むときに元の形へ戻す。
+# 詰めた形を知っているのは store（tables / components）とバックエンドの間だけで、
+# ハンドラ・キャッシュ・クライアントは今までどおりの形しか見ない。
+#
+# - キー: _KEYS にあるものは、その位置の番号（"0", "1", ...）にする。無いキーはそのまま
+# - 座標と大きさ（_PIXEL_KEYS）: "100px" は数の 100 にする。"38x" や "05px" のように、戻すと違う文字列に
+#   なるものは文字列のまま置く。元から数やリストだったもの（addNewKit は left / top を数で送る）は、
+#   "px" を付けて戻されないよう [100] のように1要素のリストに包む
+# - 既定値（_DEFAULTS）: 既定値のキーをすべて持つコンポーネントだけ、既定値と同じものを省き、
+#   _VERSION_KEY に版を書く。版のあるものを戻すときに省いたキーを足す。持っていなかったキーを
+#   足してしまわないように、1つでも欠けているものは省かない（版も書かない）
+#
+# 詰める前に保存された卓（キーが元のまま）もそのまま読める。番号のキーと元のキーが両方あれば、
+# 番号の方が新しい（詰めた後の部分更新で書かれた）。
+#
+# _KEYS は**後ろに足すことしかしてはいけない**。並べ替えたり途中に入れたりすると、保存済みの
+# 番号が別のキーを指すようになる。詰め方そのものを変えるときは SCHEMA_VERSION を上げ、
+# expand() が古い版も読めるようにしておく（→ upgrade()）。
+
+SCHEMA_VERSION = 1
+
+_VERSION_KEY = '~'
+
+_KEYS = [
+    # generate_table_json.ATTRS_IN_ORDER（name を除く。name はDBの検索に使うのでそのまま置く）
+    "top", "left", "height", "width", "color", "textColor", "showImage", "text", "text_ja", "textAlign",
+    "image", "faceupImage", "faceupText", "faceupText_ja", "facedownImage", "facedownText", "facedownText_ja",
+    "counterValue",
+    "handArea", "draggable", "flippable", "ownable", "resizable", "rollable", "traylike", "counter",
+    "boxOfComponents", "cardistry", "positionOfBoxContents", "stowage", "onAdd", "craftBoxFunction",
+    "editable", "rotatable",
+    "owner", "faceup", "zIndex",
+    # プレイ中にクライアントが足すもの
+    "componentId", "kitId", "componentsInBox", "onTray", "isStowed", "kitBoxComponentId",
+    "startRoll", "rollFinalValue", "rollDuration",
+]
+_CODES = {key: str(i) for i, key in enumerate(_KEYS)}
+_KEYS_BY_CODE = {code: key for key, code in _CODES.items()}
+
+_PIXEL_KEYS = {"top", "left", "height", "width"}
+_PIXEL_CODES = {_CODES[key] for key in _PIXEL_KEYS}
+_PIXELS = re.compile(r'-?\d+(\.\d+)?px')
+
+_DEFAULTS = {
+    "showImage": True,
+    "draggable": True,
+    "flippable": True,
+    "ownable": True,
+    "resizable": False,
+}
+
+_COMPONENTS_PATH = 'table.components.'
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _compact_pixels(value):
+    if isinstance(value, str) and _PIXELS.fullmatch(value):
+        number = float(value[:-2]) if '.' in value else int(value[:-2])
+        if _expand_pixels(number) == value:
+            return number
+    elif _is_number(value) or isinstance(value, list):
+        return [value]
+    return value
+
+
+def _expand_pixels(value):
+    if _is_number(value):
+        return f'{value!r}px'
+    if isinstance(value, list):
+        return value[0]
+    return value
+
+
+def compact_item(key, value):
+    """コンポーネントの1つのキーと値を、詰めた形の (キー, 値) にする。"""
+    code = _CODES.get(key)
+    if code is None:
+        return key, value
+    if key in _PIXEL_KEYS:
+        value = _compact_pixels(value)
+    return code, value
+
+
+def compact(component):
+    """コンポーネントを保存する形にする。component は書き換えない。"""
+    stored = {}
+    omit_defaults = all(key in component for key in _DEFAULTS)
+    for key, value in component.items():
+        if omit_defaults and key in _DEFAULTS and value == _DEFAULTS[key] and type(value) is type(_DEFAULTS[key]):
+            continue
+        code, value = compact_item(key, value)
+        stored[code] = value
+    if omit_defaults:
+        stored[_VERSION_KEY] = SCHEMA_VERSION
+    return stored
+
+
+def expand(stored):
+    """保存されている形（どの版でも、詰める前の形でも）から、元の形のコンポーネントを作る。"""
+    component = {}
+    version = stored.get(_VERSION_KEY)
+    for code, value in stored.items():
+        if code == _VERSION_KEY:
+            continue
+        key = _KEYS_BY_CODE.get(code)
+        if key is None:
+            # 番号の方が新しいので、既に入っていれば上書きしない
+            component.setdefault(code, value)
+            continue
+        component[key] = _expand_pixels(value) if code in _PIXEL_CODES else value
+    if version is not None:
+        for key, value in _DEFAULTS.items():
+            component.setdefault(key, value)
+    return component
+
+
+def upgrade(stored):
+    """今の版の詰めた形にする。既にそうなら None。"""
+    upgraded = compact(expand(stored))
+    return None if upgraded == stored else upgraded
+
+
+def compact_components(components):
+    return {component_id: compact(component) for component_id, component in components.items()}
+
+
+def expand_components(components):
+    return {component_id: expand(component) for component_id, component in components.items()}
+
+
+def compact_pending(pending):
+    """`table.components.<id>...` のパスと値を、保存する形にした PendingModification を返す。"""
+    compacted = PendingModification()
+    for path in pending.unset_fields:
+        compacted.unset(_compact_path(path))
+    for path, value in pending.set_fields.items():
+        if not path.startswith(_COMPONENTS_PATH):
+            compacted.set(path, value)
+            continue
+        component_id, _, key = path[len(_COMPONENTS_PATH):].partition('.')
+        if not key:
+            compacted.set(path, compact(value))
+            continue
+        key, _, rest = key.partition('.')
+        if rest:
+            # コンポーネントの中の値のさらに中（onTray.<id> など）。値は変えない
+            compacted.set(f'{_COMPONENTS_PATH}{component_id}.{_CODES.get(key, key)}.{rest}', value)
+            continue
+        code, value = compact_item(key, value)
+        compacted.set(f'{_COMPONENTS_PATH}{component_id}.{code}', value)
+    return compacted
+
+
+def _compact_path(path):
+    if not path.startswith(_COMPONENTS_PATH):
+        return path
+    component_id, _, key = path[len(_COMPONENTS_PATH):].partition('.')
+    if not key:
+        return path
+    key, dot, rest = key.partition('.')
+    return f'{_COMPONENTS_PATH}{component_id}.{_CODES.get(key, key)}{dot}{rest}'
@@ -1,57 +1,77 @@
-from pymongo import operations
-from . import kits
+from . import compact, kits
 
-components = None
+# connect() で渡されたバックエンドの components（store.backends.base.ComponentBackend）。
+# コンポーネント定義も卓のコンポーネントと同じく、詰めた形（store.compact）で保存し、読むときに戻す。
+backend = None
+
+# 定義を書き換えるたびに1つ増える。store.templates が名前から引いた定義を覚え直す目印
+generation = 0
+
+
+def _compacted(data):
+    return dict(data, component=compact.compact(data["component"]))
+
+
+def _expanded(data):
+    if data is None or "component" not in data:
+        return data
+    return dict(data, component=compact.expand(data["component"]))
 
 
 async def get(name):
-    data = await components.find_one({"name": name})
-    if not data:
-        return None
-    return data["table"]
+    return _expanded(await backend.get(name))
 
 
 async def get_for_kit(kit_name):
     kit = await kits.get(kit_name)
-    data = components.find({"component.name": {"$in": kit["kit"]["usedComponentNames"]}})
-    return [{"component": d["component"]} async for d in data]
+    return [_expanded(data) for data in await backend.find_by_names(kit["kit"]["usedComponentNames"])]
+
+
+async def get_by_names(names):
+    return [_expanded(data) for data in await backend.find_by_names(list(names))]
 
 
 async def get_all():
-    data = components.find()
-    return [{"component": d["component"]} async for d in data]
+    return [_expanded(data) for data in await backend.get_all()]
+
+
+def _changed():
+    global generation
+    generation += 1
 
 
-def connect(mongo_db):
-    global components
-    components = mongo_db.components
+def connect(storage):
+    global backend
+    backend = storage.components
 
 
 async def store_default(data):
     assert type(data) == list
     assert all(['component' in d for d in data])
     assert all(['name' in d['component'] for d in data])
-    await components.bulk_write(
-        [operations.UpdateOne({"component.name": c["component"]["name"]}, {"$set": c}, upsert=True)
-         for c in data])
+    await backend.store_default([_compacted(d) for d in data])
+    _changed()
 
 
 async def purge_all():
-    await components.delete_many({})
+    await backend.purge_all()
+    _changed()
 
 
 async def create_or_update(data):
     assert 'component' in data
     assert 'name' in data['component']
-    if await components.count_documents({"component.name": data['component']['name']}) > 0:
+    if await backend.exists(data['component']['name']):
         await update(data)
     else:
         await create(data)
 
 
 async def create(data):
-    await components.insert_one(data)
+    await backend.create(_compacted(data))
+    _changed()
 
 
 async def update(data):
-    await components.find_one_and_replace({'component.name': data['component']['name']}, data)
+    await backend.update(_compacted(data))
+    _changed()
@@ -0,0 +1,236 @@
+import copy
+import math
+import random
+import re
+
+from . import kits, templates
+
+# キットを卓に足すときの、コンポーネントの展開と配置。
+#
+# 以前はクライアント（play_session.js の addNewKit）が展開して、できたコンポーネントをすべて
+# add kit で送り、サーバはそれを room へそのまま配っていた。52枚のトランプなら52枚分の定義を
+# 上りで1回、下りで人数分送ることになる。
+#
+# placement（置く場所と zIndex の起点。クライアントの卓の状態から決まる）だけを受け取ったときは、
+# サーバが kits / components から展開して保存し、配信には展開のしかた（expansion）だけを載せる。
+# 受け取ったクライアントは src/js/kit_expansion.js で同じように展開する。
+#
+# どのクライアントでもサーバと同じコンポーネントにするために:
+# - 乱数（componentId と "random" の配置）は seed から作る。mulberry32 を JS と同じ32ビット演算で回す
+# - 定義は名前ではなくテンプレートID（store.templates）で渡す。展開した時点の定義の中身が決まる
+# - 数の扱い（parseFloat、Math.floor、for...in の順）は JS に合わせる
+#
+# onAdd（定義に書かれた JS）はサーバでは動かせないので、それを持つキットは展開しない。
+# クライアントは今までどおり展開したコンポーネントを送る。
+
+_INT32 = 0xFFFFFFFF
+
+_JS_FLOAT = re.compile(r'\s*([+-]?(?:Infinity|(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?))')
+_ARRAY_INDEX = re.compile(r'0|[1-9]\d*')
+
+
+class KitExpansionError(Exception):
+    pass
+
+
+def seeded_random(seed):
+    """[0, 1) の数を返す関数。kit_expansion.js の seededRandom と同じ列になる。"""
+    state = seed & _INT32
+
+    def next_random():
+        nonlocal state
+        state = (state + 0x6D2B79F5) & _INT32
+        t = state
+        t = ((t ^ (t >> 15)) * (t | 1)) & _INT32
+        t ^= (t + (((t ^ (t >> 7)) * (t | 61)) & _INT32)) & _INT32
+        return ((t ^ (t >> 14)) & _INT32) / 4294967296
+
+    return next_random
+
+
+def _parse_float(value):
+    # JS の parseFloat。"100px" は 100、数でないものは NaN
+    if isinstance(value, bool) or value is None:
+        return math.nan
+    if isinstance(value, (int, float)):
+        return float(value)
+    match = _JS_FLOAT.match(str(value))
+    if not match:
+        return math.nan
+    return float(match.group(1).replace('Infinity', 'inf'))
+
+
+def _number(value):
+    # JS では 100.0 も 100 なので、JSON で同じ形になるようにする
+    if isinstance(value, float):
+        if not math.isfinite(value):
+            return None
+        if value.is_integer():
+            return int(value)
+    return value
+
+
+def _floor(value):
+    return math.floor(value) if math.isfinite(value) else None
+
+
+def _truthy(value):
+    # JS の真偽。空のリストや dict も真
+    if isinstance(value, (list, dict)):
+        return True
+    if isinstance(value, float) and math.isnan(value):
+        return False
+    return bool(value)
+
+
+def _js_keys(obj):
+    # for...in の順。配列の添字になる名前が先に数の順で、残りは入れた順
+    indexes = sorted((key for key in obj if _ARRAY_INDEX.fullmatch(key) and int(key) < _INT32), key=int)
+    return indexes + [key for key in obj if key not in indexes]
+
+
+class _Expansion:
+    def __init__(self, definitions, kit_id, base_z_index, next_random):
+        self.definitions = definitions
+        self.kit_id = kit_id
+        self.base_z_index = base_z_index
+        self.random = next_random
+        self.new_components = {}
+
+    def component_id(self):
+        return ''.join(format(int(self.random() * 16), 'x') for _ in range(12))
+
+    def create_component(self, name):
+        component = copy.deepcopy(self.definitions[name])
+        component["kitId"] = self.kit_id
+        component["componentId"] = self.component_id()
+        self.new_components[component["componentId"]] = component
+        return component
+
+    def raise_z_index(self, component):
+        if _truthy(component.get("zIndex")):
+            component["zIndex"] += self.base_z_index
+        else:
+            component["zIndex"] = self.base_z_index
+
+    def create_contents_of_box(self, box, content_names):
+        box["componentsInBox"] = {}
+        for name in content_names:
+            box["componentsInBox"][self.create_component(name)["componentId"]] = True
+        for content_id in box["componentsInBox"]:
+            if box.get("positionOfBoxContents") == "random":
+                self.layout_randomly(self.new_components[content_id], box)
+            else:
+                self.layout_relatively_as_defined(self.new_components[content_id], box)
+
+    def layout_randomly(self, component, base_rect):
+        component["left"] = _floor(_parse_float(base_rect.get("left")) + (
+                self.random() * (_parse_float(base_rect.get("width")) - _parse_float(component.get("width")))))
+        component["top"] = _floor(_parse_float(base_rect.get("top")) + (
+                self.random() * (_parse_float(base_rect.get("height")) - _parse_float(component.get("height")))))
+        self.raise_z_index(component)
+
+    def layout_relatively_as_defined(self, component, base_rect):
+        component["left"] = _number(_parse_float(component.get("left")) + _parse_float(base_rect.get("left")))
+        component["top"] = _number(_parse_float(component.get("top")) + _parse_float(base_rect.get("top")))
+        self.raise_z_index(component)
+
+    @staticmethod
+    def layout_in_hand_area(components, hand_area):
+        horizontal_start = _parse_float(hand_area.get("left")) + 1
+        width = _parse_float(hand_area.get("width")) - 2
+        vertical_start = _parse_float(hand_area.get("top")) + 1
+        height = _parse_float(hand_area.get("height")) - 2
+        count = len(components)
+        for index, component in enumerate(sorted(components, key=lambda c: -c["zIndex"])):
+            component["left"] = _number(
+                horizontal_start + ((width - _parse_float(component.get("width"))) / count) * index)
+            component["top"] = _number(
+                vertical_start + ((height - _parse_float(component.get("height"))) / count) * index)
+
+
+def expand(layout, definitions, kit_id, placement, seed):
+    """キットを展開した {componentId: コンポーネント} を返す。kit_expansion.js の expandKit と同じ結果になる。
+
+    layout はキットの boxAndComponents と positionOfKitContents、definitions は名前 -> 定義、
+    placement は {"baseZIndex", "rect": {left, top, width, height}} か、手札置き場に配るときは
+    {"baseZIndex", "handAreas": [{left, top, width, height}, ...]}。
+    """
+    expansion = _Expansion(definitions, kit_id, placement["baseZIndex"], seeded_random(seed))
+    box_and_components = layout["boxAndComponents"]
+    position = layout.get("positionOfKitContents")
+    hand_areas = placement.get("handAreas") or []
+    if position == "on all hand areas" and hand_areas:
+        # 手札置き場ごとに1組ずつ配る。箱の中身は作らない（addNewKit がそうだった）
+        for hand_area in hand_areas:
+            components_in_hand_area = []
+            for name in _js_keys(box_and_components):
+                component = expansion.create_component(name)
+                expansion.raise_z_index(component)
+                components_in_hand_area.append(component)
+            expansion.layout_in_hand_area(components_in_hand_area, hand_area)
+        return expansion.new_components
+    rect = placement["rect"]
+    for name in _js_keys(box_and_components):
+        component = expansion.create_component(name)
+        if position == "random":
+            expansion.layout_randomly(component, rect)
+        else:
+            expansion.layout_relatively_as_defined(component, rect)
+        contents = box_and_components[name]
+        if _truthy(contents):
+            expansion.create_contents_of_box(component, contents)
+    return expansion.new_components
+
+
+def _names_in(box_and_components):
+    names = set(box_and_components)
+    for contents in box_and_components.values():
+        names.update(contents or [])
+    return names
+
+
+def _check_placement(placement):
+    if not isinstance(placement, dict):
+        raise KitExpansionError('placement is missing')
+    base_z_index = placement.get("baseZIndex")
+    if not isinstance(base_z_index, (int, float)) or isinstance(base_z_index, bool):
+        raise KitExpansionError('placement has no baseZIndex')
+
+
+def _check_placement_for(placement, position):
+    # expand() が手札置き場に配るのは "on all hand areas" のキットに handAreas があるときだけ。
+    # それ以外は rect に置く
+    if position == "on all hand areas" and placement.get("handAreas"):
+        return
+    if not isinstance(placement.get("rect"), dict):
+        raise KitExpansionError('placement has no rect')
+
+
+async def prepare(kit_name, kit_id, placement):
+    """(配信する expansion, 卓に置く {componentId: コンポーネント}) を返す。
+
+    展開できないキット（無い、定義の足りない名前がある、onAdd を持つ）なら KitExpansionError。
+    """
+    _check_placement(placement)
+    kit_data = await kits.get(kit_name)
+    if kit_data is None:
+        raise KitExpansionError(f'kit {kit_name} does not exist')
+    kit = kit_data["kit"]
+    _check_placement_for(placement, kit.get("positionOfKitContents"))
+    found = await templates.templates_for(kit.get("usedComponentNames", []))
+    for name, (_, definition) in found.items():
+        if definition.get("onAdd"):
+            raise KitExpansionError(f'kit {kit_name} has onAdd in {name}')
+    names = _names_in(kit["boxAndComponents"])
+    if not names <= found.keys():
+        raise KitExpansionError(f'kit {kit_name} has no definitions for {sorted(names - found.keys())}')
+    expansion = {
+        "seed": random.getrandbits(32),
+        "placement": placement,
+        "boxAndComponents": kit["boxAndComponents"],
+        "positionOfKitContents": kit.get("positionOfKitContents"),
+        "templates": {name: found[name][0] for name in sorted(names)},
+    }
+    definitions = {name: found[name][1] for name in names}
+    return expansion, expand(expansion, definitions, kit_id, placement, expansion["seed"])
@@ -1,53 +1,43 @@
-from pymongo import operations
-
-kits = None
+# connect() で渡されたバックエンドの kits（store.backends.base.KitBackend）。
+backend = None
 
 
 async def get(name):
-    data = await kits.find_one({"kit.name": name})
-    if not data:
-        return None
-    del data['_id']
-    return data
+    return await backend.get(name)
 
 
 async def get_all():
-    data = kits.find()
-    return [{"kit": d["kit"]} async for d in data]
+    return await backend.get_all()
 
 
-def connect(mongo_db):
-    global kits
-    kits = mongo_db.kits
+def connect(storage):
+    global backend
+    backend = storage.kits
 
 
 async def create_or_update(kit_data):
     assert 'kit' in kit_data
     assert 'name' in kit_data['kit']
-    if await kits.count_documents({"kit.name": kit_data['kit']['name']}) > 0:
+    if await backend.exists(kit_data['kit']['name']):
         await update(kit_data)
     else:
         await create(kit_data)
 
 
 async def create(kit_data):
-    await kits.insert_one({'kit': kit_data["kit"], 'version': 1})
+    await backend.create(kit_data)
 
 
 async def update(kit_data):
-    current = await kits.find_one({'kit.name': kit_data['kit']['name']})
-    current_version = current['version']
-    await kits.find_one_and_replace({'kit.name': kit_data['kit']['name']},
-                                     {'kit': kit_data["kit"], 'version': current_version + 1})
+    await backend.update(kit_data)
 
 
 async def store_default(data):
     assert type(data) == list
     assert all(['kit' in d for d in data])
     assert all(['name' in d['kit'] for d in data])
-    await kits.bulk_write(
-        [operations.UpdateOne({"kit.name": c["kit"]["name"]}, {"$set": c}, upsert=True) for c in data])
+    await backend.store_default(data)
 
 
 async def purge_all():
-    await kits.delete_many({})
+    await backend.purge_all()
@@ -0,0 +1,100 @@
+import copy
+
+
+def _is_under(path, ancestor):
+    return path.startswith(ancestor + '.')
+
+
+def _ancestors(path):
+    parts = path.split('.')
+    return ['.'.join(parts[:i]) for i in range(1, len(parts))]
+
+
+def assign_path(container, subpath, value):
+    keys = subpath.split('.')
+    for key in keys[:-1]:
+        container = container.setdefault(key, {})
+    container[keys[-1]] = value
+
+
+def remove_path(container, subpath):
+    keys = subpath.split('.')
+    for key in keys[:-1]:
+        container = container.get(key)
+        if not isinstance(container, dict):
+            return
+    container.pop(keys[-1], None)
+
+
+class PendingModification:
+    """まだDBへ書いていない `$set` / `$unset` を、ドット記法のパス単位で溜める。
+
+    同じパスへの書き込みは後勝ち（last-write-wins）で1つにまとまる。Mongoは1回の
+    update の中で親子関係にあるパス（`a` と `a.b`）を同時に指定すると
+    「path would create a conflict」で失敗するので、記録の時点で解消しておく。
+    その結果、溜まっているパス同士は常に親子関係に無い。
+
+    - 親パスの `$set` が溜まっているところへ子パスを書くと、親の値の中へ反映する
+    - 親パスの `$unset` が溜まっているところへ子パスを `$set` すると**捨てる**。
+      削除済みコンポーネントの一部のキーだけが復活するのを防ぐため
+      （update_components が存在しないcomponentIdを書かないのと同じ理由）
+    - 子パスが溜まっているところへ親パスを書くと、子パスは親に吸収される
+    """
+
+    def __init__(self):
+        self.set_fields = {}
+        self.unset_fields = {}
+        # 子孫パスを持ちうる接頭辞。取り除くことはしないので、偽陽性は走査が1回
+        # 無駄になるだけで結果は変わらない。全パスを毎回走査しないための目印。
+        self._prefixes = set()
+
+    def is_empty(self):
+        return not self.set_fields and not self.unset_fields
+
+    def set(self, path, value):
+        value = copy.deepcopy(value)
+        for ancestor in _ancestors(path):
+            if ancestor in self.unset_fields:
+                return
+            if ancestor in self.set_fields:
+                assign_path(self.set_fields[ancestor], path[len(ancestor) + 1:], value)
+                return
+        self._drop_self_and_descendants(path)
+        self.set_fields[path] = value
+        self._prefixes.update(_ancestors(path))
+
+    def unset(self, path):
+        for ancestor in _ancestors(path):
+            if ancestor in self.unset_fields:
+                return
+            if ancestor in self.set_fields:
+                remove_path(self.set_fields[ancestor], path[len(ancestor) + 1:])
+                return
+        self._drop_self_and_descendants(path)
+        self.unset_fields[path] = ''
+        self._prefixes.update(_ancestors(path))
+
+    def merge(self, newer):
+        """newer に溜まっている変更を、これより後に起きたものとして重ねる。"""
+        # パス同士が親子関係に無いので、newer の中での適用順は結果に影響しない。
+        for path in newer.unset_fields:
+            self.unset(path)
+        for path, value in newer.set_fields.items():
+            self.set(path, value)
+
+    def to_update(self):
+        update = {}
+        if self.set_fields:
+            update['$set'] = self.set_fields
+        if self.unset_fields:
+            update['$unset'] = self.unset_fields
+        return update
+
+    def _drop_self_and_descendants(self, path):
+        self.set_fields.pop(path, None)
+        self.unset_fields.pop(path, None)
+        if path not in self._prefixes:
+            return
+        for fields in (self.set_fields, self.unset_fields):
+            for existing in [p for p in fields if _is_under(p, path)]:
+                del fields[existing]
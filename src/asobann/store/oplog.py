@@ -0,0 +1,130 @@
+import asyncio
+import contextlib
+
+# 卓ごとの操作ログ。永続化される操作（コンポーネントの更新・追加、キットの追加など）に
+# 卓ごとの通し番号（seq）を振って残し、再接続してきたクライアントに、最後に受け取った
+# seq より後の操作だけを送れるようにする。
+#
+# 卓ごとに、seq は最後に振った番号。floor 以下の操作はログから消してあるので、
+# floor より前から追いつくことはできない。
+#
+# 卓そのもの（store.tables）が常に最新のスナップショットなので、ログを詰めるときに
+# スナップショットを別に作る必要は無い。詰める＝古い操作を消して floor を上げるだけ。
+#
+# 残し方は connect() で渡されたバックエンドの oplog（store.backends.base.OplogBackend）に任せる。
+backend = None
+
+# enable() したときだけ 0 より大きくなる。0 なら採番もしない。
+_length = 0
+_compact_every = 1
+
+# 卓ごとの [ロック, 使っている数]（→ recording()）。誰も使っていない卓のものは消す
+_recording = {}
+
+
+def connect(storage):
+    global backend
+    backend = storage.oplog
+
+
+def enable(length):
+    """卓ごとに直近 length 件の操作を残す。
+
+    詰めるのは length の1/4ごと。ログの長さは length から length * 1.25 の間を行き来する。
+    """
+    global _length, _compact_every
+    _length = length
+    _compact_every = max(1, length // 4)
+
+
+def disable():
+    global _length
+    _length = 0
+
+
+def enabled():
+    return _length > 0
+
+
+@contextlib.asynccontextmanager
+async def recording(tablename):
+    """卓への書き込みから append() までを、卓ごとに1つずつ行う。無効なら何もしない。
+
+    seq の順を書き込みの順に揃える。書き込みと採番の間に別の書き込みが入ると、先に書いた
+    操作が後の seq をもらい、seq 順に適用したクライアントの卓がサーバと食い違う。
+    揃うのはこのプロセスの中だけ。
+    """
+    if not enabled():
+        yield
+        return
+    entry = _recording.setdefault(tablename, [asyncio.Lock(), 0])
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            yield
+    finally:
+        entry[1] -= 1
+        if entry[1] == 0:
+            del _recording[tablename]
+
+
+async def ensure_indexes():
+    await backend.ensure_indexes()
+
+
+async def append(tablename, event, data):
+    """操作を1つ残し、振った seq を返す。
+
+    呼ぶのは卓への書き込みが終わった後、配信の前。書き込みと一緒に recording() の中で呼ぶ。seq を振った時点で書き込みは
+    済んでいるので、「現在の seq を読んでから卓を読む」と、その seq 以下の操作は
+    必ず卓に入っている（→ current()）。まとめ書き（store.write_coalescer）の窓に入れただけの
+    書き込みは、store.tables が卓を読む前に書き終わるのを待つ。
+    """
+    return await _append(tablename, {"event": event, "data": data})
+
+
+async def append_barrier(tablename, event):
+    """ここをまたいで追いつくことはできない、という印を残す（卓全体の差し替えなど）。
+
+    中身を残すと卓1つ分の大きさになるので、残さずに全量を送り直させる。
+    """
+    return await _append(tablename, {"event": event, "barrier": True})
+
+
+async def _append(tablename, operation):
+    seq = await backend.next_seq(tablename)
+    await backend.insert(tablename, seq, operation)
+    if seq % _compact_every == 0 and seq > _length:
+        await backend.compact(tablename, seq - _length)
+    return seq
+
+
+async def current(tablename):
+    seq, _ = await backend.counter(tablename)
+    return seq
+
+
+async def since(tablename, last_seq):
+    """last_seq より後の操作を seq 順に返す。追いつけないなら None。
+
+    追いつけないのは、ログが詰められて last_seq の次がもう無いとき、間に
+    append_barrier() があるとき、last_seq がこの卓のものではなさそうなとき。
+
+    seq を振られてまだ残し終えていない操作は含まれないことがある。それは残し終えた
+    後に配信されるので、先に room へ入っておけば配信で届く。
+    """
+    if not isinstance(last_seq, int) or isinstance(last_seq, bool):
+        return None
+    seq, floor = await backend.counter(tablename)
+    if last_seq < floor or last_seq > seq:
+        return None
+    operations = []
+    for op in await backend.operations(tablename, last_seq, seq):
+        if op.get("barrier"):
+            return None
+        operations.append({"seq": op["seq"], "event": op["event"], "data": op["data"]})
+    return operations
+
+
+async def purge_all():
+    await backend.purge_all()
@@ -0,0 +1,68 @@
+import asyncio
+
+
+class _Call:
+    def __init__(self, task):
+        self.task = task
+        # 結果を待っている呼び出しの数。最後に受け取ったものだけが元の結果を持っていく
+        self.waiters = 0
+
+
+class SingleFlight:
+    """キーごとに、同時に走る同じ処理を1回にまとめる（single-flight）。
+
+    run(key, func) は、同じ key の func がまだ終わっていなければ新たに呼ばず、その結果を待つ。
+    失敗も待っている全員に届く。終わった後の呼び出しは、また新しく func を呼ぶ（結果は覚えない）。
+
+    copy を渡すと、結果を受け取った側が書き換えても互いに見えないよう、最後の1人以外には
+    copy(結果) を返す。結果を渡した直後（次の await より前）にコピーするので、最後の1人が
+    元の結果を書き換え始める時点では、他の全員のコピーは済んでいる。
+
+    func はタスクとして走らせるので、待っている側がキャンセルされても他の待ち手の処理は止まらない。
+
+    on_shared を渡すと、他の呼び出しの結果を受け取ることになった呼び出しごとに、その場で呼ぶ。
+    """
+
+    def __init__(self, copy=None, on_shared=None):
+        self._copy = copy
+        self._on_shared = on_shared
+        self._calls = {}
+        # 自分では func を呼ばず、他の呼び出しの結果を受け取った回数
+        self.shared = 0
+
+    async def run(self, key, func):
+        call = self._calls.get(key)
+        if call is None:
+            call = self._calls[key] = _Call(asyncio.get_running_loop().create_task(self._call(key, func)))
+            call.task.add_done_callback(_retrieve_exception)
+        else:
+            self.shared += 1
+            if self._on_shared is not None:
+                self._on_shared()
+        call.waiters += 1
+        try:
+            result = await asyncio.shield(call.task)
+        except asyncio.CancelledError:
+            # 待つのをやめた呼び出しは数から外す
+            call.waiters -= 1
+            raise
+        call.waiters -= 1
+        if self._copy is not None and call.waiters > 0:
+            return self._copy(result)
+        return result
+
+    async def _call(self, key, func):
+        try:
+            return await func()
+        finally:
+            # タスクが終わったと同時に外す。後から来た呼び出しが、終わった結果に相乗りしないように
+            del self._calls[key]
+
+    def in_flight(self):
+        return len(self._calls)
+
+
+def _retrieve_exception(task):
+    # 待ち手が全員キャンセルされた失敗で「Task exception was never retrieved」を出さない
+    if not task.cancelled():
+        task.exception()
@@ -0,0 +1,162 @@
+import asyncio
+import copy
+import logging
+import time
+
+from .modification import PendingModification, assign_path, remove_path
+from .single_flight import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+
+class CachedTable:
+    """キャッシュ上の1卓。document は {"tablename", "table": {...}} の形（store.tables.get() の組み立て後）。"""
+
+    def __init__(self, document):
+        self.document = document
+        self.pending = PendingModification()
+        self.touched_at = time.monotonic()
+        # 続けてフラッシュに失敗した回数
+        self.failures = 0
+        # DBへの書き込み（フラッシュと丸ごと置き換え）を卓ごとに直列化する。
+        # 置き換えの後に、それより古い差分のフラッシュが着地すると巻き戻ってしまう。
+        self.lock = asyncio.Lock()
+
+    @property
+    def table(self):
+        return self.document['table']
+
+    def set(self, path, value):
+        assign_path(self.document, path, copy.deepcopy(value))
+        self.pending.set(path, value)
+
+    def unset(self, path):
+        remove_path(self.document, path)
+        self.pending.unset(path)
+
+
+class TableCache:
+    """プレイ中の卓の状態をプロセス内に持ち、変更は一定間隔でまとめてDBへ書く（write-behind）。
+
+    読み込みは load(tablename) -> 文書 or None、書き出しは
+    write(tablename, PendingModification) で、どちらも呼び出し側（store.tables）が渡す。
+    ここは文書の中身やコレクションの形を知らない。
+
+    **このプロセスが卓の唯一の書き手であることが前提。** 複数インスタンスが同じ卓を
+    それぞれキャッシュすると、互いの変更が見えないまま古い状態を返す。
+
+    書けなかった変更は次のフラッシュで書き直す。write が missing の例外（卓がもう無い）を
+    投げたとき、または max_failures 回続けて失敗したときは、溜まっている変更ごと卓を降ろす。
+    書けない変更を持ち続けると、フラッシュのたびに失敗してメモリからも降ろせない。
+    """
+
+    def __init__(self, load, write, flush_interval, idle_seconds, missing=(), max_failures=5):
+        self.entries = {}
+        self._load = load
+        self._write = write
+        self.flush_interval = flush_interval
+        self.idle_seconds = idle_seconds
+        self._missing = missing
+        self.max_failures = max_failures
+        self._task = None
+        # 載っていない卓へ同時に来た呼び出しは、1回の読み込みを共有する。
+        # 読んだ文書は CachedTable に1つ載るだけなので、コピーは要らない。
+        self._loads = SingleFlight()
+
+    async def entry(self, tablename):
+        entry = self.entries.get(tablename)
+        if entry is None:
+            document = await self._loads.run(tablename, lambda: self._load(tablename))
+            if document is None:
+                return None
+            # 読んでいる間に別のコルーチンが同じ卓を載せていたら、そちらを使う。
+            # 上書きすると、そちらに入った変更がメモリから消える。
+            entry = self.entries.setdefault(tablename, CachedTable(document))
+        entry.touched_at = time.monotonic()
+        return entry
+
+    async def replace(self, tablename, document, write_through):
+        """卓を丸ごと置き換える。書き込みは write_through() で即座に行う。
+
+        溜まっている差分は置き換えで意味を失うので捨てる。
+        """
+        created = tablename not in self.entries
+        entry = self.entries.setdefault(tablename, CachedTable(document))
+        async with entry.lock:
+            try:
+                await write_through()
+            except Exception:
+                # 書けなかった卓をキャッシュにだけ残すと、DBに無い卓が見えてしまう。
+                if created and self.entries.get(tablename) is entry:
+                    del self.entries[tablename]
+                raise
+            entry.document = document
+            entry.pending = PendingModification()
+            entry.touched_at = time.monotonic()
+
+    def clear(self):
+        self.entries.clear()
+
+    async def flush(self, tablename):
+        entry = self.entries.get(tablename)
+        if entry is None:
+            return
+        async with entry.lock:
+            if entry.pending.is_empty():
+                return
+            pending, entry.pending = entry.pending, PendingModification()
+            try:
+                await self._write(tablename, pending)
+            except self._missing:
+                self._drop(tablename, entry)
+                raise
+            except Exception:
+                entry.failures += 1
+                if entry.failures >= self.max_failures:
+                    logger.error(f'gave up flushing table {tablename} after {entry.failures} failures')
+                    self._drop(tablename, entry)
+                    raise
+                # 書けなかった分は、その後に溜まった分の下に戻して次回に回す。
+                pending.merge(entry.pending)
+                entry.pending = pending
+                raise
+            entry.failures = 0
+
+    def _drop(self, tablename, entry):
+        # 次に使われたときは、DBにあるものを読み直す（無ければ無い卓になる）
+        if self.entries.get(tablename) is entry:
+            del self.entries[tablename]
+
+    async def flush_all(self):
+        for tablename in list(self.entries):
+            try:
+                await self.flush(tablename)
+            except self._missing:
+                logger.warning(f'table {tablename} is gone; dropped its unflushed changes')
+            except Exception:
+                logger.exception(f'failed to flush table {tablename}')
+
+    def evict_idle(self):
+        threshold = time.monotonic() - self.idle_seconds
+        for tablename, entry in list(self.entries.items()):
+            if entry.touched_at < threshold and entry.pending.is_empty() and not entry.lock.locked():
+                del self.entries[tablename]
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush_all()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush_all()
+            self.evict_idle()
@@ -1,23 +1,183 @@
+import copy
+import functools
+import itertools
 import random
 import json
 from pathlib import Path
-import datetime
 
-tables = None
-table_metas = None
+from asobann import metrics
+from . import compact, templates
+from .modification import PendingModification
+from .single_flight import SingleFlight
+from .table_cache import TableCache
+from .write_coalescer import WriteCoalescer
+
+# connect() で渡されたバックエンドの tables（store.backends.base.TableBackend）。
+backend = None
+# enable_cache() したときだけ TableCache が入る。None なら従来どおり毎回DBを読み書きする。
+_cache = None
+# enable_write_coalescing() したときだけ入る。キャッシュがあればそちらが先にまとめるので使われない。
+_coalescer = None
+
+# 公開している読み書きの所要時間（キャッシュやまとめ書きで待った分も含む）。
+_operation_seconds = metrics.Histogram(
+    'asobann_store_tables_seconds', 'Latency of asobann.store.tables operations', ['function'])
+_timed = metrics.timed(_operation_seconds, 'function')
+
+# 部分更新の件数（diffs）と、実際にDBへ出した update の回数（writes）。
+# 差が「まとめたことで減った書き込み」。
+_component_diffs = metrics.Counter(
+    'asobann_store_component_diffs', 'Partial component updates and removals requested')
+_component_writes = metrics.Counter(
+    'asobann_store_component_writes', 'Component updates actually written to the backend')
+
+# 同じ卓への同時の読み込み・作成を1回にまとめる。セッションの始まりやデプロイの直後は、
+# 同じ卓の come by table が一斉に届く。1人ずつ卓全体を読んでいると、DBへの往復が
+# 卓の数ではなくプレイヤーの数だけ出る。
+# 戻り値は呼び出し側が書き換えることがある（set player name）ので、読み込みは受け取った側ごとにコピーする。
+_coalesced_loads = metrics.Counter(
+    'asobann_store_table_loads_coalesced', 'Table loads and creations that shared another in-flight call')
+_loads = SingleFlight(copy=copy.deepcopy, on_shared=_coalesced_loads.inc)
+_creations = SingleFlight(copy=copy.deepcopy, on_shared=_coalesced_loads.inc)
+
+# 卓ごとの版（→ version()）。このモジュールを通った変更のたびに、全体で単調に増える番号を振り直す。
+_version_counter = itertools.count(1)
+_versions = {}
+# まだ版を振っていない卓の版。purge_all() で上げて、消す前の卓と同じ版にならないようにする
+_base_version = 0
+
+
+def version(tablename):
+    """卓の版。このプロセスからの変更（書き込みの完了後）のたびに変わる。
+
+    版を読んでから get() した卓は、その版の時点より古くない。同じ版のうちは同じ卓が返るので、
+    卓から作ったもの（エンコードした load table など）を版と一緒に覚えておけば使い回せる。
+    他のインスタンスからの変更は知らないので、1インスタンス構成でしか当てにならない。
+    """
+    return _versions.get(tablename, _base_version)
+
+
+# _changes_table を付けた関数が、何も書かなかったときに返す（呼び出し側には None を返す）
+_UNCHANGED = object()
+
+
+def _changes_table(func):
+    """卓を変える関数に付ける。書き終わったら（失敗しても）その卓の版を上げる。
+
+    書き込みの前に上げると、上げた版で変更前の卓を読んで覚える呼び出しが出る。
+    関数が _UNCHANGED を返したとき（volatileだけの更新など）は上げない。
+    """
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        tablename = kwargs['tablename'] if 'tablename' in kwargs else args[0]
+        try:
+            result = await func(*args, **kwargs)
+        except BaseException:
+            _versions[tablename] = next(_version_counter)
+            raise
+        if result is _UNCHANGED:
+            return None
+        _versions[tablename] = next(_version_counter)
+        return result
+
+    return wrapper
 
 
 def generate_new_tablename():
     return str(random.randint(0, 9999)) + ''.join([random.choice('abddefghijklmnopqrstuvwxyz') for i in range(3)])
 
 
-async def get(tablename):
-    data = await tables.find_one({"tablename": tablename})
+@_timed
+async def get(tablename, read_only=False):
+    """卓を返す。無ければ None。
+
+    read_only なら、キャッシュの中身をコピーせずにそのまま返すことがある。書き換えてはならず、
+    次の await より後まで持っていてもいけない（その間に他の変更で書き換わる）。そのまま
+    エンコードして送るだけの呼び出し（load table、export）用。卓全体のコピーを作らずに済む。
+    """
+    if _cache:
+        entry = await _cache.entry(tablename)
+        if entry is None:
+            return None
+        if read_only:
+            return entry.table
+        # 呼び出し側は戻り値を書き換えてから store() することがある（set player name）。
+        # キャッシュの中身をそのまま渡すと、書き換えがDBを通らずに共有されてしまう。
+        return copy.deepcopy(entry.table)
+    data = await _load_document(tablename)
     if not data:
         return None
     return data["table"]
 
 
+async def _load_document(tablename):
+    """{"tablename", "table": {...}} の形で読む。キャッシュを通さない。
+
+    同じ卓を読んでいる最中の呼び出しは、その読み込みの結果（のコピー）を受け取る。
+    """
+    if _coalescer:
+        # まとめ書きの窓に入っている変更には、もう seq が振ってあることがある（update_components の wait）。
+        # 書き終わるのを待ってから読めば、先に読んだ seq 以下の操作は必ず卓に入っている
+        await _coalescer.wait_written(tablename)
+    return await _loads.run(tablename, lambda: _load_expanded(tablename))
+
+
+async def _read_document(tablename):
+    """_load_document と同じだが、同時の読み込みをまとめない。TableCache が自分でまとめる。"""
+    return await _load_expanded(tablename)
+
+
+async def _load_expanded(tablename):
+    # バックエンドに保存されている形（store.compact で詰め、store.templates で定義への参照にしたもの）の
+    # コンポーネントを、ここで元の形に戻す。ここから上（キャッシュ・ハンドラ）は元の形しか見ない
+    document = await backend.load(tablename)
+    if document is not None and "components" in document["table"]:
+        document["table"]["components"] = await templates.resolve_components(
+            compact.expand_components(document["table"]["components"]))
+    return document
+
+
+async def _stored_components(components):
+    return compact.compact_components(await templates.reference_components(components))
+
+
+async def _stored_table(table):
+    """卓を保存する形にする。コンポーネント以外（ヘッダ）はそのまま。table は書き換えない。"""
+    if "components" not in table:
+        return table
+    return dict(table, components=await _stored_components(table["components"]))
+
+
+async def _stored_pending(pending):
+    return compact.compact_pending(await templates.reference_pending(pending))
+
+
+async def split_embedded_components():
+    """分割前の形式で残っている卓をすべて移す。移した卓の数を返す。
+
+    卓は読まれたときにも移るので、これを流さなくても動く。deploy の migrate_tables 用。
+    """
+    return await backend.split_embedded_components()
+
+
+async def compact_stored_components():
+    """保存されているコンポーネントのうち、今の版の詰めた形（store.compact）でないものを書き換える。
+    書き換えたコンポーネントの数を返す。
+
+    詰める前の形も読めるので、これを流さなくても動く。deploy の migrate_tables 用。
+    キャッシュを通さないが、書き換えるのは保存の形だけで、読んだときの中身は変わらない。
+    """
+    return await backend.rewrite_components(compact.upgrade)
+
+
+def _validate_components(components):
+    for component_id in components:
+        validate_component_id(component_id)
+
+
+@_timed
+@_changes_table
 async def create(tablename, prepared_table):
     if prepared_table is None:
         with open(str(Path(__file__).parent / "./default_table.json")) as f:
@@ -25,62 +185,196 @@ async def create(tablename, prepared_table):
     elif prepared_table == '0':
         table = {'components': {}, 'kits': [], 'players': {}}
 
-    await tables.insert_one({"tablename": tablename, "table": table})
-    await table_metas.insert_one({"tablename": tablename, "created_at": datetime.datetime.now()})
+    _validate_components(table["components"])
+
+    async def write():
+        await backend.create(tablename, await _stored_table(table))
+
+    if _cache:
+        await _cache.replace(tablename, {"tablename": tablename, "table": copy.deepcopy(table)},
+                             write_through=write)
+    else:
+        await write()
     return table
 
 
+@_timed
+async def get_or_create(tablename, prepared_table=None, read_only=False):
+    """卓を読み、無ければ create(tablename, prepared_table) で作って返す。
+
+    同じ卓への同時の呼び出しは、1回の読み込みと（無ければ）1回の作成を共有する。
+    別のインスタンスが先に作っていた（TableAlreadyExists）ら、作らずにそれを読む。
+    read_only は get() と同じ。
+    """
+    table = await get(tablename, read_only=read_only)
+    if table is not None:
+        return table
+    return await _creations.run(tablename, lambda: _create_if_missing(tablename, prepared_table))
+
+
+async def _create_if_missing(tablename, prepared_table):
+    # 読んでから作成に入るまでの間に、他の呼び出しの作成が終わっていることがある
+    table = await get(tablename)
+    if table is not None:
+        return table
+    try:
+        return await create(tablename, prepared_table)
+    except TableAlreadyExists:
+        table = await get(tablename)
+        if table is None:
+            raise
+        return table
+
+
+@_timed
+@_changes_table
 async def store(tablename, table):
     table["tablename"] = tablename
-    await tables.update_one(
-        {"tablename": tablename},
-        {"$set": {"table": table}},
-        upsert=True)
-    await table_metas.update_one(
-        {"tablename": tablename},
-        {"$set": {"updated_at": datetime.datetime.now()}})
+    _validate_components(table.get("components", {}))
 
+    async def write():
+        await backend.replace(tablename, await _stored_table(table), upsert=True)
+        await backend.touch(tablename)
 
-async def purge_all():
-    # table_metas も一緒に消す。tables だけ消していたころは、同じ卓名で create() する
-    # たびに table_metas 側へ insert_one が積み上がり、tablename が重複していった。
-    await tables.delete_many({})
-    await table_metas.delete_many({})
+    if _cache:
+        await _cache.replace(tablename, {"tablename": tablename, "table": copy.deepcopy(table)},
+                             write_through=write)
+    else:
+        await write()
+
+
+@_timed
+@_changes_table
+async def set_player(tablename, player):
+    """卓の players に player を足す（同じ名前なら置き換える）。無い卓なら TableNotFound。
+
+    table.players だけを書く。卓全体を書き戻すと、読んでから書くまでの間に届いた
+    コンポーネントの更新を古い値で上書きしてしまう。
+    """
+    if _cache:
+        entry = await _cache.entry(tablename)
+        if entry is None:
+            raise TableNotFound(tablename)
+        entry.set('table.players', {**entry.table.get('players', {}), player['name']: player})
+        return
+    table = await get(tablename)
+    if table is None:
+        raise TableNotFound(tablename)
+    pending = PendingModification()
+    # 名前には '.' も入りうるので、名前ごとのパスではなく players をまるごと書く
+    pending.set('table.players', {**table.get('players', {}), player['name']: player})
+    await backend.apply(tablename, pending)
+    await backend.touch(tablename)
 
 
+async def purge_all():
+    global _base_version
+    if _cache:
+        _cache.clear()
+    try:
+        await backend.purge_all()
+    finally:
+        _versions.clear()
+        _base_version = next(_version_counter)
+
+
+@_timed
+@_changes_table
 async def update_table(tablename, table):
-    await tables.update_one({"tablename": tablename}, {"$set": {"table": table}})
-    await table_metas.update_one(
-        {"tablename": tablename},
-        {"$set": {"updated_at": datetime.datetime.now()}})
+    _validate_components(table.get("components", {}))
 
+    async def write():
+        await backend.replace(tablename, await _stored_table(table), upsert=False)
+        await backend.touch(tablename)
 
-def connect(mongo_db):
-    global tables, table_metas
-    tables = mongo_db.tables
-    table_metas = mongo_db.table_metas
+    if _cache:
+        await _cache.replace(tablename, {"tablename": tablename, "table": copy.deepcopy(table)},
+                             write_through=write)
+    else:
+        await write()
 
 
-async def ensure_indexes():
-    """tablenameで引くための索引を用意する。
+async def _write_pending(tablename, pending: PendingModification):
+    await backend.apply(tablename, await _stored_pending(pending))
+    _count_write()
+    await backend.touch(tablename)
+
+
+def _count_diff():
+    _component_diffs.inc()
+
+
+def _count_write():
+    _component_writes.inc()
+
+
+def write_stats():
+    """部分更新をまとめた効果。merged は「まとめなければ余分に出ていた update の数」。"""
+    diffs = _component_diffs._unlabeled().value
+    writes = _component_writes._unlabeled().value
+    return {'diffs': diffs, 'writes': writes, 'merged': max(0, diffs - writes)}
+
+
+def connect(storage):
+    """storage（store.backends.base.Backend）の tables に読み書きする。"""
+    global backend
+    backend = storage.tables
+
+
+def enable_cache(flush_interval, idle_seconds=300):
+    """卓の状態をプロセス内に持ち、変更を flush_interval 秒ごとにまとめて書く。
+
+    update many components のたびに卓全体を読んで $set していたのを、メモリ上の
+    卓への反映だけにする。DBへの往復はフラッシュ1回あたり卓ごとに1〜2回になる。
+    idle_seconds 触られていない卓は（書き残しが無ければ）メモリから降ろす。
+
+    このプロセスが卓の唯一の書き手であることが前提（→ TableCache）。
+    イベントループの中から呼ぶこと。フラッシュ用のタスクを起動する。
+    """
+    global _cache
+    _cache = TableCache(load=_read_document, write=_write_pending,
+                        flush_interval=flush_interval, idle_seconds=idle_seconds, missing=TableNotFound)
+    _cache.start()
+
+
+def enable_write_coalescing(window):
+    """卓ごとに window 秒の間に届いた部分更新（update_components / remove_components）を
+    1回の update にまとめる。
+
+    複数人が同時にドラッグすると、同じ文書へ小さな $set が毎秒数十回飛ぶ。窓の中では
+    パスごとに後勝ちでまとめるので、書き込みは卓ごとに窓1つあたり1回になる。
+    代わりに、呼び出し側（ハンドラ）は最大 window 秒だけ書き込みの完了を待つ。
+    """
+    global _coalescer
+    _coalescer = WriteCoalescer(write=_write_pending, window=window)
 
-    この2コレクションへのアクセスはすべて {"tablename": ...} で、_id 以外の索引が
-    無いとコレクションスキャンになる。update_components() だけでもプレイ中に
-    1クライアントあたり約13回/秒（読み1回+書き1回）走るため、卓が増えるほど効く。
 
-    tablenameは実質的な主キーなのでuniqueにする。create_index は同じ定義に対しては
-    冪等だが、**同名で定義が違う索引（uniqueの有無など）が既にあると
-    IndexKeySpecsConflict で失敗する**。起動時に呼んでいるので、その場合タスクが
-    上がらない。索引の定義を変えるときは、先に既存の索引を落とす手順が要る。
+async def close():
+    """キャッシュやまとめ書きに溜まっている変更を書き出してから、それらを止める。
+
+    DB接続を閉じる前に呼ぶこと。どちらも使っていなければ何もしない。
     """
-    await tables.create_index('tablename', unique=True)
-    await table_metas.create_index('tablename', unique=True)
+    global _cache, _coalescer
+    if _coalescer:
+        await _coalescer.close()
+        _coalescer = None
+    if _cache:
+        await _cache.close()
+        _cache = None
+
+
+async def ensure_indexes():
+    await backend.ensure_indexes()
 
 
 class TableNotFound(Exception):
     pass
 
 
+class TableAlreadyExists(Exception):
+    pass
+
+
 class InvalidComponentId(Exception):
     pass
 
@@ -112,18 +406,6 @@ def validate_component_id(component_id):
     return component_id
 
 
-def _ensure_matched(result, tablename):
-    """卓が見つからなかった書き込みを、黙って捨てずに落とす。
-
-    卓全体を読んでから書き戻していた頃は、読んだ時点で存在しない卓が None として
-    返り、その後のアクセスで必ず落ちていた。部分更新はフィルタが一致しなくても
-    update_one が成功扱いで返るので、放っておくと「クライアントには配信されたのに
-    DBには入っていない」状態を無言で作る（リロードで消える）。
-    """
-    if result.matched_count == 0:
-        raise TableNotFound(tablename)
-
-
 def collect_update_candidates(diff_of_components, volatile_keys):
     candidates = {}
     for diff in diff_of_components:
@@ -147,22 +429,55 @@ def build_modification(candidates, existing_component_ids):
     return modification
 
 
-async def update_components(tablename, diff_of_components, volatile_keys=None):
+async def _written(tablename, done):
+    # まとめ書きの窓に入れた変更が書き終わるのを待つ。書き終わったら（失敗しても）版を上げる
+    try:
+        await done
+    finally:
+        _versions[tablename] = next(_version_counter)
+
+
+@_timed
+@_changes_table
+async def update_components(tablename, diff_of_components, volatile_keys=None, wait=True):
+    """コンポーネントの部分更新。
+
+    まとめ書きのときに wait=False なら、窓に入れたところで書き終わるのを待つ awaitable を返す
+    （書き込みの順はその時点で決まる）。呼び出し側が必ず await すること。それ以外は None を返す。
+    """
     # volatileだけの更新（ドラッグ中の中間座標など）は、この時点で候補が空になる。
-    # 卓の存在チェックのためだけに全文書readするのは、書くものが何も無いときは
-    # 意味が無い。書くと決まってから読む。
+    # 卓の存在チェックのためだけに読むのは、書くものが何も無いときは意味が無い。
     candidates = collect_update_candidates(diff_of_components, volatile_keys or {})
     if not candidates:
+        return _UNCHANGED
+    if _cache:
+        entry = await _cache.entry(tablename)
+        if entry is None:
+            raise TableNotFound(tablename)
+        modification = build_modification(candidates, entry.table["components"])
+        for path, value in modification.items():
+            entry.set(path, value)
+        _count_diff()
         return
-    current_table = await get(tablename)
-    if current_table is None:
-        raise TableNotFound(tablename)
-    modification = build_modification(candidates, current_table["components"])
-    if not modification:
+    # 卓を読んで存在するコンポーネントに絞ることはしない。コンポーネント文書への
+    # update は upsert しないので、消されたコンポーネントへの更新はどこにも当たらない。
+    modification = build_modification(candidates, candidates.keys())
+    _count_diff()
+    if _coalescer:
+        written = _written(tablename, _coalescer.add(tablename, set_fields=modification))
+        if not wait:
+            return written
+        await written
         return
-    await tables.update_one({"tablename": tablename}, {"$set": modification})
+    pending = PendingModification()
+    for path, value in modification.items():
+        pending.set(path, value)
+    await backend.apply(tablename, await _stored_pending(pending))
+    _count_write()
 
 
+@_timed
+@_changes_table
 async def add_new_kit_and_components(tablename, kitData, components):
     modification = {}
     for component_id in components.keys():
@@ -170,36 +485,59 @@ async def add_new_kit_and_components(tablename, kitData, components):
         mod_key = f'table.components.{component_id}'
         modification[mod_key] = components[component_id]
 
-    result = await tables.update_one({"tablename": tablename}, {"$push": {"table.kits": kitData}})
-    _ensure_matched(result, tablename)
-    if not modification:
-        # update_one() will fail if $set is empty
+    if _cache:
+        entry = await _cache.entry(tablename)
+        if entry is None:
+            raise TableNotFound(tablename)
+        entry.set('table.kits', entry.table.get('kits', []) + [kitData])
+        for path, value in modification.items():
+            entry.set(path, value)
         return
-    result = await tables.update_one({"tablename": tablename}, {"$set": modification})
-    _ensure_matched(result, tablename)
+
+    await backend.add_kit(tablename, kitData, await _stored_components(components))
 
 
-async def remove_components(tablename, component_ids_to_remove):
-    # $unset はコンポーネント単位で消すので、卓を読んで丸ごと書き戻す必要がない。
+@_timed
+@_changes_table
+async def remove_components(tablename, component_ids_to_remove, wait=True):
+    """wait は update_components と同じ。"""
+    # コンポーネント文書を消すだけなので、卓を読んで丸ごと書き戻す必要がない。
     # 全体書き戻しだと、その間に届いた他プレイヤーの更新を巻き込んで消していた。
-    # 存在しないパスへの $unset はエラーにならないので、事前の存在確認も要らない。
+    # 存在しないコンポーネントの削除はエラーにならないので、事前の存在確認も要らない。
     modification = {f'table.components.{validate_component_id(component_id)}': ''
                     for component_id in component_ids_to_remove}
     if not modification:
+        return _UNCHANGED
+    _count_diff()
+    if _cache:
+        entry = await _cache.entry(tablename)
+        if entry is None:
+            raise TableNotFound(tablename)
+        for path in modification:
+            entry.unset(path)
         return
-    result = await tables.update_one({"tablename": tablename}, {"$unset": modification})
-    _ensure_matched(result, tablename)
-    await table_metas.update_one(
-        {"tablename": tablename},
-        {"$set": {"updated_at": datetime.datetime.now()}})
+    if _coalescer:
+        written = _written(tablename, _coalescer.add(tablename, unset_paths=modification.keys()))
+        if not wait:
+            return written
+        await written
+        return
+    pending = PendingModification()
+    for path in modification:
+        pending.unset(path)
+    await _write_pending(tablename, pending)
 
 
+@_timed
+@_changes_table
 async def add_component(tablename, component_data):
     component_id = validate_component_id(component_data["componentId"])
-    result = await tables.update_one(
-        {"tablename": tablename},
-        {"$set": {f'table.components.{component_id}': component_data}})
-    _ensure_matched(result, tablename)
-    await table_metas.update_one(
-        {"tablename": tablename},
-        {"$set": {"updated_at": datetime.datetime.now()}})
+    if _cache:
+        entry = await _cache.entry(tablename)
+        if entry is None:
+            raise TableNotFound(tablename)
+        entry.set(f'table.components.{component_id}', component_data)
+        return
+    stored = await _stored_components({component_id: component_data})
+    await backend.add_component(tablename, component_id, stored[component_id])
+    await backend.touch(tablename)
@@ -0,0 +1,208 @@
+import copy
+import hashlib
+import json
+import logging
+
+from . import compact, components as definitions
+from .modification import PendingModification
+
+logger = logging.getLogger(__name__)
+
+# 卓のコンポーネントを、キットのコンポーネント定義（テンプレート）への参照と、その卓での違いだけにする。
+#
+# キットを足すと、定義（components コレクション）をまるごと写したものが卓ごとにできていた。
+# 52枚のトランプなら卓ごとに52枚分の画像パスや大きさを持つ。name が定義と一致するコンポーネントは
+# {"~t": テンプレートID, <定義と違うキーだけ>, "~d": {<定義にあって自分には無いキー>: true}}
+# の形で保存し、読むときに定義と重ねて元に戻す。
+#
+# テンプレートは定義の名前ではなく中身から決まるID（template_id()）で引き、component_templates に
+# 置いて消さない。定義が書き換わったり、deploy の load_default で入れ直されたりしても、既にある卓は
+# 作ったときの定義のまま読める。同じIDの中身は変わらないので、読んだテンプレートはプロセスの中で
+# 覚えておける（インスタンスが複数でも食い違わない）。
+#
+# 名前から定義を引くのは、書くとき（どのテンプレートを参照するか決める）と load table を送るときだけ。
+# 覚えている定義が古くても、参照先のIDと違いの組が元の形を表すことは変わらない（違いが大きくなるだけ）。
+#
+# 参照を書くたびに、参照先のテンプレートも置く（既にあれば何もしない）。置いたことをプロセスの中で
+# 覚えておくと、別のプロセス（deploy の purge_all）に消されたときに、無いテンプレートを参照してしまう。
+
+# connect() で渡されたバックエンドの templates（store.backends.base.TemplateBackend）。
+backend = None
+
+_TEMPLATE_KEY = '~t'
+_REMOVED_KEY = '~d'
+_COMPONENTS_PATH = 'table.components.'
+
+# name -> (テンプレートID, 定義)。定義の無い名前は None
+_by_name = {}
+_by_name_generation = None
+# テンプレートID -> 定義
+_by_id = {}
+
+
+def connect(storage):
+    global backend
+    backend = storage.templates
+    _forget()
+
+
+def _forget():
+    global _by_name_generation
+    _by_name.clear()
+    _by_name_generation = None
+    _by_id.clear()
+
+
+async def purge_all():
+    await backend.purge_all()
+    _forget()
+
+
+def template_id(definition):
+    """定義の中身から決まるID。"""
+    encoded = json.dumps(definition, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.blake2b(encoded.encode('utf-8'), digest_size=10).hexdigest()
+
+
+def _same(a, b):
+    # True と 1、1 と 1.0 は == では同じだが、JSONにすると違うものになる
+    if type(a) is not type(b):
+        return False
+    if isinstance(a, dict):
+        return a.keys() == b.keys() and all(_same(a[key], b[key]) for key in a)
+    if isinstance(a, list):
+        return len(a) == len(b) and all(_same(x, y) for x, y in zip(a, b))
+    return a == b
+
+
+def _reference(component, template_id_, definition):
+    referenced = {_TEMPLATE_KEY: template_id_}
+    for key, value in component.items():
+        if key not in definition or not _same(definition[key], value):
+            referenced[key] = value
+    removed = {key: True for key in definition if key not in component}
+    if removed:
+        referenced[_REMOVED_KEY] = removed
+    return referenced
+
+
+def _resolve(stored):
+    if _TEMPLATE_KEY not in stored:
+        if _REMOVED_KEY in stored:
+            stored = dict(stored)
+            del stored[_REMOVED_KEY]
+        return stored
+    definition = _by_id.get(stored[_TEMPLATE_KEY])
+    if definition is None:
+        # 置いてから参照するので、ここには来ないはず。卓ごと読めなくするより、違いだけでも返す
+        logger.error(f'component template {stored[_TEMPLATE_KEY]} is missing')
+        definition = {}
+    removed = stored.get(_REMOVED_KEY, {})
+    # 定義の中の dict / list は、読んだ側（卓キャッシュなど）が書き換えることがあるのでコピーする
+    component = {key: copy.deepcopy(value) if isinstance(value, (dict, list)) else value
+                 for key, value in definition.items() if key not in removed}
+    for key, value in stored.items():
+        if key != _TEMPLATE_KEY and key != _REMOVED_KEY:
+            component[key] = value
+    return component
+
+
+async def templates_for(names, store=True):
+    """名前 -> (テンプレートID, 定義) を返す。定義の無い名前は入れない。
+
+    store なら、返すテンプレートを置いてから返す。参照を書く前に呼ぶときはそうする。
+    """
+    global _by_name_generation
+    if _by_name_generation != definitions.generation:
+        _by_name.clear()
+        _by_name_generation = definitions.generation
+    missing = [name for name in names if name not in _by_name]
+    if missing:
+        for data in await definitions.get_by_names(missing):
+            definition = data["component"]
+            _by_name[definition["name"]] = (template_id(definition), definition)
+        for name in missing:
+            _by_name.setdefault(name, None)
+    found = {name: _by_name[name] for name in names if _by_name.get(name)}
+    if store and found:
+        await backend.put_many({template_id_: compact.compact(definition)
+                                for template_id_, definition in found.values()})
+    _by_id.update(found.values())
+    return found
+
+
+def _names_of(components):
+    return {component["name"] for component in components
+            if isinstance(component, dict) and isinstance(component.get("name"), str)}
+
+
+async def reference_components(components, store=True):
+    """{id: コンポーネント} の、定義のあるものを参照の形にしたものを返す。components は書き換えない。
+
+    保存しないもの（送るだけのもの）なら store=False。参照先のテンプレートを置かない。
+    """
+    found = await templates_for(_names_of(components.values()), store=store)
+    if not found:
+        return components
+    return {component_id: _reference(component, *found[component["name"]])
+            if isinstance(component, dict) and component.get("name") in found else component
+            for component_id, component in components.items()}
+
+
+async def reference_pending(pending):
+    """PendingModification のうち、まるごとのコンポーネントを参照の形にしたものを返す。
+
+    コンポーネントの中のキーを消すときは、定義から出てこないように "~d" にも書く。
+    """
+    whole = {path: value for path, value in pending.set_fields.items()
+             if path.startswith(_COMPONENTS_PATH) and '.' not in path[len(_COMPONENTS_PATH):]}
+    removed_keys = [path for path in pending.unset_fields
+                    if path.startswith(_COMPONENTS_PATH) and '.' in path[len(_COMPONENTS_PATH):]]
+    if not whole and not removed_keys:
+        return pending
+    found = await templates_for(_names_of(whole.values()))
+    referenced = PendingModification()
+    for path in pending.unset_fields:
+        referenced.unset(path)
+    for path in removed_keys:
+        component_id, _, key = path[len(_COMPONENTS_PATH):].partition('.')
+        if '.' not in key:
+            referenced.set(f'{_COMPONENTS_PATH}{component_id}.{_REMOVED_KEY}.{key}', True)
+    for path, value in pending.set_fields.items():
+        if path in whole and isinstance(value, dict) and value.get("name") in found:
+            value = _reference(value, *found[value["name"]])
+        referenced.set(path, value)
+    return referenced
+
+
+async def _load(template_ids):
+    missing = [template_id_ for template_id_ in template_ids if template_id_ not in _by_id]
+    if missing:
+        for template_id_, stored in (await backend.get_many(missing)).items():
+            _by_id[template_id_] = compact.expand(stored)
+
+
+async def get_many(template_ids):
+    """{テンプレートID: 定義} を返す。無いIDは入れない。"""
+    await _load(template_ids)
+    return {template_id_: _by_id[template_id_] for template_id_ in template_ids if template_id_ in _by_id}
+
+
+async def resolve_components(components):
+    """{id: 保存されている形} を元の形に戻したものを返す。"""
+    await _load({component[_TEMPLATE_KEY] for component in components.values() if _TEMPLATE_KEY in component})
+    return {component_id: _resolve(component) for component_id, component in components.items()}
+
+
+async def referenced_table(table):
+    """load table で送る形。(コンポーネントを参照の形にした卓, {テンプレートID: 定義}) を返す。
+
+    table は書き換えない。名前を引いた後はawaitを挟まずに組み立てるので、
+    tables.get(read_only=True) の戻り値を渡してよい。クライアントは受け取ったテンプレートで
+    コンポーネントを元に戻す（src/js/component_templates.js）。
+    """
+    # 定義は一緒に送るので、テンプレートを置かなくてよい
+    referenced = await reference_components(table.get("components", {}), store=False)
+    used = {component[_TEMPLATE_KEY] for component in referenced.values()
+            if isinstance(component, dict) and _TEMPLATE_KEY in component}
+    return dict(table, components=referenced), {template_id_: _by_id[template_id_] for template_id_ in used}
@@ -0,0 +1,88 @@
+import asyncio
+
+from .modification import PendingModification
+
+
+class _Batch:
+    def __init__(self):
+        self.pending = PendingModification()
+        self.done = asyncio.get_running_loop().create_future()
+        self.task = None
+
+
+class WriteCoalescer:
+    """卓ごとに、window 秒の間に届いた部分更新を1回の update にまとめる。
+
+    最初の submit() で窓が開き、window 秒後にそれまでの分をまとめて
+    write(tablename, PendingModification) で書く。同じパスへの書き込みは後勝ち。
+    submit() はその窓の書き込みが終わるまで待つ。書き込みの失敗（TableNotFound など）は
+    同じ窓に入った全員に届く。add() は窓に入れるだけで、書き終わるのを待つものを返す。
+
+    同じ卓の窓は順に書く。前の窓の書き込みが長引いている間に次の窓が先に着地すると、
+    後勝ちが逆転する。
+    """
+
+    def __init__(self, write, window):
+        self._write = write
+        self.window = window
+        self._batches = {}
+        self._writing = {}
+        self._tasks = set()
+
+    async def submit(self, tablename, set_fields=None, unset_paths=()):
+        await self.add(tablename, set_fields, unset_paths)
+
+    def add(self, tablename, set_fields=None, unset_paths=()):
+        """変更を窓に入れ、その窓の書き込みが終わるのを待つ awaitable を返す。
+
+        await を挟まないので、呼んだ順がそのまま書き込みの後勝ちの順になる。
+        """
+        batch = self._batches.get(tablename)
+        if batch is None:
+            batch = self._batches[tablename] = _Batch()
+            batch.task = asyncio.get_running_loop().create_task(self._flush_later(tablename, batch))
+            self._tasks.add(batch.task)
+            batch.task.add_done_callback(self._tasks.discard)
+        for path in unset_paths:
+            batch.pending.unset(path)
+        for path, value in (set_fields or {}).items():
+            batch.pending.set(path, value)
+        # 待っている側がキャンセルされても、同じ窓の他の書き込みは巻き込まない。
+        return asyncio.shield(batch.done)
+
+    async def wait_written(self, tablename):
+        """今この卓の窓に入っている変更が書き終わるまで待つ。書き込みの失敗はここでは投げない。"""
+        batch = self._batches.get(tablename)
+        done = batch.done if batch is not None else self._writing.get(tablename)
+        if done is not None:
+            await asyncio.wait([done])
+
+    async def close(self):
+        """窓が閉じるのを待たずに、溜まっている分をすべて書く。"""
+        for tablename, batch in list(self._batches.items()):
+            batch.task.cancel()
+            await self._flush(tablename, batch)
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def _flush_later(self, tablename, batch):
+        await asyncio.sleep(self.window)
+        await self._flush(tablename, batch)
+
+    async def _flush(self, tablename, batch):
+        # 以降の submit() は新しい窓に入る。ここから先は await を挟むので、先に外す。
+        if self._batches.get(tablename) is batch:
+            del self._batches[tablename]
+        previous = self._writing.get(tablename)
+        self._writing[tablename] = batch.done
+        try:
+            if previous is not None:
+                await asyncio.wait([previous])
+            await self._write(tablename, batch.pending)
+        except Exception as e:
+            batch.done.set_exception(e)
+        else:
+            batch.done.set_result(None)
+        finally:
+            if self._writing.get(tablename) is batch.done:
+                del self._writing[tablename]
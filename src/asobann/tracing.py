@@ -0,0 +1,240 @@
+import contextlib
+import contextvars
+import functools
+import importlib
+import inspect
+import itertools
+import pkgutil
+import random
+import time
+import uuid
+
+from pymongo import monitoring
+
+# contextvars で今のスパンを持つ、プロセス内のスパントレース（DEBUG_PERFORMANCE_RECORDING / TRACE_SAMPLE_RATE）。
+#
+# socket.io のハンドラ1回がトレース1つ（ルートスパン）になり、その中で呼ばれた
+# store のコルーチン、Mongo のコマンド、emit が入れ子のスパンになる。手でトレースポイントを
+# 足さなくても、ドラッグが遅いときに読み込み・書き込み・emit のどこで時間を使ったかが見える。
+#
+# 無効なとき（enable() を呼んでいないとき）はスパンを作らない。instrument_package() で
+# 包んだコルーチンも、今のスパンが無ければそのまま呼ぶだけ。
+#
+# 取るかどうかはトレースの始まり（ルートスパン）で決める（head-based sampling）。
+# 取らなかったトレースの中では子スパンも作らないので、ステージングで常に有効にしておける。
+
+_current_span = contextvars.ContextVar('asobann_tracing_span', default=None)
+
+_state = {
+    # export(fragment) -> None。None なら無効
+    'export': None,
+    'sample_rate': 1.0,
+    # クライアントのトレースの続きを、間引かずに必ず取るか
+    'follow_client_traces': False,
+}
+
+
+def enable(export, sample_rate=1.0, follow_client_traces=False):
+    """トレースを有効にする。終わったトレースは export(fragment) に渡す（形は Trace.fragment() を参照）。
+
+    export はハンドラの中から呼ばれるので、書き込みは待たずに溜めるだけにすること。
+    sample_rate はトレースを取る割合。follow_client_traces なら、クライアントのトレースの続き
+    （trace() の trace_id）は間引かずに取る。クライアントが決めたことなので、開発者ツールで
+    記録しているとき（DEBUG_PERFORMANCE_RECORDING）だけにする。
+    """
+    _state['export'] = export
+    _state['sample_rate'] = sample_rate
+    _state['follow_client_traces'] = follow_client_traces
+
+
+def disable():
+    _state['export'] = None
+
+
+def enabled():
+    return _state['export'] is not None
+
+
+def timestamp():
+    """ミリ秒。/debug/traces のトレースポイントと同じ時計（小数でミリ秒未満も持つ）。"""
+    return time.time() * 1000
+
+
+class Trace:
+    def __init__(self, trace_id, name):
+        self.trace_id = trace_id
+        self.name = name
+        self.spans = []
+        self.ended = False
+        self._span_ids = itertools.count(1)
+
+    def next_span_id(self):
+        return next(self._span_ids)
+
+    def fragment(self):
+        """/debug/traces のトレース断片の形にする。
+
+        spans はスパンの木を parentId でつないだ平らなリスト（開始順）。points はクライアントと
+        同じトレースポイントの形で、各スパンの開始（ラベルはスパン名）と終わり（「スパン名 end」）。
+        """
+        spans = sorted(self.spans, key=lambda s: (s.start, s.span_id))
+        points = [{'label': s.name, 'timestamp': s.start} for s in spans]
+        points.extend({'label': f'{s.name} end', 'timestamp': s.end} for s in spans)
+        points.sort(key=lambda p: p['timestamp'])
+        return {
+            'traceId': self.trace_id,
+            'name': self.name,
+            'points': points,
+            'spans': [s.to_dict() for s in spans],
+        }
+
+
+class Span:
+    __slots__ = ('trace', 'span_id', 'parent_id', 'name', 'start', 'end')
+
+    def __init__(self, trace, name, parent=None):
+        self.trace = trace
+        self.span_id = trace.next_span_id()
+        self.parent_id = parent.span_id if parent else None
+        self.name = name
+        self.start = timestamp()
+        self.end = None
+
+    def finish(self):
+        self.end = timestamp()
+        self.trace.spans.append(self)
+
+    def to_dict(self):
+        return {
+            'spanId': self.span_id,
+            'parentId': self.parent_id,
+            'name': self.name,
+            'start': self.start,
+            'end': self.end,
+        }
+
+
+def current_span():
+    """今のスパン。トレースの外や、既に終わったトレースから引き継いだものなら None。"""
+    span = _current_span.get()
+    if span is None or span.trace.ended:
+        return None
+    return span
+
+
+@contextlib.contextmanager
+def trace(name, trace_id=None):
+    """ルートスパンを始める。無効なとき、既にトレースの中にいるときは span(name) と同じ。
+
+    trace_id にはクライアントの inspectionTraceId を渡すと、/debug/traces で
+    クライアント側のトレースポイントと同じトレースとして並ぶ。取るかどうかは他と同じく
+    sample_rate で決める（enable() の follow_client_traces なら必ず取る）。
+    """
+    if not enabled() or current_span() is not None:
+        with span(name) as s:
+            yield s
+        return
+    follow = trace_id and _state['follow_client_traces']
+    if not follow and random.random() >= _state['sample_rate']:
+        yield None
+        return
+    # クライアントのトレースの続きなら、トレースの名前はクライアントが付けたものを使う
+    root = Span(Trace(trace_id, None) if trace_id else Trace(uuid.uuid4().hex, name), name)
+    token = _current_span.set(root)
+    try:
+        yield root
+    finally:
+        _current_span.reset(token)
+        root.finish()
+        root.trace.ended = True
+        export = _state['export']
+        if export is not None:
+            export(root.trace.fragment())
+
+
+@contextlib.contextmanager
+def span(name):
+    """今のトレースの中に子スパンを作る。トレースの外なら何もしない（None を返す）。"""
+    parent = current_span()
+    if parent is None:
+        yield None
+        return
+    child = Span(parent.trace, name, parent)
+    token = _current_span.set(child)
+    try:
+        yield child
+    finally:
+        _current_span.reset(token)
+        child.finish()
+
+
+def traced(func, name=None):
+    """コルーチン関数を、呼ぶたびに span(name) で包む。name の既定は「モジュール名.関数名」。"""
+    if getattr(func, '__traced__', False):
+        return func
+    if name is None:
+        name = f'{func.__module__.rsplit(".", 1)[-1]}.{func.__qualname__}'
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        if current_span() is None:
+            return await func(*args, **kwargs)
+        with span(name):
+            return await func(*args, **kwargs)
+
+    wrapper.__traced__ = True
+    return wrapper
+
+
+def instrument_module(module):
+    """module で定義されたコルーチン関数と、クラスの async メソッドをすべて traced() で置き換える。
+
+    置き換えるのはモジュールの属性なので、`tables.get(...)` のように呼んでいるところ
+    （モジュール内の呼び出しも含む）はすべて包まれる。何度呼んでもよい。
+    """
+    for attr, value in list(vars(module).items()):
+        if getattr(value, '__module__', None) != module.__name__:
+            continue
+        if inspect.iscoroutinefunction(value):
+            setattr(module, attr, traced(value))
+        elif inspect.isclass(value):
+            for method_name, method in list(vars(value).items()):
+                if inspect.iscoroutinefunction(method):
+                    setattr(value, method_name, traced(method))
+
+
+def instrument_package(package):
+    """package とその下のモジュールを、サブパッケージの中まですべて instrument_module() する。"""
+    instrument_module(package)
+    for module_info in pkgutil.walk_packages(package.__path__, package.__name__ + '.'):
+        instrument_module(importlib.import_module(module_info.name))
+
+
+class MongoCommandListener(monitoring.CommandListener):
+    """Mongo のコマンド1つを今のスパンの子スパンにする。AsyncMongoClient の event_listeners に渡す。
+
+    async の pymongo はコマンドを呼び出し元のタスクで実行するので、started/succeeded は
+    呼び出し元の contextvars の中で呼ばれる。
+    """
+
+    def __init__(self):
+        self._spans = {}
+
+    def started(self, event):
+        parent = current_span()
+        if parent is None:
+            return
+        target = event.command.get(event.command_name)
+        name = f'mongo {event.command_name}' + (f' {target}' if isinstance(target, str) else '')
+        self._spans[(event.connection_id, event.request_id)] = Span(parent.trace, name, parent)
+
+    def succeeded(self, event):
+        self._finish(event)
+
+    def failed(self, event):
+        self._finish(event)
+
+    def _finish(self, event):
+        span = self._spans.pop((event.connection_id, event.request_id), None)
+        if span is not None:
+            span.finish()
@@ -0,0 +1,123 @@
+// Kit component definitions that table components in `load table` refer to (see
+// store/templates.py). A referenced component is {"~t": templateId, ...keys that differ,
+// "~d": {key: true for keys of the template it does not have}}.
+//
+// The content of a template never changes for its id, so templates are kept in localStorage
+// across tables and visits. Their ids are sent with `come by table`, and the server sends
+// only the ones we lack (`component templates`, always before `load table`).
+
+const STORAGE_KEY = 'asobann.componentTemplates';
+// Every known id goes up with each `come by table`, so keep the list short.
+const MAX_TEMPLATES = 500;
+
+const TEMPLATE_KEY = '~t';
+const REMOVED_KEY = '~d';
+
+function loadStored() {
+    try {
+        return JSON.parse(localStorage.getItem(STORAGE_KEY)) || {};
+    } catch (e) {
+        return {};
+    }
+}
+
+const templates = loadStored();
+
+function save() {
+    try {
+        localStorage.setItem(STORAGE_KEY, JSON.stringify(templates));
+    } catch (e) {
+        // private browsing or quota exceeded: templates are sent again next time
+    }
+}
+
+function knownTemplateIds() {
+    return Object.keys(templates);
+}
+
+function addTemplates(newTemplates) {
+    for (const templateId in newTemplates) {
+        templates[templateId] = newTemplates[templateId];
+    }
+    save();
+}
+
+function unknownTemplateIds(templateIds) {
+    return templateIds.filter((templateId) => !templates.hasOwnProperty(templateId));
+}
+
+// For templates another client made us refer to (a kit the server expanded, see
+// kit_expansion.js). They never change for their ids, so the browser may cache the response.
+async function fetchTemplates(templateIds) {
+    const response = await fetch('/components/templates?ids=' + templateIds.map(encodeURIComponent).join(','));
+    if (!response.ok) {
+        throw new Error(`failed to fetch component templates: ${response.status}`);
+    }
+    addTemplates(await response.json());
+}
+
+// {name: templateId} to {name: template}. The templates must be known.
+function templatesByName(templateIdsByName) {
+    const found = {};
+    for (const name in templateIdsByName) {
+        found[name] = templates[templateIdsByName[name]];
+    }
+    touch(Object.values(templateIdsByName));
+    return found;
+}
+
+// Moves the ids used by a table to the end so that the oldest unused ones are dropped first.
+function touch(templateIds) {
+    for (const templateId of templateIds) {
+        const template = templates[templateId];
+        delete templates[templateId];
+        templates[templateId] = template;
+    }
+    const ids = Object.keys(templates);
+    for (const templateId of ids.slice(0, Math.max(0, ids.length - MAX_TEMPLATES))) {
+        delete templates[templateId];
+    }
+    save();
+}
+
+function expandComponent(component) {
+    if (!(TEMPLATE_KEY in component)) {
+        return component;
+    }
+    const template = templates[component[TEMPLATE_KEY]];
+    if (!template) {
+        console.error(`component template ${component[TEMPLATE_KEY]} is missing`);
+    }
+    const removed = component[REMOVED_KEY] || {};
+    const expanded = {};
+    for (const key in template || {}) {
+        if (!removed[key]) {
+            // a template is shared by many components, so its nested values are copied
+            const value = template[key];
+            expanded[key] = typeof value === 'object' && value !== null ? JSON.parse(JSON.stringify(value)) : value;
+        }
+    }
+    for (const key in component) {
+        if (key !== TEMPLATE_KEY && key !== REMOVED_KEY) {
+            expanded[key] = component[key];
+        }
+    }
+    return expanded;
+}
+
+function expandTable(tableData) {
+    const used = new Set();
+    for (const componentId in tableData.components) {
+        const component = tableData.components[componentId];
+        if (TEMPLATE_KEY in component) {
+            used.add(component[TEMPLATE_KEY]);
+            tableData.components[componentId] = expandComponent(component);
+        }
+    }
+    if (used.size > 0) {
+        touch(used);
+    }
+    return tableData;
+}
+
+export {knownTemplateIds, addTemplates, expandTable, unknownTemplateIds, fetchTemplates, templatesByName};
@@ -27,12 +27,32 @@ function appendTraces(newTraces) {
             setTraceName(name, singleTrace(traceId));
         }
 
+        if (fragment.spans) {
+            // server-side span trees (asobann.tracing) are drawn as nested bars instead of points
+            addSpans(originator, fragment.spans, singleTrace(traceId));
+            continue;
+        }
         for (const point of points) {
             addPoint(originator, point, singleTrace(traceId));
         }
     }
 }
 
+function addSpans(locus, spans, singleTrace) {
+    const depths = {};
+    for (const span of spans) {
+        // spans come ordered by start, so a parent is always seen before its children
+        const depth = span.parentId == null ? 0 : depths[span.parentId] + 1;
+        depths[span.spanId] = depth;
+        addPoint(locus, {
+            label: span.name,
+            timestamp: span.start,
+            duration: span.end - span.start,
+            depth: depth,
+        }, singleTrace);
+    }
+}
+
 function singleTrace(traceId) {
     if (!traces.hasOwnProperty(traceId)) {
         traces[traceId] = {
@@ -81,13 +101,28 @@ async function refresh() {
             const locusEl = el('div.locus', [el('div.locus_label', locusKey)]);
             const pointsEl = el('div.points');
             const pointsText = titleTextForPoints(points, locusKey, startedAt);
+            let maxDepth = 0;
             for (const point of points) {
                 const ts = point.timestamp - startedAt;
+                if (point.duration !== undefined) {
+                    const text = formatMs(ts) + "ms " + point.label + " (" + formatMs(point.duration) + "ms)";
+                    const spanEl = el('div.span', { title: pointsText }, text);
+                    setStyle(spanEl, {
+                        backgroundColor: colorForText(point.label),
+                        left: ts + 'px',
+                        width: Math.max(point.duration, 1) + 'px',
+                        top: (point.depth * 1.4) + 'em',
+                    });
+                    mount(pointsEl, spanEl);
+                    maxDepth = Math.max(maxDepth, point.depth);
+                    continue;
+                }
                 const text = ts + "ms " + point.label;
                 const pointEl = el('div.point', { title: pointsText }, text);
                 setStyle(pointEl, { backgroundColor: colorForText(point.label), left: ts + 'px' });
                 mount(pointsEl, pointEl);
             }
+            setStyle(pointsEl, { minHeight: ((maxDepth + 1) * 1.4) + 'em' });
             mount(locusEl, pointsEl);
             mount(lociEl, locusEl);
         }
@@ -100,10 +135,16 @@ async function refresh() {
     function titleTextForPoints(points, locusKey, startedAt) {
         let text = 'on ' + locusKey + ':\n';
         for(const point of points) {
-            text += (point.timestamp - startedAt) + "ms " + point.label + '\n'
+            const indent = '  '.repeat(point.depth || 0);
+            const duration = point.duration !== undefined ? " (" + formatMs(point.duration) + "ms)" : "";
+            text += indent + formatMs(point.timestamp - startedAt) + "ms " + point.label + duration + '\n'
         }
         return text;
     }
+
+    function formatMs(ms) {
+        return Math.round(ms * 10) / 10;
+    }
 }
 
 function sortedTraceIds() {
@@ -165,6 +206,43 @@ function autoRefresh() {
     }
 }
 
+async function showLatencies() {
+    // aggregated on the server, so long runs don't have to be downloaded trace by trace
+    const params = new URLSearchParams({ since: '0', bucket: bucketInput.value || '60' });
+    for (const label of labelsInput.value.split(',')) {
+        if (label.trim()) {
+            params.append('label', label.trim());
+        }
+    }
+    const response = await fetch('/debug/trace_latencies?' + params.toString());
+    const data = await response.json();
+
+    const latenciesEl = document.getElementById('latencies');
+    if (latenciesEl.childElementCount > 0) {
+        latenciesEl.removeChild(latenciesEl.children[0]);
+    }
+    const rows = [el('tr', ['from', 'to', 'bucket', 'count', 'p50', 'p95', 'p99', 'max'].map(h => el('th', h)))];
+    for (const pair of data.pairs) {
+        for (const bucket of pair.buckets) {
+            rows.push(el('tr', [
+                el('td', pair.from),
+                el('td', pair.to),
+                el('td', new Date(bucket.start).toLocaleTimeString()),
+                el('td', bucket.count),
+                el('td', formatLatency(bucket.p50)),
+                el('td', formatLatency(bucket.p95)),
+                el('td', formatLatency(bucket.p99)),
+                el('td', formatLatency(bucket.max)),
+            ]));
+        }
+    }
+    mount(latenciesEl, el('table', rows));
+
+    function formatLatency(ms) {
+        return (Math.round(ms * 10) / 10) + 'ms';
+    }
+}
+
 function deleteOnServer() {
     fetch('/debug/delete_traces');
 }
@@ -182,3 +260,10 @@ mount(controlsEl, deleteButton);
 
 const autoButton = el('button', { onclick: switchAuto }, 'Start Auto Refresh');
 mount(controlsEl, autoButton);
+
+const labelsInput = el('input', { placeholder: 'labels in order, comma separated (optional)', size: 50 });
+const bucketInput = el('input', { placeholder: 'bucket seconds', size: 8, value: '60' });
+const latenciesButton = el('button', { onclick: showLatencies }, 'Latency Summary');
+mount(controlsEl, labelsInput);
+mount(controlsEl, bucketInput);
+mount(controlsEl, latenciesButton);
@@ -0,0 +1,156 @@
+// Expands a kit into components and lays them out on the table.
+//
+// When a kit is added with only a placement, the server expands it (store/kit_expansion.py),
+// stores the components and broadcasts how it did so: the seed, the placement, the kit's
+// `boxAndComponents` and the component templates by name. Every client then runs expandKit()
+// with the same arguments and gets the same components as the server. Keep the two
+// implementations in step: random numbers come only from `random`, in the same order.
+
+// mulberry32: the same sequence as seeded_random() in store/kit_expansion.py.
+function seededRandom(seed) {
+    let state = seed >>> 0;
+    return function () {
+        state = (state + 0x6D2B79F5) >>> 0;
+        let t = state;
+        t = Math.imul(t ^ (t >>> 15), t | 1);
+        t ^= t + Math.imul(t ^ (t >>> 7), t | 61);
+        return ((t ^ (t >>> 14)) >>> 0) / 4294967296;
+    };
+}
+
+// `layout` has the kit's `boxAndComponents` and `positionOfKitContents`, `definitions` maps
+// component names to definitions and `placement` is {baseZIndex, rect: {left, top, width, height}}
+// or, to deal to every hand area, {baseZIndex, handAreas: [{left, top, width, height}, ...]}.
+// Returns {componentId: component}.
+function expandKit(layout, definitions, kitId, placement, random) {
+    const baseZIndex = placement.baseZIndex;
+    const newComponents = {};
+
+    const handAreas = placement.handAreas || [];
+    if (layout.positionOfKitContents === "on all hand areas" && handAreas.length > 0) {
+        // one set per hand area; the contents of boxes are not created in this layout
+        for (const handArea of handAreas) {
+            const componentsInHandArea = [];
+            for (const name in layout.boxAndComponents) {
+                if (!layout.boxAndComponents.hasOwnProperty(name)) {
+                    continue;
+                }
+                const componentData = createComponent(name);
+                raiseZIndex(componentData);
+                componentsInHandArea.push(componentData);
+            }
+            layoutInHandArea(componentsInHandArea, handArea);
+        }
+        return newComponents;
+    }
+
+    for (const name in layout.boxAndComponents) {
+        if (!layout.boxAndComponents.hasOwnProperty(name)) {
+            continue;
+        }
+        const boxOrComponentData = createComponent(name);
+        if (layout.positionOfKitContents === "random") {
+            layoutRandomly(boxOrComponentData, placement.rect);
+        } else {
+            layoutRelativelyAsDefined(boxOrComponentData, placement.rect);
+        }
+
+        const contents = layout.boxAndComponents[name];
+        if (contents) {
+            createContentsOfBox(boxOrComponentData, contents);
+        }
+    }
+    return newComponents;
+
+    function generateComponentId() {
+        return 'xxxxxxxxxxxx'.replace(/[x]/g, function (/*c*/) {
+            return (random() * 16 | 0).toString(16);
+        });
+    }
+
+    function createComponent(name) {
+        const newComponentData = JSON.parse(JSON.stringify(definitions[name]));
+        newComponentData.kitId = kitId;
+        newComponentData.componentId = generateComponentId();
+        newComponents[newComponentData.componentId] = newComponentData;
+        return newComponentData;
+    }
+
+    function raiseZIndex(newComponentData) {
+        if (newComponentData.zIndex) {
+            newComponentData.zIndex += baseZIndex;
+        } else {
+            newComponentData.zIndex = baseZIndex;
+        }
+    }
+
+    function createContentsOfBox(boxData, contentNames) {
+        boxData.componentsInBox = {};
+        for (const name of contentNames) {
+            const boxOrComponentData = createComponent(name);
+            const componentId = boxOrComponentData.componentId;
+
+            boxData.componentsInBox[componentId] = true;
+        }
+
+        switch (boxData.positionOfBoxContents) {
+            case "random":
+                for (const contentId in boxData.componentsInBox) {
+                    const contentData = newComponents[contentId];
+                    layoutRandomly(contentData, boxData);
+                }
+                break;
+            default:
+                for (const contentId in boxData.componentsInBox) {
+                    const contentData = newComponents[contentId];
+                    layoutRelativelyAsDefined(contentData, boxData);
+                }
+        }
+    }
+
+    function layoutRandomly(newComponentData, baseRect) {
+        newComponentData.left = Math.floor(parseFloat(baseRect.left) +
+            (random() * (parseFloat(baseRect.width) - parseFloat(newComponentData.width))));
+        newComponentData.top = Math.floor(parseFloat(baseRect.top) +
+            (random() * (parseFloat(baseRect.height) - parseFloat(newComponentData.height))));
+        raiseZIndex(newComponentData);
+    }
+
+    function layoutRelativelyAsDefined(newComponentData, baseRect) {
+        newComponentData.left = parseFloat(newComponentData.left) + parseFloat(baseRect.left);
+        newComponentData.top = parseFloat(newComponentData.top) + parseFloat(baseRect.top);
+        raiseZIndex(newComponentData);
+        if (newComponentData.onAdd) {
+            // only kits added the old way have onAdd; the server does not expand them
+            Function('"use strict"; return ' + newComponentData.onAdd)()(newComponentData);
+        }
+    }
+
+    function layoutInHandArea(componentsInHandArea, handAreaData) {
+        const horizontalStart = parseFloat(handAreaData.left) + 1;
+        const width = parseFloat(handAreaData.width) - 2;
+        const verticalStart = parseFloat(handAreaData.top) + 1;
+        const height = parseFloat(handAreaData.height) - 2;
+
+        const count = componentsInHandArea.length;
+        componentsInHandArea.sort((a, b) => b.zIndex - a.zIndex);
+        let index = 0;
+        for (const cmp of componentsInHandArea) {
+            cmp.left = horizontalStart + ((width - parseFloat(cmp.width)) / count) * index;
+            cmp.top = verticalStart + ((height - parseFloat(cmp.height)) / count) * index;
+            index += 1;
+        }
+    }
+}
+
+// Whether a kit must be expanded by the client that adds it (see store/kit_expansion.py).
+function needsClientExpansion(definitions) {
+    for (const name in definitions) {
+        if (definitions[name].onAdd) {
+            return true;
+        }
+    }
+    return false;
+}
+
+export {seededRandom, expandKit, needsClientExpansion};
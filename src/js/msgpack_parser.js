@@ -0,0 +1,411 @@
+// A socket.io parser (the `parser` option of io()) that speaks MessagePack when the
+// server agrees to, and the default socket.io JSON text format otherwise.
+//
+// The client always asks for msgpack (query `serializer=msgpack`), but sends its first
+// packet (CONNECT) as JSON text, which every server understands. If the server's reply
+// arrives as binary, the server has agreed, and everything after that is sent as
+// msgpack too. A server without ASOBANN_WIRE_MSGPACK (or an older one during a rolling
+// deploy) replies in text and the connection stays JSON. This is decided again on
+// every reconnect.
+//
+// The msgpack format is the same as socket.io-msgpack-parser: one packet is one map
+// {type, data, nsp, id}. Binary attachments in JSON mode are not supported; this app
+// never sends binary data.
+
+const PacketType = {
+    CONNECT: 0,
+    DISCONNECT: 1,
+    EVENT: 2,
+    ACK: 3,
+    CONNECT_ERROR: 4,
+    BINARY_EVENT: 5,
+    BINARY_ACK: 6,
+};
+
+// The Manager creates one Encoder and one Decoder and reuses them across reconnects.
+const negotiated = {
+    msgpack: false,
+};
+
+const textEncoder = new TextEncoder();
+const textDecoder = new TextDecoder();
+
+class Writer {
+    constructor() {
+        this.bytes = new Uint8Array(256);
+        this.view = new DataView(this.bytes.buffer);
+        this.length = 0;
+    }
+
+    reserve(size) {
+        if (this.length + size <= this.bytes.length) {
+            return;
+        }
+        let capacity = this.bytes.length * 2;
+        while (capacity < this.length + size) {
+            capacity *= 2;
+        }
+        const bytes = new Uint8Array(capacity);
+        bytes.set(this.bytes.subarray(0, this.length));
+        this.bytes = bytes;
+        this.view = new DataView(bytes.buffer);
+    }
+
+    put(setter, size, value) {
+        this.reserve(size);
+        this.view[setter](this.length, value);
+        this.length += size;
+    }
+
+    u8(value) { this.put('setUint8', 1, value); }
+    u16(value) { this.put('setUint16', 2, value); }
+    u32(value) { this.put('setUint32', 4, value); }
+    i8(value) { this.put('setInt8', 1, value); }
+    i16(value) { this.put('setInt16', 2, value); }
+    i32(value) { this.put('setInt32', 4, value); }
+    f64(value) { this.put('setFloat64', 8, value); }
+
+    raw(bytes) {
+        this.reserve(bytes.length);
+        this.bytes.set(bytes, this.length);
+        this.length += bytes.length;
+    }
+
+    result() {
+        return this.bytes.slice(0, this.length);
+    }
+}
+
+function writeInteger(w, value) {
+    if (value >= 0) {
+        if (value < 0x80) {
+            w.u8(value);
+        } else if (value < 0x100) {
+            w.u8(0xcc);
+            w.u8(value);
+        } else if (value < 0x10000) {
+            w.u8(0xcd);
+            w.u16(value);
+        } else if (value < 0x100000000) {
+            w.u8(0xce);
+            w.u32(value);
+        } else {
+            w.u8(0xcf);
+            w.u32(Math.floor(value / 0x100000000));
+            w.u32(value % 0x100000000);
+        }
+    } else {
+        if (value >= -32) {
+            w.u8(value & 0xff);
+        } else if (value >= -0x80) {
+            w.u8(0xd0);
+            w.i8(value);
+        } else if (value >= -0x8000) {
+            w.u8(0xd1);
+            w.i16(value);
+        } else if (value >= -0x80000000) {
+            w.u8(0xd2);
+            w.i32(value);
+        } else {
+            const high = Math.floor(value / 0x100000000);
+            w.u8(0xd3);
+            w.i32(high);
+            w.u32(value - high * 0x100000000);
+        }
+    }
+}
+
+function writeLength(w, length, fix, fixMax, codes) {
+    if (fix !== null && length <= fixMax) {
+        w.u8(fix | length);
+    } else if (codes[0] !== null && length < 0x100) {
+        w.u8(codes[0]);
+        w.u8(length);
+    } else if (length < 0x10000) {
+        w.u8(codes[1]);
+        w.u16(length);
+    } else {
+        w.u8(codes[2]);
+        w.u32(length);
+    }
+}
+
+function write(w, value) {
+    if (value === null || value === undefined) {
+        w.u8(0xc0);
+    } else if (value === false) {
+        w.u8(0xc2);
+    } else if (value === true) {
+        w.u8(0xc3);
+    } else if (typeof value === 'number') {
+        if (Number.isSafeInteger(value)) {
+            writeInteger(w, value);
+        } else {
+            w.u8(0xcb);
+            w.f64(value);
+        }
+    } else if (typeof value === 'string') {
+        const bytes = textEncoder.encode(value);
+        writeLength(w, bytes.length, 0xa0, 31, [0xd9, 0xda, 0xdb]);
+        w.raw(bytes);
+    } else if (value instanceof ArrayBuffer || ArrayBuffer.isView(value)) {
+        const bytes = value instanceof ArrayBuffer
+            ? new Uint8Array(value)
+            : new Uint8Array(value.buffer, value.byteOffset, value.byteLength);
+        writeLength(w, bytes.length, null, 0, [0xc4, 0xc5, 0xc6]);
+        w.raw(bytes);
+    } else if (Array.isArray(value)) {
+        writeLength(w, value.length, 0x90, 15, [null, 0xdc, 0xdd]);
+        for (const item of value) {
+            write(w, item);
+        }
+    } else if (typeof value.toJSON === 'function') {
+        write(w, value.toJSON());
+    } else {
+        // Same as JSON.stringify: keys with undefined or function values are left out.
+        const keys = Object.keys(value).filter((key) => value[key] !== undefined && typeof value[key] !== 'function');
+        writeLength(w, keys.length, 0x80, 15, [null, 0xde, 0xdf]);
+        for (const key of keys) {
+            write(w, key);
+            write(w, value[key]);
+        }
+    }
+}
+
+function encode(value) {
+    const w = new Writer();
+    write(w, value);
+    return w.result();
+}
+
+class Reader {
+    constructor(bytes) {
+        this.bytes = bytes;
+        this.view = new DataView(bytes.buffer, bytes.byteOffset, bytes.byteLength);
+        this.offset = 0;
+    }
+
+    take(getter, size) {
+        const value = this.view[getter](this.offset);
+        this.offset += size;
+        return value;
+    }
+
+    u8() { return this.take('getUint8', 1); }
+    u16() { return this.take('getUint16', 2); }
+    u32() { return this.take('getUint32', 4); }
+    i8() { return this.take('getInt8', 1); }
+    i16() { return this.take('getInt16', 2); }
+    i32() { return this.take('getInt32', 4); }
+    f32() { return this.take('getFloat32', 4); }
+    f64() { return this.take('getFloat64', 8); }
+
+    raw(length) {
+        const bytes = this.bytes.subarray(this.offset, this.offset + length);
+        if (bytes.length !== length) {
+            throw new Error('msgpack: unexpected end of data');
+        }
+        this.offset += length;
+        return bytes;
+    }
+}
+
+function readString(r, length) {
+    return textDecoder.decode(r.raw(length));
+}
+
+function readArray(r, length) {
+    const array = new Array(length);
+    for (let i = 0; i < length; i++) {
+        array[i] = read(r);
+    }
+    return array;
+}
+
+function readMap(r, length) {
+    const map = {};
+    for (let i = 0; i < length; i++) {
+        const key = read(r);
+        map[key] = read(r);
+    }
+    return map;
+}
+
+function read(r) {
+    const code = r.u8();
+    if (code < 0x80) {
+        return code;
+    }
+    if (code < 0x90) {
+        return readMap(r, code & 0x0f);
+    }
+    if (code < 0xa0) {
+        return readArray(r, code & 0x0f);
+    }
+    if (code < 0xc0) {
+        return readString(r, code & 0x1f);
+    }
+    if (code >= 0xe0) {
+        return code - 0x100;
+    }
+    switch (code) {
+        case 0xc0: return null;
+        case 0xc2: return false;
+        case 0xc3: return true;
+        case 0xc4: return r.raw(r.u8()).slice();
+        case 0xc5: return r.raw(r.u16()).slice();
+        case 0xc6: return r.raw(r.u32()).slice();
+        case 0xca: return r.f32();
+        case 0xcb: return r.f64();
+        case 0xcc: return r.u8();
+        case 0xcd: return r.u16();
+        case 0xce: return r.u32();
+        case 0xcf: return r.u32() * 0x100000000 + r.u32();
+        case 0xd0: return r.i8();
+        case 0xd1: return r.i16();
+        case 0xd2: return r.i32();
+        case 0xd3: return r.i32() * 0x100000000 + r.u32();
+        case 0xd9: return readString(r, r.u8());
+        case 0xda: return readString(r, r.u16());
+        case 0xdb: return readString(r, r.u32());
+        case 0xdc: return readArray(r, r.u16());
+        case 0xdd: return readArray(r, r.u32());
+        case 0xde: return readMap(r, r.u16());
+        case 0xdf: return readMap(r, r.u32());
+    }
+    throw new Error(`msgpack: unsupported type 0x${code.toString(16)}`);
+}
+
+function decode(data) {
+    const bytes = data instanceof ArrayBuffer
+        ? new Uint8Array(data)
+        : new Uint8Array(data.buffer, data.byteOffset, data.byteLength);
+    const r = new Reader(bytes);
+    const value = read(r);
+    if (r.offset !== bytes.length) {
+        throw new Error('msgpack: extra bytes after the packet');
+    }
+    return value;
+}
+
+// The default socket.io text format: <type>[<nsp>,][<id>][<json>]
+function encodeText(packet) {
+    let encoded = String(packet.type);
+    if (packet.nsp && packet.nsp !== '/') {
+        encoded += packet.nsp + ',';
+    }
+    if (packet.id !== undefined && packet.id !== null) {
+        encoded += packet.id;
+    }
+    if (packet.data !== undefined) {
+        encoded += JSON.stringify(packet.data);
+    }
+    return encoded;
+}
+
+function decodeText(str) {
+    const packet = { type: Number(str.charAt(0)) };
+    if (!Object.values(PacketType).includes(packet.type)) {
+        throw new Error('unknown packet type ' + str.charAt(0));
+    }
+    if (packet.type === PacketType.BINARY_EVENT || packet.type === PacketType.BINARY_ACK) {
+        throw new Error('binary attachments are not supported');
+    }
+    let i = 0;
+    if (str.charAt(i + 1) === '/') {
+        const start = i + 1;
+        while (str.charAt(++i) !== ',' && i !== str.length) {
+            // skip to the end of the namespace
+        }
+        packet.nsp = str.substring(start, i);
+    } else {
+        packet.nsp = '/';
+    }
+    const start = i + 1;
+    while (i + 1 < str.length && str.charAt(i + 1) >= '0' && str.charAt(i + 1) <= '9') {
+        i++;
+    }
+    if (i + 1 > start) {
+        packet.id = Number(str.substring(start, i + 1));
+    }
+    if (i + 1 < str.length) {
+        packet.data = JSON.parse(str.substring(i + 1));
+    }
+    return packet;
+}
+
+function toMap(packet) {
+    const map = { type: packet.type, nsp: packet.nsp };
+    if (packet.data !== undefined) {
+        map.data = packet.data;
+    }
+    if (packet.id !== undefined && packet.id !== null) {
+        map.id = packet.id;
+    }
+    return map;
+}
+
+class Encoder {
+    encode(packet) {
+        if (negotiated.msgpack) {
+            return [encode(toMap(packet))];
+        }
+        return [encodeText(packet)];
+    }
+}
+
+class Decoder {
+    constructor() {
+        this.listeners = {};
+    }
+
+    on(event, listener) {
+        (this.listeners[event] = this.listeners[event] || []).push(listener);
+        return this;
+    }
+
+    off(event, listener) {
+        if (event === undefined) {
+            this.listeners = {};
+        } else if (listener === undefined) {
+            delete this.listeners[event];
+        } else if (this.listeners[event]) {
+            this.listeners[event] = this.listeners[event].filter((l) => l !== listener);
+        }
+        return this;
+    }
+
+    emit(event, ...args) {
+        for (const listener of (this.listeners[event] || []).slice()) {
+            listener.apply(this, args);
+        }
+        return this;
+    }
+
+    add(data) {
+        let packet;
+        if (typeof data === 'string') {
+            packet = decodeText(data);
+        } else {
+            negotiated.msgpack = true;
+            packet = decode(data);
+        }
+        this.emit('decoded', packet);
+    }
+
+    destroy() {
+        // Called when the connection is closed. The next one negotiates again.
+        negotiated.msgpack = false;
+    }
+}
+
+const protocol = 5;
+
+export {
+    protocol,
+    PacketType,
+    Encoder,
+    Decoder,
+    encode,
+    decode,
+};
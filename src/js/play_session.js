@@ -4,6 +4,7 @@ import {
     joinTable,
     pushCursorMovement,
     pushNewComponent,
+    pushNewKit,
     pushNewKitAndComponents,
     pushRemoveComponent,
     pushSyncWithMe,
@@ -12,6 +13,7 @@ import {
 import {Menu, MenuConnector} from "./menu.js";
 import {CraftBox, CraftBoxConnector, feats as featsForCraftBox} from "./craft_box.js";
 import {dev_inspector} from "./dev_inspector.js"
+import {expandKit, needsClientExpansion} from "./kit_expansion.js";
 import interact from 'interactjs';
 
 import '../style/game.css';
@@ -101,6 +103,7 @@ const syncTableConnector = {
     },
 
     addKitAndComponents(kitData, newComponents) {
+        delete kitsExpandedByServer[kitData.kitId];
         for (const existKit of table.data.kits) {
             if (existKit.kitId === kitData.kitId) {
                 return;
@@ -110,6 +113,21 @@ const syncTableConnector = {
         syncTableConnector.addManyComponents(newComponents);
     },
 
+    addKitRejected(kitData) {
+        // the server could not expand the kit; expand it here and send the components instead
+        const pending = kitsExpandedByServer[kitData.kitId];
+        if (!pending) {
+            return;
+        }
+        delete kitsExpandedByServer[kitData.kitId];
+        const placement = placementOfKit(pending.kit, pending.baseZIndex);
+        try {
+            expandAndPushKit(pending.kit, kitData.kitId, pending.definitions, placement);
+        } catch (e) {
+            console.error(`cannot add kit ${kitData.name}`, e);
+        }
+    },
+
     updateWholeTable(data) {
         table.update(data);
         menu.update(data);
@@ -147,6 +165,8 @@ const syncTableConnector = {
 };
 
 const otherPlayersMouse = {};
+// Kits sent with only a placement, by kitId, until the server adds or rejects them.
+const kitsExpandedByServer = {};
 
 function generateComponentId() {
     return 'xxxxxxxxxxxx'.replace(/[x]/g, function (/*c*/) {
@@ -154,16 +174,6 @@ function generateComponentId() {
     });
 }
 
-function createComponentWithinKit(kitId, componentData) {
-    const newComponentData = Object.assign({}, componentData);
-    newComponentData.kitId = kitId;
-    const componentId = generateComponentId();
-    newComponentData.componentId = componentId;
-
-    return newComponentData;
-}
-
-
 async function addNewKit(kitData) {
     const kitName = kitData.kit.name;
     const kitId = 'xxxxxxxxxxxx'.replace(/[x]/g, function (/*c*/) {
@@ -171,179 +181,55 @@ async function addNewKit(kitData) {
     });
 
     const baseZIndex = table.getNextZIndex();
-    const newComponents = {};
     const usedComponentsData = await (await fetch(encodeURI(baseUrl() + "components?kit_name=" + kitName))).json();
-    const layouter = kitLayouter(kitData.kit.positionOfKitContents);
-    const componentDataMap = {};
+    const definitions = {};
     for (const cmp of usedComponentsData) {
-        componentDataMap[cmp['component']['name']] = cmp;
+        definitions[cmp['component']['name']] = cmp['component'];
     }
+    const placement = placementOfKit(kitData.kit, baseZIndex);
 
-    layouter();
+    if (!needsClientExpansion(definitions)) {
+        // the server expands the kit, and every client including this one adds it from the broadcast
+        kitsExpandedByServer[kitId] = { kit: kitData.kit, definitions: definitions, baseZIndex: baseZIndex };
+        pushNewKit({ name: kitName, kitId: kitId }, placement);
+        return kitId;
+    }
 
+    expandAndPushKit(kitData.kit, kitId, definitions, placement);
+    return kitId;
+}
+
+function expandAndPushKit(kit, kitId, definitions, placement) {
+    const newComponents = expandKit(kit, definitions, kitId, placement, Math.random);
     pushNewKitAndComponents({
-        kit: { name: kitName, kitId: kitId },
+        kit: { name: kit.name, kitId: kitId },
     }, newComponents);
     for (const componentId in newComponents) {
         const newComponentData = newComponents[componentId];
         table.addComponent(newComponentData);
     }
-    return kitId;
-
-    function createComponent(name) {
-        const newComponentData = createComponentWithinKit(kitId, componentDataMap[name].component);
-        newComponents[newComponentData.componentId] = newComponentData;
-        return newComponentData;
-    }
-
-    function createContentsOfBox(boxData, contentNames) {
-        boxData.componentsInBox = {};
-        for (const name of contentNames) {
-            const boxOrComponentData = createComponent(name);
-            const componentId = boxOrComponentData.componentId;
-
-            boxData.componentsInBox[componentId] = true;
-        }
-
-        switch (boxData.positionOfBoxContents) {
-            case "random":
-                for (const contentId in boxData.componentsInBox) {
-                    const contentData = newComponents[contentId];
-                    layoutRandomly(contentData, boxData);
-                }
-                break;
-            default:
-                for (const contentId in boxData.componentsInBox) {
-                    const contentData = newComponents[contentId];
-                    layoutRelativelyAsDefined(contentData, boxData);
-                }
-        }
-    }
-
-    function layoutRandomly(newComponentData, baseRect) {
-        newComponentData.left = Math.floor(parseFloat(baseRect.left) +
-            (Math.random() * (parseFloat(baseRect.width) - parseFloat(newComponentData.width))));
-        newComponentData.top = Math.floor(parseFloat(baseRect.top) +
-            (Math.random() * (parseFloat(baseRect.height) - parseFloat(newComponentData.height))));
-        if (newComponentData.zIndex) {
-            newComponentData.zIndex += baseZIndex;
-        } else {
-            newComponentData.zIndex = baseZIndex;
-        }
-
-    }
-
-    function layoutRelativelyAsDefined(newComponentData, baseRect) {
-        newComponentData.left = parseFloat(newComponentData.left) + parseFloat(baseRect.left);
-        newComponentData.top = parseFloat(newComponentData.top) + parseFloat(baseRect.top);
-        if (newComponentData.zIndex) {
-            newComponentData.zIndex += baseZIndex;
-        } else {
-            newComponentData.zIndex = baseZIndex;
-        }
-        if (newComponentData.onAdd) {
-            Function('"use strict"; return ' + newComponentData.onAdd)()(newComponentData);
-        }
-    }
-
-    function layoutInHandArea(componentsInHandArea, handAreaData) {
-        const horizontalStart = parseFloat(handAreaData.left) + 1;
-        const width = parseFloat(handAreaData.width) - 2;
-        const verticalStart = parseFloat(handAreaData.top) + 1;
-        const height = parseFloat(handAreaData.height) - 2;
-
-        const count = componentsInHandArea.length;
-        componentsInHandArea.sort((a, b) => b.zIndex - a.zIndex);
-        let index = 0;
-        for (const cmp of componentsInHandArea) {
-            cmp.left = horizontalStart + ((width - parseFloat(cmp.width)) / count) * index;
-            cmp.top = verticalStart + ((height - parseFloat(cmp.height)) / count) * index;
-            index += 1;
-        }
-
-    }
+}
 
-    function kitLayouter(name) {
-        switch (name) {
-            case "on all hand areas":
-                return function () {
-                    const handAreasData = table.getAllHandAreas();
-                    if (handAreasData.length > 0) {
-                        for (const handAreaData of handAreasData) {
-                            const componentsInHandArea = [];
-                            for (const name in kitData.kit.boxAndComponents) {
-                                if (!kitData.kit.boxAndComponents.hasOwnProperty(name)) {
-                                    continue;
-                                }
-                                const boxOrComponentData = createComponent(name);
-                                if (boxOrComponentData.zIndex) {
-                                    boxOrComponentData.zIndex += baseZIndex;
-                                } else {
-                                    boxOrComponentData.zIndex = baseZIndex;
-                                }
-                                componentsInHandArea.push(boxOrComponentData);
-                            }
-                            layoutInHandArea(componentsInHandArea, handAreaData);
-
-                            const contents = kitData.kit.boxAndComponents[name];
-                            if (contents) {
-                                createContentsOfBox(boxOrComponentData, contents);
-                            }
-                        }
-                    } else {
-                        const emptySpaceRect = table.findEmptySpace(kitData.kit.width, kitData.kit.height);
-
-                        for (const name in kitData.kit.boxAndComponents) {
-                            if (!kitData.kit.boxAndComponents.hasOwnProperty(name)) {
-                                continue;
-                            }
-                            const boxOrComponentData = createComponent(name);
-                            layoutRelativelyAsDefined(boxOrComponentData, emptySpaceRect);
-
-                            const contents = kitData.kit.boxAndComponents[name];
-                            if (contents) {
-                                createContentsOfBox(boxOrComponentData, contents);
-                            }
-                        }
-                    }
-                };
-            case "random":
-                return function () {
-                    const emptySpaceRect = table.findEmptySpace(kitData.kit.width, kitData.kit.height);
-
-                    for (const name in kitData.kit.boxAndComponents) {
-                        if (!kitData.kit.boxAndComponents.hasOwnProperty(name)) {
-                            continue;
-                        }
-                        const boxOrComponentData = createComponent(name);
-                        layoutRandomly(boxOrComponentData, emptySpaceRect);
-
-                        const contents = kitData.kit.boxAndComponents[name];
-                        if (contents) {
-                            createContentsOfBox(boxOrComponentData, contents);
-                        }
-                    }
-                };
-
-            default:
-                return function () {
-                    const emptySpaceRect = table.findEmptySpace(kitData.kit.width, kitData.kit.height);
-
-                    for (const name in kitData.kit.boxAndComponents) {
-                        if (!kitData.kit.boxAndComponents.hasOwnProperty(name)) {
-                            continue;
-                        }
-                        const boxOrComponentData = createComponent(name);
-                        layoutRelativelyAsDefined(boxOrComponentData, emptySpaceRect);
-
-                        const contents = kitData.kit.boxAndComponents[name];
-                        if (contents) {
-                            createContentsOfBox(boxOrComponentData, contents);
-                        }
-                    }
-                };
-        }
+function placementOfKit(kit, baseZIndex) {
+    const placement = { baseZIndex: baseZIndex };
+    const handAreasData = kit.positionOfKitContents === "on all hand areas" ? table.getAllHandAreas() : [];
+    if (handAreasData.length > 0) {
+        placement.handAreas = handAreasData.map((handAreaData) => ({
+            left: handAreaData.left,
+            top: handAreaData.top,
+            width: handAreaData.width,
+            height: handAreaData.height,
+        }));
+    } else {
+        const emptySpaceRect = table.findEmptySpace(kit.width, kit.height);
+        placement.rect = {
+            left: emptySpaceRect.left,
+            top: emptySpaceRect.top,
+            width: emptySpaceRect.width,
+            height: emptySpaceRect.height,
+        };
     }
+    return placement;
 }
 
 function removeKit(kitId) {
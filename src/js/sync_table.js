@@ -1,11 +1,15 @@
 import {dev_inspector} from "./dev_inspector.js";
 import io from 'socket.io-client'
-
-const socket = io(
-    // {
-    //     transports: ['websocket']
-    // }
-);
+import * as msgpackParser from "./msgpack_parser.js";
+import * as componentTemplates from "./component_templates.js";
+import {expandKit, seededRandom} from "./kit_expansion.js";
+
+const socket = io({
+    // transports: ['websocket'],
+    // the server answers in msgpack only if ASOBANN_WIRE_MSGPACK is set; see msgpack_parser.js
+    query: {serializer: 'msgpack'},
+    parser: msgpackParser,
+});
 
 const context = {
     client_connection_id: 'xxxxxxxxxxxx'.replace(/[x]/g, function (/*c*/) {
@@ -27,22 +31,172 @@ function setTableContext(tablename, connector) {
     context.showOthersMouseMovement = connector.showOthersMouseMovement;
     context.addComponent = connector.addComponent;
     context.addKitAndComponents = connector.addKitAndComponents;
+    context.addKitRejected = connector.addKitRejected;
+}
+
+// Sequence numbers the server gives to persisted operations when its operation log is
+// enabled (events without `seq` are applied as they come). `lastSeq` is the highest seq
+// up to which every operation has been applied; seqs applied out of order above it wait
+// in `appliedSeqs` until the gap fills. On reconnect, `lastSeq` is sent with
+// `come by table` and the server answers with only the missing operations
+// (`catch up table`), or with the whole table when it can't.
+const sequence = {
+    lastSeq: null,
+    appliedSeqs: new Set(),
+    snapshotSeq: null,
+    // Between `come by table` and `load table` / `catch up table`, sequenced events are
+    // held so that nothing older than the table we are about to receive overwrites it.
+    awaitingTable: false,
+    held: [],
+};
+
+// Table events are applied one after another in the order they arrive. A kit the server
+// expanded may use component templates we don't have yet; while they are fetched,
+// `expandingKit` is set and the events that come meanwhile wait in `steps`.
+const tableSteps = {
+    steps: [],
+    running: false,
+    // steps queued by the running step go right after it, before the ones already waiting
+    insertAt: 0,
+    expandingKit: false,
+};
+
+function inOrder(...steps) {
+    if (tableSteps.running) {
+        tableSteps.steps.splice(tableSteps.insertAt, 0, ...steps);
+        tableSteps.insertAt += steps.length;
+        return;
+    }
+    tableSteps.steps.push(...steps);
+    runSteps();
+}
+
+function runSteps() {
+    tableSteps.running = true;
+    while (!tableSteps.expandingKit && tableSteps.steps.length > 0) {
+        const step = tableSteps.steps.shift();
+        tableSteps.insertAt = 0;
+        try {
+            step();
+        } catch (e) {
+            console.error(e);
+        }
+    }
+    tableSteps.running = false;
+}
+
+function isApplied(seq) {
+    return seq <= sequence.lastSeq || sequence.appliedSeqs.has(seq);
+}
+
+function markApplied(seq) {
+    sequence.appliedSeqs.add(seq);
+    while (sequence.appliedSeqs.has(sequence.lastSeq + 1)) {
+        sequence.lastSeq += 1;
+        sequence.appliedSeqs.delete(sequence.lastSeq);
+    }
+}
+
+// An entry of a server-batched frame carries the seqs of all the messages merged into it.
+function seqsOf(msg) {
+    if (Array.isArray(msg.seqs)) {
+        return msg.seqs;
+    }
+    if (msg.seq === undefined || msg.seq === null) {
+        return [];
+    }
+    return [msg.seq];
+}
+
+function applySequenced(seqs, data, apply) {
+    if (seqs.every((seq) => isApplied(seq))) {
+        return;
+    }
+    apply(data);
+    for (const seq of seqs) {
+        markApplied(seq);
+    }
 }
 
+function receiveSequenced(msg, apply) {
+    const seqs = seqsOf(msg);
+    if (seqs.length === 0) {
+        apply(msg);
+        return;
+    }
+    if (sequence.awaitingTable) {
+        sequence.held.push({ msg: msg, apply: apply });
+        return;
+    }
+    if (sequence.lastSeq === null) {
+        apply(msg);
+        return;
+    }
+    applySequenced(seqs, msg, apply);
+}
+
+function releaseHeld() {
+    sequence.awaitingTable = false;
+    const held = sequence.held.splice(0);
+    held.sort((a, b) => Math.min(...seqsOf(a.msg)) - Math.min(...seqsOf(b.msg)));
+    inOrder(...held.map(({ msg, apply }) => () => receiveSequenced(msg, apply)));
+}
+
+socket.on("table sequence", (msg) => {
+    if (msg.tablename !== context.tablename) {
+        return;
+    }
+    sequence.snapshotSeq = msg.seq;
+});
+
+socket.on("component templates", (msg) => {
+    componentTemplates.addTemplates(msg.templates);
+});
+
 socket.on("load table", (msg) => {
-    context.initializeTable(msg);
+    inOrder(() => {
+        context.initializeTable(componentTemplates.expandTable(msg));
+        sequence.lastSeq = sequence.snapshotSeq;
+        sequence.appliedSeqs.clear();
+        sequence.snapshotSeq = null;
+        releaseHeld();
+    });
+});
+
+socket.on("catch up table", (msg) => {
+    if (msg.tablename !== context.tablename) {
+        return;
+    }
+    console.log(`event received: catch up table (${msg.operations.length} operations)`);
+    const steps = [];
+    for (const op of msg.operations) {
+        const apply = sequencedHandlers[op.event];
+        if (apply) {
+            steps.push(() => applySequenced([op.seq], op.data, apply));
+        }
+    }
+    inOrder(...steps, releaseHeld);
 });
 
 socket.on('connect', () => {
-    emit('come by table', { tablename: context.tablename });
+    sequence.awaitingTable = true;
+    const data = { tablename: context.tablename, knownTemplates: componentTemplates.knownTemplateIds() };
+    if (sequence.lastSeq !== null) {
+        data.lastSeq = sequence.lastSeq;
+    }
+    emit('come by table', data);
 });
 
-socket.on("refresh table", (msg) => {
-    console.log("event received: refresh table", msg);
+function onRefreshTable(msg) {
     if (msg.tablename !== context.tablename) {
         return;
     }
     context.updateWholeTable(msg.table);
+}
+
+socket.on("refresh table", (msg) => {
+    console.log("event received: refresh table", msg);
+    inOrder(() => receiveSequenced(msg, onRefreshTable));
 });
 
 socket.on("confirmed player name", (msg) => {
@@ -58,6 +212,17 @@ socket.on("mouse movement", (msg) => {
     context.showOthersMouseMovement(msg.playerName, msg.mouseMovement);
 });
 
+// Sent instead of "mouse movement" when the server batches cursors per tick: the latest
+// position of each player who moved since the last frame.
+socket.on("mouse movements", (msg) => {
+    if (msg.tablename !== context.tablename) {
+        return;
+    }
+    for (const movement of msg.movements) {
+        context.showOthersMouseMovement(movement.playerName, movement.mouseMovement);
+    }
+});
+
 class ComponentUpdateBuffer {
     constructor(table) {
         this.table = table;
@@ -186,7 +351,7 @@ function updateTableDataWithComponentDiff(table, componentId, diff) {
     table.receiveData(oldData);
 }
 
-socket.on('update many components', (msg) => {
+function onUpdateManyComponents(msg) {
     if (msg.tablename !== context.tablename) {
         return;
     }
@@ -194,6 +359,17 @@ socket.on('update many components', (msg) => {
         return;
     }
     context.updateManyComponents(msg.diffs, msg.componentIdsToRemove);
+}
+
+socket.on('update many components', (msg) => {
+    if (msg.updates) {
+        // Batched by the server per tick: one entry per run of messages from one originator,
+        // in the order they arrived.
+        inOrder(...msg.updates.map((update) => () =>
+            receiveSequenced(Object.assign({ tablename: msg.tablename }, update), onUpdateManyComponents)));
+        return;
+    }
+    inOrder(() => receiveSequenced(msg, onUpdateManyComponents));
 });
 
 function pushNewComponent(componentData) {
@@ -206,12 +382,16 @@ function pushNewComponent(componentData) {
     console.log("pushNewComponent end");
 }
 
-socket.on("add component", (msg) => {
-    console.log("event received: add component", msg);
+function onAddComponent(msg) {
     if (msg.tablename !== context.tablename) {
         return;
     }
     context.addComponent(msg.component);
+}
+
+socket.on("add component", (msg) => {
+    console.log("event received: add component", msg);
+    inOrder(() => receiveSequenced(msg, onAddComponent));
 });
 
 
@@ -224,17 +404,74 @@ function pushNewKitAndComponents(kitData, newComponents) {
     })
 }
 
-socket.on("add kit", (msg) => {
-    console.log("event received: add kit", msg);
+// Only the kit and a placement; the server expands the kit and broadcasts how (kit_expansion.js).
+function pushNewKit(kit, placement) {
+    emit("add kit", {
+        tablename: context.tablename,
+        originator: context.client_connection_id,
+        kitData: { kit: kit },
+        placement: placement,
+    });
+}
+
+function onAddKit(msg) {
     if (msg.tablename !== context.tablename) {
         return;
     }
+    if (msg.expansion) {
+        addExpandedKit(msg.kit, msg.expansion);
+        return;
+    }
     if (msg.originator === context.client_connection_id) {
         return;
     }
     context.addKitAndComponents(msg.kit, msg.newComponents);
+}
+
+// Every client, the one that added the kit included, expands it as the server did.
+function addExpandedKit(kit, expansion) {
+    const add = () => {
+        const definitions = componentTemplates.templatesByName(expansion.templates);
+        const random = seededRandom(expansion.seed);
+        context.addKitAndComponents(kit, expandKit(expansion, definitions, kit.kitId, expansion.placement, random));
+    };
+    const unknown = componentTemplates.unknownTemplateIds(Object.values(expansion.templates));
+    if (unknown.length === 0) {
+        add();
+        return;
+    }
+    tableSteps.expandingKit = true;
+    componentTemplates.fetchTemplates(unknown)
+        .then(add)
+        .catch((e) => console.error(e))
+        .finally(() => {
+            tableSteps.expandingKit = false;
+            runSteps();
+        });
+}
+
+socket.on("add kit", (msg) => {
+    console.log("event received: add kit", msg);
+    inOrder(() => receiveSequenced(msg, onAddKit));
+});
+
+// The server could not expand a kit sent by pushNewKit(); only this client gets this.
+socket.on("add kit rejected", (msg) => {
+    console.log("event received: add kit rejected", msg);
+    if (msg.tablename !== context.tablename) {
+        return;
+    }
+    context.addKitRejected(msg.kit);
 });
 
+// Events that `catch up table` may replay. `refresh table` is not among them: the server
+// never replays across it and sends the whole table instead.
+const sequencedHandlers = {
+    'update many components': onUpdateManyComponents,
+    'add component': onAddComponent,
+    'add kit': onAddKit,
+};
+
 function pushRemoveComponent(componentId) {
     console.log("pushRemoveComponent", componentId);
     componentUpdateBuffer.addComponentIdToRemove(componentId);
@@ -272,6 +509,7 @@ export {
     pushComponentUpdate,
     pushNewComponent,
     pushRemoveComponent,
+    pushNewKit,
     pushNewKitAndComponents,
     pushSyncWithMe,
     joinTable,
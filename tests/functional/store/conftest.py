@@ -0,0 +1,23 @@
+import os
+
+import pytest_asyncio
+
+os.environ["FLASK_ENV"] = "test"
+
+import asobann.app
+from asobann.store import tables
+
+
+@pytest_asyncio.fixture
+async def app():
+    # モジュールトップレベルではなくfixture内で設定する: create_app()はテスト実行時に
+    # 呼ばれるため、他のテストファイルが実行順序次第でFLASK_ENVを書き換えている可能性がある。
+    os.environ["FLASK_ENV"] = "test"
+    return await asobann.app.create_app()
+
+
+@pytest_asyncio.fixture
+async def no_tables(app):
+    # tables だけ消すと table_metas に前のテストの分が残り、同じ卓名で作り直した
+    # ときに tablename が重複する（unique索引があると索引作成や insert が落ちる）。
+    await tables.purge_all()
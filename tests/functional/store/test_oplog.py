@@ -0,0 +1,83 @@
+import asyncio
+
+import pytest_asyncio
+
+from asobann.store import oplog, tables
+
+
+@pytest_asyncio.fixture
+async def log(no_tables):
+    await oplog.purge_all()
+    oplog.enable(length=8)
+    yield
+    oplog.disable()
+
+
+async def append_many(tablename, count):
+    return [await oplog.append(tablename, 'update many components', {'n': i}) for i in range(count)]
+
+
+class TestOplog:
+    async def test_seq_increases_per_table(self, log):
+        assert await append_many('table1', 3) == [1, 2, 3]
+        assert await append_many('table2', 2) == [1, 2]
+        assert await oplog.current('table1') == 3
+
+    async def test_current_of_table_without_operations_is_zero(self, log):
+        assert await oplog.current('table1') == 0
+
+    async def test_since_returns_only_the_missing_operations(self, log):
+        await append_many('table1', 5)
+        operations = await oplog.since('table1', 3)
+        assert [op['seq'] for op in operations] == [4, 5]
+        assert operations[0] == {'seq': 4, 'event': 'update many components', 'data': {'n': 3}}
+
+    async def test_since_latest_is_empty(self, log):
+        await append_many('table1', 3)
+        assert await oplog.since('table1', 3) == []
+
+    async def test_log_is_compacted_and_old_seq_needs_a_snapshot(self, log):
+        await append_many('table1', 20)
+        assert await oplog.since('table1', 2) is None
+        assert [op['seq'] for op in await oplog.since('table1', 15)] == [16, 17, 18, 19, 20]
+        assert await oplog.backend.ops.count_documents({'tablename': 'table1'}) <= 8 + 2
+
+    async def test_barrier_cannot_be_crossed(self, log):
+        await append_many('table1', 2)
+        await oplog.append_barrier('table1', 'refresh table')
+        await append_many('table1', 2)
+        assert await oplog.since('table1', 1) is None
+        assert [op['seq'] for op in await oplog.since('table1', 3)] == [4, 5]
+
+    async def test_seq_from_the_future_needs_a_snapshot(self, log):
+        # 卓が作り直されたなど、クライアントの知っている seq がこの卓のものではない。
+        await append_many('table1', 2)
+        assert await oplog.since('table1', 10) is None
+
+    async def test_invalid_seq_needs_a_snapshot(self, log):
+        await append_many('table1', 2)
+        assert await oplog.since('table1', '1') is None
+        assert await oplog.since('table1', None) is None
+
+
+class TestRecording:
+    async def test_seq_follows_the_order_of_interleaved_writes(self, log):
+        await tables.store('table1', {'components': {'c1': {'top': 0}}, 'kits': [], 'players': {}})
+
+        async def write(top, delay):
+            async with oplog.recording('table1'):
+                await tables.update_components('table1', [{'c1': {'top': top}}])
+                # 書き込みと採番の間に、もう一方の書き込みが割り込めるようにする
+                await asyncio.sleep(delay)
+                await oplog.append('table1', 'update many components', {'top': top})
+
+        await asyncio.gather(write(1, 0.02), write(2, 0))
+        # seq 順に適用した最後の値が、卓に残った値と同じ
+        last = (await oplog.since('table1', 0))[-1]
+        assert last['data']['top'] == (await tables.get('table1'))['components']['c1']['top']
+        assert oplog._recording == {}
+
+    async def test_recording_does_nothing_when_disabled(self, log):
+        oplog.disable()
+        async with oplog.recording('table1'):
+            assert oplog._recording == {}
@@ -0,0 +1,132 @@
+import asyncio
+
+import pytest
+import pytest_asyncio
+
+from asobann.store import tables
+
+
+@pytest_asyncio.fixture
+async def cache(no_tables):
+    # フラッシュはテストの中で明示的に起こすので、自動フラッシュは事実上止めておく。
+    tables.enable_cache(flush_interval=3600)
+    yield
+    await tables.close()
+
+
+async def read_from_db(tablename):
+    # キャッシュを通さずにDBの文書から組み立てる。
+    data = await tables._load_document(tablename)
+    return data["table"] if data else None
+
+
+@pytest_asyncio.fixture
+async def cached_table(cache):
+    table = {
+        'components': {
+            'component1': {'value1': 10, 'value2': 20},
+            'component2': {'value1': 110, 'value2': 120},
+        },
+        'kits': [],
+        'players': {},
+    }
+    await tables.store('table1', table)
+    return table
+
+
+class TestTableCache:
+    async def test_store_is_written_through(self, cached_table):
+        read = await read_from_db('table1')
+        assert read['components']['component1'] == {'value1': 10, 'value2': 20}
+
+    async def test_update_is_visible_before_flush(self, cached_table):
+        await tables.update_components('table1', [{'component1': {'value1': 100}}])
+        read = await tables.get('table1')
+        assert read['components']['component1'] == {'value1': 100, 'value2': 20}
+
+    async def test_update_is_not_written_until_flush(self, cached_table):
+        await tables.update_components('table1', [{'component1': {'value1': 100}}])
+        assert (await read_from_db('table1'))['components']['component1']['value1'] == 10
+
+    async def test_close_flushes_everything(self, cached_table):
+        await tables.update_components('table1', [{'component1': {'value1': 100}}])
+        await tables.remove_components('table1', ['component2'])
+        await tables.add_component('table1', {'componentId': 'component9'})
+        await tables.add_new_kit_and_components(
+            tablename='table1',
+            kitData={'name': 'kit1', 'kitId': 'kit001'},
+            components={'component8': {'value1': 1}})
+        await tables.close()
+
+        read = await read_from_db('table1')
+        assert read['components'] == {
+            'component1': {'value1': 100, 'value2': 20},
+            'component9': {'componentId': 'component9'},
+            'component8': {'value1': 1},
+        }
+        assert [k['kitId'] for k in read['kits']] == ['kit001']
+
+    async def test_update_after_remove_does_not_resurrect_the_component(self, cached_table):
+        await tables.remove_components('table1', ['component2'])
+        await tables.update_components('table1', [{'component2': {'value1': 999}}])
+        await tables.close()
+        assert 'component2' not in (await read_from_db('table1'))['components']
+
+    async def test_returned_table_is_not_shared_with_the_cache(self, cached_table):
+        read = await tables.get('table1')
+        read['players']['someone'] = {'name': 'someone'}
+        assert (await tables.get('table1'))['players'] == {}
+
+    async def test_read_only_get_is_not_copied(self, cached_table):
+        # load table や export のように、エンコードして送るだけなら卓全体のコピーは要らない
+        assert await tables.get('table1', read_only=True) is await tables.get('table1', read_only=True)
+        await tables.update_components('table1', [{'component1': {'value1': 100}}])
+        assert (await tables.get('table1', read_only=True))['components']['component1']['value1'] == 100
+
+    async def test_table_written_by_others_is_loaded_on_first_access(self, cache):
+        await tables.backend.tables.insert_one({'tablename': 'table2', 'table': {
+            'components': {'component1': {'value1': 10}}, 'kits': [], 'players': {}}})
+        await tables.update_components('table2', [{'component1': {'value1': 11}}])
+        await tables.close()
+        assert (await read_from_db('table2'))['components']['component1'] == {'value1': 11}
+
+    async def test_unknown_table_raises(self, cache):
+        with pytest.raises(tables.TableNotFound):
+            await tables.update_components('no_such_table', [{'component1': {'value1': 1}}])
+
+    async def test_concurrent_first_access_keeps_both_updates(self, cache):
+        # 2本とも読み込みから始まる。後から読み終えた方がキャッシュを上書きすると、
+        # 先に入った更新がメモリから消える。
+        await tables.backend.tables.insert_one({'tablename': 'table2', 'table': {
+            'components': {'component1': {'value1': 10}, 'component2': {'value1': 20}},
+            'kits': [], 'players': {}}})
+        await asyncio.gather(
+            tables.update_components('table2', [{'component1': {'value1': 11}}]),
+            tables.update_components('table2', [{'component2': {'value1': 21}}]),
+        )
+        read = await tables.get('table2')
+        assert read['components']['component1'] == {'value1': 11}
+        assert read['components']['component2'] == {'value1': 21}
+
+    async def test_changes_to_a_deleted_table_are_dropped(self, cached_table):
+        await tables.update_components('table1', [{'component1': {'value1': 11}}])
+        # キャッシュを通さずに消す
+        await tables.backend.purge_all()
+        with pytest.raises(tables.TableNotFound):
+            await tables._cache.flush('table1')
+        assert 'table1' not in tables._cache.entries
+        assert await tables.get('table1') is None
+
+    async def test_failing_flush_gives_up_after_max_failures(self, cached_table, monkeypatch):
+        async def failing_write(tablename, pending):
+            raise RuntimeError('write failed')
+
+        monkeypatch.setattr(tables._cache, '_write', failing_write)
+        await tables.update_components('table1', [{'component1': {'value1': 11}}])
+        for _ in range(tables._cache.max_failures - 1):
+            with pytest.raises(RuntimeError):
+                await tables._cache.flush('table1')
+            assert not tables._cache.entries['table1'].pending.is_empty()
+        with pytest.raises(RuntimeError):
+            await tables._cache.flush('table1')
+        assert 'table1' not in tables._cache.entries
@@ -1,29 +1,10 @@
 import asyncio
-import os
 
 import pytest
 import pytest_asyncio
 from pymongo.errors import DuplicateKeyError
 
-os.environ["FLASK_ENV"] = "test"
-
-import asobann.app
-from asobann.store import tables
-
-
-@pytest_asyncio.fixture
-async def app():
-    # モジュールトップレベルではなくfixture内で設定する: create_app()はテスト実行時に
-    # 呼ばれるため、他のテストファイルが実行順序次第でFLASK_ENVを書き換えている可能性がある。
-    os.environ["FLASK_ENV"] = "test"
-    return await asobann.app.create_app()
-
-
-@pytest_asyncio.fixture
-async def no_tables(app):
-    # tables だけ消すと table_metas に前のテストの分が残り、同じ卓名で作り直した
-    # ときに tablename が重複する（unique索引があると索引作成や insert が落ちる）。
-    await tables.purge_all()
+from asobann.store import compact, components, tables, templates
 
 
 @pytest_asyncio.fixture
@@ -63,6 +44,68 @@ class TestTableStore:
         assert table['kits'] == []
         assert table['players'] == {}
 
+    async def test_create_existing_table_is_rejected(self, no_tables):
+        await tables.create('table1', '0')
+        with pytest.raises(tables.TableAlreadyExists):
+            await tables.create('table1', None)
+        assert (await tables.get('table1'))['components'] == {}
+
+    async def test_concurrent_get_or_create_creates_once(self, no_tables, monkeypatch):
+        created = []
+        create = tables.create
+
+        async def counting_create(tablename, prepared_table):
+            created.append(tablename)
+            return await create(tablename, prepared_table)
+
+        monkeypatch.setattr(tables, 'create', counting_create)
+        read = await asyncio.gather(*(tables.get_or_create('table1') for _ in range(5)))
+        assert created == ['table1']
+        assert all(table['components'].keys() == read[0]['components'].keys() for table in read)
+        read[0]['players']['alice'] = {}
+        assert read[1]['players'] == {}
+
+    async def test_version_changes_with_every_write(self, simple_table):
+        versions = [tables.version('table1')]
+        await tables.update_components('table1', [{'component1': {'value1': 11}}])
+        versions.append(tables.version('table1'))
+        await tables.add_component('table1', {'componentId': 'component2'})
+        versions.append(tables.version('table1'))
+        await tables.remove_components('table1', ['component2'])
+        versions.append(tables.version('table1'))
+        await tables.get('table1')
+        assert tables.version('table1') == versions[-1]
+        assert len(set(versions)) == 4
+        await tables.purge_all()
+        assert tables.version('table1') not in versions
+
+    async def test_version_stays_when_nothing_is_written(self, simple_table):
+        before = tables.version('table1')
+        await tables.update_components('table1', [{'component1': {'top': 1}}], {'component1': ['top']})
+        await tables.remove_components('table1', [])
+        assert tables.version('table1') == before
+
+    async def test_concurrent_get_shares_one_load(self, simple_table, monkeypatch):
+        loads = []
+        load = tables.backend.load
+
+        async def counting_load(tablename):
+            loads.append(tablename)
+            return await load(tablename)
+
+        monkeypatch.setattr(tables.backend, 'load', counting_load)
+        read = await asyncio.gather(*(tables.get('table1') for _ in range(5)))
+        assert loads == ['table1']
+        assert all(table == read[0] for table in read)
+
+    async def test_coalesced_loads_count_only_the_shared_calls(self, simple_table):
+        await tables.store('table2', simple_table)
+        coalesced = tables._coalesced_loads._unlabeled()
+        before = coalesced.value
+        # 2卓の読み込みが重なっても、他の卓の分を数えない
+        await asyncio.gather(*(tables.get(tablename) for tablename in ('table1', 'table2') for _ in range(3)))
+        assert coalesced.value - before == 4
+
     async def test_store_to_create_new(self, no_tables):
         table = {
             'components': {
@@ -287,26 +330,164 @@ class TestTableStore:
                     components={'component9': {}})
 
 
+class TestComponentDocuments:
+    """コンポーネントは1つずつ別文書に置き、get() で元の形に組み立てる。"""
+
+    async def test_each_component_is_its_own_document(self, table_with_several_components):
+        header = await tables.backend.tables.find_one({'tablename': 'table1'})
+        assert 'components' not in header['table']
+        documents = [d async for d in tables.backend.table_components.find({'tablename': 'table1'})]
+        assert sorted(d['componentId'] for d in documents) == ['component1', 'component2', 'component3']
+
+    async def test_update_touches_only_the_component_document(self, table_with_several_components):
+        await tables.update_components('table1', [{'component2': {'value1': 999}}])
+        document = await tables.backend.table_components.find_one({'tablename': 'table1', 'componentId': 'component2'})
+        assert document['component'] == {'value1': 999, 'value2': 120}
+
+    async def test_update_does_not_resurrect_removed_component(self, table_with_several_components):
+        await tables.remove_components('table1', ['component2'])
+        await tables.update_components('table1', [{'component2': {'value1': 999}}])
+        assert 'component2' not in (await tables.get('table1'))['components']
+
+    async def test_store_removes_components_not_in_the_new_table(self, table_with_several_components):
+        await tables.store('table1', {
+            'components': {'component1': {'value1': 1}},
+            'kits': [],
+            'players': {},
+        })
+        read = await tables.get('table1')
+        assert read['components'] == {'component1': {'value1': 1}}
+
+    async def test_tables_do_not_share_components(self, table_with_several_components):
+        await tables.store('table2', {'components': {'component1': {'value1': 1}}, 'kits': [], 'players': {}})
+        await tables.update_components('table2', [{'component1': {'value1': 2}}])
+        assert (await tables.get('table1'))['components']['component1'] == {'value1': 10, 'value2': 20}
+
+
+class TestSplitEmbeddedComponents:
+    """分割前の形式（table.components に全部入り）で残っている卓の移行。"""
+
+    @pytest_asyncio.fixture
+    async def embedded_table(self, no_tables):
+        await tables.backend.tables.insert_one({'tablename': 'table1', 'table': {
+            'components': {'component1': {'value1': 10}, 'component2': {'value1': 20}},
+            'kits': [{'kitId': 'kit001'}],
+            'players': {},
+        }})
+
+    async def test_get_migrates_and_returns_the_same_shape(self, embedded_table):
+        read = await tables.get('table1')
+        assert read['components'] == {'component1': {'value1': 10}, 'component2': {'value1': 20}}
+        assert read['kits'] == [{'kitId': 'kit001'}]
+        header = await tables.backend.tables.find_one({'tablename': 'table1'})
+        assert 'components' not in header['table']
+
+    async def test_update_before_any_read_is_not_lost(self, embedded_table):
+        await tables.update_components('table1', [{'component1': {'value1': 11}}])
+        assert (await tables.get('table1'))['components']['component1'] == {'value1': 11}
+
+    async def test_migrating_again_keeps_newer_values(self, embedded_table):
+        # 並行した移行や、途中で落ちた移行のやり直しで、移った後の更新を巻き戻さない。
+        embedded = (await tables.backend.tables.find_one({'tablename': 'table1'}))['table']['components']
+        await tables.get('table1')
+        await tables.update_components('table1', [{'component1': {'value1': 11}}])
+        await tables.backend._split_embedded_components('table1', embedded)
+        assert (await tables.get('table1'))['components']['component1'] == {'value1': 11}
+
+    async def test_split_all(self, embedded_table):
+        assert await tables.split_embedded_components() == 1
+        assert await tables.split_embedded_components() == 0
+        assert len((await tables.get('table1'))['components']) == 2
+
+
+class TestCompactSchema:
+    """コンポーネントは詰めた形（store.compact）で保存し、読むときに元の形へ戻す。"""
+
+    CARD = {'name': 'card', 'top': '100px', 'left': '50px', 'faceupImage': '/static/images/card.png',
+            'showImage': True, 'draggable': True, 'flippable': True, 'ownable': True, 'resizable': False}
+
+    @pytest_asyncio.fixture
+    async def card_table(self, no_tables):
+        await tables.store('table1', {'components': {'c1': dict(self.CARD)}, 'kits': [], 'players': {}})
+
+    async def stored(self, component_id):
+        document = await tables.backend.table_components.find_one({'tablename': 'table1', 'componentId': component_id})
+        return document['component']
+
+    async def test_stored_compact_and_read_as_is(self, card_table):
+        assert await self.stored('c1') == compact.compact(self.CARD)
+        assert (await tables.get('table1'))['components']['c1'] == self.CARD
+
+    async def test_partial_update_is_stored_compact(self, card_table):
+        await tables.update_components('table1', [{'c1': {'top': '120px', 'owner': 'alice'}}])
+        assert await self.stored('c1') == compact.compact(dict(self.CARD, top='120px', owner='alice'))
+        assert (await tables.get('table1'))['components']['c1'] == dict(self.CARD, top='120px', owner='alice')
+
+    async def test_migrate_stored_components(self, no_tables):
+        await tables.store('table1', {'components': {}, 'kits': [], 'players': {}})
+        await tables.backend.table_components.insert_one(
+            {'tablename': 'table1', 'componentId': 'c1', 'component': dict(self.CARD)})
+        assert await tables.compact_stored_components() == 1
+        assert await tables.compact_stored_components() == 0
+        assert await self.stored('c1') == compact.compact(self.CARD)
+        assert (await tables.get('table1'))['components']['c1'] == self.CARD
+
+    async def test_migration_does_not_overwrite_a_newer_component(self, no_tables, monkeypatch):
+        await tables.store('table1', {'components': {}, 'kits': [], 'players': {}})
+        collection = tables.backend.table_components
+        await collection.insert_one({'tablename': 'table1', 'componentId': 'c1', 'component': dict(self.CARD)})
+        bulk_write = collection.bulk_write
+
+        async def updated_before_write(*args, **kwargs):
+            # 読んでから書くまでの間に、プレイ中の更新が入った
+            await collection.update_one({'componentId': 'c1'}, {'$set': {'component.top': '300px'}})
+            return await bulk_write(*args, **kwargs)
+
+        monkeypatch.setattr(collection, 'bulk_write', updated_before_write)
+        assert await tables.compact_stored_components() == 0
+        assert (await tables.get('table1'))['components']['c1']['top'] == '300px'
+
+
+class TestComponentTemplates:
+    """キットのコンポーネントは定義（テンプレート）への参照と、その卓での違いだけを保存する。"""
+
+    async def test_stored_as_reference(self, no_tables):
+        card = {'name': 'card', 'width': '64px', 'faceupImage': 'card.png'}
+        await components.purge_all()
+        await components.store_default([{'component': dict(card)}])
+        await tables.store('table1', {'components': {'c1': dict(card, top='10px')}, 'kits': [], 'players': {}})
+        document = await tables.backend.table_components.find_one({'tablename': 'table1', 'componentId': 'c1'})
+        assert compact.expand(document['component']) == {'~t': templates.template_id(card), 'top': '10px'}
+        assert await templates.backend.templates.count_documents({'_id': templates.template_id(card)}) == 1
+        assert (await tables.get('table1'))['components']['c1'] == dict(card, top='10px')
+
+
 class TestEnsureIndexes:
     async def test_tablename_is_indexed(self, app):
         # create_app() が起動時に呼ぶので、app フィクスチャを取った時点で貼られている。
-        for collection in (tables.tables, tables.table_metas):
+        for collection in (tables.backend.tables, tables.backend.table_metas):
             keys = [tuple(info['key']) for info in (await collection.index_information()).values()]
             assert (('tablename', 1),) in keys
 
+    async def test_component_documents_are_unique_per_table(self, no_tables):
+        await tables.backend.table_components.insert_one({'tablename': 'table1', 'componentId': 'c1'})
+        await tables.backend.table_components.insert_one({'tablename': 'table2', 'componentId': 'c1'})
+        with pytest.raises(DuplicateKeyError):
+            await tables.backend.table_components.insert_one({'tablename': 'table1', 'componentId': 'c1'})
+
     async def test_duplicate_tablename_is_rejected_in_tables(self, no_tables):
         # unique であること自体の確認。tablename は実質的な主キーなので、
         # 同じ名前の卓が2つできる状態を索引で防ぐ。
-        await tables.tables.insert_one({'tablename': 'table1', 'table': {}})
+        await tables.backend.tables.insert_one({'tablename': 'table1', 'table': {}})
         with pytest.raises(DuplicateKeyError):
-            await tables.tables.insert_one({'tablename': 'table1', 'table': {}})
+            await tables.backend.tables.insert_one({'tablename': 'table1', 'table': {}})
 
     async def test_duplicate_tablename_is_rejected_in_table_metas(self, no_tables):
         # table_metas 側も unique。ここが緩いと、purge_all() の削除漏れのような
         # 経路で重複が積み上がっても気づけない（実際それでテストDBに4696件溜まっていた）。
-        await tables.table_metas.insert_one({'tablename': 'table1'})
+        await tables.backend.table_metas.insert_one({'tablename': 'table1'})
         with pytest.raises(DuplicateKeyError):
-            await tables.table_metas.insert_one({'tablename': 'table1'})
+            await tables.backend.table_metas.insert_one({'tablename': 'table1'})
 
 
 class TestValidateComponentId:
@@ -0,0 +1,60 @@
+import asyncio
+
+import pytest
+import pytest_asyncio
+
+from asobann.store import tables
+
+
+@pytest_asyncio.fixture
+async def coalescing(no_tables):
+    tables.enable_write_coalescing(window=0.05)
+    yield
+    await tables.close()
+
+
+@pytest_asyncio.fixture
+async def table_with_several_components(coalescing):
+    await tables.store('table1', {
+        'components': {
+            'component1': {'value1': 10, 'value2': 20},
+            'component2': {'value1': 110, 'value2': 120},
+            'component3': {'value1': 210, 'value2': 220},
+        },
+        'kits': [],
+        'players': {},
+    })
+
+
+class TestWriteCoalescing:
+    async def test_concurrent_updates_become_one_write(self, table_with_several_components):
+        before = tables.write_stats()
+        await asyncio.gather(
+            tables.update_components('table1', [{'component1': {'value1': 11}}]),
+            tables.update_components('table1', [{'component1': {'value1': 12}}]),
+            tables.update_components('table1', [{'component2': {'value2': 121}}]),
+            tables.remove_components('table1', ['component3']),
+        )
+        after = tables.write_stats()
+        assert after['diffs'] - before['diffs'] == 4
+        assert after['writes'] - before['writes'] == 1
+
+        read = await tables.get('table1')
+        assert read['components']['component1']['value1'] in (11, 12)
+        assert read['components']['component2'] == {'value1': 110, 'value2': 121}
+        assert 'component3' not in read['components']
+
+    async def test_update_is_written_when_it_returns(self, table_with_several_components):
+        await tables.update_components('table1', [{'component1': {'value1': 11}}])
+        read = await tables.get('table1')
+        assert read['components']['component1'] == {'value1': 11, 'value2': 20}
+
+    async def test_unknown_table_raises(self, coalescing):
+        with pytest.raises(tables.TableNotFound):
+            await tables.remove_components('no_such_table', ['component1'])
+
+    async def test_read_waits_for_queued_updates(self, table_with_several_components):
+        written = await tables.update_components('table1', [{'component1': {'value1': 11}}], wait=False)
+        read = await tables.get('table1')
+        assert read['components']['component1'] == {'value1': 11, 'value2': 20}
+        await written
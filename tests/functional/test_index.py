@@ -1,9 +1,12 @@
+import json
 import os
 import pytest_asyncio
 
 os.environ["FLASK_ENV"] = "test"
 
 import asobann.app
+import asobann.config_common
+from asobann.app.wire import MsgPackNegotiatingServer
 
 
 @pytest_asyncio.fixture
@@ -39,3 +42,101 @@ async def test_googleanalytics_available_in_prod(app, client):
     assert b'Google Analytics' in data
     assert b'UA-' not in data
     assert b'id=dummy-id' in data
+
+
+async def test_metrics(client):
+    await client.get('/export?tablename=no-such-table')
+    resp = await client.get('/metrics')
+    assert resp.status_code == 200
+    assert resp.headers['Content-Type'].startswith('text/plain; version=0.0.4')
+    data = (await resp.get_data()).decode()
+    assert 'asobann_store_tables_seconds_count{function="get"}' in data
+    assert 'asobann_socket_connected_sids 0' in data
+
+
+
+
+async def test_debug_trace_latencies_rejects_bad_params(client):
+    for query in ('bucket=0', 'bucket=-1', 'bucket=abc', 'since=abc', 'until=abc', 'since=inf'):
+        resp = await client.get(f'/debug/trace_latencies?{query}')
+        assert resp.status_code == 400, query
+    assert (await client.get('/debug/get_traces?since=abc')).status_code == 400
+
+async def test_metrics_needs_the_token_when_set(monkeypatch):
+    monkeypatch.setattr(asobann.config_common, 'METRICS_TOKEN', 's3cret')
+    app = await asobann.app.create_app()
+    async with app.test_client() as client:
+        assert (await client.get('/metrics')).status_code == 401
+        assert (await client.get('/metrics', headers={'Authorization': 'Bearer wrong'})).status_code == 401
+        assert (await client.get('/metrics', headers={'Authorization': 'Bearer s3cret'})).status_code == 200
+
+
+async def test_metrics_is_closed_in_production_without_a_token(monkeypatch):
+    monkeypatch.setenv('FLASK_ENV', 'production')
+    monkeypatch.setenv('PUBLIC_HOSTNAME', 'asobann.example.com')
+    monkeypatch.setenv('GOOGLE_ANALYTICS_ID', 'dummy-id')
+    monkeypatch.setattr(asobann.config_common, 'STORAGE', 'memory')
+    app = await asobann.app.create_app()
+    async with app.test_client() as client:
+        assert (await client.get('/metrics')).status_code == 404
+
+async def test_debug_traces_are_written_in_the_background(client):
+    from asobann.app import debug_tools
+    await client.get('/debug/delete_traces')
+    data = {'traces': [{'traceId': 'abc', 'name': 'drag', 'points': []}], 'originator': 'alice'}
+    await client.post('/debug/add_traces', data=json.dumps(data))
+    await debug_tools.close()
+    resp = await client.get('/debug/get_traces?since=0')
+    assert [t['traces'] for t in (await resp.get_json())['data']] == [data]
+
+
+async def test_debug_trace_latencies(client):
+    from asobann.app import debug_tools
+    await client.get('/debug/delete_traces')
+    for originator, label, ts in (('alice', 'emitted', 1000), ('server', 'handle update many components', 1012)):
+        data = {'traces': [{'traceId': 'abc', 'name': None, 'points': [{'label': label, 'timestamp': ts}]}],
+                'originator': originator}
+        await client.post('/debug/add_traces', data=json.dumps(data))
+    await debug_tools.close()
+    resp = await client.get('/debug/trace_latencies?since=0&bucket=10'
+                            '&label=emitted&label=handle update many components')
+    [pair] = (await resp.get_json())['pairs']
+    assert pair['buckets'] == [{'start': 0, 'count': 1, 'p50': 12, 'p95': 12, 'p99': 12, 'max': 12}]
+
+
+async def test_wire_is_json_by_default(app):
+    assert not isinstance(app.sio, MsgPackNegotiatingServer)
+
+
+async def test_wire_msgpack_is_negotiated_per_connection(monkeypatch):
+    monkeypatch.setattr(asobann.config_common, 'WIRE_MSGPACK', True)
+    app = await asobann.app.create_app()
+    assert isinstance(app.sio, MsgPackNegotiatingServer)
+
+
+async def test_profile_needs_the_token_and_valid_params(monkeypatch):
+    monkeypatch.setattr(asobann.config_common, 'PROFILER', True)
+    monkeypatch.setattr(asobann.config_common, 'PROFILER_TOKEN', 's3cret')
+    app = await asobann.app.create_app()
+    auth = {'Authorization': 'Bearer s3cret'}
+    async with app.test_client() as client:
+        assert (await client.get('/debug/profile?seconds=0.01')).status_code == 401
+        for query in ('seconds=abc', 'seconds=0', 'seconds=nan', 'interval=-1'):
+            assert (await client.get(f'/debug/profile?{query}', headers=auth)).status_code == 400
+        assert (await client.get('/debug/profile?seconds=0.01', headers=auth)).status_code == 200
+
+
+async def test_profile_is_off_without_a_token(monkeypatch):
+    monkeypatch.setattr(asobann.config_common, 'PROFILER', True)
+    app = await asobann.app.create_app()
+    async with app.test_client() as client:
+        assert (await client.get('/debug/profile?seconds=0.01')).status_code == 404
+
+
+async def test_debug_traces_are_not_found_without_mongo(monkeypatch):
+    monkeypatch.setattr(asobann.config_common, 'STORAGE', 'memory')
+    app = await asobann.app.create_app()
+    async with app.test_client() as client:
+        for path in ('/debug/trace_latencies', '/debug/get_traces?since=0', '/debug/delete_traces',
+                     '/debug/delete_all_traces'):
+            assert (await client.get(path)).status_code == 404
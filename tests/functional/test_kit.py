@@ -1,4 +1,5 @@
 import os
+import pytest
 import pytest_asyncio
 import json
 
@@ -7,6 +8,7 @@ os.environ["FLASK_ENV"] = "test"
 # pylint: disable=E402
 import asobann.app
 import asobann.deploy
+from asobann.store import tables, kit_expansion
 
 
 @pytest_asyncio.fixture
@@ -37,3 +39,59 @@ async def test_get_kits(client, default_kits):
     data = json.loads(await resp.get_data())
     assert len(data) > 0
     assert data[0]['kit']['name'] == 'Note'
+
+
+PLACEMENT = {"baseZIndex": 10, "rect": {"left": 64, "top": 64, "width": 300, "height": 200}}
+
+
+async def test_kit_expanded_by_server_is_expanded_the_same_by_client(client, default_kits):
+    await tables.purge_all()
+    await tables.store('table1', {'components': {}, 'kits': [], 'players': {}})
+    expansion, new_components = await kit_expansion.prepare('Playing Card', 'k1', PLACEMENT)
+    await tables.add_new_kit_and_components('table1', {'name': 'Playing Card', 'kitId': 'k1'}, new_components)
+    stored = (await tables.get('table1'))['components']
+    assert stored == new_components
+    assert len(stored) == 56
+
+    # クライアントはテンプレートIDで定義を取ってきて、同じように展開する
+    resp = await client.get('/components/templates?ids=' + ','.join(expansion['templates'].values()))
+    fetched = json.loads(await resp.get_data())
+    definitions = {name: fetched[template_id] for name, template_id in expansion['templates'].items()}
+    assert kit_expansion.expand(expansion, definitions, 'k1', expansion['placement'], expansion['seed']) == stored
+
+
+async def test_kit_with_on_add_is_not_expanded_by_server(default_kits):
+    with pytest.raises(kit_expansion.KitExpansionError):
+        await kit_expansion.prepare('Dice (Blue)', 'k1', PLACEMENT)
+
+
+async def test_kit_placed_on_hand_areas_needs_a_rect_unless_it_deals_to_them(default_kits):
+    hand_areas_only = {"baseZIndex": 10, "handAreas": [{"left": 0, "top": 0, "width": 300, "height": 100}]}
+    with pytest.raises(kit_expansion.KitExpansionError):
+        await kit_expansion.prepare('Playing Card', 'k1', hand_areas_only)
+
+
+async def test_kit_that_cannot_be_expanded_is_returned_to_the_sender(app, default_kits, monkeypatch):
+    await tables.purge_all()
+    await tables.store('table1', {'components': {}, 'kits': [], 'players': {}})
+    emitted = []
+
+    async def emit(event, data, to=None, room=None, **kwargs):
+        emitted.append((event, data, to, room))
+
+    monkeypatch.setattr(app.sio, 'emit', emit)
+    kit = {'name': 'Dice (Blue)', 'kitId': 'k1'}
+    await app.sio._trigger_event('add kit', '/', 'sid1', {
+        'tablename': 'table1', 'originator': 'alice', 'kitData': {'kit': kit}, 'placement': PLACEMENT})
+    [(event, data, to, room)] = emitted
+    assert (event, data['kit'], to, room) == ('add kit rejected', kit, 'sid1', None)
+    assert (await tables.get('table1'))['kits'] == []
+
+
+async def test_templates_are_cached_only_when_all_are_found(client, default_kits):
+    expansion, _ = await kit_expansion.prepare('Playing Card', 'k1', PLACEMENT)
+    ids = ','.join(expansion['templates'].values())
+    resp = await client.get('/components/templates?ids=' + ids)
+    assert 'immutable' in resp.headers['Cache-Control']
+    resp = await client.get('/components/templates?ids=' + ids + ',no-such-template')
+    assert resp.headers['Cache-Control'] == 'no-store'
@@ -0,0 +1,71 @@
+import asyncio
+import os
+
+import pytest_asyncio
+
+os.environ["FLASK_ENV"] = "test"
+
+import asobann.app
+import asobann.config_common
+from asobann.store import tables, oplog
+
+
+@pytest_asyncio.fixture
+async def coalescing_app(monkeypatch):
+    os.environ["FLASK_ENV"] = "test"
+    monkeypatch.setattr(asobann.config_common, 'STORAGE', 'memory')
+    monkeypatch.setattr(asobann.config_common, 'OPLOG_LENGTH', 100)
+    monkeypatch.setattr(asobann.config_common, 'WRITE_COALESCING_WINDOW', 0.05)
+    app = await asobann.app.create_app()
+    emitted = []
+
+    async def emit(event, data=None, to=None, room=None, **kwargs):
+        emitted.append((event, data))
+
+    monkeypatch.setattr(app.sio, 'emit', emit)
+    app.emitted = emitted
+    yield app
+    await tables.close()
+    oplog.disable()
+
+
+def update(top):
+    return {'tablename': 'table1', 'originator': 'alice', 'diffs': [{'c1': {'top': top}}],
+            'componentIdsToRemove': []}
+
+
+async def test_sequenced_updates_share_one_coalesced_write(coalescing_app):
+    await tables.store('table1', {'components': {'c1': {'top': 0}}, 'kits': [], 'players': {}})
+    before = tables.write_stats()
+    await asyncio.gather(*[
+        coalescing_app.sio._trigger_event('update many components', '/', 'sid1', update(top))
+        for top in range(10)])
+    assert tables.write_stats()['writes'] - before['writes'] == 1
+    # seq 順に適用した最後の値が、卓に残った値と同じ
+    last = (await oplog.since('table1', 0))[-1]
+    assert last['data']['diffs'] == [{'c1': {'top': (await tables.get('table1'))['components']['c1']['top']}}]
+
+
+async def test_set_player_writes_only_players(coalescing_app):
+    await tables.store('table1', {'components': {'c1': {'top': 0}}, 'kits': [], 'players': {}})
+    await coalescing_app.sio._trigger_event('set player name', '/', 'sid1', {
+        'tablename': 'table1', 'player': {'name': 'a.b', 'isHost': True}})
+    table = await tables.get('table1')
+    assert table['players'] == {'a.b': {'name': 'a.b', 'isHost': True}}
+    assert table['components'] == {'c1': {'top': 0}}
+    assert coalescing_app.emitted == [('confirmed player name', {'player': {'name': 'a.b'}})]
+
+
+async def test_set_player_keeps_an_update_made_while_it_reads(coalescing_app, monkeypatch):
+    await tables.store('table1', {'components': {'c1': {'top': 0}}, 'kits': [], 'players': {}})
+    get = tables.get
+
+    async def get_then_update(tablename, read_only=False):
+        table = await get(tablename, read_only=read_only)
+        await tables.update_components('table1', [{'c1': {'top': 5}}])
+        return table
+
+    monkeypatch.setattr(tables, 'get', get_then_update)
+    await coalescing_app.sio._trigger_event('set player name', '/', 'sid1', {
+        'tablename': 'table1', 'player': {'name': 'alice', 'isHost': True}})
+    assert (await get('table1'))['components']['c1'] == {'top': 5}
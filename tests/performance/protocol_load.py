@@ -0,0 +1,447 @@
+"""
+Headless load generator that speaks socket.io directly, instead of driving browsers.
+
+Each simulated player is one websocket connection that sends the same events as
+src/js/sync_table.js: `come by table` and `set player name` to join, `mouse movement`
+for the cursor, `update many components` with `volatileKeys` for drags, and `add kit`.
+Nothing is rendered, so one process holds thousands of players on a single core - the
+browser workers of framework.py/sustained_load.py top out at a few dozen per machine.
+Keep the browser workers for correctness checks (does the cursor actually move on the
+other screen); use this one to put load on the server.
+
+Latency is measured per message. Every event a player sends carries its send time
+(`sentAt` inside the mouse movement, `loadgenSentAt` as a volatile key of the dragged
+component, `loadgenSentAt` on the added kit), and every other player in the table
+records receive time minus send time. All players of a run share this process's clock,
+so no cross-machine clock comparison is involved (see sustained_load.same_machine_pairs
+for why that matters). To use more cores, start one process per core with different
+--table-prefix values; each process reports its own tables.
+
+Behaviour is scriptable: --profile is one of PROFILES below, or `package.module:function`
+naming an `async def profile(player, params)` that runs until cancelled. `params` holds
+DEFAULTS overridden with --param key=value.
+
+Output: {'players', 'tables', 'failed_to_join', 'total': {...}, 'timeline': [...]}.
+`total` and each timeline entry map event name to sent/received counts and
+p50/p95/p99/max latency in ms; timeline entries cover --report-interval seconds each,
+attributed by send time.
+
+The websocket client is `websockets`, which the app already depends on through
+uvicorn[standard].
+
+Run: python -m tests.performance.protocol_load --url http://localhost:5000 \
+    --players 2000 --players-per-table 6 --profile dragger --duration 600 \
+    --param mousemove_hz=30 --output results/protocol_load.json
+"""
+
+import asyncio
+import importlib
+import json
+import math
+import random
+import sys
+import time
+import uuid
+from typing import Callable, Dict, List, Optional
+
+DEFAULTS = {
+    'mousemove_hz': 30,
+    'drag_interval_seconds': 10,
+    # sync_table.js flushes its component update buffer every 75ms
+    'drag_hz': 13,
+    'drag_steps': 20,
+    'kit_interval_seconds': 60,
+    'kit_components': 10,
+}
+
+# How long to wait for `load table` after `come by table` before counting the player
+# as failed to join.
+JOIN_TIMEOUT_SECONDS = 30
+
+# How long to keep receiving after the profiles stop, so the run's own tail traffic is
+# not counted as lost.
+SETTLE_SECONDS = 3
+
+
+def log(*args):
+    print(*args)
+    sys.stdout.flush()
+
+
+def now_ms():
+    return time.time() * 1000
+
+
+def encode_event(event: str, data) -> str:
+    """engine.io MESSAGE (4) + socket.io EVENT (2) on the default namespace, JSON payload."""
+    return '42' + json.dumps([event, data], separators=(',', ':'))
+
+
+def decode_event(message: str):
+    """(event, data) for an event packet on the default namespace, None for anything else."""
+    if not message.startswith('42'):
+        return None
+    decoded = json.loads(message[2:])
+    if len(decoded) < 2:
+        return decoded[0], None
+    return decoded[0], decoded[1]
+
+
+def websocket_url(url: str) -> str:
+    base = url.rstrip('/')
+    if base.startswith('https://'):
+        base = 'wss://' + base[len('https://'):]
+    elif base.startswith('http://'):
+        base = 'ws://' + base[len('http://'):]
+    # Straight to websocket: no long-polling handshake, no upgrade.
+    return base + '/socket.io/?EIO=4&transport=websocket'
+
+
+def percentile(ordered: List[float], p: float) -> float:
+    """Nearest-rank percentile of an already sorted list."""
+    return ordered[max(1, math.ceil(p / 100 * len(ordered))) - 1]
+
+
+class LatencyRecorder:
+    """Sent counts and received latencies per event, bucketed by send time."""
+
+    def __init__(self, report_interval_seconds: float):
+        self.report_interval_ms = report_interval_seconds * 1000
+        self.started_at = now_ms()
+        # interval index -> event -> count / [latency ms]
+        self.sent_counts: Dict[int, Dict[str, int]] = {}
+        self.latencies: Dict[int, Dict[str, List[float]]] = {}
+
+    def _interval(self, at_ms: float) -> int:
+        return max(0, int((at_ms - self.started_at) // self.report_interval_ms))
+
+    def sent(self, event: str, sent_at: float):
+        counts = self.sent_counts.setdefault(self._interval(sent_at), {})
+        counts[event] = counts.get(event, 0) + 1
+
+    def received(self, event: str, sent_at: float):
+        latency = now_ms() - sent_at
+        self.latencies.setdefault(self._interval(sent_at), {}).setdefault(event, []).append(latency)
+
+    @staticmethod
+    def _summarize(sent: Dict[str, int], latencies: Dict[str, List[float]]) -> dict:
+        summary = {}
+        for event in sorted(set(sent) | set(latencies)):
+            ordered = sorted(latencies.get(event, []))
+            entry = {'sent': sent.get(event, 0), 'received': len(ordered)}
+            if ordered:
+                entry.update(p50=percentile(ordered, 50), p95=percentile(ordered, 95),
+                             p99=percentile(ordered, 99), max=ordered[-1])
+            summary[event] = entry
+        return summary
+
+    def timeline(self) -> List[dict]:
+        intervals = sorted(set(self.sent_counts) | set(self.latencies))
+        return [{
+            'elapsed_seconds': int(interval * self.report_interval_ms / 1000),
+            'events': self._summarize(self.sent_counts.get(interval, {}), self.latencies.get(interval, {})),
+        } for interval in intervals]
+
+    def total(self) -> dict:
+        sent, latencies = {}, {}
+        for counts in self.sent_counts.values():
+            for event, count in counts.items():
+                sent[event] = sent.get(event, 0) + count
+        for by_event in self.latencies.values():
+            for event, values in by_event.items():
+                latencies.setdefault(event, []).extend(values)
+        return self._summarize(sent, latencies)
+
+
+class Player:
+    """One simulated browser tab: a socket.io connection joined to one table."""
+
+    def __init__(self, name: str, url: str, tablename: str, recorder: LatencyRecorder):
+        self.name = name
+        self.url = url
+        self.tablename = tablename
+        self.recorder = recorder
+        # sync_table.js's context.client_connection_id; used as `originator`
+        self.client_connection_id = uuid.uuid4().hex[:12]
+        self.table: Optional[dict] = None
+        self._loaded = asyncio.Event()
+        self._websocket = None
+        self._receiving = None
+
+    async def join(self):
+        await self.connect()
+        await self._send('come by table', {'tablename': self.tablename})
+        await asyncio.wait_for(self._loaded.wait(), JOIN_TIMEOUT_SECONDS)
+        await self._send('set player name', {
+            'tablename': self.tablename,
+            'player': {'name': self.name, 'isHost': False},
+        })
+
+    async def connect(self):
+        """Open the socket.io connection without joining any table."""
+        import websockets
+
+        self._websocket = await websockets.connect(
+            websocket_url(self.url), max_size=None, compression=None, ping_interval=None)
+        opening = await self._websocket.recv()
+        if not opening.startswith('0'):
+            raise RuntimeError(f'unexpected engine.io open packet: {opening[:50]}')
+        await self._websocket.send('40')
+        # Events sent before the namespace connect is acknowledged can be handled before
+        # it (the server handles messages concurrently) and get dropped.
+        while not (await self._websocket.recv()).startswith('40'):
+            pass
+        self._receiving = asyncio.get_running_loop().create_task(self._receive())
+
+    async def close(self):
+        if self._receiving:
+            self._receiving.cancel()
+            await asyncio.gather(self._receiving, return_exceptions=True)
+        if self._websocket:
+            await self._websocket.close()
+
+    async def _send(self, event: str, data):
+        await self._websocket.send(encode_event(event, data))
+
+    async def _receive(self):
+        async for message in self._websocket:
+            if message == '2':
+                # engine.io ping from the server
+                await self._websocket.send('3')
+                continue
+            decoded = decode_event(message)
+            if decoded:
+                self.on_event(*decoded)
+
+    def on_event(self, event: str, data):
+        if event == 'load table':
+            self.table = data
+            self._loaded.set()
+        elif event == 'mouse movement':
+            self._received_movement(data)
+        elif event == 'mouse movements':
+            # batched by the server (ASOBANN_MOUSE_MOVEMENT_TICK / ASOBANN_OUTBOUND_HIGH_WATER)
+            for movement in data['movements']:
+                self._received_movement(movement)
+        elif event == 'update many components':
+            for update in data['updates'] if 'updates' in data else [data]:
+                if update.get('originator') == self.client_connection_id:
+                    continue
+                for diff in update['diffs']:
+                    for value in diff.values():
+                        if 'loadgenSentAt' in value:
+                            self.recorder.received('update many components', value['loadgenSentAt'])
+        elif event == 'add kit':
+            if data.get('originator') != self.client_connection_id and 'loadgenSentAt' in data['kit']:
+                self.recorder.received('add kit', data['kit']['loadgenSentAt'])
+
+    def _received_movement(self, movement):
+        if movement['playerName'] == self.name:
+            return
+        sent_at = movement['mouseMovement'].get('sentAt')
+        if sent_at is not None:
+            self.recorder.received('mouse movement', sent_at)
+
+    def component_ids(self) -> List[str]:
+        return sorted(self.table.get('components', {})) if self.table else []
+
+    async def move_cursor(self, x: int, y: int):
+        sent_at = now_ms()
+        await self._send('mouse movement', {
+            'tablename': self.tablename,
+            'playerName': self.name,
+            'mouseMovement': {'mouseOnTableX': x, 'mouseOnTableY': y, 'mouseButtons': 0, 'sentAt': sent_at},
+        })
+        self.recorder.sent('mouse movement', sent_at)
+
+    async def update_component(self, component_id: str, diff: dict, volatile: bool):
+        """One flush of sync_table.js's ComponentUpdateBuffer for a single component."""
+        sent_at = now_ms()
+        volatile_keys = list(diff) if volatile else []
+        await self._send('update many components', {
+            'tablename': self.tablename,
+            'originator': self.client_connection_id,
+            'diffs': [{component_id: dict(diff, loadgenSentAt=sent_at)}],
+            'componentIdsToRemove': [],
+            # the timestamp is never persisted, even at the end of a drag
+            'volatileKeys': {component_id: volatile_keys + ['loadgenSentAt']},
+        })
+        self.recorder.sent('update many components', sent_at)
+
+    async def drag(self, component_id: str, steps: int, hz: float):
+        """Intermediate positions are volatile; the drop persists the final one."""
+        left, top = random.randint(0, 600), random.randint(0, 600)
+        for step in range(steps):
+            await self.update_component(
+                component_id, {'left': f'{left + step}px', 'top': f'{top + step}px'}, volatile=step < steps - 1)
+            await asyncio.sleep(1 / hz)
+
+    async def add_kit(self, component_count: int):
+        sent_at = now_ms()
+        kit_id = uuid.uuid4().hex
+        new_components = {}
+        for n in range(component_count):
+            component_id = f'loadgen-{kit_id}-{n}'
+            new_components[component_id] = {
+                'componentId': component_id, 'kitId': kit_id, 'name': f'loadgen {n}',
+                'left': f'{n * 10}px', 'top': '0px', 'width': '50px', 'height': '75px',
+                'draggable': True, 'flippable': False, 'zIndex': n,
+            }
+        await self._send('add kit', {
+            'tablename': self.tablename,
+            'originator': self.client_connection_id,
+            'kitData': {'kit': {'name': 'loadgen', 'kitId': kit_id, 'loadgenSentAt': sent_at}},
+            'newComponents': new_components,
+        })
+        self.recorder.sent('add kit', sent_at)
+
+
+async def idle(player: Player, params: dict):
+    """Joined and listening; sends nothing."""
+    await asyncio.Event().wait()
+
+
+async def cursor(player: Player, params: dict):
+    """Moves the cursor continuously, like GameHelper.start_mouse_load."""
+    interval = 1 / params['mousemove_hz']
+    x, y = random.randint(0, 100), random.randint(0, 100)
+    while True:
+        x = (x + 1) % 1000
+        await player.move_cursor(x, y)
+        await asyncio.sleep(interval)
+
+
+async def dragger(player: Player, params: dict):
+    """Cursor load, plus dragging one of the table's components every drag_interval_seconds."""
+    cursor_task = asyncio.get_running_loop().create_task(cursor(player, params))
+    try:
+        if params['drag_interval_seconds'] <= 0:
+            await asyncio.Event().wait()
+        # spread the players' drags over the interval
+        await asyncio.sleep(random.uniform(0, params['drag_interval_seconds']))
+        while True:
+            component_ids = player.component_ids()
+            if component_ids:
+                await player.drag(random.choice(component_ids), params['drag_steps'], params['drag_hz'])
+            await asyncio.sleep(params['drag_interval_seconds'])
+    finally:
+        cursor_task.cancel()
+
+
+async def kit_adder(player: Player, params: dict):
+    """dragger, plus adding a kit every kit_interval_seconds."""
+    dragging = asyncio.get_running_loop().create_task(dragger(player, params))
+    try:
+        await asyncio.sleep(random.uniform(0, params['kit_interval_seconds']))
+        while True:
+            await player.add_kit(params['kit_components'])
+            await asyncio.sleep(params['kit_interval_seconds'])
+    finally:
+        dragging.cancel()
+
+
+PROFILES: Dict[str, Callable] = {
+    'idle': idle,
+    'cursor': cursor,
+    'dragger': dragger,
+    'kit_adder': kit_adder,
+}
+
+
+def resolve_profile(spec: str) -> Callable:
+    if spec in PROFILES:
+        return PROFILES[spec]
+    module_name, _, function_name = spec.partition(':')
+    if not function_name:
+        raise ValueError(f'unknown profile "{spec}": use one of {sorted(PROFILES)} or module:function')
+    return getattr(importlib.import_module(module_name), function_name)
+
+
+def get_params(parameters: Dict[str, str]) -> dict:
+    """DEFAULTS overridden by --param values, converted to the default's type.
+
+    Keys not in DEFAULTS (for a custom profile) are passed through as strings.
+    """
+    params = dict(DEFAULTS)
+    for key, value in parameters.items():
+        params[key] = type(DEFAULTS[key])(value) if key in DEFAULTS else value
+    return params
+
+
+async def run(url: str, players: int, players_per_table: int, profile: Callable, params: dict,
+              duration_seconds: float, report_interval_seconds: float = 60, ramp_up_seconds: float = 10,
+              table_prefix: str = None) -> dict:
+    recorder = LatencyRecorder(report_interval_seconds)
+    table_prefix = table_prefix or f'loadgen-{uuid.uuid4().hex[:8]}'
+    simulated = [Player(f'P{n}', url, f'{table_prefix}-{n // players_per_table}', recorder)
+                 for n in range(players)]
+
+    async def join(player, delay):
+        await asyncio.sleep(delay)
+        try:
+            await player.join()
+            return True
+        except Exception as e:
+            log(f'{player.name} failed to join {player.tablename}: {e!r}')
+            return False
+
+    log(f'joining {players} players to {math.ceil(players / players_per_table)} tables over {ramp_up_seconds}s')
+    joined = await asyncio.gather(*(join(player, ramp_up_seconds * n / players)
+                                    for n, player in enumerate(simulated)))
+    active = [player for player, ok in zip(simulated, joined) if ok]
+    log(f'{len(active)} players joined; running {profile.__name__} for {duration_seconds}s')
+
+    loop = asyncio.get_running_loop()
+    behaviours = [loop.create_task(profile(player, params)) for player in active]
+    await asyncio.sleep(duration_seconds)
+    for behaviour in behaviours:
+        behaviour.cancel()
+    results = await asyncio.gather(*behaviours, return_exceptions=True)
+    for player, result in zip(active, results):
+        if isinstance(result, Exception) and not isinstance(result, asyncio.CancelledError):
+            log(f'{player.name} stopped with {result!r}')
+    await asyncio.sleep(SETTLE_SECONDS)
+    await asyncio.gather(*(player.close() for player in simulated), return_exceptions=True)
+
+    return {
+        'players': players,
+        'tables': sorted({player.tablename for player in simulated}),
+        'failed_to_join': players - len(active),
+        'total': recorder.total(),
+        'timeline': recorder.timeline(),
+    }
+
+
+def main():
+    import typer
+
+    def command(url: str = typer.Option(...),
+                players: int = typer.Option(100),
+                players_per_table: int = typer.Option(6),
+                profile: str = typer.Option('dragger'),
+                duration: float = typer.Option(60, help='seconds of load after everyone joined'),
+                report_interval: float = typer.Option(60),
+                ramp_up: float = typer.Option(10, help='seconds to spread the joins over'),
+                table_prefix: Optional[str] = typer.Option(None),
+                param: List[str] = typer.Option([], help='key=value overriding DEFAULTS'),
+                output: Optional[str] = typer.Option(None)):
+        from .cli import parse_params
+        try:
+            # the app runs on uvloop too (asgi.py); the generator should not be the bottleneck
+            from uvloop import run as run_loop
+        except ImportError:
+            run_loop = asyncio.run
+        result = run_loop(run(url, players, players_per_table, resolve_profile(profile),
+                                 get_params(parse_params(param)), duration,
+                                 report_interval_seconds=report_interval, ramp_up_seconds=ramp_up,
+                                 table_prefix=table_prefix))
+        print(json.dumps(result['total'], indent=2))
+        if output:
+            with open(output, 'w') as f:
+                json.dump(result, f, indent=2)
+
+    typer.run(command)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,216 @@
+"""
+Replay recorded table sessions against a server, as a repeatable benchmark.
+
+A recording is what the server writes with ASOBANN_RECORD_EVENTS: gzipped NDJSON, one
+inbound event per line, {'t', 'sid', 'table', 'event', 'data'} (see
+src/asobann/app/event_recorder.py). Record on staging or production while people play,
+then replay the same traffic against a local server before and after a change.
+
+Every recorded sid becomes one connection (protocol_load.Player, without its scripted
+join) that sends that sid's events in order, at the recorded offsets divided by --speed.
+--speed 0 sends as fast as possible, keeping only the order within each connection.
+--copies runs the whole recording that many times at once, each copy on its own tables
+(`<prefix>-<copy>-<recorded table>`) and starting --offset seconds after the previous one, so a
+recording of two tables can stand in for a few hundred.
+
+Latency uses the same markers as protocol_load: the send time is stamped into
+`mouse movement` (sentAt) and `update many components` (the volatile key
+loadgenSentAt), and the other replayed players in the table record how long it took
+to reach them. `load table` is the time from `come by table` to the table arriving.
+`send_lag` is how far behind the recorded schedule the replayer fell; if it grows, the
+replayer is the bottleneck and the run says nothing about the server.
+
+Output: {'connections', 'copies', 'speed', 'failed', 'sent', 'received',
+'send_lag_ms', 'total', 'timeline'}; `total` and `timeline` are LatencyRecorder's.
+
+Run: python -m tests.performance.replay --url http://localhost:5000 \
+    --recording recordings/events-20261018-201500-1.ndjson.gz --speed 1 \
+    --copies 20 --offset 30 --output results/replay.json
+"""
+
+import asyncio
+import collections
+import gzip
+import json
+import uuid
+from typing import Dict, List, Optional
+
+from .protocol_load import LatencyRecorder, Player, log, now_ms, percentile
+
+
+def load(paths: List[str]) -> List[dict]:
+    """Events of all recordings, oldest first."""
+    events = []
+    for path in paths:
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            events.extend(json.loads(line) for line in f if line.strip())
+    events.sort(key=lambda e: e['t'])
+    return events
+
+
+def sessions(events: List[dict]) -> Dict[str, List[dict]]:
+    """sid -> that connection's events, in order."""
+    by_sid = {}
+    for event in events:
+        by_sid.setdefault(event['sid'], []).append(event)
+    return by_sid
+
+
+def rewrite(event: str, data, table_prefix: str, sent_at: float):
+    """The recorded payload, moved to the replay's copy of its table and stamped for latency."""
+    if not isinstance(data, dict):
+        return data
+    data = dict(data)
+    if 'tablename' in data:
+        data['tablename'] = table_prefix + data['tablename']
+    if event == 'come by table':
+        # the replay's tables have their own operation log
+        data.pop('lastSeq', None)
+    elif event == 'mouse movement':
+        data['mouseMovement'] = dict(data.get('mouseMovement') or {}, sentAt=sent_at)
+    elif event == 'update many components' and data.get('diffs'):
+        diffs = [{component_id: dict(diff, loadgenSentAt=sent_at) for component_id, diff in entry.items()}
+                 for entry in data['diffs']]
+        volatile_keys = {component_id: list(keys) for component_id, keys in (data.get('volatileKeys') or {}).items()}
+        for entry in diffs:
+            for component_id in entry:
+                volatile_keys.setdefault(component_id, []).append('loadgenSentAt')
+        data['diffs'] = diffs
+        data['volatileKeys'] = volatile_keys
+    return data
+
+
+class ReplayedClient(Player):
+    """One recorded connection, sending what it sent then."""
+
+    def __init__(self, url: str, table_prefix: str, recorder: LatencyRecorder, received: collections.Counter):
+        super().__init__(name='', url=url, tablename='', recorder=recorder)
+        self.table_prefix = table_prefix
+        self.received_counts = received
+        self._joining_at = None
+
+    def on_event(self, event: str, data):
+        self.received_counts[event] += 1
+        if event == 'load table' and self._joining_at is not None:
+            self.recorder.received('load table', self._joining_at)
+            self._joining_at = None
+        super().on_event(event, data)
+
+    async def send(self, event: str, data):
+        sent_at = now_ms()
+        if isinstance(data, dict):
+            # Player.on_event skips this client's own messages by these
+            if event == 'set player name':
+                self.name = data.get('player', {}).get('name', self.name)
+            elif event == 'update many components':
+                self.client_connection_id = data.get('originator', self.client_connection_id)
+        data = rewrite(event, data, self.table_prefix, sent_at)
+        if isinstance(data, dict) and 'tablename' in data:
+            self.tablename = data['tablename']
+        await self._send(event, data)
+        if event == 'come by table':
+            self._joining_at = sent_at
+            self.recorder.sent('load table', sent_at)
+        elif event in ('mouse movement', 'update many components'):
+            self.recorder.sent(event, sent_at)
+
+
+async def replay_session(client: ReplayedClient, events: List[dict], started_at: float, recording_start: float,
+                         speed: float, sent: collections.Counter, lags: List[float]):
+    """Connect when the recorded connection appeared and send its events on schedule."""
+
+    async def wait_until(recorded_at):
+        if speed <= 0:
+            return
+        delay = started_at + (recorded_at - recording_start) / speed - now_ms()
+        if delay > 0:
+            await asyncio.sleep(delay / 1000)
+        else:
+            lags.append(-delay)
+
+    if speed <= 0:
+        # no schedule within a copy, but the copies still start --offset apart
+        await asyncio.sleep(max(0.0, started_at - now_ms()) / 1000)
+    await wait_until(events[0]['t'])
+    await client.connect()
+    for event in events:
+        if event['event'] == 'connect':
+            continue
+        if event['event'] == 'disconnect':
+            await client.close()
+            break
+        await wait_until(event['t'])
+        await client.send(event['event'], event['data'])
+        sent[event['event']] += 1
+
+
+async def run(url: str, events: List[dict], speed: float = 1, copies: int = 1, offset_seconds: float = 0,
+              report_interval_seconds: float = 60, table_prefix: Optional[str] = None) -> dict:
+    recorder = LatencyRecorder(report_interval_seconds)
+    table_prefix = table_prefix or f'replay-{uuid.uuid4().hex[:8]}'
+    sent, received = collections.Counter(), collections.Counter()
+    lags = []
+    recording_start = events[0]['t']
+    started_at = now_ms()
+
+    clients, tasks = [], []
+    recorded = sessions(events)
+    for copy in range(copies):
+        for session in recorded.values():
+            client = ReplayedClient(url, f'{table_prefix}-{copy}-', recorder, received)
+            clients.append(client)
+            tasks.append(replay_session(client, session, started_at + copy * offset_seconds * 1000,
+                                        recording_start, speed, sent, lags))
+
+    log(f'replaying {len(events)} events of {len(recorded)} connections x {copies} copies')
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    failed = 0
+    for client, result in zip(clients, results):
+        if isinstance(result, Exception):
+            failed += 1
+            log(f'{client.tablename or client.table_prefix} {client.name}: {result!r}')
+    await asyncio.gather(*(client.close() for client in clients), return_exceptions=True)
+
+    lags.sort()
+    return {
+        'connections': len(clients),
+        'copies': copies,
+        'speed': speed,
+        'failed': failed,
+        'sent': dict(sent),
+        'received': dict(received),
+        'send_lag_ms': {'count': len(lags), 'p50': percentile(lags, 50), 'p99': percentile(lags, 99),
+                        'max': lags[-1]} if lags else {'count': 0},
+        'total': recorder.total(),
+        'timeline': recorder.timeline(),
+    }
+
+
+def main():
+    import typer
+
+    def command(url: str = typer.Option(...),
+                recording: List[str] = typer.Option(..., help='recorded .ndjson.gz; repeat for several'),
+                speed: float = typer.Option(1, help='1 = as recorded, 4 = four times faster, 0 = no waits'),
+                copies: int = typer.Option(1),
+                offset: float = typer.Option(0, help='seconds between the starts of copies'),
+                report_interval: float = typer.Option(60),
+                table_prefix: Optional[str] = typer.Option(None),
+                output: Optional[str] = typer.Option(None)):
+        try:
+            # the app runs on uvloop too (asgi.py); the replayer should not be the bottleneck
+            from uvloop import run as run_loop
+        except ImportError:
+            run_loop = asyncio.run
+        result = run_loop(run(url, load(recording), speed=speed, copies=copies, offset_seconds=offset,
+                              report_interval_seconds=report_interval, table_prefix=table_prefix))
+        print(json.dumps({key: result[key] for key in ('failed', 'send_lag_ms', 'total')}, indent=2))
+        if output:
+            with open(output, 'w') as f:
+                json.dump(result, f, indent=2)
+
+    typer.run(command)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+import asyncio
+
+import pytest
+
+from .protocol_load import LatencyRecorder, Player, decode_event, encode_event, get_params, now_ms, \
+    resolve_profile, websocket_url, PROFILES
+
+
+def test_event_packets_round_trip():
+    message = encode_event('mouse movement', {'tablename': 't', 'x': 1})
+    assert message == '42["mouse movement",{"tablename":"t","x":1}]'
+    assert decode_event(message) == ('mouse movement', {'tablename': 't', 'x': 1})
+    assert decode_event('40{"sid":"abc"}') is None
+
+
+def test_websocket_url():
+    assert websocket_url('https://staging.example/') == 'wss://staging.example/socket.io/?EIO=4&transport=websocket'
+    assert websocket_url('http://localhost:5000') == 'ws://localhost:5000/socket.io/?EIO=4&transport=websocket'
+
+
+def test_params_keep_the_type_of_the_defaults():
+    params = get_params({'drag_steps': '5', 'mousemove_hz': '10', 'custom': 'x'})
+    assert (params['drag_steps'], params['mousemove_hz'], params['custom']) == (5, 10, 'x')
+    assert params['drag_hz'] == 13
+
+
+def test_profiles_resolve_by_name_or_module_path():
+    assert resolve_profile('dragger') is PROFILES['dragger']
+    assert resolve_profile('tests.performance.protocol_load:idle') is PROFILES['idle']
+    with pytest.raises(ValueError):
+        resolve_profile('no_such_profile')
+
+
+class TestPlayer:
+    def player(self, recorder):
+        return Player('P1', 'http://localhost', 'table1', recorder)
+
+    def test_other_players_messages_are_measured(self):
+        recorder = LatencyRecorder(report_interval_seconds=60)
+        player = self.player(recorder)
+        sent_at = now_ms() - 20
+        player.on_event('mouse movements', {'tablename': 'table1', 'movements': [
+            {'playerName': 'P0', 'mouseMovement': {'sentAt': sent_at}},
+            {'playerName': 'P1', 'mouseMovement': {'sentAt': sent_at}},
+        ]})
+        player.on_event('update many components', {'tablename': 'table1', 'updates': [
+            {'originator': 'other', 'diffs': [{'c1': {'top': '1px', 'loadgenSentAt': sent_at}}]},
+            {'originator': player.client_connection_id, 'diffs': [{'c1': {'loadgenSentAt': sent_at}}]},
+        ]})
+        total = recorder.total()
+        assert total['mouse movement']['received'] == 1
+        assert total['update many components']['received'] == 1
+        assert total['mouse movement']['p50'] >= 20
+
+    def test_latencies_are_reported_per_interval_of_send_time(self):
+        recorder = LatencyRecorder(report_interval_seconds=1)
+        recorder.sent('mouse movement', recorder.started_at + 10)
+        recorder.sent('mouse movement', recorder.started_at + 1500)
+        recorder.received('mouse movement', recorder.started_at + 1500)
+        timeline = recorder.timeline()
+        assert [entry['elapsed_seconds'] for entry in timeline] == [0, 1]
+        assert timeline[0]['events']['mouse movement'] == {'sent': 1, 'received': 0}
+        assert timeline[1]['events']['mouse movement']['received'] == 1
+
+
+async def test_drag_sends_volatile_steps_then_a_persisted_drop():
+    sent = []
+
+    class Recording(Player):
+        async def _send(self, event, data):
+            sent.append(data)
+
+    player = Recording('P1', 'http://localhost', 'table1', LatencyRecorder(60))
+    await player.drag('c1', steps=3, hz=1000)
+    assert [update['volatileKeys']['c1'] for update in sent] == [
+        ['left', 'top', 'loadgenSentAt'], ['left', 'top', 'loadgenSentAt'], ['loadgenSentAt']]
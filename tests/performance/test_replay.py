@@ -0,0 +1,56 @@
+import collections
+import gzip
+import json
+
+from .protocol_load import LatencyRecorder
+from .replay import ReplayedClient, load, replay_session, rewrite, sessions
+
+
+def recorded(t, sid, event, data=None):
+    return {'t': t, 'sid': sid, 'table': (data or {}).get('tablename'), 'event': event, 'data': data}
+
+
+def test_recordings_are_merged_in_time_order(tmp_path):
+    for name, events in (('a', [recorded(2, 's1', 'x')]), ('b', [recorded(1, 's2', 'y'), recorded(3, 's2', 'z')])):
+        with gzip.open(tmp_path / f'{name}.ndjson.gz', 'wt') as f:
+            f.writelines(json.dumps(e) + '\n' for e in events)
+    events = load([str(tmp_path / 'a.ndjson.gz'), str(tmp_path / 'b.ndjson.gz')])
+    assert [e['event'] for e in events] == ['y', 'x', 'z']
+    assert {sid: [e['event'] for e in session] for sid, session in sessions(events).items()} == {
+        's2': ['y', 'z'], 's1': ['x']}
+
+
+def test_rewrite_moves_to_the_copy_and_stamps_send_time():
+    data = rewrite('update many components', {
+        'tablename': 'table1',
+        'diffs': [{'c1': {'top': '1px'}}],
+        'volatileKeys': {'c1': ['top']},
+    }, 'replay-0-', 1000)
+    assert data['tablename'] == 'replay-0-table1'
+    assert data['diffs'] == [{'c1': {'top': '1px', 'loadgenSentAt': 1000}}]
+    assert data['volatileKeys'] == {'c1': ['top', 'loadgenSentAt']}
+    assert 'lastSeq' not in rewrite('come by table', {'tablename': 't', 'lastSeq': 5}, '', 0)
+
+
+async def test_session_is_sent_in_order_until_disconnect():
+    sent_messages = []
+
+    class Offline(ReplayedClient):
+        async def connect(self):
+            pass
+
+        async def _send(self, event, data):
+            sent_messages.append((event, data.get('tablename')))
+
+    client = Offline('http://localhost', 'replay-1-', LatencyRecorder(60), collections.Counter())
+    sent = collections.Counter()
+    await replay_session(client, [
+        recorded(0, 's1', 'connect'),
+        recorded(5, 's1', 'come by table', {'tablename': 'table1'}),
+        recorded(9, 's1', 'set player name', {'tablename': 'table1', 'player': {'name': 'alice'}}),
+        recorded(10, 's1', 'disconnect'),
+        recorded(11, 's1', 'mouse movement', {'tablename': 'table1'}),
+    ], started_at=0, recording_start=0, speed=0, sent=sent, lags=[])
+    assert sent_messages == [('come by table', 'replay-1-table1'), ('set player name', 'replay-1-table1')]
+    assert client.name == 'alice'
+    assert sent == {'come by table': 1, 'set player name': 1}
@@ -0,0 +1,40 @@
+import {describe, expect} from "@jest/globals";
+import {knownTemplateIds, addTemplates, expandTable, unknownTemplateIds, templatesByName} from "../../src/js/component_templates";
+
+const card = {name: 'card', width: '64px', showImage: true, cardistry: ['spread']};
+
+describe('expandTable', () => {
+    test('referenced components get the keys of the template', () => {
+        addTemplates({t1: card});
+        const table = expandTable({components: {c1: {'~t': 't1', top: 10, componentId: 'c1'}, c2: {name: 'dice'}}});
+        expect(table.components.c1).toEqual({...card, top: 10, componentId: 'c1'});
+        expect(table.components.c2).toEqual({name: 'dice'});
+    });
+
+    test('removed keys are left out and own keys win', () => {
+        addTemplates({t1: card});
+        const table = expandTable({components: {c1: {'~t': 't1', '~d': {showImage: true}, width: '80px'}}});
+        expect(table.components.c1).toEqual({name: 'card', width: '80px', cardistry: ['spread']});
+    });
+
+    test('nested values are not shared between components', () => {
+        addTemplates({t1: card});
+        const table = expandTable({components: {c1: {'~t': 't1'}, c2: {'~t': 't1'}}});
+        table.components.c1.cardistry.push('flip');
+        expect(table.components.c2.cardistry).toEqual(['spread']);
+    });
+
+    test('templates are remembered across loads', () => {
+        addTemplates({t2: {name: 'token'}});
+        expect(knownTemplateIds()).toContain('t2');
+        expect(JSON.parse(localStorage.getItem('asobann.componentTemplates'))).toHaveProperty('t2');
+    });
+});
+
+describe('templatesByName', () => {
+    test('known templates are looked up by component name', () => {
+        addTemplates({t1: card});
+        expect(unknownTemplateIds(['t1', 't9'])).toEqual(['t9']);
+        expect(templatesByName({card: 't1'})).toEqual({card: card});
+    });
+});
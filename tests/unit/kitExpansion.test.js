@@ -0,0 +1,52 @@
+import {describe, expect} from "@jest/globals";
+import {expandKit, needsClientExpansion, seededRandom} from "../../src/js/kit_expansion";
+
+// The same values as tests/unit/test_kit_expansion.py: the server and clients must expand alike.
+const card = {name: 'card', top: '10px', left: '0px', width: '64px', height: '100px', zIndex: 2};
+const box = {name: 'box', top: '0px', left: '0px', width: '200px', height: '150px', positionOfBoxContents: 'random'};
+const definitions = {card: card, box: box};
+const rect = {left: 64, top: 64.5, width: 300, height: 200};
+
+describe('expandKit', () => {
+    test('seeded random numbers', () => {
+        const random = seededRandom(1);
+        expect([random(), random(), random()]).toEqual([0.6270739405881613, 0.002735721180215478, 0.5274470399599522]);
+    });
+
+    test('relative layout', () => {
+        const components = expandKit({boxAndComponents: {card: null}}, definitions, 'k1', {baseZIndex: 5, rect: rect}, seededRandom(42));
+        expect(components).toEqual({
+            '97da2849d73e': {...card, kitId: 'k1', componentId: '97da2849d73e', left: 64, top: 74.5, zIndex: 7},
+        });
+    });
+
+    test('random layout of box contents', () => {
+        const components = expandKit({boxAndComponents: {box: ['card', 'card']}}, definitions, 'k1', {baseZIndex: 0, rect: rect}, seededRandom(42));
+        const [boxData, ...cards] = Object.values(components);
+        expect(Object.keys(boxData.componentsInBox)).toEqual(cards.map((c) => c.componentId));
+        expect(cards.map((c) => [c.left, c.top])).toEqual([[69, 67], [139, 94]]);
+    });
+
+    test('hand areas get one set each', () => {
+        const handAreas = [
+            {left: '0px', top: '500px', width: '302px', height: '102px'},
+            {left: '400px', top: '500px', width: '302px', height: '102px'},
+        ];
+        const components = expandKit({boxAndComponents: {box: ['card'], card: null}, positionOfKitContents: 'on all hand areas'},
+            definitions, 'k1', {baseZIndex: 3, handAreas: handAreas}, seededRandom(7));
+        const cards = Object.values(components).filter((c) => c.name === 'card');
+        expect(Object.values(components).length).toEqual(4);
+        expect(cards.map((c) => [c.left, c.top])).toEqual([[1, 501], [401, 501]]);
+    });
+
+    test('definitions are not shared between components', () => {
+        const components = expandKit({boxAndComponents: {box: ['card']}}, definitions, 'k1', {baseZIndex: 0, rect: rect}, seededRandom(1));
+        expect(definitions.box.componentsInBox).toBeUndefined();
+        expect(Object.keys(components).length).toEqual(2);
+    });
+
+    test('kits with onAdd are expanded by the client', () => {
+        expect(needsClientExpansion(definitions)).toBe(false);
+        expect(needsClientExpansion({dice: {name: 'dice', onAdd: 'function(c) {}'}})).toBe(true);
+    });
+});
@@ -0,0 +1,61 @@
+import {beforeEach, describe, expect} from "@jest/globals";
+import {Encoder, Decoder, PacketType, encode, decode} from "../../src/js/msgpack_parser";
+
+describe('encode and decode', () => {
+    test.each([
+        0, 127, 128, 65536, 2 ** 32, -1, -33, -129, -(2 ** 31) - 1, 1.5,
+        'a', 'あいう', 'x'.repeat(300), null, true, false,
+        [], [1, [2, 3]], new Array(20).fill(7),
+        {a: 1, b: {c: 'd'}},
+    ])('round trip %p', (value) => {
+        expect(decode(encode(value))).toEqual(value);
+    });
+
+    test('keys with undefined values are left out like JSON', () => {
+        expect(decode(encode({a: 1, b: undefined}))).toEqual({a: 1});
+    });
+
+    test('same bytes as msgpack for a packet', () => {
+        expect(Array.from(encode({type: 2, nsp: '/'}))).toEqual(
+            [0x82, 0xa4, 0x74, 0x79, 0x70, 0x65, 0x02, 0xa3, 0x6e, 0x73, 0x70, 0xa1, 0x2f]);
+    });
+});
+
+describe('negotiation', () => {
+    let encoder;
+    let decoder;
+    let decoded;
+
+    beforeEach(() => {
+        encoder = new Encoder();
+        decoder = new Decoder();
+        decoded = [];
+        decoder.on('decoded', (packet) => decoded.push(packet));
+        decoder.destroy();
+    });
+
+    test('sends text until the server answers in binary', () => {
+        expect(encoder.encode({type: PacketType.CONNECT, nsp: '/'})).toEqual(['0']);
+        decoder.add('0{"sid":"abc"}');
+        expect(decoded).toEqual([{type: PacketType.CONNECT, nsp: '/', data: {sid: 'abc'}}]);
+        expect(encoder.encode({type: PacketType.EVENT, nsp: '/', data: ['ev', 1]})).toEqual(['2["ev",1]']);
+    });
+
+    test('switches to msgpack after a binary packet', () => {
+        decoder.add(encode({type: PacketType.CONNECT, nsp: '/', data: {sid: 'abc'}}));
+        expect(decoded).toEqual([{type: PacketType.CONNECT, nsp: '/', data: {sid: 'abc'}}]);
+        const [packet] = encoder.encode({type: PacketType.EVENT, nsp: '/', data: ['ev', 1], id: 3});
+        expect(decode(packet)).toEqual({type: PacketType.EVENT, nsp: '/', data: ['ev', 1], id: 3});
+    });
+
+    test('negotiates again after the connection is closed', () => {
+        decoder.add(encode({type: PacketType.CONNECT, nsp: '/'}));
+        decoder.destroy();
+        expect(encoder.encode({type: PacketType.CONNECT, nsp: '/'})).toEqual(['0']);
+    });
+
+    test('decodes text packets with namespace and ack id', () => {
+        decoder.add('3/x,12[1]');
+        expect(decoded).toEqual([{type: PacketType.ACK, nsp: '/x', id: 12, data: [1]}]);
+    });
+});
@@ -0,0 +1,158 @@
+import asyncio
+
+import pytest
+
+from asobann.app.broadcasting import MouseMovementBatcher, ComponentUpdateBatcher, RoomBatcher
+
+
+class RecordingServer:
+    def __init__(self):
+        self.emitted = []
+
+    async def emit(self, event, data, room=None):
+        self.emitted.append((event, data, room))
+
+
+def counts(sut):
+    return sut._batched.value, sut._frames.value
+
+
+def movement(player_name, x):
+    return {'tablename': 'table1', 'playerName': player_name,
+            'mouseMovement': {'mouseOnTableX': x, 'mouseOnTableY': 0, 'mouseButtons': 0}}
+
+
+class TestMouseMovementBatcher:
+    async def test_movements_in_one_tick_become_one_frame(self):
+        sio = RecordingServer()
+        sut = MouseMovementBatcher(sio, tick=0.01)
+        sut.add('table1', movement('alice', 1))
+        sut.add('table1', movement('bob', 2))
+        await asyncio.sleep(0.03)
+        assert len(sio.emitted) == 1
+        event, data, room = sio.emitted[0]
+        assert (event, room) == ('mouse movements', 'table1')
+        assert data['tablename'] == 'table1'
+        assert [m['playerName'] for m in data['movements']] == ['alice', 'bob']
+
+    async def test_only_the_latest_position_of_each_player_is_sent(self):
+        sio = RecordingServer()
+        sut = MouseMovementBatcher(sio, tick=0.01)
+        received, frames = counts(sut)
+        for x in range(10):
+            sut.add('table1', movement('alice', x))
+        await asyncio.sleep(0.03)
+        _, data, _ = sio.emitted[0]
+        assert [m['mouseMovement']['mouseOnTableX'] for m in data['movements']] == [9]
+        assert counts(sut) == (received + 10, frames + 1)
+
+    async def test_rooms_are_sent_separately(self):
+        sio = RecordingServer()
+        sut = MouseMovementBatcher(sio, tick=0.01)
+        sut.add('table1', movement('alice', 1))
+        sut.add('table2', movement('bob', 2))
+        await asyncio.sleep(0.03)
+        assert sorted(room for _, _, room in sio.emitted) == ['table1', 'table2']
+
+    async def test_movement_after_a_frame_goes_into_the_next(self):
+        sio = RecordingServer()
+        sut = MouseMovementBatcher(sio, tick=0.01)
+        sut.add('table1', movement('alice', 1))
+        await asyncio.sleep(0.03)
+        sut.add('table1', movement('alice', 2))
+        await asyncio.sleep(0.03)
+        assert [data['movements'][0]['mouseMovement']['mouseOnTableX'] for _, data, _ in sio.emitted] == [1, 2]
+
+    async def test_close_drops_pending_frames(self):
+        sio = RecordingServer()
+        sut = MouseMovementBatcher(sio, tick=10)
+        sut.add('table1', movement('alice', 1))
+        await sut.close()
+        assert sio.emitted == []
+
+
+def update(originator, diffs, remove=(), seq=None):
+    message = {'tablename': 'table1', 'originator': originator, 'diffs': diffs,
+               'componentIdsToRemove': list(remove), 'volatileKeys': {}}
+    if seq is not None:
+        message['seq'] = seq
+    return message
+
+
+async def one_frame(sut, *messages):
+    for message in messages:
+        sut.add('table1', message)
+    await asyncio.sleep(0.03)
+    assert len(sut.sio.emitted) == 1
+    event, data, room = sut.sio.emitted[0]
+    assert (event, room, data['tablename']) == ('update many components', 'table1', 'table1')
+    return data['updates']
+
+
+class TestComponentUpdateBatcher:
+    async def test_messages_in_one_tick_become_one_frame(self):
+        sut = ComponentUpdateBatcher(RecordingServer(), tick=0.01)
+        received, frames = counts(sut)
+        updates = await one_frame(
+            sut,
+            update('alice', [{'c1': {'top': '1px'}}]),
+            update('bob', [{'c2': {'top': '2px'}}]))
+        assert [u['originator'] for u in updates] == ['alice', 'bob']
+        assert updates[1]['diffs'] == [{'c2': {'top': '2px'}}]
+        assert counts(sut) == (received + 2, frames + 1)
+
+    async def test_consecutive_messages_of_one_originator_are_merged(self):
+        sut = ComponentUpdateBatcher(RecordingServer(), tick=0.01)
+        updates = await one_frame(
+            sut,
+            update('alice', [{'c1': {'top': '1px', 'left': '1px'}}], seq=5),
+            update('alice', [{'c1': {'top': '2px'}}, {'c2': {'top': '3px'}}], remove=['c3'], seq=6))
+        assert updates == [{
+            'originator': 'alice',
+            'diffs': [{'c1': {'top': '2px', 'left': '1px'}}, {'c2': {'top': '3px'}}],
+            'componentIdsToRemove': ['c3'],
+            'seqs': [5, 6],
+            'volatileKeys': {},
+        }]
+
+    async def test_a_key_stays_volatile_only_while_every_write_to_it_is_volatile(self):
+        sut = ComponentUpdateBatcher(RecordingServer(), tick=0.01)
+        dragging = update('alice', [{'c1': {'top': '1px', 'left': '1px'}}])
+        dragging['volatileKeys'] = {'c1': ['top', 'left']}
+        dropped = update('alice', [{'c1': {'top': '2px'}}])
+        updates = await one_frame(sut, dragging, dropped)
+        assert updates[0]['volatileKeys'] == {'c1': ['left']}
+
+    async def test_messages_interleaved_with_another_originator_keep_their_order(self):
+        # alice の2通をまとめると、bob の c1 が alice の2通目より後に適用されてしまう。
+        sut = ComponentUpdateBatcher(RecordingServer(), tick=0.01)
+        updates = await one_frame(
+            sut,
+            update('alice', [{'c1': {'top': '1px'}}]),
+            update('bob', [{'c1': {'top': '2px'}}]),
+            update('alice', [{'c1': {'top': '3px'}}]))
+        assert [(u['originator'], u['diffs']) for u in updates] == [
+            ('alice', [{'c1': {'top': '1px'}}]),
+            ('bob', [{'c1': {'top': '2px'}}]),
+            ('alice', [{'c1': {'top': '3px'}}]),
+        ]
+
+    async def test_merging_does_not_change_the_received_message(self):
+        sut = ComponentUpdateBatcher(RecordingServer(), tick=0.01)
+        first = update('alice', [{'c1': {'top': '1px'}}])
+        await one_frame(sut, first, update('alice', [{'c1': {'top': '2px'}}]))
+        assert first['diffs'] == [{'c1': {'top': '1px'}}]
+
+
+def test_batcher_must_say_how_to_frame():
+    class CountingBatcher(RoomBatcher):
+        event = 'counts'
+
+        def new_pending(self):
+            return []
+
+        def merge(self, pending, item):
+            pending.append(item)
+
+    with pytest.raises(TypeError):
+        CountingBatcher(RecordingServer(), tick=0.01)
@@ -0,0 +1,90 @@
+import json
+from pathlib import Path
+
+import pytest
+
+from asobann.store import compact
+from asobann.store.modification import PendingModification
+
+CARD = {
+    "name": "card", "top": "100px", "left": "185.64101615137753px", "width": "64px", "height": "100px",
+    "showImage": True, "draggable": True, "flippable": True, "ownable": True, "resizable": False,
+    "faceupImage": "/static/images/card.png", "faceup": False, "zIndex": 3, "componentId": "c1",
+}
+
+
+class TestCompact:
+    def test_round_trip(self):
+        stored = compact.compact(CARD)
+        assert compact.expand(stored) == CARD
+        assert "faceupImage" not in stored
+        assert stored["name"] == "card"
+
+    def test_pixels_are_numbers(self):
+        stored = compact.compact({"top": "100px", "left": "1.5px"})
+        assert sorted(stored.values()) == [1.5, 100]
+
+    @pytest.mark.parametrize('value', [
+        "38x", "05px", "1.50px", "-0px", "1e5px", "", 100, 1.5, [1, 2], None, True])
+    def test_pixels_that_are_not_plain_px_come_back_unchanged(self, value):
+        assert compact.expand(compact.compact({"top": value})) == {"top": value}
+
+    def test_defaults_are_omitted_only_when_all_are_present(self):
+        assert len(compact.compact(CARD)) == len(CARD) - len(compact._DEFAULTS) + 1
+        partial = {"showImage": True, "draggable": True, "value1": 1}
+        assert compact.expand(compact.compact(partial)) == partial
+
+    def test_non_default_values_are_kept(self):
+        card = dict(CARD, draggable=False, resizable=True)
+        assert compact.expand(compact.compact(card)) == card
+
+    def test_bundled_components_round_trip(self):
+        path = Path(compact.__file__).parent.parent / "initial_deploy_data.json"
+        with open(path, encoding='utf-8') as f:
+            components = [c["component"] for c in json.load(f)["components"]]
+        for component in components:
+            assert compact.expand(compact.compact(component)) == component
+
+
+class TestReadingOlderForms:
+    def test_uncompacted_component_reads_as_is(self):
+        assert compact.expand(CARD) == CARD
+
+    def test_code_written_after_the_verbose_key_wins(self):
+        # 詰める前の卓に、詰めた後の部分更新が入ったもの
+        code, value = compact.compact_item("top", "200px")
+        assert compact.expand(dict(CARD, **{code: value}))["top"] == "200px"
+        assert compact.expand({code: value, "top": "100px"})["top"] == "200px"
+
+    def test_upgrade(self):
+        assert compact.expand(compact.upgrade(CARD)) == CARD
+        assert compact.upgrade(compact.compact(CARD)) is None
+
+
+class TestCompactPending:
+    def compacted(self, *operations):
+        pending = PendingModification()
+        for operation in operations:
+            getattr(pending, operation[0])(*operation[1:])
+        return compact.compact_pending(pending)
+
+    def test_component_key_and_value(self):
+        code, _ = compact.compact_item("top", "")
+        pending = self.compacted(('set', 'table.components.c1.top', '20px'))
+        assert pending.set_fields == {f'table.components.c1.{code}': 20}
+
+    def test_whole_component(self):
+        pending = self.compacted(('set', 'table.components.c1', CARD))
+        assert pending.set_fields == {'table.components.c1': compact.compact(CARD)}
+
+    def test_nested_path_keeps_its_value(self):
+        code, _ = compact.compact_item("onTray", None)
+        pending = self.compacted(('set', 'table.components.c1.onTray.c2', '10px'))
+        assert pending.set_fields == {f'table.components.c1.{code}.c2': '10px'}
+
+    def test_unset_and_header_paths(self):
+        code, _ = compact.compact_item("owner", None)
+        pending = self.compacted(('unset', 'table.components.c1.owner'), ('unset', 'table.components.c2'),
+                                 ('set', 'table.players', {}))
+        assert set(pending.unset_fields) == {f'table.components.c1.{code}', 'table.components.c2'}
+        assert pending.set_fields == {'table.players': {}}
@@ -0,0 +1,39 @@
+import asyncio
+
+import pytest
+
+from asobann.app import debug_tools
+from asobann.app.debug_tools import TraceSink
+
+
+class Collection:
+    def __init__(self):
+        self.inserted = []
+
+    async def insert_many(self, documents, ordered=True):
+        self.inserted.append(documents)
+
+
+@pytest.fixture
+async def sink():
+    sink = TraceSink(Collection(), flush_interval=0.01, capacity=3)
+    yield sink
+    await sink.close()
+
+
+class TestTraceSink:
+    async def test_traces_are_written_together_in_the_background(self, sink):
+        sink.add({'n': 1})
+        sink.add({'n': 2})
+        assert sink.collection.inserted == []
+        await asyncio.sleep(0.03)
+        assert sink.collection.inserted == [[{'n': 1}, {'n': 2}]]
+
+    async def test_oldest_traces_are_dropped_when_the_buffer_is_full(self, sink):
+        dropped = debug_tools._traces_dropped._unlabeled()
+        before = dropped.value
+        for n in range(5):
+            sink.add({'n': n})
+        await sink.close()
+        assert sink.collection.inserted == [[{'n': 2}, {'n': 3}, {'n': 4}]]
+        assert dropped.value - before == 2
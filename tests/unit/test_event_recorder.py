@@ -0,0 +1,42 @@
+import gzip
+import json
+
+from asobann.app.event_recorder import EventRecorder
+from asobann.app.instrumentation import InstrumentedServer
+
+
+def read(path):
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        return [json.loads(line) for line in f]
+
+
+async def test_events_are_appended_as_gzipped_ndjson(tmp_path):
+    recorder = EventRecorder(tmp_path, flush_interval=60)
+    recorder.record('come by table', 'sid1', {'tablename': 'table1'})
+    await recorder.flush()
+    recorder.record('mouse movement', 'sid1', {'tablename': 'table1', 'mouseMovement': {}})
+    await recorder.close()
+
+    events = read(recorder.path)
+    assert [(e['event'], e['sid'], e['table']) for e in events] == [
+        ('come by table', 'sid1', 'table1'), ('mouse movement', 'sid1', 'table1')]
+    assert events[0]['data'] == {'tablename': 'table1'}
+    assert events[0]['t'] <= events[1]['t']
+
+
+async def test_server_records_handled_events_and_connections(tmp_path):
+    recorder = EventRecorder(tmp_path, flush_interval=60)
+    server = InstrumentedServer(async_mode='asgi', event_recorder=recorder)
+
+    @server.on('say hello')
+    async def handle(sid, data):
+        pass
+
+    await server._trigger_event('connect', '/', 'sid1', {'HTTP_COOKIE': 'secret'}, None)
+    await server._trigger_event('say hello', '/', 'sid1', {'tablename': 'table1'})
+    await server._trigger_event('unknown', '/', 'sid1', {'tablename': 'table1'})
+    await server._trigger_event('disconnect', '/', 'sid1', 'client disconnect')
+    await recorder.close()
+
+    assert [(e['event'], e['data']) for e in read(recorder.path)] == [
+        ('connect', None), ('say hello', {'tablename': 'table1'}), ('disconnect', None)]
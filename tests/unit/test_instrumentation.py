@@ -0,0 +1,60 @@
+import itertools
+
+import pytest
+
+from asobann import metrics
+from asobann.app.instrumentation import InstrumentedServer
+
+
+class RecordingEngineIO:
+    ids = itertools.count()
+
+    def generate_id(self):
+        return f'sid{next(self.ids)}'
+
+    async def send_packet(self, eio_sid, eio_pkt):
+        pass
+
+
+def sample(name):
+    for line in metrics.REGISTRY.exposition().splitlines():
+        if line.startswith(name + ' '):
+            return float(line.rsplit(' ', 1)[1])
+    return 0
+
+
+@pytest.fixture
+async def server():
+    server = InstrumentedServer(async_mode='asgi')
+    server.eio = RecordingEngineIO()
+    for eio_sid, room in (('a', 'table1'), ('b', 'table1'), ('c', 'table2')):
+        await server._handle_eio_connect(eio_sid, {})
+        sid = await server.manager.connect(eio_sid, '/')
+        await server.enter_room(sid, room)
+    return server
+
+
+class TestInstrumentedServer:
+    async def test_emit_counts_local_recipients(self, server):
+        emits = sample('asobann_socket_emits_total{event="tick"}')
+        recipients = sample('asobann_socket_emit_recipients_total{event="tick"}')
+        await server.emit('tick', {}, room='table1')
+        assert sample('asobann_socket_emits_total{event="tick"}') == emits + 1
+        assert sample('asobann_socket_emit_recipients_total{event="tick"}') == recipients + 2
+
+    async def test_registered_handlers_are_timed(self, server):
+        @server.on('say hello')
+        async def handle(sid, data):
+            pass
+
+        count = sample('asobann_socket_handler_seconds_count{event="say hello"}')
+        await server._trigger_event('say hello', '/', 'sid', {})
+        await server._trigger_event('unknown', '/', 'sid', {})
+        assert sample('asobann_socket_handler_seconds_count{event="say hello"}') == count + 1
+        assert 'event="unknown"' not in metrics.REGISTRY.exposition()
+
+    async def test_room_metrics(self, server):
+        collected = {metric.name: metric for metric in server.collect_room_metrics()}
+        assert collected['asobann_socket_connected_sids'].exposition().endswith(' 3')
+        assert collected['asobann_socket_rooms'].exposition().endswith(' 2')
+        assert 'asobann_socket_room_size_bucket{le="2"} 2' in collected['asobann_socket_room_size'].exposition()
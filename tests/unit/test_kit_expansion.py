@@ -0,0 +1,57 @@
+import pytest
+
+from asobann.store.kit_expansion import expand, seeded_random
+
+# tests/unit/kitExpansion.test.js と同じ値。サーバとクライアントの展開が食い違わないことの確認
+CARD = {"name": "card", "top": "10px", "left": "0px", "width": "64px", "height": "100px", "zIndex": 2}
+BOX = {"name": "box", "top": "0px", "left": "0px", "width": "200px", "height": "150px",
+       "positionOfBoxContents": "random"}
+DEFINITIONS = {"card": CARD, "box": BOX}
+RECT = {"left": 64, "top": 64.5, "width": 300, "height": 200}
+
+
+def test_seeded_random():
+    random = seeded_random(1)
+    assert [random(), random(), random()] == [0.6270739405881613, 0.002735721180215478, 0.5274470399599522]
+
+
+def test_relative_layout():
+    components = expand({"boxAndComponents": {"card": None}}, DEFINITIONS, "k1", {"baseZIndex": 5, "rect": RECT}, 42)
+    assert components == {"97da2849d73e": dict(CARD, kitId="k1", componentId="97da2849d73e",
+                                               left=64, top=74.5, zIndex=7)}
+
+
+def test_random_layout_of_box_contents():
+    components = expand({"boxAndComponents": {"box": ["card", "card"]}}, DEFINITIONS, "k1",
+                        {"baseZIndex": 0, "rect": RECT}, 42)
+    box, *cards = components.values()
+    assert box["componentsInBox"] == {card["componentId"]: True for card in cards}
+    assert [(card["left"], card["top"]) for card in cards] == [(69, 67), (139, 94)]
+    # 箱（left 64, top 64.5）の中
+    assert all(64 <= card["left"] <= 64 + 200 - 64 and 64 <= card["top"] <= 64.5 + 150 - 100 for card in cards)
+
+
+@pytest.mark.parametrize('contents, in_box', [([], {}), (None, None)])
+def test_empty_contents_still_make_a_box(contents, in_box):
+    # JS では空のリストも真
+    box, = expand({"boxAndComponents": {"box": contents}}, DEFINITIONS, "k1", {"baseZIndex": 0, "rect": RECT}, 1).values()
+    assert box.get("componentsInBox") == in_box
+
+
+def test_hand_areas_get_one_set_each():
+    hand_areas = [{"left": "0px", "top": "500px", "width": "302px", "height": "102px"},
+                  {"left": "400px", "top": "500px", "width": "302px", "height": "102px"}]
+    components = expand({"boxAndComponents": {"box": ["card"], "card": None},
+                         "positionOfKitContents": "on all hand areas"},
+                        DEFINITIONS, "k1", {"baseZIndex": 3, "handAreas": hand_areas}, 7)
+    # 箱の中身は作らない
+    assert sorted(component["name"] for component in components.values()) == ["box", "box", "card", "card"]
+    cards = [component for component in components.values() if component["name"] == "card"]
+    assert [(card["left"], card["top"]) for card in cards] == [(1, 501), (401, 501)]
+
+
+def test_names_are_expanded_in_javascript_key_order():
+    components = expand({"boxAndComponents": {"card": None, "2": None, "10": None}},
+                        dict(DEFINITIONS, **{"2": dict(CARD, name="2"), "10": dict(CARD, name="10")}),
+                        "k1", {"baseZIndex": 0, "rect": RECT}, 1)
+    assert [component["name"] for component in components.values()] == ["2", "10", "card"]
@@ -0,0 +1,66 @@
+import asyncio
+
+from asobann.app.load_table_cache import LoadTableCache
+from asobann.store import tables
+
+
+class CountingLoader:
+    def __init__(self, table):
+        self.table = table
+        self.calls = 0
+
+    async def __call__(self):
+        self.calls += 1
+        await asyncio.sleep(0.01)
+        return dict(self.table)
+
+
+def bump(tablename):
+    # store.tables の変更関数が終わったときと同じことをする
+    tables._versions[tablename] = next(tables._version_counter)
+
+
+class TestLoadTableCache:
+    async def test_unchanged_table_is_encoded_once(self):
+        loader = CountingLoader({'players': {}})
+        encoded = []
+        sut = LoadTableCache(encode=lambda table: encoded.append(table) or repr(table))
+        assert await sut.get('table1', loader) == await sut.get('table1', loader) == "{'players': {}}"
+        assert (loader.calls, len(encoded)) == (1, 1)
+
+    async def test_changed_table_is_encoded_again(self):
+        loader = CountingLoader({'players': {}})
+        sut = LoadTableCache(encode=repr)
+        await sut.get('table1', loader)
+        bump('table1')
+        loader.table = {'players': {'alice': {}}}
+        assert await sut.get('table1', loader) == "{'players': {'alice': {}}}"
+        assert loader.calls == 2
+
+    async def test_concurrent_misses_share_one_load(self):
+        loader = CountingLoader({'players': {}})
+        sut = LoadTableCache(encode=repr)
+        results = await asyncio.gather(*(sut.get('table1', loader) for _ in range(10)))
+        assert len(set(results)) == 1
+        assert loader.calls == 1
+
+    async def test_change_during_load_is_not_hidden(self):
+        # 読んでいる間に変わった卓は、読み始めた版で覚える。次の呼び出しは読み直す
+        loader = CountingLoader({'players': {}})
+        sut = LoadTableCache(encode=repr)
+        reading = asyncio.ensure_future(sut.get('table1', loader))
+        await asyncio.sleep(0)
+        bump('table1')
+        await reading
+        await sut.get('table1', loader)
+        assert loader.calls == 2
+
+    async def test_least_recently_used_tables_are_dropped(self):
+        loader = CountingLoader({})
+        sut = LoadTableCache(encode=repr, max_tables=2)
+        for tablename in ('table1', 'table2', 'table1', 'table3'):
+            await sut.get(tablename, loader)
+        await sut.get('table1', loader)
+        assert loader.calls == 3
+        await sut.get('table2', loader)
+        assert loader.calls == 4
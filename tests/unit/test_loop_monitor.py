@@ -0,0 +1,35 @@
+import asyncio
+import time
+
+from asobann.app.loop_monitor import LoopMonitor
+
+
+def block(seconds):
+    time.sleep(seconds)
+
+
+class TestLoopMonitor:
+    async def test_stall_is_recorded_with_the_stack_that_blocked_the_loop(self, caplog):
+        monitor = LoopMonitor(threshold=0.05, interval=0.01)
+        monitor.start()
+        try:
+            await asyncio.sleep(0.03)
+            block(0.15)
+            await asyncio.sleep(0.03)
+        finally:
+            await monitor.close()
+        [stall] = monitor.snapshot()['slowest']
+        assert stall['lag'] >= 0.1
+        assert 'in block' in stall['stack']
+        assert 'event loop has been blocked' in caplog.text
+
+    async def test_short_delays_are_not_stalls(self):
+        monitor = LoopMonitor(threshold=0.5, interval=0.01)
+        monitor.start()
+        try:
+            await asyncio.sleep(0.05)
+        finally:
+            await monitor.close()
+        snapshot = monitor.snapshot()
+        assert snapshot['slowest'] == []
+        assert snapshot['maxLag'] < 0.5
@@ -0,0 +1,76 @@
+import pytest
+
+from asobann import metrics
+
+
+@pytest.fixture
+def registry():
+    return metrics.Registry()
+
+
+class TestExposition:
+    def test_counter_with_labels(self, registry):
+        counter = metrics.Counter('requests', 'Requests handled', ['event'], registry=registry)
+        counter.labels(event='add kit').inc()
+        counter.labels('add kit').inc(2)
+        assert registry.exposition() == (
+            '# HELP requests_total Requests handled\n'
+            '# TYPE requests_total counter\n'
+            'requests_total{event="add kit"} 3\n')
+
+    def test_gauge_reads_its_function_when_scraped(self, registry):
+        gauge = metrics.Gauge('queued', 'Queued things', registry=registry)
+        values = iter([1, 5])
+        gauge.set_function(lambda: next(values))
+        assert registry.exposition().endswith('queued 1\n')
+        assert registry.exposition().endswith('queued 5\n')
+
+    def test_histogram_buckets_are_cumulative(self, registry):
+        histogram = metrics.Histogram('latency', 'Latency', buckets=(0.1, 1), registry=registry)
+        for value in (0.05, 0.1, 0.5, 3):
+            histogram.observe(value)
+        assert registry.exposition().splitlines()[2:] == [
+            'latency_bucket{le="0.1"} 2',
+            'latency_bucket{le="1"} 3',
+            'latency_bucket{le="+Inf"} 4',
+            'latency_sum 3.65',
+            'latency_count 4',
+        ]
+
+    def test_label_values_are_escaped(self, registry):
+        counter = metrics.Counter('events', 'Events', ['event'], registry=registry)
+        counter.labels(event='say "hi"\n').inc()
+        assert 'events_total{event="say \\"hi\\"\\n"} 1' in registry.exposition()
+
+    def test_same_name_cannot_be_registered_twice(self, registry):
+        metrics.Counter('events', 'Events', registry=registry)
+        with pytest.raises(ValueError):
+            metrics.Counter('events', 'Events', registry=registry)
+
+    def test_collector_is_replaced_by_name(self, registry):
+        def collect(value):
+            gauge = metrics.Gauge('rooms', 'Rooms', registry=False)
+            gauge.set(value)
+            return [gauge]
+
+        registry.set_collector('socketio', lambda: collect(1))
+        registry.set_collector('socketio', lambda: collect(2))
+        assert registry.exposition().splitlines()[2:] == ['rooms 2']
+
+
+    def test_metric_without_children_cannot_be_made(self, registry):
+        class Summary(metrics._Metric):
+            type = 'summary'
+
+        with pytest.raises(TypeError):
+            Summary('latency', 'Latency', registry=registry)
+
+async def test_timed_records_latency_per_function(registry):
+    histogram = metrics.Histogram('store_seconds', 'Store latency', ['function'], registry=registry)
+
+    @metrics.timed(histogram, 'function')
+    async def get(tablename):
+        return tablename
+
+    assert await get('table1') == 'table1'
+    assert 'store_seconds_count{function="get"} 1' in registry.exposition()
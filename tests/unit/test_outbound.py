@@ -0,0 +1,128 @@
+import asyncio
+import json
+
+import pytest
+from engineio import packet as eio_packet
+
+from asobann.app import outbound
+from asobann.app.outbound import OutboundLimitingServer
+
+
+class Socket:
+    def __init__(self):
+        self.queue = asyncio.Queue()
+
+    def events(self):
+        """送信キューを空にして、溜まっていたイベントを (event, data) で返す。"""
+        events = []
+        while not self.queue.empty():
+            pkt = self.queue.get_nowait()
+            if isinstance(pkt.data, str) and pkt.data.startswith('2'):
+                events.append(tuple(json.loads(pkt.data[1:])))
+        return events
+
+
+class QueueingEngineIO:
+    """engine.io の接続ごとの送信キューだけを真似る。クライアントは何も読まない。"""
+
+    def __init__(self):
+        self.sockets = {}
+
+    def generate_id(self):
+        return f'sid{len(self.sockets)}'
+
+    def _get_socket(self, eio_sid):
+        return self.sockets[eio_sid]
+
+    async def send_packet(self, eio_sid, pkt):
+        await self.sockets[eio_sid].queue.put(pkt)
+
+    async def send(self, eio_sid, data):
+        await self.send_packet(eio_sid, eio_packet.Packet(eio_packet.MESSAGE, data))
+
+
+@pytest.fixture
+async def server():
+    server = OutboundLimitingServer(async_mode='asgi', outbound_high_water=3, drain_interval=0.01)
+    server.eio = QueueingEngineIO()
+    server.eio.sockets['slow'] = Socket()
+    await server._handle_eio_connect('slow', {})
+    sid = await server.manager.connect('slow', '/')
+    await server.enter_room(sid, 'table1')
+    return server
+
+
+def socket(server):
+    return server.eio.sockets['slow']
+
+
+async def fill(server):
+    for n in range(3):
+        await server.emit('add component', {'tablename': 'table1', 'n': n}, room='table1')
+
+
+def movement(x):
+    return {'tablename': 'table1', 'playerName': 'alice',
+            'mouseMovement': {'mouseOnTableX': x, 'mouseOnTableY': 0, 'mouseButtons': 0}}
+
+
+def dragging(top):
+    return {'tablename': 'table1', 'originator': 'bob', 'diffs': [{'c1': {'top': top}}],
+            'componentIdsToRemove': [], 'volatileKeys': {'c1': ['top']}}
+
+
+class TestOutboundLimitingServer:
+    async def test_everything_is_sent_below_the_high_water_mark(self, server):
+        await server.emit('mouse movement', movement(1), room='table1')
+        await server.emit('mouse movement', movement(2), room='table1')
+        assert [event for event, _ in socket(server).events()] == ['mouse movement', 'mouse movement']
+
+    async def test_cursor_positions_above_the_mark_collapse_to_the_latest(self, server):
+        shed, collapsed = outbound._shed._unlabeled().value, outbound._collapsed_frames._unlabeled().value
+        await fill(server)
+        for x in range(10):
+            await server.emit('mouse movement', movement(x), room='table1')
+        assert len(socket(server).events()) == 3
+        await asyncio.sleep(0.03)
+        events = socket(server).events()
+        assert events == [('mouse movements', {'tablename': 'table1', 'movements': [
+            {'playerName': 'alice', 'mouseMovement': movement(9)['mouseMovement']}]})]
+        assert outbound._shed._unlabeled().value - shed == 10
+        assert outbound._collapsed_frames._unlabeled().value - collapsed == 1
+
+    async def test_volatile_component_updates_collapse_to_the_latest(self, server):
+        await fill(server)
+        for top in ('1px', '2px', '3px'):
+            await server.emit('update many components', dragging(top), room='table1')
+        socket(server).events()
+        await asyncio.sleep(0.03)
+        [(event, data)] = socket(server).events()
+        assert event == 'update many components'
+        assert data['updates'][0]['originator'] == 'bob'
+        assert data['updates'][0]['diffs'] == [{'c1': {'top': '3px'}}]
+
+    async def test_persisted_events_are_always_sent_after_what_was_held(self, server):
+        await fill(server)
+        await server.emit('update many components', dragging('1px'), room='table1')
+        dropped = dict(dragging('2px'), volatileKeys={})
+        await server.emit('update many components', dropped, room='table1')
+        events = socket(server).events()
+        assert [data.get('updates', [data])[0]['diffs'] for _, data in events[3:]] == [
+            [{'c1': {'top': '1px'}}],
+            [{'c1': {'top': '2px'}}],
+        ]
+
+    async def test_held_events_are_dropped_when_the_client_is_gone(self, server):
+        dropped = outbound._dropped_on_disconnect._unlabeled().value
+        await fill(server)
+        await server.emit('mouse movement', movement(1), room='table1')
+        del server.eio.sockets['slow']
+        await asyncio.sleep(0.03)
+        assert server._held == {}
+        assert outbound._dropped_on_disconnect._unlabeled().value - dropped == 1
+
+    async def test_nothing_is_shed_when_disabled(self, server):
+        server.outbound_high_water = 0
+        await fill(server)
+        await server.emit('mouse movement', movement(1), room='table1')
+        assert len(socket(server).events()) == 4
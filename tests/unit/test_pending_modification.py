@@ -0,0 +1,86 @@
+from asobann.store.modification import PendingModification
+
+
+def recorded(*operations):
+    pending = PendingModification()
+    for operation in operations:
+        getattr(pending, operation[0])(*operation[1:])
+    return pending.to_update()
+
+
+class TestPendingModification:
+    def test_nothing_recorded_is_empty(self):
+        pending = PendingModification()
+        assert pending.is_empty()
+        assert pending.to_update() == {}
+
+    def test_later_set_to_the_same_path_wins(self):
+        assert recorded(
+            ('set', 'table.components.c1.top', '10px'),
+            ('set', 'table.components.c1.top', '20px'),
+        ) == {'$set': {'table.components.c1.top': '20px'}}
+
+    def test_different_paths_are_kept_side_by_side(self):
+        assert recorded(
+            ('set', 'table.components.c1.top', '10px'),
+            ('set', 'table.components.c2.top', '20px'),
+        ) == {'$set': {'table.components.c1.top': '10px', 'table.components.c2.top': '20px'}}
+
+    def test_set_into_a_pending_parent_goes_inside_its_value(self):
+        # 同じupdateで親子のパスを両方指定するとMongoが失敗するので、親の値へ畳み込む。
+        assert recorded(
+            ('set', 'table.components.c1', {'name': 'card', 'top': '0px'}),
+            ('set', 'table.components.c1.top', '20px'),
+        ) == {'$set': {'table.components.c1': {'name': 'card', 'top': '20px'}}}
+
+    def test_set_to_a_parent_absorbs_pending_children(self):
+        assert recorded(
+            ('set', 'table.components.c1.top', '20px'),
+            ('unset', 'table.components.c1.owner'),
+            ('set', 'table.components.c1', {'name': 'card'}),
+        ) == {'$set': {'table.components.c1': {'name': 'card'}}}
+
+    def test_unset_replaces_a_pending_set(self):
+        assert recorded(
+            ('set', 'table.components.c1.top', '20px'),
+            ('unset', 'table.components.c1'),
+        ) == {'$unset': {'table.components.c1': ''}}
+
+    def test_set_after_unset_of_the_same_path_wins(self):
+        assert recorded(
+            ('unset', 'table.components.c1'),
+            ('set', 'table.components.c1', {'name': 'card'}),
+        ) == {'$set': {'table.components.c1': {'name': 'card'}}}
+
+    def test_set_under_a_pending_unset_is_dropped(self):
+        # 削除したコンポーネントの一部のキーだけが復活しないように。
+        assert recorded(
+            ('unset', 'table.components.c1'),
+            ('set', 'table.components.c1.top', '20px'),
+        ) == {'$unset': {'table.components.c1': ''}}
+
+    def test_unset_inside_a_pending_parent_removes_the_key_from_its_value(self):
+        assert recorded(
+            ('set', 'table.components.c1', {'name': 'card', 'owner': 'p1'}),
+            ('unset', 'table.components.c1.owner'),
+        ) == {'$set': {'table.components.c1': {'name': 'card'}}}
+
+    def test_recorded_value_is_not_affected_by_later_changes_of_the_original(self):
+        value = {'name': 'card'}
+        pending = PendingModification()
+        pending.set('table.components.c1', value)
+        value['name'] = 'changed'
+        assert pending.to_update() == {'$set': {'table.components.c1': {'name': 'card'}}}
+
+    def test_merge_applies_newer_on_top(self):
+        older = PendingModification()
+        older.set('table.components.c1.top', '10px')
+        older.set('table.components.c2.top', '10px')
+        newer = PendingModification()
+        newer.set('table.components.c1.top', '20px')
+        newer.unset('table.components.c2')
+        older.merge(newer)
+        assert older.to_update() == {
+            '$set': {'table.components.c1.top': '20px'},
+            '$unset': {'table.components.c2': ''},
+        }
@@ -0,0 +1,69 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from asobann.app import profiler
+
+
+async def wait_for_mongo(event):
+    await event.wait()
+
+
+async def handle_event(event):
+    await wait_for_mongo(event)
+
+
+async def burn_cpu(seconds):
+    # プロファイラのスレッドが動き出すのを待ってから、ループを止める
+    await asyncio.sleep(0.02)
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        pass
+
+
+async def run_profile(seconds):
+    return await asyncio.to_thread(
+        profiler.profile, asyncio.get_running_loop(), threading.get_ident(), seconds, 0.005)
+
+
+class TestProfiler:
+    async def test_waiting_coroutines_are_attributed_to_their_handler(self):
+        event = asyncio.Event()
+        waiter = asyncio.get_running_loop().create_task(handle_event(event))
+        counts = await run_profile(0.05)
+        event.set()
+        await waiter
+        stack = max((stack for stack in counts if 'wait_for_mongo' in stack), key=counts.get)
+        frames = stack.split(';')
+        assert frames[0] == 'await'
+        assert frames[1].startswith('handle_event (test_profiler.py:')
+        assert frames[2].startswith('wait_for_mongo')
+        assert frames[-1] == '[Future]'
+
+    async def test_cpu_on_the_loop_is_sampled_from_the_loop_thread(self):
+        profiling = asyncio.get_running_loop().create_task(run_profile(0.15))
+        await burn_cpu(0.1)
+        counts = await profiling
+        assert any(stack.startswith('loop;') and 'burn_cpu' in stack for stack in counts)
+        assert profiler.collapsed(counts).endswith('\n')
+
+    async def test_only_one_profile_runs_at_a_time(self):
+        first = asyncio.get_running_loop().create_task(run_profile(0.05))
+        await asyncio.sleep(0.01)
+        with pytest.raises(profiler.AlreadyRunning):
+            await run_profile(0.01)
+        await first
+
+    async def test_tasks_are_read_on_the_loop_thread(self, monkeypatch):
+        read_on = set()
+        awaiting_stacks = profiler._awaiting_stacks
+
+        def recording(loop):
+            read_on.add(threading.get_ident())
+            return awaiting_stacks(loop)
+
+        monkeypatch.setattr(profiler, '_awaiting_stacks', recording)
+        await run_profile(0.03)
+        assert read_on == {threading.get_ident()}
@@ -0,0 +1,173 @@
+import asyncio
+import itertools
+
+import pytest
+import socketio
+
+from asobann.app.room_routing import RoomAffineRedisManager
+
+
+class Broker:
+    """Redis の pub/sub だけを真似る。publish は受け取った購読者の数を返す。"""
+
+    def __init__(self):
+        self.subscribers = {}
+        self.published = []
+
+    async def publish(self, channel, message):
+        if isinstance(message, str):
+            message = message.encode('utf-8')
+        self.published.append(channel)
+        pubsubs = self.subscribers.get(channel, set())
+        for pubsub in pubsubs:
+            pubsub.queue.put_nowait({'type': 'message', 'channel': channel.encode('utf-8'), 'data': message})
+        return len(pubsubs)
+
+
+class PubSub:
+    def __init__(self, broker):
+        self.broker = broker
+        self.queue = asyncio.Queue()
+
+    async def subscribe(self, *channels):
+        for channel in channels:
+            self.broker.subscribers.setdefault(channel, set()).add(self)
+
+    async def unsubscribe(self, *channels):
+        for channel in channels:
+            self.broker.subscribers.get(channel, set()).discard(self)
+
+    async def listen(self):
+        while True:
+            yield await self.queue.get()
+
+
+class BrokerManager(RoomAffineRedisManager):
+    def __init__(self, broker, **kwargs):
+        super().__init__(**kwargs)
+        self.broker = broker
+
+    def _redis_connect(self):
+        self.redis = self.broker
+        self.pubsub = PubSub(self.broker)
+        self.connected = True
+
+
+class RecordingEngineIO:
+    ids = itertools.count()
+
+    def __init__(self):
+        self.sent = []
+
+    def generate_id(self):
+        return f'sid{next(self.ids)}'
+
+    def start_background_task(self, target, *args, **kwargs):
+        return asyncio.get_running_loop().create_task(target(*args, **kwargs))
+
+    async def send_packet(self, eio_sid, eio_pkt):
+        self.sent.append(eio_pkt.data)
+
+
+class Instance:
+    def __init__(self, broker):
+        self.manager = BrokerManager(broker, shards=4)
+        self.sio = socketio.AsyncServer(async_mode='asgi', client_manager=self.manager)
+        self.sio.eio = RecordingEngineIO()
+        self.eio_sids = itertools.count()
+
+    async def join(self, room):
+        eio_sid = f'eio{next(self.eio_sids)}'
+        await self.sio._handle_eio_connect(eio_sid, {})
+        sid = await self.manager.connect(eio_sid, '/')
+        await self.sio.enter_room(sid, room)
+        # listen が購読を済ませるのを待つ
+        await asyncio.sleep(0.01)
+        return sid
+
+    @property
+    def received(self):
+        return self.sio.eio.sent
+
+    async def close(self):
+        self.manager.thread.cancel()
+        await asyncio.gather(self.manager.thread, return_exceptions=True)
+
+
+@pytest.fixture
+async def instances():
+    broker = Broker()
+    created = []
+
+    def create():
+        instance = Instance(broker)
+        created.append(instance)
+        return instance
+
+    create.broker = broker
+    yield create
+    for instance in created:
+        await instance.close()
+
+
+async def settle():
+    await asyncio.sleep(0.01)
+
+
+class TestRoomAffineRedisManager:
+    async def test_emit_reaches_members_on_other_instance(self, instances):
+        a, b = instances(), instances()
+        await a.join('table1')
+        await b.join('table1')
+        await a.sio.emit('ev', {'n': 1}, room='table1')
+        await settle()
+        assert a.received == ['2["ev",{"n":1}]']
+        assert b.received == ['2["ev",{"n":1}]']
+
+    async def test_instance_without_members_does_not_subscribe_to_the_room(self, instances):
+        a, b, c = instances(), instances(), instances()
+        await a.join('table1')
+        await b.join('table1')
+        await c.join('another')
+        shard = a.manager.shard_of('table1')
+        assert c.manager.shard_of('another') != shard  # 同じ shard だとこのテストの意味が無い
+        subscribers = instances.broker.subscribers[a.manager.shard_channel(shard)]
+        assert subscribers == {a.manager._listening_pubsub, b.manager._listening_pubsub}
+
+    async def test_emit_is_kept_local_while_all_members_are_here(self, instances):
+        a = instances()
+        await a.join('table1')
+        await a.join('table1')
+        for n in range(3):
+            await a.sio.emit('ev', n, room='table1')
+        await settle()
+        assert len(a.received) == 6
+        assert (a.manager.published, a.manager.kept_local) == (1, 2)
+
+    async def test_publishing_resumes_when_another_instance_joins(self, instances):
+        a, b = instances(), instances()
+        await a.join('table1')
+        await a.sio.emit('ev', 1, room='table1')
+        await settle()
+        assert a.manager._alone_since
+        await b.join('table1')
+        await a.sio.emit('ev', 2, room='table1')
+        await settle()
+        assert b.received == ['2["ev",2]']
+
+    async def test_shard_is_unsubscribed_when_the_last_member_leaves(self, instances):
+        a = instances()
+        sid = await a.join('table1')
+        channel = a.manager.shard_channel(a.manager.shard_of('table1'))
+        await a.sio.leave_room(sid, 'table1')
+        await settle()
+        assert not instances.broker.subscribers[channel]
+
+    async def test_emit_to_a_local_sid_does_not_go_through_redis(self, instances):
+        a = instances()
+        sid = await a.join('table1')
+        instances.broker.published.clear()
+        await a.sio.emit('ev', 1, to=sid)
+        await settle()
+        assert a.received == ['2["ev",1]']
+        assert instances.broker.published == []
@@ -0,0 +1,76 @@
+import asyncio
+import copy
+
+import pytest
+
+from asobann.store.single_flight import SingleFlight
+
+
+class CountingLoader:
+    def __init__(self, result=None, fail_with=None):
+        self.calls = 0
+        self.result = result
+        self.fail_with = fail_with
+
+    async def __call__(self):
+        self.calls += 1
+        await asyncio.sleep(0.01)
+        if self.fail_with:
+            raise self.fail_with
+        return self.result
+
+
+class TestSingleFlight:
+    async def test_concurrent_calls_share_one_call(self):
+        loader = CountingLoader(result='table')
+        sut = SingleFlight()
+        results = await asyncio.gather(*(sut.run('table1', loader) for _ in range(10)))
+        assert results == ['table'] * 10
+        assert (loader.calls, sut.shared) == (1, 9)
+        assert sut.in_flight() == 0
+
+    async def test_each_shared_call_is_reported_once(self):
+        reported = []
+        sut = SingleFlight(on_shared=lambda: reported.append(1))
+        # 別々の卓の読み込みが重なっても、共有した呼び出しの数だけ数える
+        await asyncio.gather(*(sut.run(key, CountingLoader()) for key in ('table1', 'table2') for _ in range(3)))
+        assert len(reported) == 4
+
+    async def test_keys_are_separate(self):
+        loader = CountingLoader()
+        sut = SingleFlight()
+        await asyncio.gather(sut.run('table1', loader), sut.run('table2', loader))
+        assert loader.calls == 2
+
+    async def test_finished_call_is_not_reused(self):
+        loader = CountingLoader()
+        sut = SingleFlight()
+        await sut.run('table1', loader)
+        await sut.run('table1', loader)
+        assert loader.calls == 2
+
+    async def test_failure_reaches_everyone(self):
+        sut = SingleFlight()
+        loader = CountingLoader(fail_with=KeyError('table1'))
+        results = await asyncio.gather(*(sut.run('table1', loader) for _ in range(3)), return_exceptions=True)
+        assert [type(r) for r in results] == [KeyError] * 3
+        assert loader.calls == 1
+
+    async def test_each_caller_gets_its_own_copy(self):
+        sut = SingleFlight(copy=copy.deepcopy)
+        results = await asyncio.gather(*(sut.run('table1', CountingLoader(result={'players': {}}))
+                                         for _ in range(3)))
+        results[0]['players']['alice'] = {}
+        assert results[1] == results[2] == {'players': {}}
+        assert len({id(r) for r in results}) == 3
+
+    async def test_cancelled_caller_does_not_cancel_the_call(self):
+        loader = CountingLoader(result='table')
+        sut = SingleFlight()
+        first = asyncio.ensure_future(sut.run('table1', loader))
+        second = asyncio.ensure_future(sut.run('table1', loader))
+        await asyncio.sleep(0)
+        first.cancel()
+        assert await second == 'table'
+        with pytest.raises(asyncio.CancelledError):
+            await first
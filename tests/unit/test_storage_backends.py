@@ -0,0 +1,276 @@
+import asyncio
+import gc
+
+import pytest
+import pytest_asyncio
+
+from asobann.store import tables, components, kits, oplog, templates
+from asobann.store.backends.memory import MemoryBackend
+from asobann.store.modification import PendingModification
+from asobann.store.backends.sqlite import SqliteBackend, _Database
+
+# store.backends のうち、Mongo以外のもの。Mongoは tests/functional/store で同じことを確かめている。
+BACKENDS = {
+    'memory': lambda tmp_path: MemoryBackend(),
+    'sqlite': lambda tmp_path: SqliteBackend(str(tmp_path / 'asobann.sqlite3'), commit_interval=0.01),
+}
+
+
+@pytest_asyncio.fixture(params=sorted(BACKENDS))
+async def storage(request, tmp_path):
+    previous = [module.backend for module in (tables, components, kits, templates, oplog)]
+    backend = BACKENDS[request.param](tmp_path)
+    for module in (tables, components, kits, templates, oplog):
+        module.connect(backend)
+    await tables.ensure_indexes()
+    await oplog.ensure_indexes()
+    yield backend
+    await backend.close()
+    for module, saved in zip((tables, components, kits, templates, oplog), previous):
+        module.backend = saved
+
+
+@pytest_asyncio.fixture
+async def table(storage):
+    table = {
+        'components': {
+            'component1': {'value1': 10, 'value2': 20},
+            'component2': {'value1': 110, 'value2': 120},
+        },
+        'kits': [],
+        'players': {},
+    }
+    await tables.store('table1', table)
+    return table
+
+
+class TestTables:
+    async def test_create_default_table(self, storage):
+        created = await tables.create('table1', None)
+        assert (await tables.get('table1'))['components'].keys() == created['components'].keys()
+        assert await tables.get('table2') is None
+
+    async def test_returned_table_is_a_copy(self, table):
+        read = await tables.get('table1')
+        read['players']['alice'] = {}
+        read['components']['component1']['value1'] = 0
+        assert await tables.get('table1') == dict(table, tablename='table1')
+
+    async def test_store_replaces_components(self, table):
+        await tables.store('table1', {'components': {'component3': {'value1': 1}}, 'kits': [], 'players': {}})
+        assert (await tables.get('table1'))['components'] == {'component3': {'value1': 1}}
+
+    async def test_update_table_does_not_create(self, storage):
+        await tables.update_table('table1', {'components': {}, 'kits': [], 'players': {}})
+        assert await tables.get('table1') is None
+
+    async def test_update_components(self, table):
+        await tables.update_components('table1', [{'component1': {'value1': 100}}, {'component2': {'value3': 3}}])
+        read = await tables.get('table1')
+        assert read['components']['component1'] == {'value1': 100, 'value2': 20}
+        assert read['components']['component2'] == {'value1': 110, 'value2': 120, 'value3': 3}
+
+    async def test_removed_component_is_not_revived_by_update(self, table):
+        await tables.remove_components('table1', ['component1'])
+        await tables.update_components('table1', [{'component1': {'value1': 100}}])
+        assert 'component1' not in (await tables.get('table1'))['components']
+
+    async def test_unknown_table_raises(self, storage):
+        with pytest.raises(tables.TableNotFound):
+            await tables.update_components('no_such_table', [{'component1': {'value1': 1}}])
+        with pytest.raises(tables.TableNotFound):
+            await tables.add_component('no_such_table', {'componentId': 'c1'})
+        with pytest.raises(tables.TableNotFound):
+            await tables.add_new_kit_and_components('no_such_table', {'kitId': 'k1'}, {})
+
+    async def test_add_kit_and_components(self, table):
+        await tables.add_new_kit_and_components('table1', {'kitId': 'k1'}, {'c10': {'name': 'card'}})
+        await tables.add_component('table1', {'componentId': 'c11', 'name': 'dice'})
+        read = await tables.get('table1')
+        assert read['kits'] == [{'kitId': 'k1'}]
+        assert read['components']['c10'] == {'name': 'card'}
+        assert read['components']['c11'] == {'componentId': 'c11', 'name': 'dice'}
+
+    async def test_invalid_component_id_is_rejected(self, storage):
+        with pytest.raises(tables.InvalidComponentId):
+            await tables.store('table1', {'components': {'a.b': {}}, 'kits': [], 'players': {}})
+
+    async def test_purge_all(self, table):
+        await tables.purge_all()
+        assert await tables.get('table1') is None
+
+    async def test_compact_stored_components(self, storage):
+        card = {'name': 'card', 'top': '100px', 'left': 40, 'owner': 'alice'}
+        await storage.tables.create('table1', {'components': {'c1': dict(card)}, 'kits': [], 'players': {}})
+        assert await tables.compact_stored_components() == 1
+        assert await tables.compact_stored_components() == 0
+        await tables.update_components('table1', [{'c1': {'top': '120px'}}])
+        assert (await tables.get('table1'))['components']['c1'] == dict(card, top='120px')
+
+
+class TestKitsAndComponents:
+    async def test_kit_versions(self, storage):
+        await kits.create_or_update({'kit': {'name': 'cards', 'usedComponentNames': ['card']}})
+        await kits.create_or_update({'kit': {'name': 'cards', 'usedComponentNames': ['card', 'joker']}})
+        assert await kits.get('cards') == {'kit': {'name': 'cards', 'usedComponentNames': ['card', 'joker']},
+                                           'version': 2}
+        assert await kits.get_all() == [{'kit': {'name': 'cards', 'usedComponentNames': ['card', 'joker']}}]
+
+    async def test_components_for_kit(self, storage):
+        await kits.store_default([{'kit': {'name': 'cards', 'usedComponentNames': ['card', 'joker']}}])
+        await components.store_default([{'component': {'name': 'card'}}, {'component': {'name': 'dice'}}])
+        await components.create_or_update({'component': {'name': 'joker', 'width': 1}})
+        await components.create_or_update({'component': {'name': 'joker', 'width': 2}})
+        found = await components.get_for_kit('cards')
+        assert sorted(found, key=lambda c: c['component']['name']) == [
+            {'component': {'name': 'card'}}, {'component': {'name': 'joker', 'width': 2}}]
+        assert len(await components.get_all()) == 3
+
+
+class TestTemplates:
+    CARD = {'name': 'card', 'width': '64px', 'faceupImage': 'card.png', 'cardistry': ['spread']}
+
+    @pytest_asyncio.fixture
+    async def card_table(self, storage):
+        await components.store_default([{'component': dict(self.CARD)}])
+        placed = dict(self.CARD, componentId='c1', top='10px', owner='alice')
+        await tables.store('table1', {'components': {'c1': placed, 'c2': {'name': 'dice'}}, 'kits': [], 'players': {}})
+        return placed
+
+    async def test_component_of_a_kit_refers_to_its_definition(self, storage, card_table):
+        stored = (await storage.tables.load('table1'))['table']['components']
+        assert 'faceupImage' not in str(stored['c1'])
+        assert stored['c2'] == {'name': 'dice'}
+        assert (await tables.get('table1'))['components']['c1'] == card_table
+
+    async def test_table_keeps_the_definition_it_was_made_with(self, storage, card_table):
+        await components.create_or_update({'component': dict(self.CARD, width='80px')})
+        await components.purge_all()
+        templates.connect(storage)
+        assert (await tables.get('table1'))['components']['c1'] == card_table
+
+    async def test_removed_keys_stay_removed(self, storage, card_table):
+        del card_table['faceupImage']
+        await tables.add_component('table1', card_table)
+        pending = PendingModification()
+        pending.unset('table.components.c1.cardistry')
+        await storage.tables.apply('table1', await templates.reference_pending(pending))
+        read = (await tables.get('table1'))['components']['c1']
+        assert 'faceupImage' not in read and 'cardistry' not in read
+
+    async def test_templates_purged_by_another_process_are_put_again(self, storage, card_table):
+        # deploy の purge_all は別のプロセスで動くので、このプロセスの覚えていることは消えない
+        await storage.templates.purge_all()
+        await tables.add_component('table1', dict(card_table, componentId='c3'))
+        template_id = templates.template_id(self.CARD)
+        assert (await storage.templates.get_many([template_id])).keys() == {template_id}
+
+    async def test_referenced_table(self, card_table):
+        table, used = await templates.referenced_table(await tables.get('table1'))
+        assert table['components']['c1'] == {'~t': templates.template_id(self.CARD), 'componentId': 'c1',
+                                             'top': '10px', 'owner': 'alice'}
+        assert used == {templates.template_id(self.CARD): self.CARD}
+
+
+class TestOplog:
+    @pytest.fixture(autouse=True)
+    def log(self, storage):
+        oplog.enable(8)
+        yield
+        oplog.disable()
+
+    async def test_catch_up_and_compaction(self):
+        for n in range(20):
+            assert await oplog.append('table1', 'add component', {'n': n}) == n + 1
+        assert await oplog.current('table1') == 20
+        assert [op['data']['n'] for op in await oplog.since('table1', 17)] == [17, 18, 19]
+        assert await oplog.since('table1', 1) is None
+        assert await oplog.since('table2', 0) == []
+
+    async def test_barrier_cannot_be_crossed(self):
+        await oplog.append('table1', 'add component', {})
+        await oplog.append_barrier('table1', 'refresh table')
+        await oplog.append('table1', 'add component', {})
+        assert await oplog.since('table1', 0) is None
+        assert [op['seq'] for op in await oplog.since('table1', 2)] == [3]
+
+
+class TestSqlite:
+    async def test_writes_are_committed_in_batches_and_survive_reopen(self, tmp_path):
+        path = str(tmp_path / 'asobann.sqlite3')
+        backend = SqliteBackend(path, commit_interval=60)
+        await backend.tables.create('table1', {'components': {'c1': {'value': 1}}, 'kits': []})
+        await backend.kits.create({'kit': {'name': 'cards'}})
+        # コミットはまだだが、同じ接続からは見える
+        assert backend.database.commits == 0
+        assert (await backend.tables.load('table1'))['table']['components'] == {'c1': {'value': 1}}
+        await backend.close()
+
+        reopened = SqliteBackend(path)
+        assert (await reopened.tables.load('table1'))['table']['components'] == {'c1': {'value': 1}}
+        assert (await reopened.kits.get('cards'))['version'] == 1
+        await reopened.close()
+
+    async def test_failed_write_leaves_other_writes(self, tmp_path):
+        backend = SqliteBackend(str(tmp_path / 'asobann.sqlite3'), commit_interval=60)
+        await backend.tables.create('table1', {'components': {}, 'kits': []})
+        with pytest.raises(tables.TableAlreadyExists):
+            await backend.tables.create('table1', {'components': {'c1': {}}, 'kits': []})
+        assert (await backend.tables.load('table1'))['table']['components'] == {}
+        await backend.close()
+
+    async def test_concurrent_first_reads_open_one_connection(self, tmp_path, monkeypatch):
+        opened = []
+        original_open = _Database._open
+
+        def counting_open(database):
+            opened.append(database)
+            return original_open(database)
+
+        monkeypatch.setattr(_Database, '_open', counting_open)
+        backend = SqliteBackend(str(tmp_path / 'asobann.sqlite3'), commit_interval=60)
+        await asyncio.gather(*[backend.tables.load(f'table{n}') for n in range(5)])
+        assert len(opened) == 1
+        await backend.close()
+
+    def test_writes_are_committed_after_their_loop_stops(self, tmp_path):
+        path = str(tmp_path / 'asobann.sqlite3')
+        # close() しないままループが止まる（テストごとに create_app() し直すときなど）
+        first = SqliteBackend(path, commit_interval=0.01)
+        asyncio.run(first.tables.create('table1', {'components': {}, 'kits': []}))
+
+        async def use_second():
+            second = SqliteBackend(path)
+            await second.tables.purge_all()
+            await second.tables.create('table2', {'components': {}, 'kits': []})
+            await second.close()
+
+        asyncio.run(use_second())
+
+    def test_backend_dropped_without_close_commits(self, tmp_path):
+        path = str(tmp_path / 'asobann.sqlite3')
+        first = SqliteBackend(path, commit_interval=60)
+        asyncio.run(first.tables.create('table1', {'components': {}, 'kits': []}))
+        assert first.database.commits == 0
+        del first
+        gc.collect()
+
+        async def read_with_second():
+            second = SqliteBackend(path)
+            try:
+                return await second.tables.load('table1')
+            finally:
+                await second.close()
+
+        assert asyncio.run(read_with_second())['tablename'] == 'table1'
+
+
+def test_incomplete_backend_cannot_be_made():
+    from asobann.store.backends.base import TemplateBackend
+
+    class GetOnlyTemplates(TemplateBackend):
+        async def get_many(self, template_ids):
+            return {}
+
+    with pytest.raises(TypeError):
+        GetOnlyTemplates()
@@ -0,0 +1,54 @@
+from asobann.app.trace_analysis import latency_distribution, percentile
+
+
+def document(trace_id, originator, *points):
+    return {'traces': {
+        'traces': [{'traceId': trace_id, 'name': None,
+                    'points': [{'label': label, 'timestamp': ts} for label, ts in points]}],
+        'originator': originator,
+    }}
+
+
+def drag(trace_id, at, handled, received):
+    return [
+        document(trace_id, 'alice', ('emitted', at)),
+        document(trace_id, 'server', ('handle update many components', at + handled)),
+        document(trace_id, 'bob', ('finished sync update many components', at + received)),
+        document(trace_id, 'carol', ('finished sync update many components', at + received + 10)),
+    ]
+
+
+PATH = ['emitted', 'handle update many components', 'finished sync update many components']
+
+
+class TestLatencyDistribution:
+    def test_points_of_a_trace_are_joined_across_loci(self):
+        [emitted, handled] = latency_distribution(drag('t1', 1000, 5, 30), bucket_ms=60000, path=PATH)
+        assert (emitted['from'], emitted['to']) == ('emitted', 'handle update many components')
+        assert emitted['buckets'] == [{'start': 0, 'count': 1, 'p50': 5, 'p95': 5, 'p99': 5, 'max': 5}]
+        # 受け取ったクライアントごとに1つ
+        assert handled['buckets'][0]['count'] == 2
+        assert handled['buckets'][0]['max'] == 35
+
+    def test_latencies_are_split_into_buckets_by_start_time(self):
+        documents = []
+        for n in range(100):
+            documents.extend(drag(f't{n}', 1000 + n * 100, n + 1, 50))
+        [emitted, _] = latency_distribution(documents, bucket_ms=5000, path=PATH)
+        assert [bucket['start'] for bucket in emitted['buckets']] == [0, 5000, 10000]
+        assert [bucket['count'] for bucket in emitted['buckets']] == [40, 50, 10]
+        assert emitted['buckets'][1] == {
+            'start': 5000, 'count': 50, 'p50': 65, 'p95': 88, 'p99': 90, 'max': 90}
+
+    def test_adjacent_points_are_paired_without_a_path(self):
+        pairs = latency_distribution(drag('t1', 1000, 5, 30), bucket_ms=60000)
+        assert [(pair['from'], pair['to']) for pair in pairs] == [
+            ('emitted', 'handle update many components'),
+            ('handle update many components', 'finished sync update many components'),
+            ('finished sync update many components', 'finished sync update many components'),
+        ]
+
+
+def test_percentile_is_nearest_rank():
+    values = list(range(1, 101))
+    assert (percentile(values, 50), percentile(values, 99), percentile([7], 95)) == (50, 99, 7)
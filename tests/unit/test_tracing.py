@@ -0,0 +1,154 @@
+import asyncio
+import datetime
+import types
+
+import pytest
+from pymongo import monitoring
+
+from asobann import tracing
+from asobann.app.instrumentation import InstrumentedServer
+
+
+@pytest.fixture
+def exported():
+    fragments = []
+
+    tracing.enable(fragments.append)
+    yield fragments
+    tracing.disable()
+
+
+def make_store_module():
+    module = types.ModuleType('asobann.store.fake')
+
+    async def read(tablename):
+        await asyncio.sleep(0)
+        return {'tablename': tablename}
+
+    async def update(tablename):
+        await module.read(tablename)
+        return True
+
+    for func in (read, update):
+        func.__module__ = module.__name__
+        func.__qualname__ = func.__name__
+        setattr(module, func.__name__, func)
+    tracing.instrument_module(module)
+    return module
+
+
+def tree(fragment):
+    """{span名: 親のspan名} にする。"""
+    names = {span['spanId']: span['name'] for span in fragment['spans']}
+    return {span['name']: names.get(span['parentId']) for span in fragment['spans']}
+
+
+class TestTracing:
+    async def test_instrumented_coroutines_become_nested_spans(self, exported):
+        store = make_store_module()
+        with tracing.trace('handle update'):
+            assert await store.update('table1')
+        [fragment] = exported
+        assert fragment['name'] == 'handle update'
+        assert tree(fragment) == {
+            'handle update': None,
+            'fake.update': 'handle update',
+            'fake.read': 'fake.update',
+        }
+        assert all(span['start'] <= span['end'] for span in fragment['spans'])
+        assert [point['label'] for point in fragment['points']][:2] == ['handle update', 'fake.update']
+
+    async def test_nothing_is_recorded_outside_a_trace_or_when_disabled(self, exported):
+        store = make_store_module()
+        assert await store.update('table1')
+        tracing.disable()
+        with tracing.trace('handle update') as root:
+            assert root is None
+            assert await store.update('table1')
+        assert exported == []
+
+    async def test_sampling_is_decided_at_the_root(self, exported):
+        store = make_store_module()
+        tracing.enable(exported.append, sample_rate=0.0)
+        with tracing.trace('handle update') as root:
+            assert root is None
+            assert await store.update('table1')
+        # クライアントのトレースの続きも同じように間引く
+        with tracing.trace('handle update', trace_id='abc') as root:
+            assert root is None
+        assert exported == []
+
+    async def test_client_traces_are_followed_only_when_asked(self, exported):
+        tracing.enable(exported.append, sample_rate=0.0, follow_client_traces=True)
+        with tracing.trace('handle update', trace_id='abc'):
+            pass
+        with tracing.trace('handle update') as root:
+            assert root is None
+        assert [fragment['traceId'] for fragment in exported] == ['abc']
+
+    async def test_package_is_instrumented_down_to_subpackages(self, exported, tmp_path, monkeypatch):
+        backends = tmp_path / 'fakestore' / 'backends'
+        backends.mkdir(parents=True)
+        (tmp_path / 'fakestore' / '__init__.py').write_text('')
+        (backends / '__init__.py').write_text('')
+        (backends / 'memory.py').write_text(
+            'class Tables:\n'
+            '    async def load(self, tablename):\n'
+            '        return tablename\n')
+        monkeypatch.syspath_prepend(str(tmp_path))
+        import fakestore
+        tracing.instrument_package(fakestore)
+        from fakestore.backends.memory import Tables
+        with tracing.trace('handle update'):
+            await Tables().load('table1')
+        [fragment] = exported
+        assert tree(fragment) == {'handle update': None, 'memory.Tables.load': 'handle update'}
+
+    async def test_spans_after_the_trace_ended_are_not_recorded(self, exported):
+        store = make_store_module()
+        with tracing.trace('handle update'):
+            task = asyncio.get_running_loop().create_task(store.update('table1'))
+        await task
+        [fragment] = exported
+        assert tree(fragment) == {'handle update': None}
+
+    async def test_mongo_commands_become_spans_of_the_caller(self, exported):
+        listener = tracing.MongoCommandListener()
+        address = ('localhost', 27017)
+        with tracing.trace('handle update'):
+            listener.started(monitoring.CommandStartedEvent(
+                {'update': 'tables', 'updates': []}, 'asobann', 1, address, 1))
+            listener.succeeded(monitoring.CommandSucceededEvent(datetime.timedelta(milliseconds=1), {'ok': 1}, 'update', 1, address, 1))
+        [fragment] = exported
+        assert tree(fragment) == {'handle update': None, 'mongo update tables': 'handle update'}
+
+
+class RecordingEngineIO:
+    def generate_id(self):
+        return 'sid0'
+
+    async def send_packet(self, eio_sid, eio_pkt):
+        pass
+
+
+class TestInstrumentedServerTracing:
+    async def test_handler_is_traced_with_the_client_trace_id(self, exported):
+        server = InstrumentedServer(async_mode='asgi')
+        server.eio = RecordingEngineIO()
+        store = make_store_module()
+
+        @server.on('update')
+        async def handle_update(sid, data):
+            await store.read(data['tablename'])
+            await server.emit('updated', data)
+
+        await server._trigger_event('update', '/', 'sid0', {'tablename': 'table1', 'inspectionTraceId': 'abc'})
+        [fragment] = exported
+        assert fragment['traceId'] == 'abc'
+        # 名前はクライアントが付けたものを使う
+        assert fragment['name'] is None
+        assert tree(fragment) == {
+            'handle update': None,
+            'fake.read': 'handle update',
+            'emit updated': 'handle update',
+        }
@@ -0,0 +1,105 @@
+import asyncio
+import itertools
+
+import msgpack
+import pytest
+from socketio import packet
+
+from asobann.app.wire import DualPacket, MsgPackNegotiatingServer
+from test_outbound import QueueingEngineIO, Socket, movement
+
+
+class MsgPackSocket(Socket):
+    def events(self):
+        events = []
+        while not self.queue.empty():
+            decoded = msgpack.loads(self.queue.get_nowait().data)
+            if decoded['type'] == packet.EVENT:
+                events.append(tuple(decoded['data']))
+        return events
+
+
+class TwoClientEngineIO(QueueingEngineIO):
+    def __init__(self):
+        super().__init__()
+        self.ids = itertools.count()
+
+    def generate_id(self):
+        return f'sid{next(self.ids)}'
+
+
+class TestDualPacket:
+    def test_json_round_trip(self):
+        encoded = DualPacket(packet.EVENT, data=['update table', {'a': 1}]).encode()
+        assert encoded == '2["update table",{"a":1}]'
+        decoded = DualPacket(encoded_packet=encoded)
+        assert (decoded.packet_type, decoded.data) == (packet.EVENT, ['update table', {'a': 1}])
+
+    def test_msgpack_round_trip(self):
+        encoded = DualPacket(packet.EVENT, data=['update table', {'a': 1}], id=3).encode_msgpack()
+        # socket.io-msgpack-parser と同じ形
+        assert msgpack.loads(encoded) == {'type': packet.EVENT, 'data': ['update table', {'a': 1}], 'nsp': '/', 'id': 3}
+        decoded = DualPacket(encoded_packet=encoded)
+        assert (decoded.packet_type, decoded.data, decoded.id, decoded.namespace) == (
+            packet.EVENT, ['update table', {'a': 1}], 3, '/')
+
+    def test_msgpack_is_encoded_once(self):
+        source = DualPacket(packet.EVENT, data=['ev'])
+        assert source.encode().source is source
+        assert source.encode_msgpack() is source.encode_msgpack()
+
+
+@pytest.fixture
+async def server():
+    server = MsgPackNegotiatingServer(async_mode='asgi', outbound_high_water=3, drain_interval=0.01)
+    server.eio = TwoClientEngineIO()
+    server.eio.sockets['json'] = Socket()
+    server.eio.sockets['mp'] = MsgPackSocket()
+    await server._handle_eio_connect('json', {'QUERY_STRING': 'EIO=4&transport=websocket'})
+    await server._handle_eio_connect('mp', {'QUERY_STRING': 'EIO=4&serializer=msgpack&transport=websocket'})
+    for eio_sid in ('json', 'mp'):
+        sid = await server.manager.connect(eio_sid, '/')
+        await server.enter_room(sid, 'table1')
+    return server
+
+
+def socket(server, eio_sid):
+    return server.eio.sockets[eio_sid]
+
+
+class TestMsgPackNegotiatingServer:
+    async def test_room_emit_uses_the_format_each_client_asked_for(self, server):
+        await server.emit('update table', {'a': 1}, room='table1')
+        assert socket(server, 'json').queue.get_nowait().data == '2["update table",{"a":1}]'
+        sent = socket(server, 'mp').queue.get_nowait()
+        assert msgpack.loads(sent.data) == {'type': packet.EVENT, 'data': ['update table', {'a': 1}], 'nsp': '/'}
+
+    async def test_direct_packets_use_msgpack_too(self, server):
+        await server._send_packet('mp', DualPacket(packet.CONNECT, data={'sid': 'x'}))
+        await server._send_packet('json', DualPacket(packet.CONNECT, data={'sid': 'x'}))
+        assert msgpack.loads(socket(server, 'mp').queue.get_nowait().data)['type'] == packet.CONNECT
+        assert socket(server, 'json').queue.get_nowait().data == '0{"sid":"x"}'
+
+    async def test_disconnected_client_is_forgotten(self, server):
+        await server._handle_eio_disconnect('mp', 'client disconnect')
+        assert 'mp' not in server._msgpack_eio_sids
+
+    async def test_encoded_event_is_sent_in_the_format_each_client_asked_for(self, server):
+        encoded = server.encode_event('load table', {'a': 1})
+        for eio_sid in ('json', 'mp'):
+            await server.emit_encoded('load table', encoded, to=server.manager.sid_from_eio_sid(eio_sid, '/'))
+        assert socket(server, 'json').events() == [('load table', {'a': 1})]
+        sent = socket(server, 'mp').queue.get_nowait()
+        assert msgpack.loads(sent.data)['data'] == ['load table', {'a': 1}]
+        # 何人に送っても、msgpackへのエンコードは1回
+        assert sent.data is encoded.source.encode_msgpack()
+
+    async def test_volatile_events_collapse_in_msgpack_too(self, server):
+        for n in range(3):
+            await server.emit('add component', {'tablename': 'table1', 'n': n}, room='table1')
+        for x in range(10):
+            await server.emit('mouse movement', movement(x), room='table1')
+        assert len(socket(server, 'mp').events()) == 3
+        await asyncio.sleep(0.03)
+        assert socket(server, 'mp').events() == [('mouse movements', {'tablename': 'table1', 'movements': [
+            {'playerName': 'alice', 'mouseMovement': movement(9)['mouseMovement']}]})]
@@ -0,0 +1,66 @@
+import asyncio
+
+from asobann.store.write_coalescer import WriteCoalescer
+
+
+class RecordingWriter:
+    def __init__(self, fail_with=None, delay=0):
+        self.writes = []
+        self.fail_with = fail_with
+        self.delay = delay
+
+    async def __call__(self, tablename, pending):
+        await asyncio.sleep(self.delay)
+        if self.fail_with:
+            raise self.fail_with
+        self.writes.append((tablename, pending.to_update()))
+
+
+class TestWriteCoalescer:
+    async def test_diffs_in_one_window_become_one_write(self):
+        writer = RecordingWriter()
+        sut = WriteCoalescer(write=writer, window=0.01)
+        await asyncio.gather(
+            sut.submit('table1', set_fields={'table.components.c1.top': '10px'}),
+            sut.submit('table1', set_fields={'table.components.c1.top': '20px'}),
+            sut.submit('table1', unset_paths=['table.components.c2']),
+        )
+        assert writer.writes == [('table1', {
+            '$set': {'table.components.c1.top': '20px'},
+            '$unset': {'table.components.c2': ''},
+        })]
+
+    async def test_tables_are_written_separately(self):
+        writer = RecordingWriter()
+        sut = WriteCoalescer(write=writer, window=0.01)
+        await asyncio.gather(
+            sut.submit('table1', set_fields={'table.components.c1.top': '10px'}),
+            sut.submit('table2', set_fields={'table.components.c1.top': '20px'}),
+        )
+        assert sorted(t for t, _ in writer.writes) == ['table1', 'table2']
+
+    async def test_later_window_is_written_after_earlier_one(self):
+        writer = RecordingWriter(delay=0.05)
+        sut = WriteCoalescer(write=writer, window=0.01)
+        first = asyncio.create_task(sut.submit('table1', set_fields={'table.components.c1.top': '10px'}))
+        await asyncio.sleep(0.02)  # 1つ目の窓は閉じて書き込み中
+        await sut.submit('table1', set_fields={'table.components.c1.top': '20px'})
+        await first
+        assert [w[1]['$set']['table.components.c1.top'] for w in writer.writes] == ['10px', '20px']
+
+    async def test_failure_reaches_every_submitter_in_the_window(self):
+        sut = WriteCoalescer(write=RecordingWriter(fail_with=KeyError('no table')), window=0.01)
+        results = await asyncio.gather(
+            sut.submit('table1', set_fields={'table.components.c1.top': '10px'}),
+            sut.submit('table1', set_fields={'table.components.c2.top': '10px'}),
+            return_exceptions=True)
+        assert all(isinstance(r, KeyError) for r in results)
+
+    async def test_close_writes_without_waiting_for_the_window(self):
+        writer = RecordingWriter()
+        sut = WriteCoalescer(write=writer, window=3600)
+        submitted = asyncio.create_task(sut.submit('table1', set_fields={'table.components.c1.top': '10px'}))
+        await asyncio.sleep(0)
+        await asyncio.wait_for(sut.close(), timeout=1)
+        await submitted
+        assert len(writer.writes) == 1